@@ -16,7 +16,10 @@ def main(
     max_gen_len: Optional[int] = 1024,
     load_model: bool = True,
     compiled_model: bool = False,
-    triton_weight: bool = True
+    triton_weight: bool = True,
+    block_size: int = 16,
+    window_size: Optional[int] = None,
+    sink_size: Optional[int] = None,
 ):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     if max_seq_len <= 1024:
@@ -35,6 +38,11 @@ def main(
         compiled_model = compiled_model,
         triton_weight = triton_weight,
         device=device,
+        block_size = block_size,
+        # 设置 window_size 时 kv cache 只保留 sink_size 个 (默认一个 block) 开头的 token 和最近的 window_size 个 token,
+        # 长时间对话的显存占用和每个 token 的延迟保持不变
+        sink_size = sink_size,
+        window_size = window_size,
     )
     
     while True:
@@ -57,12 +65,10 @@ def main(
             max_gen_len=max_gen_len,
         )
 
-        completion = '' # 初始化生成结果
-        # NOTE: 创建了一个 generator 后，可以通过 for 循环来迭代它
-        for batch_completions in stream:
-            new_text = batch_completions[0]['generation'][len(completion):]
-            completion = batch_completions[0]['generation']
-            print(new_text, end='', flush=True)
+        # NOTE: 创建了一个 generator 后，可以通过 for 循环来迭代它, 每步只返回新增的文本
+        for batch_deltas in stream:
+            for delta in batch_deltas:
+                print(delta['text'], end='', flush=True)
         print("\n\n==================================\n")
 
 if __name__ == "__main__":
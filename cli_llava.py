@@ -32,7 +32,7 @@ def main(
         max_gpu_num_blocks: 用户自行设置的最大可用 blocks(tokens), 如果设置该值， kv cache 内存管理器的最大可用内存-tokens 由该值决定。
         max_gen_len (Optional[int], optional): 生成文本的最大长度。默认值为 512。
         load_model (bool, optional): 是否加载模型。默认值为True。
-        compiled_model (bool, optional): 是否使用编译模型。默认值为True。
+        compiled_model (bool, optional): 是否使用 cuda graph, 调度器的分页打包 forward 不支持, 为 True 时回退到 eager 执行。默认值为False。
         triton_weight (bool, optional): 是否使用Triton权重。默认值为True。
     """
     console = Console()
@@ -104,13 +104,11 @@ def main(
             console.print(f"[red]文本生成失败: {e}[/red]")
             continue
         
-        completion = ''  # 初始化生成结果
         console.print("ASSISTANT: ", end='')
         
-        for batch_completions in stream:
-            next_text = batch_completions[0]['generation'][len(completion):]
-            completion = batch_completions[0]['generation']
-            print(f"\033[91m{next_text}\033[0m", end='', flush=True)  # 红色文本
+        for batch_deltas in stream:
+            for delta in batch_deltas:
+                print(f"\033[91m{delta['text']}\033[0m", end='', flush=True)  # 红色文本
         
         console.print("\n[bold green]==================================[/bold green]\n")
     
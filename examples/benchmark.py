@@ -25,7 +25,7 @@ def load_lite_llama_generator(
         max_seq_len=max_seq_len,
         max_gpu_num_blocks = max_gpu_num_blocks,
         load_model=True,
-        compiled_model=True,
+        compiled_model=False,
         triton_weight=True,
         device=device,
     )
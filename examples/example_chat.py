@@ -36,7 +36,7 @@ def cli_generate_stream(
         max_gpu_num_blocks = max_gpu_num_blocks, 
         max_seq_len=max_seq_len,
         load_model=True,
-        compiled_model=True,
+        compiled_model=False,
         triton_weight=True,
         device=device,
     )
@@ -65,12 +65,10 @@ def cli_generate_stream(
             max_gen_len=max_gen_len,
         )
 
-        # 初始化生成结果
-        completion = ''
-        for batch_completions in stream:
-            new_text = batch_completions[0]['generation'][len(completion):]
-            completion = batch_completions[0]['generation']
-            print(new_text, end='', flush=True)
+        # 每步只返回新增的文本
+        for batch_deltas in stream:
+            for delta in batch_deltas:
+                print(delta['text'], end='', flush=True)
         print("\n\n==================================\n")
 
 def cli_generate(
@@ -101,7 +99,7 @@ def cli_generate(
 		tokenizer_path = checkpoints_dir,
 		max_seq_len = max_seq_len,
 		load_model = True,
-		compiled_model = True,
+		compiled_model = False,
 		triton_weight = True,
 		device = device,
 	)
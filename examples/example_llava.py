@@ -14,7 +14,7 @@ def main(
     max_gpu_num_blocks = None,
     max_gen_len: Optional[int] = 64,
     load_model: bool = True,
-    compiled_model: bool = True,
+    compiled_model: bool = False,
     triton_weight: bool = True
 ):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -42,12 +42,10 @@ def main(
         max_gen_len=max_gen_len,
     )
 
-    completion = '' # 初始化生成结果
-    # NOTE: 创建了一个 generator 后，可以通过 for 循环来迭代它
-    for batch_completions in stream:
-        new_text = batch_completions[0]['generation'][len(completion):]
-        completion = batch_completions[0]['generation']
-        print(new_text, end=' ', flush=True)
+    # NOTE: 创建了一个 generator 后，可以通过 for 循环来迭代它, 每步只返回新增的文本
+    for batch_deltas in stream:
+        for delta in batch_deltas:
+            print(delta['text'], end='', flush=True)
     print("\n\n==================================\n")
 
 if __name__ == "__main__":
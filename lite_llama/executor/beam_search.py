@@ -0,0 +1,216 @@
+import torch, logging
+from dataclasses import dataclass, field
+from typing import List, Sequence, Tuple
+
+from .scheduler import Request, RequestStatus
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class BeamHypothesis:
+    """beam search 得到的一个候选序列"""
+    tokens: List[int] # 生成的 token (不含 prompt), 以 eos 结束时包含 eos
+    sum_logprobs: float
+    score: float # sum_logprobs / len(tokens) ** length_penalty
+
+@dataclass
+class _BeamGroup:
+    """一个 prompt 的 beam 状态"""
+    max_gen_len: int
+    beams: List[Tuple[Request, float]] = field(default_factory=list) # (beam, 累计对数概率)
+    hypotheses: List[BeamHypothesis] = field(default_factory=list) # 已结束的候选, 按 score 降序, 最多 beam_width 个
+    done: bool = False
+
+class BeamSearchDecoder:
+    """
+    基于 ContinuousBatchScheduler 的 kv cache 管理实现的 beam search。
+
+    每个 beam 是一个占用 block_tables 一行的 Request, 所有 prompt 的全部 beam 打包在一次前向中 decode。
+    每步从各 prompt 的 beam_width * vocab_size 个候选中保留累计对数概率最大的 beam_width 个, beam 重排只是
+    索引重映射: 只有一个后继的 beam 原地追加 token; 有多个后继时, 其余后继通过引用计数共享父 beam 的完整
+    block, 只写 block_tables, 不复制 kv。末尾未写满的 block 之后会被各后继写入不同的 token, 只有它需要复制
+    (block_size = 1 时从不复制); 没有后继的 beam 立即释放其 kv cache。
+
+    结束条件与 HuggingFace 的 BeamSearchScorer 相同: 候选的得分为 sum_logprobs / 生成长度 ** length_penalty;
+    每个 prompt 收集到 beam_width 个以 eos 结束的候选后, early_stopping=True 时立即结束, 否则在仍在搜索的
+    beam 不可能超过最差候选时结束; 达到最大生成长度时剩余的 beam 也作为候选。
+    """
+    def __init__(
+        self, scheduler, beam_width: int = 4, length_penalty: float = 1.0, early_stopping: bool = False,
+        stop_token_ids: Sequence[int] = (),
+    ):
+        if not 1 <= beam_width <= scheduler.max_batch_size:
+            raise ValueError(f"beam_width must be in [1, max_batch_size={scheduler.max_batch_size}], got {beam_width}")
+        self.scheduler = scheduler
+        self.beam_width = beam_width
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.stop_token_ids = set(stop_token_ids) | {scheduler.eos_token_id} # 与 eos 一样结束候选序列的 token
+
+    def _score(self, sum_logprobs: float, length: int) -> float:
+        return sum_logprobs / length ** self.length_penalty
+
+    def _add_hypothesis(self, group: _BeamGroup, tokens: List[int], sum_logprobs: float):
+        score = self._score(sum_logprobs, len(tokens))
+        if len(group.hypotheses) == self.beam_width and score <= group.hypotheses[-1].score:
+            return
+        group.hypotheses.append(BeamHypothesis(tokens, sum_logprobs, score))
+        group.hypotheses.sort(key=lambda hyp: hyp.score, reverse=True)
+        del group.hypotheses[self.beam_width:]
+
+    def _is_done(self, group: _BeamGroup, best_sum_logprobs: float, cur_len: int) -> bool:
+        if len(group.hypotheses) < self.beam_width:
+            return False
+        if self.early_stopping:
+            return True
+        return group.hypotheses[-1].score >= self._score(best_sum_logprobs, cur_len)
+
+    def _new_beam(self, prompt_tokens: List[int], output_tokens: List[int], max_gen_len: int) -> Request:
+        scheduler = self.scheduler
+        beam = Request(scheduler._next_request_id, prompt_tokens, max_gen_len, temperature=0.0)
+        scheduler._next_request_id += 1
+        beam.output_tokens = list(output_tokens)
+        beam.status = RequestStatus.RUNNING
+        beam.table_row = scheduler.free_table_rows.pop()
+        return beam
+
+    def _grow_kv(self, beam: Request, need_size: int):
+        if not self.scheduler._grow_kv(beam, need_size):
+            raise RuntimeError("no enough kv cache for beam search")
+
+    def _advance(self, groups: List[_BeamGroup], logprobs: torch.Tensor):
+        """
+        每个 prompt 从 [num_beams, vocab_size] 的候选中选出下一步的 beam, 并完成 beam 的重映射。
+
+        参数:
+            logprobs (torch.Tensor): [sum(num_beams), vocab_size], 依次为各 prompt 各 beam 最新 token 处的对数概率。
+        """
+        width, vocab_size = self.beam_width, logprobs.shape[-1]
+
+        # 所有 prompt 补齐到 beam_width 个 beam 后一次 topk, 整步只与设备同步一次
+        scores = logprobs.new_full((len(groups), width, vocab_size), -float("inf"))
+        offset = 0
+        for i, group in enumerate(groups):
+            num_beams = len(group.beams)
+            sum_logprobs = torch.tensor([s for _, s in group.beams], dtype=logprobs.dtype).to(logprobs.device)
+            scores[i, :num_beams] = logprobs[offset: offset + num_beams] + sum_logprobs[:, None]
+            offset += num_beams
+        top_scores, top_index = torch.topk(scores.view(len(groups), -1), min(2 * width, width * vocab_size), dim=-1)
+        top_scores, top_index = top_scores.tolist(), top_index.tolist()
+
+        for group, group_scores, group_index in zip(groups, top_scores, top_index):
+            cur_len = len(group.beams[0][0].output_tokens) + 1 # 本步之后的生成长度
+            # 只有 eos 时前 2 * beam_width 个候选中至多 beam_width 个结束, 其余候选足够组成下一步的 beam
+            successors = [] # (父 beam, token, 累计对数概率)
+            for rank, (score, index) in enumerate(zip(group_scores, group_index)):
+                if score == -float("inf"):
+                    break # 只剩补齐的 beam
+                parent, token = group.beams[index // vocab_size][0], index % vocab_size
+                if token in self.stop_token_ids:
+                    if rank < width:
+                        self._add_hypothesis(group, parent.output_tokens + [token], score)
+                    continue
+                successors.append((parent, token, score))
+                if len(successors) == width:
+                    break
+
+            if cur_len >= group.max_gen_len:
+                for parent, token, score in successors:
+                    self._add_hypothesis(group, parent.output_tokens + [token], score)
+                group.done = True
+            elif not successors or self._is_done(group, successors[0][2], cur_len):
+                group.done = True
+            if group.done:
+                for beam, _ in group.beams:
+                    self.scheduler._free_request(beam)
+                group.beams = []
+                continue
+            self._remap(group, successors)
+
+    def _remap(self, group: _BeamGroup, successors):
+        """按后继重新组织 beam: 先释放没有后继的 beam, 再为同一父 beam 的其余后继共享其 kv cache"""
+        scheduler = self.scheduler
+        parents = {id(parent) for parent, _, _ in successors}
+        for beam, _ in group.beams:
+            if id(beam) not in parents:
+                scheduler._free_request(beam)
+
+        reused, beams = set(), []
+        for parent, token, score in successors:
+            if id(parent) in reused:
+                beam = self._new_beam(parent.prompt_tokens, parent.output_tokens, parent.max_gen_len)
+                if not scheduler._share_kv(parent, beam):
+                    raise RuntimeError("no enough kv cache for beam search")
+            else:
+                reused.add(id(parent))
+                beam = parent
+            beams.append((beam, token, score))
+
+        # 所有后继都共享完父 beam 的 kv cache 后再追加 token
+        group.beams = []
+        for beam, token, score in beams:
+            beam.output_tokens.append(token)
+            group.beams.append((beam, score))
+
+    @torch.inference_mode()
+    def search(self, prompt_tokens: List[List[int]], max_gen_len: int) -> List[List[BeamHypothesis]]:
+        """
+        对每个 prompt 做 beam search。调度器在此期间不能有其他请求, block_tables 的行数不够容纳全部 prompt
+        的 beam 时分批搜索。
+
+        参数:
+            prompt_tokens (List[List[int]]): 已分词的 prompt。
+            max_gen_len (int): 最大生成长度, 同时受调度器的 max_seq_len 限制。
+        返回:
+            List[List[BeamHypothesis]]: 每个 prompt 按 score 降序排列的 beam_width 个候选。
+        """
+        if self.scheduler.has_unfinished_requests():
+            raise RuntimeError("beam search needs a scheduler without other requests")
+        for tokens in prompt_tokens:
+            if not 0 < len(tokens) < self.scheduler.max_seq_len:
+                raise ValueError(f"prompt length must be in [1, {self.scheduler.max_seq_len}), got {len(tokens)}")
+
+        num_groups = self.scheduler.max_batch_size // self.beam_width
+        results = []
+        for start in range(0, len(prompt_tokens), num_groups):
+            results.extend(self._search_batch(prompt_tokens[start: start + num_groups], max_gen_len))
+        return results
+
+    def _search_batch(self, prompt_tokens: List[List[int]], max_gen_len: int) -> List[List[BeamHypothesis]]:
+        scheduler = self.scheduler
+        groups, chunks = [], []
+        try:
+            # 1. 每个 prompt 只 prefill 一次, 命中 prefix cache 的前缀直接复用
+            for tokens in prompt_tokens:
+                gen_len = min(max_gen_len, scheduler.max_seq_len - len(tokens))
+                beam = self._new_beam(list(tokens), [], gen_len)
+                groups.append(_BeamGroup(gen_len, [(beam, 0.0)]))
+                scheduler._match_prefix(beam)
+                self._grow_kv(beam, beam.seq_len + 1)
+                chunks.append((beam, beam.num_computed_tokens, beam.prompt_tokens[beam.num_computed_tokens:], 1))
+            logits = scheduler._forward([], chunks)
+
+            # 2. 所有 prompt 的全部 beam 打包 decode, 直到每个 prompt 都结束
+            live = groups
+            while True:
+                for group in live:
+                    for beam, _ in group.beams:
+                        beam.num_computed_tokens = beam.seq_len
+                self._advance(live, torch.log_softmax(logits.float(), dim=-1))
+                live = [group for group in live if not group.done]
+                if not live:
+                    break
+                decode_items = []
+                for group in live:
+                    for beam, _ in group.beams:
+                        self._grow_kv(beam, beam.seq_len)
+                        decode_items.append((beam, beam.output_tokens[-1], beam.seq_len - 1))
+                logits = scheduler._forward(decode_items, [])
+        except Exception:
+            # 出错时归还所有 beam 占用的 kv cache 和 block_tables 行
+            for group in groups:
+                for beam, _ in group.beams:
+                    scheduler._free_request(beam)
+            raise
+
+        return [group.hypotheses for group in groups]
@@ -68,6 +68,10 @@ class CUDAGraphRunner:
         return self.forward(*args, **kwargs)
     
 class ModelRunner:
+    """
+    按 batch size 捕获 decode 的 CUDA 图。只适用于 block_size=1 的连续 kv cache 和非打包的 decode forward,
+    与调度器的分页打包 forward 不兼容, ModelExecutor 在 compiled_model=True 时给出警告并回退到 eager 执行。
+    """
     def __init__(self, model, model_config, 
                 max_gpu_num_blocks:int,
                 kv_mem_manager: KVCacheMemoryManager,
@@ -93,6 +97,7 @@ class ModelRunner:
 
         atten_info = AttentionInfo
         atten_info.kv_buffer = self.kv_mem_manager.gpu_kv_buffer
+        atten_info.kv_scale = self.kv_mem_manager.gpu_kv_scale
 
         atten_info.select_index = torch.zeros((512), dtype=torch.long, device=device)
         decode_index, _, _ = self.kv_mem_manager.alloc_contiguous_kvcache(batch_size)
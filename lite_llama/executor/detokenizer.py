@@ -0,0 +1,76 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence
+
+@dataclass
+class DecodeState:
+    """
+    单个序列的增量解码状态, 位置相对于 context + 生成的 token。
+
+    context 是 prompt 末尾的几个 token: sentencepiece 等分词器单独解码一段 token 时会丢掉第一个 token 的前导空格,
+    从上下文开始解码才能得到正确的文本。[prefix_offset, read_offset) 是上一次已经输出的窗口。
+    """
+    context: List[int] = field(default_factory=list)
+    prefix_offset: int = 0
+    read_offset: int = 0
+
+    @classmethod
+    def from_prompt(cls, prompt_tokens: Sequence[int], num_context_tokens: int = 5) -> "DecodeState":
+        context = list(prompt_tokens[-num_context_tokens:])
+        return cls(context, 0, len(context))
+
+    def window(self, tokens: Sequence[int], start: int, end: int) -> List[int]:
+        """context + tokens 中 [start, end) 的 token, 只复制窗口内的部分"""
+        num_context = len(self.context)
+        if start >= num_context:
+            return list(tokens[start - num_context: end - num_context])
+        return self.context[start:] + list(tokens[:end - num_context])
+
+class IncrementalDetokenizer:
+    """
+    批量增量解码: 每步对所有序列只解码最近的一小段 token, 全部序列合并为一次 tokenizer.batch_decode 调用,
+    代价与已生成的长度无关。
+
+    每个序列解码 [prefix_offset, 末尾) 和 [prefix_offset, read_offset) 两段文本, 前者多出的部分即新文本。
+    字节回退 (byte-fallback) 或字节级 BPE 把一个多字节字符拆成多个 token 时, 字符不完整的部分会解码成替换字符
+    U+FFFD, 此时先不输出, 等后续 token 补全后再一起输出; 序列结束时不再等待。
+    """
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+
+    def decode(
+        self,
+        token_lists: Sequence[Sequence[int]],
+        states: Sequence[DecodeState],
+        finished: Optional[Sequence[bool]] = None,
+    ) -> List[str]:
+        """
+        参数:
+            token_lists: 各序列已生成的全部 token (不含 prompt)。
+            states: 各序列的解码状态, 输出新文本后原地更新。
+            finished (optional): 各序列是否已经结束, 结束的序列输出全部剩余文本。
+        返回:
+            List[str]: 各序列新增的文本, 没有可以输出的新文本时为空字符串。
+        """
+        if not token_lists:
+            return []
+        prefix_windows, full_windows, ends = [], [], []
+        for tokens, state in zip(token_lists, states):
+            end = len(state.context) + len(tokens)
+            prefix_windows.append(state.window(tokens, state.prefix_offset, state.read_offset))
+            full_windows.append(state.window(tokens, state.prefix_offset, end))
+            ends.append(end)
+        texts = self.tokenizer.batch_decode(prefix_windows + full_windows, skip_special_tokens=self.skip_special_tokens)
+
+        deltas = []
+        num_seqs = len(token_lists)
+        for i, state in enumerate(states):
+            prefix_text, new_text = texts[i], texts[num_seqs + i]
+            is_finished = finished is not None and finished[i]
+            if len(new_text) <= len(prefix_text) or (new_text.endswith("\ufffd") and not is_finished):
+                deltas.append("")
+                continue
+            state.prefix_offset = state.read_offset
+            state.read_offset = ends[i]
+            deltas.append(new_text[len(prefix_text):])
+        return deltas
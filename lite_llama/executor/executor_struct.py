@@ -13,6 +13,26 @@ class ModelRunnerConfig:
 class AttentionInfo:
     select_index = torch.tensor([])
     kv_buffer = List[torch.tensor([])]
+    # 量化 kv cache (int8 / fp8) 各层的缩放因子, 形状为 [max_num_tokens, 2 * num_kv_heads], 为 None 表示未量化
+    kv_scale = None
     decode_index = torch.tensor([])
     start_index = torch.tensor([])
-    cur_select_index = torch.empty((0,),dtype=torch.long)
\ No newline at end of file
+    cur_select_index = torch.empty((0,),dtype=torch.long)
+    b_seq_len = torch.tensor([])
+    max_actual_seq_len = 0
+    # 分页 kv cache: batch 中第 i 个序列第 j 个 token 位于 block block_tables[b_req_idx[i], j // block_size]
+    # 的第 j % block_size 个位置, 即 kv buffer 的第 block * block_size + j % block_size 行
+    block_tables = None
+    b_req_idx = None
+    block_size = 1
+    # prefill 时各序列已缓存在 kv cache 中的前缀长度, 为 None 表示没有前缀, 只需对本次输入的 token 做 attention;
+    # 打包 batch 中只描述 prefill 分块
+    b_prefix_len = None
+    # 打包 (混合) batch: 输入形状为 [1, total_tokens], 前 num_decode_seqs 个 token 各属于一个 decode 序列,
+    # 其后是各序列的 prefill 分块首尾相接, 第 i 个分块为其后的第 [cu_seqlens[i], cu_seqlens[i+1]) 个 token;
+    # b_seq_len / b_req_idx 依同样顺序覆盖全部序列. cu_seqlens 为 None 表示普通的 prefill 或 decode batch
+    cu_seqlens = None
+    max_q_len = 0
+    num_decode_seqs = 0
+    # 打包 batch 中需要计算 logits 的 token 下标, 通常是每个序列的最后一个 token, 投机解码的验证分块需要其中每个 token
+    logits_index = None
@@ -0,0 +1,564 @@
+import json, re, torch, logging
+from collections import deque
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+def _byte_set(*bytes_or_ranges) -> int:
+    """把字节和 (lo, hi) 闭区间转为 256 位的整数位图"""
+    mask = 0
+    for item in bytes_or_ranges:
+        lo, hi = item if isinstance(item, tuple) else (item, item)
+        mask |= ((1 << (hi - lo + 1)) - 1) << lo
+    return mask
+
+_DIGIT = _byte_set((ord("0"), ord("9")))
+_WORD = _byte_set((ord("a"), ord("z")), (ord("A"), ord("Z")), (ord("0"), ord("9")), ord("_"))
+_SPACE = _byte_set(ord(" "), ord("\t"), ord("\n"), ord("\r"), 0x0B, 0x0C)
+_CLASS_ESCAPES = {"d": _DIGIT, "w": _WORD, "s": _SPACE}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+_ASCII = _byte_set((0, 0x7F))
+_CONTINUATION = ("set", _byte_set((0x80, 0xBF)))
+# 一个完整的多字节 UTF-8 字符: 取反的字符类和 . 按字符而不是按字节匹配
+_UTF8_MULTI_BYTE = ("alt", [
+    ("seq", [("set", _byte_set((0xC2, 0xDF))), _CONTINUATION]),
+    ("seq", [("set", _byte_set((0xE0, 0xEF))), _CONTINUATION, _CONTINUATION]),
+    ("seq", [("set", _byte_set((0xF0, 0xF4))), _CONTINUATION, _CONTINUATION, _CONTINUATION]),
+])
+
+def _any_char_except(mask: int):
+    """不属于 ASCII 字节集合 mask 的任意一个字符"""
+    return ("alt", [("set", _ASCII & ~mask), _UTF8_MULTI_BYTE])
+
+class _RegexParser:
+    """
+    把正则表达式解析为字节级的语法树, 支持字面量、转义、字符类、.、分组、|、*、+、?、{m,n}。
+    非 ASCII 字符按 UTF-8 编码展开为字节序列, 字符类中只支持 ASCII 字符; \\d \\w \\s 只匹配 ASCII 字符 (同 re.ASCII),
+    取反的字符类和 . 匹配一个完整的 UTF-8 字符。
+
+    语法树节点: ("set", 字节位图), ("seq", [节点]), ("alt", [节点]), ("repeat", 节点, 最少次数, 最多次数或 None)。
+    """
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        if self.pattern.startswith("^"):
+            self.pos = 1
+        node = self._alternation()
+        if self.pos != len(self.pattern):
+            raise ValueError(f"unexpected {self.pattern[self.pos]!r} at {self.pos} in regex {self.pattern!r}")
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            raise ValueError(f"unexpected end of regex {self.pattern!r}")
+        ch = self.pattern[self.pos]
+        self.pos += 1
+        return ch
+
+    def _alternation(self):
+        branches = [self._sequence()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._sequence())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _sequence(self):
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            if self._peek() == "$" and self.pos == len(self.pattern) - 1:
+                self.pos += 1
+                break
+            items.append(self._quantified(self._atom()))
+        return ("seq", items)
+
+    def _quantified(self, node):
+        while True:
+            ch = self._peek()
+            if ch == "*":
+                bounds = (0, None)
+            elif ch == "+":
+                bounds = (1, None)
+            elif ch == "?":
+                bounds = (0, 1)
+            elif ch == "{" and re.match(r"\{(\d+(,\d*)?|,\d+)\}", self.pattern[self.pos:]):
+                end = self.pattern.index("}", self.pos)
+                lo, _, hi = self.pattern[self.pos + 1: end].partition(",")
+                if "," not in self.pattern[self.pos: end]:
+                    hi = lo
+                bounds = (int(lo or 0), int(hi) if hi else None)
+                if bounds[1] is not None and bounds[1] < bounds[0]:
+                    raise ValueError(f"bad repeat bounds in regex {self.pattern!r}")
+                self.pos = end
+            else:
+                return node
+            self.pos += 1
+            if self._peek() == "?": # 非贪婪修饰对全匹配没有影响
+                self.pos += 1
+            node = ("repeat", node, bounds[0], bounds[1])
+
+    def _atom(self):
+        ch = self._next()
+        if ch == "(":
+            if self._peek() == "?":
+                if self.pattern[self.pos: self.pos + 2] != "?:":
+                    raise ValueError(f"only (?:...) groups are supported, got regex {self.pattern!r}")
+                self.pos += 2
+            node = self._alternation()
+            if self._next() != ")":
+                raise ValueError(f"missing ) in regex {self.pattern!r}")
+            return node
+        if ch == "[":
+            return self._char_class()
+        if ch == ".":
+            return _any_char_except(_byte_set(ord("\n")))
+        if ch == "\\":
+            escaped = self._escape()
+            if isinstance(escaped, tuple):
+                return escaped
+            ch = escaped
+        elif ch in "*+?":
+            raise ValueError(f"nothing to repeat at {self.pos - 1} in regex {self.pattern!r}")
+        return ("seq", [("set", 1 << b) for b in ch.encode("utf-8")])
+
+    def _escape(self) -> Union[str, tuple]:
+        """返回转义得到的字符, 或 \\d 等字符类的语法树节点"""
+        ch = self._next()
+        if ch.lower() in _CLASS_ESCAPES:
+            mask = _CLASS_ESCAPES[ch.lower()]
+            return ("set", mask) if ch.islower() else _any_char_except(mask)
+        if ch in _CHAR_ESCAPES:
+            return _CHAR_ESCAPES[ch]
+        if ch in "xu":
+            num_digits = 2 if ch == "x" else 4
+            digits = self.pattern[self.pos: self.pos + num_digits]
+            if not re.fullmatch(r"[0-9a-fA-F]+", digits) or len(digits) != num_digits:
+                raise ValueError(f"bad \\{ch} escape in regex {self.pattern!r}")
+            self.pos += num_digits
+            return chr(int(digits, 16))
+        if ch.isalnum():
+            raise ValueError(f"unsupported escape \\{ch} in regex {self.pattern!r}")
+        return ch
+
+    def _class_char(self) -> Union[str, tuple]:
+        ch = self._next()
+        return self._escape() if ch == "\\" else ch
+
+    def _char_class(self):
+        negate = self._peek() == "^"
+        if negate:
+            self.pos += 1
+        mask, first = 0, True
+        while first or self._peek() != "]":
+            first = False
+            lo = self._class_char()
+            if isinstance(lo, tuple):
+                if lo[0] != "set":
+                    raise ValueError(f"negated escapes are not supported in character classes, got regex {self.pattern!r}")
+                mask |= lo[1]
+                continue
+            hi = lo
+            if self._peek() == "-" and self.pattern[self.pos + 1: self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                hi = self._class_char()
+                if isinstance(hi, tuple):
+                    raise ValueError(f"bad character range in regex {self.pattern!r}")
+            if ord(hi) > 0x7F:
+                raise ValueError(f"character classes only support ASCII, got {hi!r} in regex {self.pattern!r}")
+            if ord(hi) < ord(lo):
+                raise ValueError(f"bad character range {lo}-{hi} in regex {self.pattern!r}")
+            mask |= _byte_set((ord(lo), ord(hi)))
+        self.pos += 1
+        return _any_char_except(mask) if negate else ("set", mask)
+
+class _NFA:
+    """Thompson 构造的 NFA, 边上是字节位图"""
+    def __init__(self):
+        self.edges: List[List[Tuple[int, int]]] = []
+        self.epsilon: List[List[int]] = []
+
+    def new_state(self) -> int:
+        self.edges.append([])
+        self.epsilon.append([])
+        return len(self.edges) - 1
+
+    def build(self, node) -> Tuple[int, int]:
+        """为语法树节点构造片段, 返回 (起始状态, 接受状态)"""
+        kind = node[0]
+        start = self.new_state()
+        if kind == "set":
+            end = self.new_state()
+            self.edges[start].append((node[1], end))
+            return start, end
+        if kind == "seq":
+            end = start
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.epsilon[end].append(item_start)
+                end = item_end
+            return start, end
+        if kind == "alt":
+            end = self.new_state()
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.epsilon[start].append(item_start)
+                self.epsilon[item_end].append(end)
+            return start, end
+        _, item, lo, hi = node
+        end = start
+        for _ in range(lo):
+            item_start, item_end = self.build(item)
+            self.epsilon[end].append(item_start)
+            end = item_end
+        if hi is None:
+            item_start, item_end = self.build(item)
+            self.epsilon[end].append(item_start)
+            self.epsilon[item_end].append(item_start)
+            loop_end = self.new_state()
+            self.epsilon[end].append(loop_end)
+            self.epsilon[item_end].append(loop_end)
+            return start, loop_end
+        optional_end = self.new_state()
+        for _ in range(hi - lo):
+            self.epsilon[end].append(optional_end)
+            item_start, item_end = self.build(item)
+            self.epsilon[end].append(item_start)
+            end = item_end
+        self.epsilon[end].append(optional_end)
+        return start, optional_end
+
+    def closure(self, states) -> FrozenSet[int]:
+        seen, stack = set(states), list(states)
+        while stack:
+            for target in self.epsilon[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+def regex_to_dfa(pattern: str) -> Tuple[List[Dict[int, int]], List[bool]]:
+    """
+    把正则表达式编译为字节级 DFA (全匹配语义), 初始状态为 0。
+
+    返回:
+        Tuple[List[Dict[int, int]], List[bool]]: 每个状态的转移 {字节: 下一状态} 与是否为接受状态。
+            无法到达接受状态的死状态已被删除, 缺失的转移即不允许的字节。
+    """
+    nfa = _NFA()
+    start, accept = nfa.build(_RegexParser(pattern).parse())
+
+    # 按所有边的位图把 256 个字节划分为等价类, 子集构造时每个等价类只计算一次
+    masks = sorted({mask for edges in nfa.edges for mask, _ in edges})
+    classes: Dict[Tuple[bool, ...], List[int]] = {}
+    for b in range(256):
+        classes.setdefault(tuple(bool(mask >> b & 1) for mask in masks), []).append(b)
+    byte_classes = [(members[0], members) for signature, members in classes.items() if any(signature)]
+
+    initial = nfa.closure([start])
+    state_ids = {initial: 0}
+    subsets, transitions = [initial], []
+    while len(transitions) < len(subsets):
+        subset = subsets[len(transitions)]
+        moves = {}
+        for representative, members in byte_classes:
+            targets = [t for s in subset for mask, t in nfa.edges[s] if mask >> representative & 1]
+            if not targets:
+                continue
+            target = nfa.closure(targets)
+            if target not in state_ids:
+                state_ids[target] = len(subsets)
+                subsets.append(target)
+            for b in members:
+                moves[b] = state_ids[target]
+        transitions.append(moves)
+    accepting = [accept in subset for subset in subsets]
+    return _prune_dead_states(transitions, accepting, "regex", pattern)
+
+def _prune_dead_states(transitions, accepting, kind: str, source) -> Tuple[List[Dict[int, int]], List[bool]]:
+    """删除无法到达接受状态的状态和指向它们的转移, 并按原顺序重新编号 (初始状态仍为 0)"""
+    reverse = [[] for _ in transitions]
+    for state, moves in enumerate(transitions):
+        for target in set(moves.values()):
+            reverse[target].append(state)
+    live = [False] * len(transitions)
+    queue = deque(state for state, is_accepting in enumerate(accepting) if is_accepting)
+    for state in queue:
+        live[state] = True
+    while queue:
+        for source_state in reverse[queue.popleft()]:
+            if not live[source_state]:
+                live[source_state] = True
+                queue.append(source_state)
+    if not live[0]:
+        raise ValueError(f"{kind} {source!r} cannot be matched")
+
+    new_ids = {state: i for i, state in enumerate(s for s in range(len(transitions)) if live[s])}
+    new_transitions = [
+        {key: new_ids[target] for key, target in transitions[state].items() if live[target]} for state in new_ids
+    ]
+    return new_transitions, [accepting[state] for state in new_ids]
+
+# JSON schema 转正则: 值之间最多一个空格, 避免模型在空白上无限生成
+_WS = r"[ ]?"
+_JSON_STRING = r'"([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+_JSON_STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+_JSON_INTEGER = r"-?(0|[1-9][0-9]*)"
+_JSON_NUMBER = _JSON_INTEGER + r"(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+_JSON_TYPES = {
+    "string": _JSON_STRING, "integer": _JSON_INTEGER, "number": _JSON_NUMBER,
+    "boolean": "(true|false)", "null": "null",
+}
+
+def json_schema_to_regex(schema: Union[str, dict]) -> str:
+    """
+    把 JSON schema 转为匹配其 JSON 文本的正则表达式。
+
+    支持 type (string / integer / number / boolean / null / array / object 及其列表)、enum、const、
+    anyOf / oneOf、单个元素的 allOf、本文档内的 $ref, 字符串的 minLength / maxLength, 数组的 minItems / maxItems。
+    对象的属性按 properties 中的声明顺序输出, 不在 required 中的属性可以省略; 不生成 properties 之外的属性。
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    return _SchemaConverter(schema).convert(schema)
+
+class _SchemaConverter:
+    def __init__(self, root: dict):
+        self.root = root
+        self._ref_stack: List[str] = []
+
+    def _resolve(self, ref: str) -> dict:
+        if not ref.startswith("#/"):
+            raise ValueError(f"only local $ref is supported, got {ref!r}")
+        node = self.root
+        for part in ref[2:].split("/"):
+            node = node[part.replace("~1", "/").replace("~0", "~")]
+        return node
+
+    def convert(self, schema: dict) -> str:
+        if schema is True or schema == {}:
+            raise ValueError("unconstrained JSON values are not regular, give the schema a type")
+        if "$ref" in schema:
+            ref = schema["$ref"]
+            if ref in self._ref_stack:
+                raise ValueError(f"recursive $ref {ref!r} is not supported")
+            self._ref_stack.append(ref)
+            try:
+                return self.convert(self._resolve(ref))
+            finally:
+                self._ref_stack.pop()
+        if "const" in schema:
+            return re.escape(json.dumps(schema["const"], ensure_ascii=False))
+        if "enum" in schema:
+            return "(" + "|".join(re.escape(json.dumps(v, ensure_ascii=False)) for v in schema["enum"]) + ")"
+        for key in ("anyOf", "oneOf"):
+            if key in schema:
+                return "(" + "|".join(self.convert(sub) for sub in schema[key]) + ")"
+        if "allOf" in schema:
+            if len(schema["allOf"]) != 1:
+                raise ValueError("allOf with more than one schema is not supported")
+            return self.convert(schema["allOf"][0])
+
+        schema_type = schema.get("type")
+        if schema_type is None:
+            schema_type = "object" if "properties" in schema else None
+        if isinstance(schema_type, list):
+            return "(" + "|".join(self.convert({**schema, "type": t}) for t in schema_type) + ")"
+        if schema_type == "string" and ("minLength" in schema or "maxLength" in schema):
+            lo, hi = schema.get("minLength", 0), schema.get("maxLength", "")
+            return f'"{_JSON_STRING_CHAR}{{{lo},{hi}}}"'
+        if schema_type in _JSON_TYPES:
+            return _JSON_TYPES[schema_type]
+        if schema_type == "array":
+            return self._array(schema)
+        if schema_type == "object":
+            return self._object(schema)
+        raise ValueError(f"unsupported JSON schema {schema!r}")
+
+    def _array(self, schema: dict) -> str:
+        if "items" not in schema:
+            raise ValueError("array schemas need items")
+        item = self.convert(schema["items"])
+        lo, hi = schema.get("minItems", 0), schema.get("maxItems")
+        if hi == 0:
+            return rf"\[{_WS}\]"
+        rest = f"({_WS},{_WS}{item})"
+        rest += f"{{{max(lo - 1, 0)},{'' if hi is None else hi - 1}}}"
+        items = f"{item}{rest}"
+        if lo == 0:
+            items = f"({items})?"
+        return rf"\[{_WS}{items}{_WS}\]"
+
+    def _object(self, schema: dict) -> str:
+        properties = schema.get("properties")
+        if not properties:
+            raise ValueError("object schemas need properties")
+        required = set(schema.get("required", []))
+        items = [
+            (f"{_WS}{re.escape(json.dumps(name, ensure_ascii=False))}{_WS}:{_WS}{self.convert(sub)}", name in required)
+            for name, sub in properties.items()
+        ]
+
+        # rest[i][first]: 从第 i 个属性开始的部分, first 表示之前还没有输出任何属性 (不需要前导逗号)
+        rest = [["", ""] for _ in range(len(items) + 1)]
+        for i in range(len(items) - 1, -1, -1):
+            item, is_required = items[i]
+            after = rest[i + 1][False]
+            if is_required:
+                rest[i] = [f",{item}{after}", f"{item}{after}"]
+            else:
+                rest[i] = [f"(,{item})?{after}", f"({item}{after}|{rest[i + 1][True]})"]
+        return rf"\{{{rest[0][True]}{_WS}\}}"
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    """GPT-2 字节级 BPE 中字节到可见字符的映射"""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+def vocab_bytes(tokenizer) -> List[Optional[bytes]]:
+    """
+    每个 token 解码出的字节串, 特殊 token 为 None。支持字节级 BPE (Llama-3, Qwen2 等, 以 Ġ 表示空格)
+    和 sentencepiece (Llama-2 等, 以 ▁ 表示空格, <0xXX> 为字节回退 token)。
+    """
+    pieces = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    special_ids = set(getattr(tokenizer, "all_special_ids", []))
+    byte_decoder = {c: b for b, c in _bytes_to_unicode().items()}
+    byte_level = any(piece is not None and "Ġ" in piece for piece in pieces)
+
+    result = []
+    for token_id, piece in enumerate(pieces):
+        if piece is None or token_id in special_ids:
+            result.append(None)
+        elif re.fullmatch(r"<0x[0-9A-Fa-f]{2}>", piece):
+            result.append(bytes([int(piece[3:5], 16)]))
+        elif byte_level and all(c in byte_decoder for c in piece):
+            result.append(bytes(byte_decoder[c] for c in piece))
+        else:
+            result.append(piece.replace("▁", " ").encode("utf-8"))
+    return result
+
+class TokenGuide:
+    """
+    词表上的有限状态机: 状态 i 允许的 token 及转移由 transitions[i] 给出, 接受状态还允许结束 token。
+
+    所有状态允许的 token 在编译时预先计算为按位压缩的掩码表 masks ([num_states, ceil(vocab_size / 8)], uint8),
+    常驻设备; 每步只需按各序列的状态取出对应的行, 在设备上展开并作用于 logits, 不在主机端逐 token 计算。
+    """
+    def __init__(
+        self, transitions: List[Dict[int, int]], accepting: List[bool], end_token_ids: Sequence[int],
+        vocab_size: int, device: str = "cuda",
+    ):
+        self.transitions = transitions
+        self.accepting = accepting
+        self.end_token_ids = tuple(end_token_ids)
+        self.vocab_size = vocab_size
+
+        allowed = torch.zeros((len(transitions), (vocab_size + 7) // 8 * 8), dtype=torch.bool)
+        for state, moves in enumerate(transitions):
+            tokens = list(moves) + (list(self.end_token_ids) if accepting[state] else [])
+            allowed[state, torch.tensor(tokens, dtype=torch.long)] = True
+        shifts = torch.arange(8, dtype=torch.uint8)
+        packed = (allowed.view(len(transitions), -1, 8).to(torch.uint8) << shifts).sum(dim=-1, dtype=torch.uint8)
+        self.masks = packed.to(device)
+        vocab = torch.arange(vocab_size, device=device)
+        self._byte_index = vocab // 8
+        self._bit_index = (vocab % 8).to(torch.uint8)
+
+    @property
+    def num_states(self) -> int:
+        return len(self.transitions)
+
+    def is_accepting(self, state: int) -> bool:
+        return self.accepting[state]
+
+    def next_state(self, state: int, token: int) -> int:
+        """token 之后的状态; 结束 token 保持状态不变, 不允许的 token 返回 -1"""
+        if token in self.end_token_ids:
+            return state if self.accepting[state] else -1
+        return self.transitions[state].get(token, -1)
+
+    def apply(self, logits: torch.Tensor, states: Sequence[int]) -> torch.Tensor:
+        """
+        把各行当前状态不允许的 token 的 logits 置为 -inf。
+
+        参数:
+            logits (torch.Tensor): [batch_size, vocab_size], 原地修改。
+            states: 每行的状态, 位于主机端。
+        """
+        rows = torch.as_tensor(states, dtype=torch.long).to(self.masks.device, non_blocking=True)
+        bits = (self.masks[rows][:, self._byte_index] >> self._bit_index) & 1
+        return logits.masked_fill_(bits == 0, -float("inf"))
+
+class GrammarCompiler:
+    """
+    把正则表达式或 JSON schema 编译为 TokenGuide。词表的字节串与前缀树只构建一次, 编译结果按模式缓存,
+    相同的 schema 只在第一次使用时编译; 编译在添加请求时完成, 不在生成的关键路径上。
+    """
+    def __init__(self, tokenizer, vocab_size: int, end_token_ids: Sequence[int], device: str = "cuda"):
+        self.tokenizer = tokenizer
+        self.vocab_size = vocab_size # 模型 logits 的宽度, 可以大于分词器的词表 (填充的 token 总是不允许)
+        self.end_token_ids = tuple(end_token_ids)
+        self.device = device
+        self._trie = None
+        self._cache: Dict[str, TokenGuide] = {}
+
+    def _build_trie(self):
+        """按字节组织全部 token 的前缀树, 节点为 (子节点 {字节: 节点}, 在此结束的 token 列表)"""
+        root = ({}, [])
+        for token_id, data in enumerate(vocab_bytes(self.tokenizer)[:self.vocab_size]):
+            if not data or token_id in self.end_token_ids:
+                continue
+            node = root
+            for b in data:
+                node = node[0].setdefault(b, ({}, []))
+            node[1].append(token_id)
+        return root
+
+    def compile_regex(self, pattern: str) -> TokenGuide:
+        if pattern not in self._cache:
+            self._cache[pattern] = self._compile(pattern)
+        return self._cache[pattern]
+
+    def compile_json_schema(self, schema: Union[str, dict]) -> TokenGuide:
+        return self.compile_regex(json_schema_to_regex(schema))
+
+    def _compile(self, pattern: str) -> TokenGuide:
+        if self._trie is None:
+            self._trie = self._build_trie()
+        dfa, dfa_accepting = regex_to_dfa(pattern)
+
+        # 从初始状态出发, 在前缀树上与 DFA 同步遍历得到每个可达状态允许的 token, 死前缀的整棵子树直接剪掉
+        state_ids, dfa_states, transitions = {0: 0}, [0], []
+        while len(transitions) < len(dfa_states):
+            moves = {}
+            stack = [(self._trie, dfa_states[len(transitions)])]
+            while stack:
+                (children, _), dfa_state = stack.pop()
+                for b, child in children.items():
+                    target = dfa[dfa_state].get(b)
+                    if target is None:
+                        continue
+                    if child[1]:
+                        if target not in state_ids:
+                            state_ids[target] = len(dfa_states)
+                            dfa_states.append(target)
+                        for token_id in child[1]:
+                            moves[token_id] = state_ids[target]
+                    stack.append((child, target))
+            transitions.append(moves)
+        accepting = [dfa_accepting[state] for state in dfa_states]
+
+        # 词表可能无法拼出某些字节序列, 在 token 级别再删除一次无法到达接受状态的状态
+        transitions, accepting = _prune_dead_states(transitions, accepting, "regex with this vocabulary", pattern)
+        logger.info(f"compiled regex into a token guide with {len(transitions)} states")
+        return TokenGuide(transitions, accepting, self.end_token_ids, self.vocab_size, self.device)
@@ -0,0 +1,151 @@
+# kv cache 快照: 把一段前缀 (系统提示或整段对话) 已计算的 kv 保存为内存映射文件, 之后的请求或重启后的进程
+# 把它映射回空闲的 block, 不必重新 prefill
+
+import json, os, struct
+from typing import List, Optional, Tuple
+
+import torch
+
+from .mem_manager import KVCacheMemoryManager
+
+# 文件布局: MAGIC | version (uint32) | header 长度 (uint32) | JSON header | 按 ALIGNMENT 对齐的数据区
+# 数据区依次为各层的 kv [num_tokens, 2 * num_kv_heads, head_dim], 量化 kv cache 再依次为各层的缩放因子
+# [num_tokens, 2 * num_kv_heads] (float32)。按 token 而非 block 存储, 恢复时 block_size 可以不同。
+MAGIC = b"LLKVSNAP"
+VERSION = 1
+ALIGNMENT = 64
+
+_DTYPES = {
+    "float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32,
+    "int8": torch.int8, "float8_e4m3fn": torch.float8_e4m3fn,
+}
+
+def _dtype_name(dtype: torch.dtype) -> str:
+    return str(dtype).replace("torch.", "")
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _snapshot_header(kv_mem_manager: KVCacheMemoryManager, model_id: str, token_ids: List[int]) -> dict:
+    return {
+        "model_id": model_id,
+        "num_layers": kv_mem_manager.num_layers,
+        "num_kv_heads": kv_mem_manager.num_kv_heads,
+        "head_dim": kv_mem_manager.head_dim,
+        "dtype": _dtype_name(kv_mem_manager.gpu_kv_buffer[0].dtype),
+        "kv_cache_dtype": kv_mem_manager.kv_cache_dtype,
+        "num_tokens": len(token_ids),
+        "token_ids": list(token_ids),
+    }
+
+def _layout(header: dict) -> Tuple[List[Tuple[int, tuple, torch.dtype]], int]:
+    """
+    按 header 计算数据区中各张量的布局。
+
+    返回:
+        各层 kv (及缩放因子) 相对数据区起点的 (偏移, 形状, 类型), 以及数据区的总字节数。
+    """
+    num_tokens, num_heads = header["num_tokens"], 2 * header["num_kv_heads"]
+    shapes = [((num_tokens, num_heads, header["head_dim"]), _DTYPES[header["dtype"]])] * header["num_layers"]
+    if header["kv_cache_dtype"] is not None:
+        shapes += [((num_tokens, num_heads), torch.float32)] * header["num_layers"]
+
+    layout, offset = [], 0
+    for shape, dtype in shapes:
+        layout.append((offset, shape, dtype))
+        offset = _align(offset + torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size())
+    return layout, offset
+
+def _tensor_views(mapped: torch.Tensor, data_offset: int, header: dict) -> List[torch.Tensor]:
+    """把映射的文件字节切分为各层的 kv (及缩放因子) 张量视图"""
+    views = []
+    for offset, shape, dtype in _layout(header)[0]:
+        nbytes = torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+        start = data_offset + offset
+        views.append(mapped[start: start + nbytes].view(dtype).view(shape))
+    return views
+
+def read_kv_snapshot_header(path: str) -> Tuple[dict, int]:
+    """
+    读取快照文件的 header。
+
+    返回:
+        Tuple[dict, int]: header 和数据区在文件中的起始偏移。
+    """
+    with open(path, "rb") as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if len(prefix) < len(MAGIC) + 8 or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a kv cache snapshot")
+        version, header_len = struct.unpack("<II", prefix[len(MAGIC):])
+        if version != VERSION:
+            raise ValueError(f"unsupported kv cache snapshot version {version}, expected {VERSION}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    return header, _align(len(MAGIC) + 8 + header_len)
+
+@torch.no_grad()
+def save_kv_snapshot(
+    path: str, kv_mem_manager: KVCacheMemoryManager, token_ids: List[int], block_index: torch.Tensor, model_id: str,
+):
+    """
+    把 block_index 指向的前 len(token_ids) 个 token 的 kv 写入快照文件。文件先按总大小创建, 数据经共享内存映射
+    直接从 kv buffer 拷贝进文件, 不经过额外的主机端缓冲。
+
+    参数:
+        token_ids (List[int]): 前缀的 token 序列, 与 kv 一起保存, 恢复时用于 prefix cache 匹配。
+        block_index (torch.Tensor): 该前缀占用的 block 索引, 至少覆盖 len(token_ids) 个 token。
+        model_id (str): 模型标识, 恢复时必须一致。
+    """
+    num_tokens = len(token_ids)
+    if block_index.numel() * kv_mem_manager.block_size < num_tokens:
+        raise ValueError(f"block_index covers fewer than {num_tokens} tokens")
+    header = _snapshot_header(kv_mem_manager, model_id, token_ids)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    sources = list(kv_mem_manager.gpu_kv_buffer) + list(kv_mem_manager.gpu_kv_scale or [])
+    file_size = data_offset + _layout(header)[1]
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<II", VERSION, len(header_bytes)) + header_bytes)
+        f.truncate(file_size)
+
+    if num_tokens > 0:
+        slots = kv_mem_manager._to_device(kv_mem_manager.get_token_slots(kv_mem_manager._to_host(block_index), num_tokens))
+        mapped = torch.from_file(tmp_path, shared=True, size=file_size, dtype=torch.uint8)
+        for view, src in zip(_tensor_views(mapped, data_offset, header), sources):
+            view.copy_(src[slots])
+        del mapped
+    os.replace(tmp_path, path) # 写完后再替换, 中途失败不会留下不完整的快照
+
+@torch.no_grad()
+def load_kv_snapshot(
+    path: str, kv_mem_manager: KVCacheMemoryManager, model_id: str,
+) -> Optional[Tuple[List[int], torch.Tensor]]:
+    """
+    把快照文件映射回 kv cache: 分配空闲 block 并把各层的 kv 从映射的文件拷贝进去。
+
+    返回:
+        Tuple[List[int], torch.Tensor] | None: 前缀的 token 序列和持有一次引用的 block 索引 (主机端);
+            空闲 block 不足时返回 None。
+    """
+    header, data_offset = read_kv_snapshot_header(path)
+    expected = _snapshot_header(kv_mem_manager, model_id, [])
+    for key in ("model_id", "num_layers", "num_kv_heads", "head_dim", "dtype", "kv_cache_dtype"):
+        if header[key] != expected[key]:
+            raise ValueError(f"kv cache snapshot {key} mismatch: file has {header[key]!r}, expected {expected[key]!r}")
+    file_size = os.path.getsize(path)
+    if file_size < data_offset + _layout(header)[1]:
+        raise ValueError(f"kv cache snapshot {path} is truncated")
+
+    token_ids, num_tokens = header["token_ids"], header["num_tokens"]
+    num_blocks = (num_tokens + kv_mem_manager.block_size - 1) // kv_mem_manager.block_size
+    block_index = kv_mem_manager.alloc_blocks(num_blocks, device="cpu")
+    if block_index is None:
+        return None
+    if num_tokens > 0:
+        slots = kv_mem_manager._to_device(kv_mem_manager.get_token_slots(block_index, num_tokens))
+        mapped = torch.from_file(path, shared=False, size=file_size, dtype=torch.uint8)
+        targets = list(kv_mem_manager.gpu_kv_buffer) + list(kv_mem_manager.gpu_kv_scale or [])
+        for view, target in zip(_tensor_views(mapped, data_offset, header), targets):
+            target[slots] = view.to(target.device)
+    return token_ids, block_index
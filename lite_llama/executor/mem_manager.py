@@ -1,6 +1,8 @@
 import torch
-import logging, gc
-from typing import List
+import logging, gc, bisect
+from typing import List, Optional
+
+from ..kernels.kv_quant import KV_CACHE_DTYPES, write_kv_cache
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +24,8 @@ class ComputeMaxAvailableBlocks:
         head_dim = None, 
         gpu_memory_utilization=0.9, 
         block_size=1, 
-        dtype="float16"
+        dtype="float16",
+        kv_cache_dtype=None,
     ):
         self.hidden_size = hidden_size
         self.num_heads = num_heads
@@ -32,14 +35,16 @@ class ComputeMaxAvailableBlocks:
 
         self.gpu_memory_utilization = gpu_memory_utilization
         self.block_size = block_size # 一个 block 表示多少个 tokens
-        self.dtype = dtype
+        # 量化 kv cache 时按存储类型计算, 每个 (token, kv head) 另有一个 float32 缩放因子
+        self.dtype = dtype if kv_cache_dtype is None else kv_cache_dtype
+        self.scale_size = 0 if kv_cache_dtype is None else 4
         
         if self.dtype in ["float16", "bfloat16", "fp16", "bfp16"]:
             self.dtype_size = 2
-        elif self.dtype in ["int8", "fp18"]:
+        elif self.dtype in ["int8", "fp8"]:
             self.dtype_size = 1 # byte
         else:
-            print(f"Unsupported dtype: {self.dtype_size}!")
+            raise ValueError(f"Unsupported dtype: {self.dtype}!")
         
     def compute_cache_block_size_bytes(self):
         """Get the size of the KV cache block size in bytes.
@@ -52,7 +57,7 @@ class ComputeMaxAvailableBlocks:
         num_layers = self.num_layers
         num_kv_heads = self.num_kv_heads
         # num_heads * head_size = hidden_size
-        kv_cache_token_bytes_per_layer = (num_kv_heads * head_size) * 2 * self.dtype_size
+        kv_cache_token_bytes_per_layer = (num_kv_heads * head_size) * 2 * self.dtype_size + num_kv_heads * 2 * self.scale_size
         transformer_kv_cache_token_bytes = kv_cache_token_bytes_per_layer * num_layers
 
         transformer_kv_cache_blocks_bytes = transformer_kv_cache_token_bytes * self.block_size
@@ -131,8 +136,165 @@ class ComputeMaxAvailableBlocks:
         return num_gpu_blocks
     
 
+class KVCacheAllocator:
+    """
+    主机端的 kv cache 位置分配器, 分配和释放都只操作 CPU 上的数据结构, 不会触发 GPU 同步。
+
+    空闲位置保存为互不相交的区间 [start, end), 释放时与相邻的空闲区间合并 (range coalescing);
+    每个位置的引用计数保存在 CPU 张量 ref_counts 上。非连续分配总是从地址最小的空闲区间头部切分,
+    均摊 O(1); 连续分配按 first fit 扫描空闲区间, 代价只与空闲区间个数有关, 与 cache 大小无关。
+    """
+    def __init__(self, num_tokens: int):
+        self.num_tokens = num_tokens
+        self.ref_counts = torch.zeros(num_tokens, dtype=torch.int32)
+        self.num_free = num_tokens
+
+        self._free_ranges = {} # start -> end
+        self._range_by_end = {} # end -> start
+        self._neg_starts = [] # 空闲区间起点取负后升序排列, 列表末尾是地址最小的区间
+        self.free_all()
+
+    def free_all(self):
+        self.ref_counts.zero_()
+        self._free_ranges.clear()
+        self._range_by_end.clear()
+        self._neg_starts.clear()
+        if self.num_tokens > 0:
+            self._insert_range(0, self.num_tokens)
+        self.num_free = self.num_tokens
+
+    def _insert_range(self, start, end):
+        self._free_ranges[start] = end
+        self._range_by_end[end] = start
+        bisect.insort(self._neg_starts, -start)
+
+    def _remove_range(self, start):
+        end = self._free_ranges.pop(start)
+        del self._range_by_end[end]
+        del self._neg_starts[bisect.bisect_left(self._neg_starts, -start)]
+        return end
+
+    def _take_head(self, pos, start, end, size):
+        """从第 pos 个空闲区间 [start, end) 的头部切下 size 个位置"""
+        del self._free_ranges[start]
+        if size == end - start:
+            del self._range_by_end[end]
+            del self._neg_starts[pos]
+        else:
+            # 新起点仍位于相邻两个空闲区间之间, 原地修改即可保持有序
+            self._free_ranges[start + size] = end
+            self._range_by_end[end] = start + size
+            self._neg_starts[pos] = -(start + size)
+
+    def _release_range(self, start, end):
+        """归还区间 [start, end), 并与前后相邻的空闲区间合并"""
+        prev_start = self._range_by_end.get(start)
+        if prev_start is not None:
+            self._remove_range(prev_start)
+            start = prev_start
+        if end in self._free_ranges:
+            end = self._remove_range(end)
+        self._insert_range(start, end)
+
+    def _carve(self, index):
+        """把单个空闲位置从所在的空闲区间中挖去"""
+        pos = bisect.bisect_left(self._neg_starts, -index)
+        start = -self._neg_starts[pos]
+        end = self._remove_range(start)
+        if start < index:
+            self._insert_range(start, index)
+        if index + 1 < end:
+            self._insert_range(index + 1, end)
+
+    def alloc(self, need_size: int) -> Optional[torch.Tensor]:
+        """分配 need_size 个位置 (不要求连续), 返回 CPU 上的 long 索引张量, 空间不足时返回 None"""
+        if need_size > self.num_free:
+            return None
+
+        pieces = []
+        remain = need_size
+        while remain > 0:
+            pos = len(self._neg_starts) - 1
+            start = -self._neg_starts[pos]
+            end = self._free_ranges[start]
+            size = min(remain, end - start)
+            self._take_head(pos, start, end, size)
+            pieces.append(torch.arange(start, start + size, dtype=torch.long))
+            remain -= size
+
+        select_index = torch.cat(pieces) if pieces else torch.empty(0, dtype=torch.long)
+        self.ref_counts[select_index] = 1
+        self.num_free -= need_size
+        return select_index
+
+    def alloc_contiguous(self, need_size: int) -> Optional[int]:
+        """分配 need_size 个连续位置, 返回起始位置, 找不到足够大的空闲区间时返回 None"""
+        if need_size > self.num_free:
+            return None
+
+        for pos in range(len(self._neg_starts) - 1, -1, -1):
+            start = -self._neg_starts[pos]
+            end = self._free_ranges[start]
+            if end - start >= need_size:
+                self._take_head(pos, start, end, need_size)
+                self.ref_counts[start: start + need_size] = 1
+                self.num_free -= need_size
+                return start
+
+        return None
+
+    def add_ref(self, token_index: torch.Tensor):
+        """增加引用计数, token_index 可以包含重复位置, 也可以包含尚未分配的位置"""
+        newly_used = token_index[self.ref_counts[token_index] == 0].unique()
+        for index in newly_used.tolist():
+            self._carve(index)
+        self.num_free -= newly_used.numel()
+        self.ref_counts.index_add_(0, token_index, torch.ones_like(token_index, dtype=torch.int32))
+
+    def release_ref(self, token_index: torch.Tensor):
+        """减少引用计数, 计数减到 0 的位置归还空闲区间; 已经空闲的位置 (如 free_all 之后) 被忽略"""
+        token_index, counts = token_index.unique(return_counts=True)
+        ref_counts = self.ref_counts[token_index]
+        new_ref_counts = (ref_counts - counts.to(torch.int32)).clamp_(min=0)
+        self.ref_counts[token_index] = new_ref_counts
+
+        # unique 的结果有序, 合并成连续段后再归还
+        freed = token_index[(ref_counts > 0) & (new_ref_counts == 0)].tolist()
+        self.num_free += len(freed)
+        run_start = 0
+        for i in range(1, len(freed) + 1):
+            if i == len(freed) or freed[i] != freed[i - 1] + 1:
+                self._release_range(freed[run_start], freed[i - 1] + 1)
+                run_start = i
+
+    def fragmentation_stats(self) -> dict:
+        """
+        返回空闲空间的碎片化统计。
+
+        返回:
+            dict: num_free_tokens, num_free_ranges, largest_free_range 以及
+                fragmentation = 1 - largest_free_range / num_free_tokens (0 表示空闲空间完全连续)。
+        """
+        largest = max((end - start for start, end in self._free_ranges.items()), default=0)
+        return {
+            "num_free_tokens": self.num_free,
+            "num_free_ranges": len(self._free_ranges),
+            "largest_free_range": largest,
+            "fragmentation": 0.0 if self.num_free == 0 else 1.0 - largest / self.num_free,
+        }
+
 class KVCacheMemoryManager:
-    def __init__(self, num_layers, num_kv_heads, head_dim, gpu_num_blocks, block_size=1, dtype=torch.float16, device="cuda"):
+    """
+    kv cache 显存管理, 分配以 block 为单位。传入 allocator 时与其他管理器共享 block 的分配和引用计数,
+    例如投机解码的 draft 模型与目标模型使用同一组 block 索引和 block_tables, 各自只保存自己的 kv buffer。
+
+    kv_cache_dtype 为 "int8" / "fp8" 时 kv buffer 以 1 字节类型存储, 另用 gpu_kv_scale 保存每个 (token, kv head)
+    的 float32 缩放因子, 写入时量化、attention kernel 读取时反量化; 为 None 时 kv buffer 的类型为 dtype。
+    """
+    def __init__(
+        self, num_layers, num_kv_heads, head_dim, gpu_num_blocks, block_size=1, dtype=torch.float16, device="cuda",
+        allocator: Optional[KVCacheAllocator] = None, kv_cache_dtype: Optional[str] = None,
+    ):
         self.num_layers = num_layers
         self.num_kv_heads = num_kv_heads
         self.head_dim = head_dim
@@ -142,11 +304,17 @@ class KVCacheMemoryManager:
 
         self.dtype = dtype
         self.device = device
-        self.can_use_mem_size = gpu_num_blocks # 可用的 kv cache tokens 数量
+        if kv_cache_dtype is not None and kv_cache_dtype not in KV_CACHE_DTYPES:
+            raise ValueError(f"unsupported kv_cache_dtype {kv_cache_dtype!r}, expected one of {list(KV_CACHE_DTYPES)}")
+        self.kv_cache_dtype = kv_cache_dtype
 
-        # 定义 kv 内存位置索引和内存使用状态变量
-        self.kv_mem_pos_indexs = torch.arange(0, self.max_num_tokens, dtype=torch.long, device="cuda")
-        self.kv_mem_use_state = torch.zeros(self.max_num_tokens, dtype = torch.int32, device="cuda")
+        # 以 block 为单位分配 kv cache, 分配和引用计数都在主机端完成, device 上只保留引用计数的镜像, 按需同步
+        if allocator is not None and allocator.num_tokens != gpu_num_blocks:
+            raise ValueError(f"shared allocator has {allocator.num_tokens} blocks, expected {gpu_num_blocks}")
+        self.allocator = KVCacheAllocator(gpu_num_blocks) if allocator is None else allocator
+        self.kv_mem_pos_indexs = torch.arange(0, self.max_num_tokens, dtype=torch.long, device=device)
+        self._kv_mem_use_state = torch.zeros(gpu_num_blocks, dtype = torch.int32, device=device)
+        self._use_state_dirty = False
 
         # Initialize the gpu_kv_buffer
         self.init_kv_buffers(
@@ -154,6 +322,27 @@ class KVCacheMemoryManager:
             head_dim, num_kv_heads, num_layers, 
             dtype, device)
 
+    @property
+    def can_use_mem_size(self) -> int:
+        """可用的 kv cache tokens 数量"""
+        return self.allocator.num_free * self.block_size
+
+    @property
+    def can_use_num_blocks(self) -> int:
+        return self.allocator.num_free
+
+    @property
+    def kv_mem_use_state(self) -> torch.Tensor:
+        """各 block 引用计数在 device 上的镜像, 只在 kernel 需要读取时才从主机端同步"""
+        if self._use_state_dirty:
+            self._kv_mem_use_state.copy_(self.allocator.ref_counts)
+            self._use_state_dirty = False
+        return self._kv_mem_use_state
+
+    def fragmentation_stats(self) -> dict:
+        """以 block 为单位的碎片化统计, 见 KVCacheAllocator.fragmentation_stats"""
+        return self.allocator.fragmentation_stats()
+
     def init_kv_buffers(self, 
         max_num_tokens,
         head_dim, num_kv_heads, num_layers,
@@ -162,96 +351,284 @@ class KVCacheMemoryManager:
     )-> List[torch.Tensor]:
         # kv cache shape: config.max_batch_size, config.max_seq_len, self.num_kv_heads, self.head_dim
         # max_num_tokens = max_num_blocks * self.block_size
-        # TODO 修改 kv buffer 形状支持 PagedAttention
+        # 分页存储: 第 b 个 block 占据 kv buffer 的 [b * block_size, (b + 1) * block_size) 行,
+        # 即 buffer 可以 view 成 [num_blocks, block_size, 2 * num_kv_heads, head_dim]
+        buffer_dtype = dtype if self.kv_cache_dtype is None else KV_CACHE_DTYPES[self.kv_cache_dtype][0]
         self.gpu_kv_buffer = [
-            torch.empty((max_num_tokens, 2 * num_kv_heads, head_dim), dtype=dtype, device=device) for _ in range(num_layers)
+            torch.empty((max_num_tokens, 2 * num_kv_heads, head_dim), dtype=buffer_dtype, device=device) for _ in range(num_layers)
+        ]
+        # 量化 kv cache 的缩放因子, 与 kv buffer 一样前 num_kv_heads 列属于 k, 后 num_kv_heads 列属于 v
+        self.gpu_kv_scale = None if self.kv_cache_dtype is None else [
+            torch.ones((max_num_tokens, 2 * num_kv_heads), dtype=torch.float32, device=device) for _ in range(num_layers)
         ]
         logger.debug(f"gpu_kv_buffer per layer shape: {self.gpu_kv_buffer[0].shape}")
-    
+
+    def _to_host(self, token_index: torch.Tensor) -> torch.Tensor:
+        # 调用方持有 device 上的索引时这里会同步一次, 调度器等热路径应直接持有主机端索引
+        return token_index.to(device="cpu", dtype=torch.long)
+
+    def _to_device(self, host_index: torch.Tensor, device=None) -> torch.Tensor:
+        device = torch.device(self.device if device is None else device)
+        if device.type == "cpu":
+            return host_index
+        return host_index.pin_memory().to(device, non_blocking=True)
+
+    def get_token_slots(self, block_index: torch.Tensor, num_tokens: int, start: int = 0) -> torch.Tensor:
+        """把序列的 block 索引展开为第 [start, num_tokens) 个 token 在 kv buffer 中的位置"""
+        pos = torch.arange(start, num_tokens, dtype=block_index.dtype, device=block_index.device)
+        return block_index[pos // self.block_size] * self.block_size + pos % self.block_size
+
     @torch.no_grad()
-    def alloc_kvcache(self, need_size):
-        if need_size > self.can_use_mem_size:
-            logger.warning(f"warn no enough cache need_size {need_size} left_size {self.can_use_mem_size}")
+    def alloc_blocks(self, num_blocks, device=None):
+        """
+        分配 num_blocks 个 kv cache block (不要求连续)。
+
+        参数:
+            num_blocks (int): 需要的 block 数。
+            device (optional): 返回索引所在的设备, 默认与 kv buffer 相同; 传入 "cpu" 可避免后续释放时的同步。
+        返回:
+            torch.Tensor | None: block 索引, 空间不足时返回 None。
+        """
+        if num_blocks > self.can_use_num_blocks:
+            logger.warning(f"warn no enough cache need_blocks {num_blocks} left_blocks {self.can_use_num_blocks}")
             return None
         
-        can_use_pos_index = torch.nonzero(self.kv_mem_use_state == 0).view(-1)
-        select_index = can_use_pos_index[0:need_size]
-        self.add_ref(select_index)
+        block_index = self.allocator.alloc(num_blocks)
+        self._use_state_dirty = True
         
-        return select_index
+        return self._to_device(block_index, device)
+
+    @torch.no_grad()
+    def alloc_kvcache(self, need_size, device=None):
+        """逐 token 分配 need_size 个 kv cache 位置 (不要求连续), 只适用于 block_size=1"""
+        assert self.block_size == 1, "alloc_kvcache only supports block_size=1, use alloc_blocks for paged kv cache"
+        return self.alloc_blocks(need_size, device)
     
     @torch.no_grad()
-    def alloc_contiguous_kvcache(self, need_size):
+    def alloc_contiguous_kvcache(self, need_size, device=None):
+        assert self.block_size == 1, "alloc_contiguous_kvcache only supports block_size=1"
         if need_size > self.can_use_mem_size:
             logger.warning(f"warn no enough contiguous cache need_size {need_size} left_size {self.can_use_mem_size}")
             return None
 
-        # 获取未使用的内存块索引
-        can_use_pos_index = torch.nonzero(self.kv_mem_use_state == 0).view(-1)
-        N = can_use_pos_index.numel()
-        if N >= need_size:
-            # 正确地计算 start_indexs 和 end_indexs. 
-            # NOTE: 起始索引不能大于 N - need_size, 又因为 [: index] 切片操作是不包含 index 的, 所以需要将 N - need_size 加 1
-            start_indexs = can_use_pos_index[:N - need_size + 1]
-            # NOTE: can_use_pos_index[3:], 将获取索引为 3 到 9 的元素。
-            end_indexs = can_use_pos_index[need_size - 1:]
-            diff = end_indexs - start_indexs
-
-            # 寻找连续的块，差值应为 need_size - 1
-            contiguous_blocks = (diff == need_size - 1).nonzero(as_tuple=True)[0]
-
-            if contiguous_blocks.numel() > 0:
-                start_index = start_indexs[contiguous_blocks[0]].item()
-                end_index = start_index + need_size
-                select_index = self.kv_mem_pos_indexs[start_index:end_index]
-                self.add_ref(select_index)
-                return select_index, start_index, end_index
+        start_index = self.allocator.alloc_contiguous(need_size)
+        if start_index is None:
+            return None
 
-        return None
+        self._use_state_dirty = True
+        end_index = start_index + need_size
+        if device is None or torch.device(device) == self.kv_mem_pos_indexs.device:
+            select_index = self.kv_mem_pos_indexs[start_index:end_index]
+        else:
+            select_index = torch.arange(start_index, end_index, dtype=torch.long, device=device)
+
+        return select_index, start_index, end_index
     
     @torch.no_grad()
-    def alloc_kvcache_index(self, need_size):
-        alloc_mem = self.alloc_contiguous_kvcache(need_size)
+    def alloc_kvcache_index(self, need_size, device=None):
+        alloc_mem = self.alloc_contiguous_kvcache(need_size, device=device)
         if alloc_mem is not None:
             select_index, start_index, _ = alloc_mem
         else:
-            select_index, start_index, _  = self.alloc_kvcache(need_size)
+            select_index = self.alloc_kvcache(need_size, device=device)
         
         return select_index
     
-    # 增加引用计数
+    @torch.no_grad()
+    def grow_kvcache(self, kv_index, need_size, chunk_size=32, max_size=None, device=None):
+        """
+        按需为单个序列追加 kv cache, 每次按 chunk_size 的整数倍增长, 新分配的 block 不要求和已有 block 连续。
+
+        参数:
+            kv_index (torch.Tensor | None): 序列已占有的 block 索引 (block table), block_size=1 时即 token 位置。
+            need_size (int): 序列需要的最小容量 (token 数)。
+            chunk_size (int): 增长粒度 (token 数), 避免每个 decode step 都调用分配。
+            max_size (int, optional): 容量上限, 通常是该序列最多可能写入的 token 数。
+            device (optional): 新分配索引所在的设备, 需与 kv_index 一致。
+        返回:
+            torch.Tensor | None: 增长后的 block 索引 (前缀与 kv_index 相同); 空间不足时返回 None, kv_index 保持不变。
+        """
+        cur_blocks = 0 if kv_index is None else kv_index.numel()
+        if need_size <= cur_blocks * self.block_size:
+            return kv_index
+
+        new_size = (need_size + chunk_size - 1) // chunk_size * chunk_size
+        if max_size is not None:
+            new_size = max(min(new_size, max_size), need_size)
+
+        grow_blocks = (new_size + self.block_size - 1) // self.block_size - cur_blocks
+        if grow_blocks > self.can_use_num_blocks:
+            # 整块不够时退化为只分配本次必须的部分
+            grow_blocks = (need_size + self.block_size - 1) // self.block_size - cur_blocks
+        new_index = self.alloc_blocks(grow_blocks, device=device)
+        if new_index is None:
+            return None
+
+        return new_index if kv_index is None else torch.cat([kv_index, new_index])
+
+    @torch.no_grad()
+    def rollback_kvcache(self, kv_index, num_tokens):
+        """
+        回滚序列末尾多余的 kv cache, 只保留容纳前 num_tokens 个 token 所需的 block, 其余 block 释放一次引用。
+        用于投机解码: 为 draft token 预留的位置在 token 被拒绝后归还。
+
+        返回:
+            torch.Tensor: 保留的 block 索引 (kv_index 的前缀)。
+        """
+        keep_blocks = (num_tokens + self.block_size - 1) // self.block_size
+        if kv_index is None or kv_index.numel() <= keep_blocks:
+            return kv_index
+        self.release_ref(kv_index[keep_blocks:])
+        return kv_index[:keep_blocks]
+
+    @torch.no_grad()
+    def copy_blocks(self, src_index: torch.Tensor, dst_index: torch.Tensor):
+        """
+        把各层 kv buffer 中 src_index 指向的 block 复制到 dst_index, 用于共享 block 的写时复制 (copy-on-write)。
+        """
+        src = self._to_device(self._to_host(src_index))
+        dst = self._to_device(self._to_host(dst_index))
+        for kv_buffer in self.gpu_kv_buffer + (self.gpu_kv_scale or []):
+            blocks = kv_buffer.view(self.gpu_num_blocks, self.block_size, *kv_buffer.shape[1:])
+            blocks[dst] = blocks[src]
+
+    def evict_kvcache(self, kv_index: torch.Tensor, start_block: int, num_blocks: int) -> torch.Tensor:
+        """
+        从序列的 block 索引中移除第 [start_block, start_block + num_blocks) 个 block 并释放一次引用, 用于 attention
+        sink + 滑动窗口: 淘汰 sink 之后最旧的 block, 归还的 block 立即可以分配给其他序列。
+
+        返回:
+            torch.Tensor: 移除后的 block 索引, 之后的 block 依次前移。
+        """
+        self.release_ref(kv_index[start_block: start_block + num_blocks])
+        return torch.cat([kv_index[:start_block], kv_index[start_block + num_blocks:]])
+
+    @torch.no_grad()
+    def rotate_keys(self, token_slots: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor):
+        """
+        把各层 kv buffer 中 token_slots 位置的 k 再旋转一个固定角度 (rotate_half 形式的 RoPE): 由于
+        R(p) R(d) = R(p + d), 位置为 p 的 k 乘上 cos(d) / sin(d) 后等价于在位置 p + d 计算的 k。
+        量化 kv cache 先反量化, 旋转后重新量化 k 并更新其缩放因子。
+
+        参数:
+            token_slots (torch.Tensor): 需要旋转的 token 在 kv buffer 中的位置。
+            cos, sin (torch.Tensor): 形状为 [head_dim], 旋转角度 d 对应的 cos / sin (float32)。
+        """
+        if token_slots.numel() == 0:
+            return
+        slots = self._to_device(self._to_host(token_slots))
+        num_kv_heads, half = self.num_kv_heads, self.head_dim // 2
+        for layer, kv_buffer in enumerate(self.gpu_kv_buffer):
+            kv_scale = None if self.gpu_kv_scale is None else self.gpu_kv_scale[layer][:, :num_kv_heads]
+            k = kv_buffer[slots, :num_kv_heads].float()
+            if kv_scale is not None:
+                k = k * kv_scale[slots][..., None]
+            rotated = torch.cat([-k[..., half:], k[..., :half]], dim=-1)
+            k = k * cos.to(k.device) + rotated * sin.to(k.device)
+            write_kv_cache(k.to(self.dtype), kv_buffer[:, :num_kv_heads], kv_scale, slots)
+
+    # 增加引用计数, 索引以 block 为单位 (block_size=1 时即 token 位置)
     @torch.no_grad()
     def add_ref(self, token_index: torch.Tensor):
-        state = self.kv_mem_use_state[token_index]
-        has_used_tokens = torch.count_nonzero(state).item()
-        all_tokens = len(state)
-        self.can_use_mem_size -= all_tokens - has_used_tokens
-  
-        self.kv_mem_use_state[token_index] += 1
+        self.allocator.add_ref(self._to_host(token_index))
+        self._use_state_dirty = True
         return
     
     # 减少引用计数
     @torch.no_grad()
     def release_ref(self, token_index: torch.Tensor):
-        # 使用 unique 方法获取 token_index 中唯一的 token 索引，并返回每个唯一索引在原始张量中出现的次数。
-        token_index, counts = token_index.unique(return_counts=True)
         # 当引用计数减少到零时，意味着该缓存块可以被释放或重新分配。
-        self.kv_mem_use_state[token_index] -= counts
-        state = self.kv_mem_use_state[token_index]
-        used_tokens = torch.count_nonzero(state).item()
-        all_tokens = len(state)
-        self.can_use_mem_size += all_tokens - used_tokens
+        self.allocator.release_ref(self._to_host(token_index))
+        self._use_state_dirty = True
         return
     
     # 释放键值缓存缓冲区
     def _free_buffers(self):
         self.gpu_kv_buffer = None
+        self.gpu_kv_scale = None
     
     # 释放所有内存
     @torch.no_grad()
     def free_all(self,):
-        self.can_use_mem_size = len(self.kv_mem_use_state)
-        self.kv_mem_use_state[:] = 0
+        self.allocator.free_all()
+        self._use_state_dirty = True
+
+class HostKVCachePool:
+    """
+    kv cache 的主机端交换空间 (swap space): 与 kv_mem_manager 的 kv buffer (及量化缩放因子) 布局相同、以 block
+    为单位的锁页内存池。显存不足时调度器把被抢占请求的 kv block 换出到这里, 显存空闲后再换入新分配的 block,
+    恢复时不必重新 prefill。
+
+    设备上的 kv buffer 在 CPU 上时 (如测试中的桩模型) 同样可用, 此时不使用锁页内存。
+    """
+    def __init__(self, kv_mem_manager: KVCacheMemoryManager, num_blocks: int):
+        self.kv_mem_manager = kv_mem_manager
+        self.num_blocks = num_blocks
+        self.block_size = kv_mem_manager.block_size
+        self.allocator = KVCacheAllocator(num_blocks)
+
+        pin_memory = torch.device(kv_mem_manager.device).type == "cuda"
+        self.host_kv_buffer = [
+            torch.empty((num_blocks, *buffer.shape[1:]), dtype=buffer.dtype, pin_memory=pin_memory)
+            for buffer in self._device_buffers()
+        ]
+
+    @property
+    def can_use_num_blocks(self) -> int:
+        return self.allocator.num_free
+
+    def _device_buffers(self) -> List[torch.Tensor]:
+        manager = self.kv_mem_manager
+        buffers = manager.gpu_kv_buffer + (manager.gpu_kv_scale or [])
+        return [buffer.view(manager.gpu_num_blocks, self.block_size, *buffer.shape[1:]) for buffer in buffers]
+
+    def _host_blocks(self, host_buffer: torch.Tensor, host_index: torch.Tensor):
+        """连续的 host block 返回锁页内存上的切片, 与设备之间的拷贝可以异步进行"""
+        start, end = int(host_index[0]), int(host_index[-1]) + 1
+        if end - start == host_index.numel():
+            return host_buffer[start:end]
+        return None
+
+    @torch.no_grad()
+    def swap_out(self, block_index: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        把设备上 block_index 指向的 kv block 拷贝到交换空间, 设备上的 block 由调用方释放。
+
+        返回:
+            torch.Tensor | None: 交换空间中的 block 索引 (主机端), 交换空间不足时返回 None。
+        """
+        num_blocks = block_index.numel()
+        start = self.allocator.alloc_contiguous(num_blocks)
+        if start is not None:
+            host_index = torch.arange(start, start + num_blocks, dtype=torch.long)
+        else:
+            host_index = self.allocator.alloc(num_blocks)
+            if host_index is None:
+                return None
+
+        src = self.kv_mem_manager._to_device(self.kv_mem_manager._to_host(block_index))
+        for device_buffer, host_buffer in zip(self._device_buffers(), self.host_kv_buffer):
+            host_blocks = self._host_blocks(host_buffer, host_index)
+            if host_blocks is not None:
+                # 与之后写入这些 block 的 kernel 在同一个 stream 上, 无需等待拷贝完成
+                host_blocks.copy_(device_buffer[src], non_blocking=True)
+            else:
+                host_buffer[host_index] = device_buffer[src].cpu()
+        return host_index
+
+    @torch.no_grad()
+    def swap_in(self, host_index: torch.Tensor, block_index: torch.Tensor):
+        """把交换空间中 host_index 指向的 kv block 拷贝到设备上新分配的 block_index, 并归还交换空间"""
+        dst = self.kv_mem_manager._to_device(self.kv_mem_manager._to_host(block_index))
+        for device_buffer, host_buffer in zip(self._device_buffers(), self.host_kv_buffer):
+            host_blocks = self._host_blocks(host_buffer, host_index)
+            if host_blocks is None:
+                host_blocks = host_buffer[host_index]
+            device_buffer[dst] = host_blocks.to(device_buffer.device, non_blocking=True)
+        self.free(host_index)
+
+    def free(self, host_index: torch.Tensor):
+        self.allocator.release_ref(host_index)
 
 def indexs_convert(indexs: torch.tensor, batch_size: int):
     """
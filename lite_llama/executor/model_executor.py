@@ -9,7 +9,9 @@ from .mem_manager import ComputeMaxAvailableBlocks, KVCacheMemoryManager
 
 from .cuda_graph import ModelRunner
 from .executor_struct import AttentionInfo
+from .kv_snapshot import load_kv_snapshot, save_kv_snapshot
 from ..models.model_config import LlamaConfig, Qwen2Config
+from ..utils.file_interface import get_model_name_from_path
 from .weight_convert import convert_llama_torch_to_litellama, \
                             convert_llavallama_hf_to_litellama, \
                             convert_qwen2_hf_to_litellama
@@ -52,6 +54,9 @@ class ModelExecutor:
         triton_weight: bool = True,
         compiled_model: bool = False, 
         device: str = "cuda", 
+        block_size: int = 1,
+        kv_allocator = None,
+        kv_cache_dtype = None,
     ):
         """
         构建 ModelExecutor 实例, 加载模型、分词器和初始化推理信息结构体 atten_info。
@@ -61,6 +66,10 @@ class ModelExecutor:
             load_model (bool): 是否加载模型权重。
             max_seq_len (int): 最大序列长度。
             device (str): 设备类型（'cuda'或'cpu'）。
+            compiled_model (bool): cuda graph decode, 与调度器的分页打包 forward 不兼容, 为 True 时给出警告并回退到 eager 执行。
+            block_size (int): kv cache 每个 block 包含的 token 数, 大于 1 时使用分页 kv cache。
+            kv_allocator (KVCacheAllocator, optional): 与其他 ModelExecutor 共享的 block 分配器, 如投机解码的 draft 模型。
+            kv_cache_dtype (str, optional): "int8" 或 "fp8" 时量化 kv cache, 每个 token 的 kv 字节数约减半。
 
         返回:
             ModelExecutor: 初始化后的 ModelExecutor 实例。
@@ -69,7 +78,10 @@ class ModelExecutor:
         # model = ModelExecutor._accelerate_load_weight(model_config, checkpoints_dir)
         model = ModelExecutor._load_model_weight(model_config, checkpoints_dir, load_model, triton_weight, device=device) # 加载权重后的模型
 
-        return ModelExecutor(model_config, model, max_gpu_num_blocks, compiled_model, device)
+        return ModelExecutor(
+            model_config, model, max_gpu_num_blocks, compiled_model, device, block_size, kv_allocator, kv_cache_dtype,
+            model_id=get_model_name_from_path(checkpoints_dir),
+        )
 
     @staticmethod
     def _accelerate_load_weight(model_config, checkpoints_dir, load_model = True, triton_weight=True, device="cuda"):
@@ -181,7 +193,10 @@ class ModelExecutor:
 
         return model_config
 
-    def __init__(self, model_config, model, max_gpu_num_blocks=None, compiled_model=False, device="cuda"):
+    def __init__(
+        self, model_config, model, max_gpu_num_blocks=None, compiled_model=False, device="cuda", block_size=1,
+        kv_allocator=None, kv_cache_dtype=None, model_id=None,
+    ):
         self.model_config = model_config
 
         if isinstance(model_config, LlavaConfig):
@@ -190,23 +205,34 @@ class ModelExecutor:
             self.llm_config = model_config
 
         self.model_type = model_config.model_type
+        self.model_id = model_id or self.model_type # kv cache 快照中记录的模型标识
         self.model = model
 
         self.compiled_model = False
         self.model_runner = None
+        if compiled_model:
+            # cuda_graph.ModelRunner 只捕获了 block_size=1、非打包的 decode, 调度器的每一步都是按 block_tables
+            # 寻址的打包 batch, 两者的输入布局不一致, 不能回放, 这里回退到 eager 执行
+            logger.warning(
+                "compiled_model=True is ignored: the CUDA graph targets the contiguous decode path, "
+                "but the scheduler runs paged, packed forwards over block tables; falling back to eager execution"
+            )
+        self.kv_cache_dtype = kv_cache_dtype
         
+        if kv_allocator is not None:
+            # 共享分配器时 block 数必须一致, 两个模型的 block 索引才能互相通用
+            max_gpu_num_blocks = kv_allocator.num_tokens
         if max_gpu_num_blocks:
-            self.kv_mem_manager = self._init_mem_manager(max_gpu_num_blocks)
+            self.kv_mem_manager = self._init_mem_manager(max_gpu_num_blocks, block_size=block_size, device=device, allocator=kv_allocator)
         else:
-            max_gpu_num_blocks, self.max_gpu_num_tokens = self._get_max_avaliable_tokens(gpu_memory_utilization=0.9, block_size=1)
-            self.kv_mem_manager = self._init_mem_manager(max_gpu_num_blocks, block_size=1)
-        
-        if compiled_model:
-            self.apply_cuda_graph() # 调用 cuda graph 优化
+            max_gpu_num_blocks, self.max_gpu_num_tokens = self._get_max_avaliable_tokens(gpu_memory_utilization=0.9, block_size=block_size)
+            self.kv_mem_manager = self._init_mem_manager(max_gpu_num_blocks, block_size=block_size, device=device)
 
         self.gpu_kv_buffer = self.kv_mem_manager.gpu_kv_buffer
         self.atten_info = AttentionInfo() # 创建 AttentionInfo 实例
         self.atten_info.kv_buffer = self.kv_mem_manager.gpu_kv_buffer
+        self.atten_info.kv_scale = self.kv_mem_manager.gpu_kv_scale
+        self.atten_info.block_size = self.kv_mem_manager.block_size
 
     def _get_max_avaliable_tokens(self, gpu_memory_utilization=0.9, block_size=1):
         avaliable_blocks = ComputeMaxAvailableBlocks(
@@ -216,13 +242,14 @@ class ModelExecutor:
             num_kv_heads = self.llm_config.num_kv_heads, 
             gpu_memory_utilization = gpu_memory_utilization, 
             block_size = block_size,
+            kv_cache_dtype = self.kv_cache_dtype,
         )
         max_gpu_num_blocks = avaliable_blocks.compute_num_available_blocks()
         max_gpu_num_tokens = max_gpu_num_blocks * block_size
 
         return max_gpu_num_blocks, max_gpu_num_tokens
     
-    def _init_mem_manager(self, gpu_num_blocks, block_size=1, dtype=torch.float16,  device="cuda"):
+    def _init_mem_manager(self, gpu_num_blocks, block_size=1, dtype=torch.float16,  device="cuda", allocator=None):
         kv_mem_manager = KVCacheMemoryManager(
             num_layers = self.llm_config.num_layers,
             num_kv_heads = self.llm_config.num_kv_heads,
@@ -231,7 +258,9 @@ class ModelExecutor:
             gpu_num_blocks = gpu_num_blocks,
             block_size = block_size,
             dtype = dtype,
-            device=device
+            device=device,
+            allocator=allocator,
+            kv_cache_dtype=self.kv_cache_dtype,
         )
 
         return kv_mem_manager
@@ -289,10 +318,45 @@ class ModelExecutor:
             select_index = torch.cat([self.atten_info.select_index, self.atten_info.decode_index])
             self.atten_info.select_index = select_index
     
-    def forward(self, input_ids, prev_pos, image_tensor=None):            
+    @torch.no_grad()
+    def shift_kv_positions(self, token_slots: torch.Tensor, delta: int):
+        """
+        把 kv cache 中 token_slots 位置的 k 的位置编号整体平移 delta (重新旋转 RoPE), 用于滑动窗口淘汰中间的 token 后
+        保留的 token 前移, 使 cache 中的位置编号保持连续。
+        """
+        model = self.model.language_model if self.model_type == "llava" else self.model
+        rotary_emb = model.rotary_emb
+        position_ids = torch.tensor([[delta]], dtype=torch.long, device=rotary_emb.inv_freq.device)
+        cos, sin = rotary_emb(rotary_emb.inv_freq.float(), position_ids) # x 只用于确定输出的 device 和 dtype
+        self.kv_mem_manager.rotate_keys(token_slots, cos.reshape(-1), sin.reshape(-1))
+
+    def save_kv_cache(self, path: str, token_ids, block_index: torch.Tensor):
+        """
+        把一段已完成 prefill 的前缀 (token_ids, 占用 block_index) 的 kv 保存为内存映射的快照文件,
+        之后的请求或重启后的进程用 load_kv_cache 恢复, 不必重新 prefill。
+        """
+        save_kv_snapshot(path, self.kv_mem_manager, list(token_ids), block_index, self.model_id)
+
+    def load_kv_cache(self, path: str):
+        """
+        把 save_kv_cache 保存的快照映射回空闲的 block。快照的模型标识、层数、kv 头数、head_dim 或 dtype
+        与当前模型不一致时抛出 ValueError。
+
+        返回:
+            Tuple[List[int], torch.Tensor] | None: 前缀的 token 序列和持有一次引用的 block 索引, 用完后由调用方
+                release_ref; 空闲 block 不足时返回 None。
+        """
+        return load_kv_snapshot(path, self.kv_mem_manager, self.model_id)
+
+    def forward(self, input_ids, prev_pos, image_tensor=None, position_ids=None):
+        """
+        参数:
+            - position_ids: 可选, 形状为 (batch_size, seq_len) 的位置编号. 连续批处理时 batch 中
+              各请求位置不同, 需要显式传入; 为 None 时使用 prev_pos 开始的连续位置.
+        """
         if self.model_type == "llava":
             logits = self.model.forward(input_ids, prev_pos, self.atten_info, image_tensor)
         else:
-            logits = self.model.forward(input_ids, prev_pos, self.atten_info)            
+            logits = self.model.forward(input_ids, prev_pos, self.atten_info, position_ids=position_ids)
         
         return logits
\ No newline at end of file
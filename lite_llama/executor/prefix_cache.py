@@ -0,0 +1,234 @@
+import heapq, logging
+import torch
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class RadixNode:
+    def __init__(self, key: Tuple[int, ...] = (), value: Optional[torch.Tensor] = None, parent=None):
+        self.children: Dict[Tuple[int, ...], "RadixNode"] = {} # 以子节点第一个 block 的 token 作为键
+        self.key = key      # 该节点对应的 token 序列, 长度为 block_size 的整数倍
+        self.value = value  # 这些 token 所在的 kv cache block 索引 (主机端)
+        self.parent = parent
+        self.last_access = 0
+
+    def __lt__(self, other):
+        return self.last_access < other.last_access
+
+class RadixPrefixCache:
+    """
+    基于基数树 (radix tree) 的前缀缓存, 树的边是 token id 序列, 节点保存这些 token 对应的 kv cache block。
+
+    缓存以 block 为粒度, 只缓存完整的 block, 因此命中的前缀长度总是 block_size 的整数倍。引用计数复用
+    KVCacheMemoryManager 的 add_ref / release_ref: 树本身对缓存的每个 block 持有一个引用, 命中前缀的请求
+    再各自持有一个引用。引用计数为 1 (只被树引用) 的叶子节点可以被淘汰, 按最近最少使用 (LRU) 顺序淘汰。
+
+    传入 remote_tier (RemoteKVTier) 时, 淘汰的 block 先写入远端共享存储; 本地未命中的部分再到远端查找,
+    命中的 block 拉回后插入树中, 多个副本之间共享已经 prefill 的前缀。
+    """
+    def __init__(self, kv_mem_manager, remote_tier=None):
+        self.kv_mem_manager = kv_mem_manager
+        self.remote_tier = remote_tier
+        self.block_size = kv_mem_manager.block_size
+        self.root = RadixNode()
+        self.num_cached_blocks = 0
+        self._clock = 0
+
+        # 命中率统计
+        self.num_query_tokens = 0
+        self.num_hit_tokens = 0
+        self.num_remote_hit_tokens = 0
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _common_blocks(self, key: Tuple[int, ...], token_ids: List[int], start: int) -> int:
+        """key 与 token_ids[start:] 的公共前缀长度, 以完整 block 计"""
+        bs = self.block_size
+        num_blocks = min(len(key), len(token_ids) - start) // bs
+        for i in range(num_blocks):
+            if tuple(token_ids[start + i * bs: start + (i + 1) * bs]) != key[i * bs: (i + 1) * bs]:
+                return i
+        return num_blocks
+
+    def _split(self, node: RadixNode, num_blocks: int) -> RadixNode:
+        """把 node 在第 num_blocks 个 block 处拆分, 返回新的前半部分节点"""
+        split_len = num_blocks * self.block_size
+        new_node = RadixNode(node.key[:split_len], node.value[:num_blocks], node.parent)
+        new_node.last_access = node.last_access
+        new_node.children[node.key[split_len: split_len + self.block_size]] = node
+        node.parent.children[node.key[:self.block_size]] = new_node
+
+        node.parent = new_node
+        node.key = node.key[split_len:]
+        node.value = node.value[num_blocks:]
+        return new_node
+
+    @torch.no_grad()
+    def match_prefix(self, token_ids: List[int], max_tokens: Optional[int] = None) -> Tuple[torch.Tensor, int]:
+        """
+        查找 token_ids 在缓存中的最长前缀, 命中的 block 会增加一次引用, 由调用方在用完后 release_ref。
+
+        参数:
+            token_ids (List[int]): 请求的 token 序列。
+            max_tokens (int, optional): 最多复用的 token 数, prefill 至少需要保留一个 token 计算 logits。
+        返回:
+            Tuple[torch.Tensor, int]: 命中的 block 索引 (主机端) 和命中的 token 数。
+        """
+        limit = len(token_ids) if max_tokens is None else min(len(token_ids), max_tokens)
+        limit = limit // self.block_size * self.block_size
+        token_ids = token_ids[:limit]
+
+        matched = []
+        node, pos = self.root, 0
+        timestamp = self._tick()
+        while pos < limit:
+            child = node.children.get(tuple(token_ids[pos: pos + self.block_size]))
+            if child is None:
+                break
+            num_blocks = self._common_blocks(child.key, token_ids, pos)
+            child.last_access = timestamp
+            matched.append(child.value[:num_blocks])
+            pos += num_blocks * self.block_size
+            if num_blocks * self.block_size < len(child.key):
+                break
+            node = child
+
+        block_index = torch.empty(0, dtype=torch.long)
+        if matched:
+            block_index = torch.cat(matched)
+            self.kv_mem_manager.add_ref(block_index)
+        num_local_tokens = pos
+        if self.remote_tier is not None and pos < limit:
+            block_index, pos = self._fetch_remote(token_ids, block_index, pos)
+
+        self.num_query_tokens += len(token_ids)
+        self.num_hit_tokens += pos
+        self.num_remote_hit_tokens += pos - num_local_tokens
+        return block_index, pos
+
+    def _fetch_remote(self, token_ids: List[int], block_index: torch.Tensor, pos: int) -> Tuple[torch.Tensor, int]:
+        """从远端拉回本地命中之后连续命中的 block, 插入树中并返回调用方持有引用的完整前缀"""
+        start_block = pos // self.block_size
+        payloads = self.remote_tier.fetch(token_ids, start_block, len(token_ids) // self.block_size - start_block)
+        if not payloads:
+            return block_index, pos
+        if self.kv_mem_manager.can_use_num_blocks < len(payloads):
+            # 已命中的 block 由调用方持有引用, 不会在这里被淘汰
+            self.evict(len(payloads) - self.kv_mem_manager.can_use_num_blocks)
+        remote_index = self.remote_tier.load(payloads)
+        if remote_index is None:
+            return block_index, pos
+
+        block_index = torch.cat([block_index, remote_index])
+        pos += remote_index.numel() * self.block_size
+        self.insert(token_ids[:pos], block_index) # 树为拉回的 block 增加一次引用, 分配时的引用交给调用方
+        return block_index, pos
+
+    def _node_tokens(self, node: RadixNode) -> List[int]:
+        """从根到 node 的完整 token 序列"""
+        keys = []
+        while node is not self.root:
+            keys.append(node.key)
+            node = node.parent
+        return [token for key in reversed(keys) for token in key]
+
+    @torch.no_grad()
+    def insert(self, token_ids: List[int], block_index: torch.Tensor) -> int:
+        """
+        把序列已经写入 kv cache 的 token 及其 block 加入缓存, 树对新缓存的 block 增加一次引用。
+        已经在缓存中的部分保持不变, 调用方持有的重复 block 随调用方 release_ref 释放。
+
+        返回:
+            int: 新缓存的 token 数。
+        """
+        num_blocks = min(len(token_ids) // self.block_size, block_index.numel())
+        token_ids = token_ids[:num_blocks * self.block_size]
+
+        node, pos = self.root, 0
+        timestamp = self._tick()
+        while pos < len(token_ids):
+            child = node.children.get(tuple(token_ids[pos: pos + self.block_size]))
+            if child is None:
+                break
+            common = self._common_blocks(child.key, token_ids, pos)
+            if common * self.block_size < len(child.key):
+                child = self._split(child, common)
+            child.last_access = timestamp
+            node = child
+            pos += common * self.block_size
+
+        if pos == len(token_ids):
+            return 0
+
+        new_value = block_index[pos // self.block_size: num_blocks]
+        new_node = RadixNode(tuple(token_ids[pos:]), new_value, node)
+        new_node.last_access = timestamp
+        node.children[new_node.key[:self.block_size]] = new_node
+        self.kv_mem_manager.add_ref(new_value)
+        self.num_cached_blocks += new_value.numel()
+        return len(token_ids) - pos
+
+    def _is_evictable(self, node: RadixNode) -> bool:
+        if node is self.root or node.children:
+            return False
+        # 只被树引用的 block 才能释放, 正在被请求使用的前缀不能淘汰
+        return bool(torch.all(self.kv_mem_manager.allocator.ref_counts[node.value] == 1))
+
+    @torch.no_grad()
+    def evict(self, num_blocks: int) -> int:
+        """
+        按 LRU 顺序淘汰未被请求引用的叶子节点, 直到释放至少 num_blocks 个 block 或没有可淘汰的节点。
+
+        返回:
+            int: 实际释放的 block 数。
+        """
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if self._is_evictable(node):
+                leaves.append(node)
+        heapq.heapify(leaves)
+
+        num_evicted, evicted = 0, []
+        while leaves and num_evicted < num_blocks:
+            node = heapq.heappop(leaves)
+            evicted.append(node)
+            num_evicted += node.value.numel()
+            parent = node.parent
+            del parent.children[node.key[:self.block_size]]
+            if self._is_evictable(parent):
+                heapq.heappush(leaves, parent)
+
+        if self.remote_tier is not None and evicted:
+            # 释放前把所有淘汰的 block 一次排队写入远端 (后台线程上传), 之后本副本或其他副本可以拉回
+            sequences = []
+            for node in evicted:
+                tokens = self._node_tokens(node)
+                sequences.append((tokens, node.value, len(tokens) // self.block_size - node.value.numel()))
+            self.remote_tier.push_many(sequences)
+        for node in evicted:
+            self.kv_mem_manager.release_ref(node.value)
+
+        self.num_cached_blocks -= num_evicted
+        if num_evicted:
+            logger.debug(f"prefix cache evicted {num_evicted} blocks, {self.num_cached_blocks} blocks cached")
+        return num_evicted
+
+    @torch.no_grad()
+    def clear(self):
+        """释放树持有的全部引用"""
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            self.kv_mem_manager.release_ref(node.value)
+        self.root = RadixNode()
+        self.num_cached_blocks = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return 0.0 if self.num_query_tokens == 0 else self.num_hit_tokens / self.num_query_tokens
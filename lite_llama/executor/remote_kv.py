@@ -0,0 +1,434 @@
+# 远端共享 kv cache 层: prefix cache 淘汰的 block 序列化后写入外部的键值存储, 键为 token 哈希链,
+# 任意副本在本地前缀未命中时可以从存储中拉回, 跨副本复用已经 prefill 的前缀
+import hashlib, json, logging, queue, socket, socketserver, struct, threading, time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+from .mem_manager import KVCacheMemoryManager
+
+logger = logging.getLogger(__name__)
+
+
+class KVStore(ABC):
+    """
+    远端 kv 层使用的键值存储接口, 键和值都是 bytes。接口均为批量操作, 网络实现应把一批键合并为一次往返。
+    """
+    @abstractmethod
+    def put_many(self, items: Sequence[Tuple[bytes, bytes]]):
+        ...
+
+    @abstractmethod
+    def get_many(self, keys: Sequence[bytes], timeout: Optional[float] = None) -> List[Optional[bytes]]:
+        """返回与 keys 一一对应的值, 不存在的键为 None; 超过 timeout 秒未完成时抛出 TimeoutError"""
+
+    @abstractmethod
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        ...
+
+class InMemoryKVStore(KVStore):
+    """
+    进程内的键值存储, 超过 max_bytes 时按最近最少使用 (LRU) 顺序淘汰。既可以直接用于单进程测试,
+    也是 KVStoreServer 的后端。
+    """
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._data: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def put_many(self, items: Sequence[Tuple[bytes, bytes]]):
+        with self._lock:
+            for key, value in items:
+                old = self._data.pop(key, None)
+                if old is not None:
+                    self.num_bytes -= len(old)
+                self._data[key] = value
+                self.num_bytes += len(value)
+            while self.max_bytes is not None and self.num_bytes > self.max_bytes and self._data:
+                _, value = self._data.popitem(last=False)
+                self.num_bytes -= len(value)
+
+    def get_many(self, keys: Sequence[bytes], timeout: Optional[float] = None) -> List[Optional[bytes]]:
+        with self._lock:
+            values = []
+            for key in keys:
+                value = self._data.get(key)
+                if value is not None:
+                    self._data.move_to_end(key)
+                values.append(value)
+            return values
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        with self._lock:
+            return [key in self._data for key in keys]
+
+# TCP 协议: 每次调用是一个批量请求和一个响应, 一次往返。
+# 请求为 op (1 字节) | 键数 (uint32) | 每个键: key 长度 (uint32) | key [| value 长度 (uint64) | value (仅 op 为 b"P")]。
+# 响应: b"P" (写入) 为 1 字节确认; b"G" (读取) 为每个键的 int64 长度 (-1 表示不存在) 及其 value;
+# b"E" (是否存在) 为每个键 1 字节。
+_HEADER = struct.Struct("<cI")
+_KEY_LEN = struct.Struct("<I")
+_VALUE_LEN = struct.Struct("<Q")
+_GET_LEN = struct.Struct("<q")
+
+def _recv_exact(sock: socket.socket, num_bytes: int, deadline: Optional[float] = None) -> bytes:
+    """读取 num_bytes 个字节; 设置 deadline (time.monotonic() 的时刻) 时整个读取不超过该时刻"""
+    buf = bytearray()
+    while len(buf) < num_bytes:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("kv store request timed out")
+            sock.settimeout(remaining)
+        chunk = sock.recv(min(num_bytes - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError("kv store connection closed")
+        buf += chunk
+    return bytes(buf)
+
+def _encode_keys(keys: Sequence[bytes]) -> List[bytes]:
+    return [_KEY_LEN.pack(len(key)) + key for key in keys]
+
+class _KVStoreHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        store: InMemoryKVStore = self.server.store
+        sock = self.request
+        try:
+            while True:
+                op, count = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+                keys, values = [], []
+                for _ in range(count):
+                    (key_len,) = _KEY_LEN.unpack(_recv_exact(sock, _KEY_LEN.size))
+                    keys.append(_recv_exact(sock, key_len))
+                    if op == b"P":
+                        (value_len,) = _VALUE_LEN.unpack(_recv_exact(sock, _VALUE_LEN.size))
+                        values.append(_recv_exact(sock, value_len))
+                if op == b"P":
+                    store.put_many(list(zip(keys, values)))
+                    sock.sendall(b"\x01")
+                elif op == b"G":
+                    response = []
+                    for value in store.get_many(keys):
+                        response.append(_GET_LEN.pack(-1) if value is None else _GET_LEN.pack(len(value)) + value)
+                    sock.sendall(b"".join(response))
+                elif op == b"E":
+                    sock.sendall(bytes(store.contains_many(keys)))
+                else:
+                    logger.warning(f"kv store received unknown op {op!r}, closing connection")
+                    return
+        except OSError: # 客户端断开
+            return
+
+class KVStoreServer(socketserver.ThreadingTCPServer):
+    """
+    本地替身服务: 在后台线程中通过 TCP 提供 InMemoryKVStore, 用于在没有外部键值服务时测试和部署多副本共享。
+    port 为 0 时由系统分配端口, 实际地址见 address。
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, store: Optional[InMemoryKVStore] = None):
+        super().__init__((host, port), _KVStoreHandler)
+        self.store = InMemoryKVStore() if store is None else store
+        self._thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server_address[:2]
+
+    def start(self) -> "KVStoreServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class TCPKVStore(KVStore):
+    """
+    KVStoreServer 的客户端。每个线程复用自己的长连接 (调度器线程的读取不会排在后台写入之后),
+    出错或超时时断开, 下次调用时重连。
+    """
+    def __init__(self, host: str, port: int, timeout: float = 5.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._socks = []
+        self._lock = threading.Lock()
+
+    def _connect(self, deadline: Optional[float]) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            timeout = self.timeout if deadline is None else max(deadline - time.monotonic(), 1e-3)
+            sock = socket.create_connection(self.address, timeout=timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.sock = sock
+            with self._lock:
+                self._socks.append(sock)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            self._local.sock = None
+            with self._lock:
+                self._socks.remove(sock)
+            sock.close()
+
+    def close(self):
+        """关闭所有线程的连接"""
+        with self._lock:
+            socks, self._socks = self._socks, []
+        for sock in socks:
+            sock.close()
+        self._local = threading.local()
+
+    def _call(self, request: bytes, read_response, timeout: Optional[float] = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            sock = self._connect(deadline)
+            sock.sendall(request)
+            return read_response(sock, deadline)
+        except OSError:
+            self._disconnect() # 连接状态未知 (如超时后响应仍在路上), 不能复用
+            raise
+
+    def put_many(self, items: Sequence[Tuple[bytes, bytes]]):
+        if not items:
+            return
+        request = [_HEADER.pack(b"P", len(items))]
+        for key, value in items:
+            request += [_KEY_LEN.pack(len(key)), key, _VALUE_LEN.pack(len(value)), value]
+        self._call(b"".join(request), lambda sock, deadline: _recv_exact(sock, 1, deadline))
+
+    def get_many(self, keys: Sequence[bytes], timeout: Optional[float] = None) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        def read_values(sock, deadline):
+            values = []
+            for _ in keys:
+                (value_len,) = _GET_LEN.unpack(_recv_exact(sock, _GET_LEN.size, deadline))
+                values.append(None if value_len < 0 else _recv_exact(sock, value_len, deadline))
+            return values
+        request = b"".join([_HEADER.pack(b"G", len(keys))] + _encode_keys(keys))
+        return self._call(request, read_values, timeout)
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        if not keys:
+            return []
+        request = b"".join([_HEADER.pack(b"E", len(keys))] + _encode_keys(keys))
+        response = self._call(request, lambda sock, deadline: _recv_exact(sock, len(keys), deadline))
+        return [bool(exists) for exists in response]
+
+class RemoteKVTier:
+    """
+    kv_mem_manager 之后的远端 kv 层: 以 block 为单位把 kv (及量化缩放因子) 序列化后写入 KVStore, 按需拉回到新分配的
+    block。第 i 个 block 的键是 token 哈希链 h_i = sha256(h_{i-1} || 第 i 个 block 的 token), h_{-1} 由模型标识和
+    kv cache 布局决定, 因此同一个键总是对应同一段完整前缀, 不同模型或布局的副本不会误用彼此的 kv。
+
+    写入不在调度器的路径上: push 只把 block 异步拷贝到主机端并放入有界队列, 由后台线程一次批量写入,
+    队列已满时丢弃。读取是一次批量请求, 最多 max_fetch_blocks 个 block、不超过 fetch_timeout 秒,
+    慢的存储不会拖住一步 decode。远端存储只是缓存: 读写失败或超时时记录警告并按未命中处理, 不影响推理。
+    """
+    def __init__(
+        self, kv_mem_manager: KVCacheMemoryManager, store: KVStore, namespace: str,
+        fetch_timeout: float = 0.1, max_fetch_blocks: int = 256, max_pending_pushes: int = 64,
+    ):
+        self.kv_mem_manager = kv_mem_manager
+        self.store = store
+        self.block_size = kv_mem_manager.block_size
+        self.fetch_timeout = fetch_timeout
+        self.max_fetch_blocks = max_fetch_blocks
+
+        layout = {
+            "namespace": namespace,
+            "num_layers": kv_mem_manager.num_layers,
+            "num_kv_heads": kv_mem_manager.num_kv_heads,
+            "head_dim": kv_mem_manager.head_dim,
+            "dtype": str(kv_mem_manager.gpu_kv_buffer[0].dtype),
+            "kv_cache_dtype": kv_mem_manager.kv_cache_dtype,
+            "block_size": self.block_size,
+        }
+        self._root_hash = hashlib.sha256(json.dumps(layout, sort_keys=True).encode("utf-8")).digest()
+        # 每个 block 序列化后依次为各层 kv 和各层缩放因子的字节
+        self._block_nbytes = [buffer[0].numel() * buffer.element_size() for buffer in self._block_buffers()]
+        self._pin_memory = torch.device(kv_mem_manager.device).type == "cuda"
+        # 最近写入或拉回的键, 再次淘汰时不必拷贝和上传
+        self._known_keys: "OrderedDict[bytes, None]" = OrderedDict()
+        self._max_known_keys = 1 << 16
+        self._keys_lock = threading.Lock() # 后台线程写入失败时会移除键
+
+        self.num_pushed_blocks = 0
+        self.num_fetched_blocks = 0
+        self.num_dropped_blocks = 0
+        self._push_queue = queue.Queue(maxsize=max_pending_pushes)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @classmethod
+    def from_address(cls, kv_mem_manager: KVCacheMemoryManager, address: str, namespace: str, **kwargs) -> "RemoteKVTier":
+        """连接 "host:port" 上的 KVStoreServer (或兼容协议的服务)"""
+        host, port = address.rsplit(":", 1)
+        return cls(kv_mem_manager, TCPKVStore(host, int(port)), namespace, **kwargs)
+
+    def _block_buffers(self) -> List[torch.Tensor]:
+        manager = self.kv_mem_manager
+        buffers = manager.gpu_kv_buffer + (manager.gpu_kv_scale or [])
+        return [buffer.view(manager.gpu_num_blocks, self.block_size, *buffer.shape[1:]) for buffer in buffers]
+
+    def block_hashes(self, token_ids: List[int], num_blocks: int) -> List[bytes]:
+        """token_ids 前 num_blocks 个完整 block 的哈希链"""
+        hashes, prev = [], self._root_hash
+        for i in range(num_blocks):
+            block = token_ids[i * self.block_size: (i + 1) * self.block_size]
+            prev = hashlib.sha256(prev + struct.pack(f"<{len(block)}q", *block)).digest()
+            hashes.append(prev)
+        return hashes
+
+    def _remember(self, keys: List[bytes]):
+        with self._keys_lock:
+            for key in keys:
+                self._known_keys[key] = None
+                self._known_keys.move_to_end(key)
+            while len(self._known_keys) > self._max_known_keys:
+                self._known_keys.popitem(last=False)
+
+    def _forget(self, keys: List[bytes]):
+        with self._keys_lock:
+            for key in keys:
+                self._known_keys.pop(key, None)
+
+    def push(self, token_ids: List[int], block_index: torch.Tensor, start_block: int = 0) -> int:
+        """把前缀 token_ids 中从第 start_block 个 block 开始、位于 block_index 的 kv block 排队写入远端"""
+        return self.push_many([(token_ids, block_index, start_block)])
+
+    @torch.no_grad()
+    def push_many(self, sequences: List[Tuple[List[int], torch.Tensor, int]]) -> int:
+        """
+        把多段前缀的 kv block 一起排队写入远端, 已知存在的键跳过。所有 block 合并为一次设备到主机的异步拷贝,
+        调用返回后 block 即可释放, 序列化和网络写入由后台线程完成。
+
+        参数:
+            sequences: (token_ids, block_index, start_block) 列表, block_index 对应前缀中从第 start_block 个开始的 block。
+        返回:
+            int: 排队写入的 block 数。
+        """
+        keys, blocks = [], []
+        for token_ids, block_index, start_block in sequences:
+            num_blocks = min(block_index.numel(), len(token_ids) // self.block_size - start_block)
+            if num_blocks <= 0:
+                continue
+            host_index = self.kv_mem_manager._to_host(block_index).tolist()
+            with self._keys_lock:
+                for i, key in enumerate(self.block_hashes(token_ids, start_block + num_blocks)[start_block:]):
+                    if key not in self._known_keys:
+                        keys.append(key)
+                        blocks.append(host_index[i])
+        if not keys:
+            return 0
+
+        device_index = self.kv_mem_manager._to_device(torch.tensor(blocks, dtype=torch.long))
+        rows = torch.cat([
+            buffer[device_index].view(torch.uint8).reshape(len(keys), -1) for buffer in self._block_buffers()
+        ], dim=1)
+        event = None
+        if self._pin_memory:
+            host_rows = torch.empty(rows.shape, dtype=torch.uint8, pin_memory=True)
+            host_rows.copy_(rows, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            rows = host_rows
+        try:
+            self._push_queue.put_nowait((keys, rows, event))
+        except queue.Full:
+            self.num_dropped_blocks += len(keys)
+            logger.debug(f"remote kv push queue is full, dropped {len(keys)} blocks")
+            return 0
+        self._remember(keys)
+        return len(keys)
+
+    def _write_loop(self):
+        while True:
+            item = self._push_queue.get()
+            try:
+                if item is None:
+                    return
+                keys, rows, event = item
+                if event is not None:
+                    event.synchronize()
+                exists = self.store.contains_many(keys)
+                items = [(key, rows[i].numpy().tobytes()) for i, key in enumerate(keys) if not exists[i]]
+                self.store.put_many(items)
+                self.num_pushed_blocks += len(items)
+            except OSError as e:
+                logger.warning(f"failed to push kv blocks to remote store: {e}")
+                self._forget(keys)
+            finally:
+                self._push_queue.task_done()
+
+    def flush(self):
+        """等待已排队的写入完成"""
+        self._push_queue.join()
+
+    def close(self):
+        """写完已排队的 block 后停止后台线程"""
+        if self._writer.is_alive():
+            self._push_queue.put(None)
+            self._writer.join()
+
+    def fetch(self, token_ids: List[int], start_block: int, max_blocks: int) -> List[bytes]:
+        """
+        查询前缀 token_ids 从第 start_block 个 block 开始连续命中的远端 block, 最多
+        min(max_blocks, max_fetch_blocks) 个, 一次批量读取。
+
+        返回:
+            List[bytes]: 命中的 block 的序列化数据, 交给 load 写入 kv cache; 超时或出错时为空。
+        """
+        max_blocks = min(max_blocks, self.max_fetch_blocks)
+        if max_blocks <= 0:
+            return []
+        keys = self.block_hashes(token_ids, start_block + max_blocks)[start_block:]
+        try:
+            values = self.store.get_many(keys, timeout=self.fetch_timeout)
+        except OSError as e:
+            logger.warning(f"failed to fetch kv blocks from remote store: {e}")
+            return []
+        payloads = []
+        for value in values:
+            if value is None or len(value) != sum(self._block_nbytes):
+                break
+            payloads.append(value)
+        self._remember(keys[:len(payloads)])
+        return payloads
+
+    @torch.no_grad()
+    def load(self, payloads: List[bytes]) -> Optional[torch.Tensor]:
+        """
+        分配 block 并写入 fetch 拉回的 kv。
+
+        返回:
+            torch.Tensor | None: 持有一次引用的 block 索引 (主机端), 空闲 block 不足时返回 None。
+        """
+        block_index = self.kv_mem_manager.alloc_blocks(len(payloads), device="cpu")
+        if block_index is None:
+            return None
+        rows = torch.frombuffer(bytearray(b"".join(payloads)), dtype=torch.uint8).view(len(payloads), -1)
+        device_index = self.kv_mem_manager._to_device(block_index)
+        offset = 0
+        for buffer, nbytes in zip(self._block_buffers(), self._block_nbytes):
+            data = rows[:, offset: offset + nbytes].contiguous().view(buffer.dtype).view(len(payloads), *buffer.shape[1:])
+            buffer[device_index] = data.to(buffer.device)
+            offset += nbytes
+        self.num_fetched_blocks += len(payloads)
+        return block_index
@@ -0,0 +1,188 @@
+import torch
+from typing import Optional, Sequence, Union
+
+from ..kernels.softmax_sampling import fused_top_p_sampling
+from ..kernels.logprobs import fused_logprobs_topk, torch_logprobs_topk
+
+Params = Union[torch.Tensor, Sequence]
+
+def _to_host(values: Optional[Params], batch_size: int, default, dtype) -> torch.Tensor:
+    if values is None:
+        return torch.full((batch_size,), default, dtype=dtype)
+    return torch.as_tensor(values, dtype=dtype, device="cpu")
+
+def _filter_sorted_probs(
+    sorted_probs: torch.Tensor, top_ks: torch.Tensor, top_ps: torch.Tensor, min_ps: torch.Tensor
+) -> torch.Tensor:
+    """
+    在按概率降序排列的候选 token 上依次应用 top_k / top_p / min_p 截断, 被截掉的位置概率置 0 (不重新归一化)。
+    """
+    ranks = torch.arange(sorted_probs.shape[-1], device=sorted_probs.device)
+    mask = (top_ks[:, None] > 0) & (ranks[None, :] >= top_ks[:, None])
+    # 累积概率 (不含当前 token) 已超过 top_p 的 token 不在 nucleus 内, 第一个 token 总会保留
+    mask |= (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > top_ps[:, None]
+    mask |= sorted_probs < min_ps[:, None] * sorted_probs[:, :1]
+    return sorted_probs.masked_fill(mask, 0.0)
+
+def _exponential_noise(shape, seeds: torch.Tensor, device) -> torch.Tensor:
+    """生成 Exp(1) 噪声, seeds[i] >= 0 的行使用由该种子确定的随机数, 与 batch 中其他行无关"""
+    noise = torch.empty(shape, dtype=torch.float32, device=device).exponential_()
+    for row in torch.nonzero(seeds >= 0).view(-1).tolist():
+        generator = torch.Generator(device=device).manual_seed(int(seeds[row]))
+        noise[row].exponential_(generator=generator)
+    return noise
+
+@torch.no_grad()
+def sample(
+    logits: torch.Tensor,
+    temperatures: Params,
+    top_ks: Optional[Params] = None,
+    top_ps: Optional[Params] = None,
+    min_ps: Optional[Params] = None,
+    seeds: Optional[Params] = None,
+    num_candidates: int = 1024,
+) -> torch.Tensor:
+    """
+    批量采样下一个 token, batch 中每一行使用各自的采样参数。
+
+    - temperature <= 0 的行直接取 argmax, 不计算 softmax;
+    - top_p 截断不对整个词表排序: 先用 topk 取出概率最大的 num_candidates 个候选 (top_k 更大时取 top_k 个),
+      在候选上完成 top_k / top_p / min_p 截断; 只有 nucleus 在候选内没有闭合的行才回退到全词表排序;
+    - 不做任何截断的行直接在整个词表上采样;
+    - 采样使用 argmax(p / q), q ~ Exp(1), 与按 p 归一化后的多项式采样等价, 不需要归一化;
+    - 在 GPU 上, 没有 top_k 的行交给融合的 fused_top_p_sampling kernel, logits 只读取一次, 阈值在片上的候选中查找。
+
+    采样参数应位于主机端 (列表或 cpu 张量), 根据它们对行分组时不需要与设备同步。
+
+    参数:
+        logits (torch.Tensor): 形状为 [batch_size, vocab_size]。
+        temperatures: 每行的温度。
+        top_ks: 每行保留概率最大的 k 个 token, <= 0 表示不限制。
+        top_ps: 每行的 nucleus 累积概率阈值, 1.0 表示不限制。
+        min_ps: 每行保留概率不小于 min_p * 最大概率的 token, 0 表示不限制。
+        seeds: 每行的随机种子, < 0 表示使用全局随机数发生器; 相同的种子和 logits 总是得到相同的 token。
+        num_candidates (int): top_p / min_p 截断时预先选取的候选 token 数。
+    返回:
+        torch.Tensor: 形状为 [batch_size] 的 token 索引。
+    """
+    batch_size, vocab_size = logits.shape
+    temperatures = _to_host(temperatures, batch_size, 1.0, torch.float32)
+    top_ks = _to_host(top_ks, batch_size, -1, torch.long)
+    top_ps = _to_host(top_ps, batch_size, 1.0, torch.float32)
+    min_ps = _to_host(min_ps, batch_size, 0.0, torch.float32)
+    seeds = _to_host(seeds, batch_size, -1, torch.long)
+
+    greedy = temperatures <= 0
+    if bool(greedy.all()):
+        return torch.argmax(logits, dim=-1)
+
+    next_tokens = torch.empty(batch_size, dtype=torch.long, device=logits.device)
+    if bool(greedy.any()):
+        greedy_rows = torch.nonzero(greedy).view(-1)
+        next_tokens[greedy_rows.to(logits.device)] = torch.argmax(logits[greedy_rows.to(logits.device)], dim=-1)
+
+    top_ks = torch.where(top_ks >= vocab_size, torch.zeros_like(top_ks), top_ks)
+    remaining = ~greedy
+    if logits.is_cuda:
+        # 没有 top_k 的行在 GPU 上使用融合 kernel, 不生成 [batch_size, vocab_size] 的 probs 和排序结果
+        fused = remaining & (top_ks <= 0)
+        if bool(fused.any()):
+            rows = torch.nonzero(fused).view(-1)
+            row_seeds = seeds[rows]
+            row_seeds = torch.where(row_seeds >= 0, row_seeds, torch.randint_like(row_seeds, 0, 2 ** 31 - 1))
+            to_device = lambda values: values.to(logits.device, non_blocking=True)
+            device_rows = to_device(rows)
+            next_tokens[device_rows] = fused_top_p_sampling(
+                logits, to_device(temperatures[rows]), to_device(top_ps[rows]), to_device(min_ps[rows]),
+                to_device(row_seeds), rows=device_rows,
+            )
+        remaining &= ~fused
+
+    no_filter = remaining & (top_ks <= 0) & (top_ps >= 1.0) & (min_ps <= 0.0)
+    filtered = remaining & ~no_filter
+
+    for rows_mask in (no_filter, filtered):
+        if not bool(rows_mask.any()):
+            continue
+        rows = torch.nonzero(rows_mask).view(-1)
+        device_rows = rows.to(logits.device, non_blocking=True)
+        probs = torch.softmax(logits[device_rows].float() / temperatures[rows].to(logits.device)[:, None], dim=-1)
+
+        if rows_mask is no_filter:
+            noise = _exponential_noise(probs.shape, seeds[rows], logits.device)
+            next_tokens[device_rows] = torch.argmax(probs / noise, dim=-1)
+            continue
+
+        row_top_ks = top_ks[rows].to(logits.device)
+        row_top_ps = top_ps[rows].to(logits.device)
+        row_min_ps = min_ps[rows].to(logits.device)
+
+        # 在候选 token 上截断, 只需部分选择 (topk), 不对整个词表排序
+        num_k = min(vocab_size, max(num_candidates, int(top_ks[rows].max())))
+        cand_probs, cand_idx = torch.topk(probs, num_k, dim=-1)
+        cand_probs = _filter_sorted_probs(cand_probs, row_top_ks, row_top_ps, row_min_ps)
+
+        if num_k < vocab_size:
+            # top_k 未生效且最后一个候选仍未被截掉, 说明 nucleus 可能延伸到候选之外, 这些行回退到全词表排序;
+            # 只有这里需要与设备同步一次, 概率分布很平坦时才会出现
+            open_rows = (row_top_ks <= 0) & (cand_probs[:, -1] > 0)
+            if bool(open_rows.any()):
+                open_idx = torch.nonzero(open_rows).view(-1)
+                full_probs, full_idx = torch.sort(probs[open_idx], dim=-1, descending=True)
+                full_probs = _filter_sorted_probs(full_probs, row_top_ks[open_idx], row_top_ps[open_idx], row_min_ps[open_idx])
+                noise = _exponential_noise(full_probs.shape, seeds[rows][open_idx.cpu()], logits.device)
+                full_tokens = torch.gather(full_idx, -1, torch.argmax(full_probs / noise, dim=-1, keepdim=True))
+                cand_probs[open_idx] = 0.0
+                cand_probs[open_idx, 0] = 1.0
+                cand_idx[open_idx, 0] = full_tokens.view(-1)
+
+        noise = _exponential_noise(cand_probs.shape, seeds[rows], logits.device)
+        sampled = torch.argmax(cand_probs / noise, dim=-1, keepdim=True)
+        next_tokens[device_rows] = torch.gather(cand_idx, -1, sampled).view(-1)
+
+    return next_tokens
+
+@torch.no_grad()
+def sampling_probs(
+    logits: torch.Tensor,
+    temperatures: Params,
+    top_ks: Optional[Params] = None,
+    top_ps: Optional[Params] = None,
+    min_ps: Optional[Params] = None,
+) -> torch.Tensor:
+    """
+    返回 sample 实际采样的分布: 按各行参数截断后重新归一化的概率, 贪心行为 argmax 的 one-hot。
+    需要完整分布的场景 (如投机解码的拒绝采样) 使用, 会对整个词表排序。
+
+    返回:
+        torch.Tensor: 形状为 [batch_size, vocab_size] 的 float32 概率。
+    """
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+    temperatures = _to_host(temperatures, batch_size, 1.0, torch.float32).to(device)
+    top_ks = _to_host(top_ks, batch_size, -1, torch.long).to(device)
+    top_ps = _to_host(top_ps, batch_size, 1.0, torch.float32).to(device)
+    min_ps = _to_host(min_ps, batch_size, 0.0, torch.float32).to(device)
+
+    greedy = temperatures <= 0
+    probs = torch.softmax(logits.float() / torch.where(greedy, 1.0, temperatures)[:, None], dim=-1)
+    sorted_probs, sorted_idx = torch.sort(probs, dim=-1, descending=True)
+    sorted_probs = _filter_sorted_probs(sorted_probs, top_ks, top_ps, min_ps)
+    probs = torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_probs)
+    probs.div_(probs.sum(dim=-1, keepdim=True))
+
+    one_hot = torch.zeros_like(probs).scatter_(-1, torch.argmax(logits, dim=-1, keepdim=True), 1.0)
+    return torch.where(greedy[:, None], one_hot, probs)
+
+@torch.no_grad()
+def logprobs_topk(logits: torch.Tensor, tokens: torch.Tensor, k: int = 0) -> torch.Tensor:
+    """
+    tokens 的对数概率 (未经 temperature 缩放的模型分布) 与每行对数概率最大的 k 个 token。
+    GPU 上使用融合 kernel, 只读取一次 logits; 格式见 fused_logprobs_topk。
+
+    返回:
+        torch.Tensor: 形状为 [batch_size, 1 + 2k] 的 float32 张量。
+    """
+    if logits.is_cuda:
+        return fused_logprobs_topk(logits, tokens, k)
+    return torch_logprobs_topk(logits, tokens, k)
@@ -0,0 +1,899 @@
+import torch, logging
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+from .prefix_cache import RadixPrefixCache
+from .mem_manager import HostKVCachePool
+from .sampler import sample, sampling_probs
+from .speculative import rejection_sample
+from .stop_checker import StopStringMatcher
+from .detokenizer import DecodeState, IncrementalDetokenizer
+from .grammar import TokenGuide
+
+logger = logging.getLogger(__name__)
+
+class RequestStatus(Enum):
+    WAITING = 0   # 在等待队列中, 尚未分配 kv cache
+    RUNNING = 1   # 已完成 prefill, 处于 decode 阶段
+    FINISHED = 2  # 生成结束, kv cache 已释放
+    SWAPPED = 3   # 被抢占, kv cache 已换出到主机端交换空间, 等待换入
+
+@dataclass
+class Request:
+    """单个生成请求的状态, 由 ContinuousBatchScheduler 维护"""
+    request_id: int
+    prompt_tokens: List[int]
+    max_gen_len: int
+    temperature: float = 0.6
+    top_p: float = 0.9
+    top_k: int = -1
+    min_p: float = 0.0
+    seed: Optional[int] = None # 设置后该请求的采样结果可复现, 与同一 batch 中的其他请求无关
+    n: int = 1 # 并行采样数, prompt 只 prefill 一次, 之后分叉为 n 个共享 prompt kv cache 的分支
+    stop_token_ids: Tuple[int, ...] = () # 除 eos 外生成后立即结束的 token
+    stop_matcher: Optional[StopStringMatcher] = None # 停止字符串的自动机, 在解码出的文本上增量匹配
+    guide: Optional[TokenGuide] = None # 约束解码的词表状态机, 采样前屏蔽当前状态不允许的 token
+    guide_state: int = 0
+    priority: int = 0 # 数值越小优先级越高, kv cache 不足时先抢占数值大的请求, 相同时先抢占后加入的请求
+
+    output_tokens: List[int] = field(default_factory=list)
+    status: RequestStatus = RequestStatus.WAITING
+    kv_index: Optional[torch.Tensor] = None # 该请求占用的 kv cache block 索引 (主机端), 按 chunk 增长, 不要求连续
+    swap_index: Optional[torch.Tensor] = None # 被换出时 kv cache 在交换空间中的 block 索引
+    num_evicted_tokens: int = 0 # 滑动窗口模式下已从 kv cache 中淘汰的 token 数, 之后 token 的 cache 位置依次前移
+    table_row: Optional[int] = None # 该请求在 block_tables 中的行号
+    num_cached_tokens: int = 0 # 最近一次 prefill 时命中 prefix cache 的 token 数
+    num_computed_tokens: int = 0 # 已写入 kv cache 的 token 数
+    num_draft_computed_tokens: int = 0 # 投机解码时已写入 draft 模型 kv cache 的 token 数
+    num_proposed_tokens: int = 0 # 投机解码累计提议的 token 数
+    num_accepted_tokens: int = 0 # 其中被目标模型接受的 token 数
+    branches: List["Request"] = field(default_factory=list) # 并行采样时从该请求分叉出的其余 n - 1 个分支
+    fork_table_rows: List[int] = field(default_factory=list) # 为尚未分叉的分支预留的 block_tables 行号
+    finish_reason: Optional[str] = None # "stop": 遇到 eos / 停止 token / 停止字符串; "length": 达到长度上限
+    stop_reason: Optional[Union[int, str]] = None # 结束时匹配到的停止 token 或停止字符串
+
+    # 调度器传入 tokenizer 时每步增量解码输出文本 (不含停止 token), 匹配到停止字符串时截断到停止字符串之前
+    output_text: str = ""
+    decode_state: Optional[DecodeState] = None
+    stop_state: int = 0 # stop_matcher 的状态
+
+    def __post_init__(self):
+        self.decode_state = DecodeState.from_prompt(self.prompt_tokens)
+
+    @property
+    def prompt_len(self) -> int:
+        return len(self.prompt_tokens)
+
+    @property
+    def seq_len(self) -> int:
+        """已写入或即将写入 kv cache 的 token 数目"""
+        return len(self.prompt_tokens) + len(self.output_tokens)
+
+    @property
+    def is_prefilling(self) -> bool:
+        """prompt (或被抢占前已生成的) token 还没有全部写入 kv cache, 需要继续分块 prefill"""
+        return self.num_computed_tokens < self.seq_len - 1 or not self.output_tokens
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status == RequestStatus.FINISHED
+
+    @property
+    def num_stable_chars(self) -> int:
+        """output_text 中可以安全输出的字符数, 末尾可能是停止字符串前缀的部分需要等后续 token 确定"""
+        if self.is_finished or self.stop_matcher is None:
+            return len(self.output_text)
+        return len(self.output_text) - self.stop_matcher.depth(self.stop_state)
+
+    @property
+    def samples(self) -> List["Request"]:
+        """并行采样的全部 n 个分支, 第一个是请求本身"""
+        return [self] + self.branches
+
+    @property
+    def acceptance_rate(self) -> float:
+        """投机解码中 draft token 的接受率"""
+        return 0.0 if self.num_proposed_tokens == 0 else self.num_accepted_tokens / self.num_proposed_tokens
+
+class ContinuousBatchScheduler:
+    """
+    迭代级 (iteration-level) 连续批处理调度器。
+
+    与静态批处理等待整个 batch 全部结束不同, 每次调用 step() 都会:
+        1. 为运行中的请求按需追加 kv cache (每次增长 kv_chunk_size 个 token), 空间不足时抢占最晚加入的请求;
+        2. 按先来先服务顺序接纳等待队列中的新请求 (受 max_batch_size 和可用 kv cache 限制);
+        3. 对尚未完成 prefill 的请求 prefill 下一个分块, 每步 prefill 的 token 总数不超过 prefill_chunk_size,
+           后续分块通过 kv cache 读取前面分块的 kv, 长 prompt 因此不会长时间阻塞 decode, 峰值激活显存也有上界;
+        4. 对已完成 prefill 的请求 decode 一个 token, 每个请求使用自己的 b_req_idx / b_seq_len / 位置编号;
+           decode token 与 prefill 分块打包为一个混合 batch, 只做一次前向;
+        5. 移除遇到 eos 或达到最大生成长度的请求, 并立即释放其 kv cache, 空出的位置在下一步即可被新请求使用。
+
+    请求的 kv cache 不再一次性预留 prompt_len + max_gen_len, 而是随 decode 分块增长, 因此不要求连续,
+    各请求占用的 kv cache block 依次记录在 block_tables 中。被抢占的请求回到等待队列队首, 之后重新 prefill
+    prompt 和已生成的 token (recompute)。
+
+    传入 prefix_cache 时, 新请求先复用缓存中最长的公共前缀, 只 prefill 未命中的后缀; 请求结束或被抢占时,
+    其已计算的 kv cache 加入 prefix_cache。kv cache 不足时先淘汰 prefix_cache 中未被使用的 block, 再抢占请求。
+
+    model_executor 只需提供 forward(input_ids, prev_pos, position_ids=...), atten_info 和 kv_mem_manager,
+    因此可以用桩模型 (stub model) 在 CPU 上测试。
+
+    传入 proposer (如 DraftModelProposer) 时使用投机解码: decode 请求先由 proposer 提议若干 token, 目标模型
+    把最新 token 和 draft token 作为一个分块一次验证, 按拒绝采样接受其中的前缀, 为被拒绝的 token 预留的
+    kv cache 随即回滚。
+
+    n > 1 的请求 (并行采样) 只 prefill 一次 prompt, 采样第一个 token 前分叉为 n 个分支: 分支通过引用计数共享
+    prompt 的完整 block, 只有 prompt 末尾未写满、之后会被各分支写入的 block 在分叉时复制 (copy-on-write),
+    之后各分支作为独立的请求 decode。
+
+    传入 tokenizer 时, 每步把所有产生了新 token 的请求合并为一次增量解码 (IncrementalDetokenizer), 维护各请求的
+    output_text。除 eos 外, 请求可以设置停止 token 和停止字符串 (需要 tokenizer); 停止字符串由 StopStringMatcher
+    在每步新解码出的文本上增量匹配, 请求在停止字符串出现的那一步就结束并释放 kv cache。
+
+    设置了 guide (由 GrammarCompiler 编译的 TokenGuide) 的请求只能生成匹配其正则表达式 / JSON schema 的文本:
+    采样前在设备上按各请求的状态屏蔽不允许的 token, 只有在接受状态才允许结束 token。这类请求不参与投机解码。
+
+    kv cache 不足时按 priority 选择被抢占的请求。传入 swap_space (HostKVCachePool) 时, 已完成 prefill 的被抢占
+    请求的 kv cache 换出到主机端交换空间 (swap), 之后显存空闲时优先于新请求换入并继续 decode; 交换空间不足或
+    请求仍在 prefill 时退化为释放 kv cache、之后重新计算 (recompute)。
+
+    设置 window_size 时使用 attention sink + 滑动窗口 (StreamingLLM): 每个请求的 kv cache 只保留前 sink_size 个
+    token 和最近的 token, 总数不超过 sink_size + window_size, 生成长度不再受 max_seq_len 限制 (prompt 也可以
+    超过 max_seq_len, 分块 prefill 时同样淘汰)。超出时按 block 淘汰 sink 之后最旧的 token (每次至少
+    min(kv_chunk_size, window_size // 4) 个, 摊薄开销), 淘汰的 block 立即归还 kv_mem_manager。模型看到的位置
+    编号是 token 在 cache 中的位置, 保留的 token 前移后其 k 按位移重新旋转 (model_executor.shift_kv_positions),
+    位置编号始终连续。sink 之后的 block 会被重新旋转, 因此 prefix cache 只复用和缓存 sink 部分, 且不支持投机解码
+    和并行采样 (n > 1)。
+    """
+    def __init__(
+        self,
+        model_executor,
+        eos_token_id: int,
+        max_batch_size: int = 16,
+        max_seq_len: int = 2048,
+        kv_chunk_size: int = 32,
+        prefill_chunk_size: Optional[int] = 512,
+        prefix_cache: Optional[RadixPrefixCache] = None,
+        device: str = "cuda",
+        proposer = None,
+        tokenizer = None,
+        swap_space: Optional[HostKVCachePool] = None,
+        sink_size: int = 4,
+        window_size: Optional[int] = None,
+    ):
+        self.model_executor = model_executor
+        self.kv_mem_manager = model_executor.kv_mem_manager
+        self.atten_info = model_executor.atten_info
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.kv_chunk_size = kv_chunk_size
+        self.prefill_chunk_size = prefill_chunk_size # 为 None 时整个 prompt 一次 prefill
+        self.block_size = self.kv_mem_manager.block_size
+        self.prefix_cache = prefix_cache
+        self.device = device
+        self.proposer = proposer
+        self.detokenizer = IncrementalDetokenizer(tokenizer) if tokenizer is not None else None
+        self._stop_matchers: Dict[Tuple[str, ...], StopStringMatcher] = {} # 相同的停止字符串共享自动机
+
+        self.swap_space = swap_space
+        self.sink_size = sink_size
+        self.window_size = window_size
+        # 每个请求最多占用的 kv cache 容量 (token 数)
+        self._kv_capacity = max_seq_len if window_size is None else sink_size + window_size
+        if window_size is not None:
+            if sink_size % self.block_size or window_size % self.block_size:
+                raise ValueError(f"sink_size and window_size must be multiples of block_size {self.block_size}")
+            if window_size < 2 * self.block_size:
+                raise ValueError(f"window_size must be at least 2 * block_size, got {window_size}")
+            if self._kv_capacity > max_seq_len:
+                raise ValueError(f"sink_size + window_size ({self._kv_capacity}) exceeds max_seq_len {max_seq_len}")
+            if proposer is not None:
+                raise ValueError("speculative decoding is not supported with a sliding window kv cache")
+        self.waiting: Deque[Request] = deque()
+        self.running: List[Request] = []
+        self.swapped: List[Request] = []
+        self._next_request_id = 0
+
+        # 每个运行中的请求占一行, 依次记录其占用的 kv cache block
+        max_blocks_per_seq = (max_seq_len + self.block_size - 1) // self.block_size
+        self.block_tables = torch.zeros((max_batch_size, max_blocks_per_seq), dtype=torch.int32, device=device)
+        self.free_table_rows = list(range(max_batch_size))
+
+        # 主机与设备之间的拷贝经过锁页内存并使用 non_blocking, 每步只在读回采样结果时同步一次;
+        # 投机解码的请求读回 (接受数, 下一个 token) 两个值, 因此缓冲区为 2 * max_batch_size
+        self._pin_memory = torch.device(device).type == "cuda"
+        self._token_buffer = torch.empty(2 * max_batch_size, dtype=torch.long, pin_memory=self._pin_memory)
+        self._copy_event = torch.cuda.Event() if self._pin_memory else None
+
+    def add_request(
+        self,
+        prompt_tokens: List[int],
+        max_gen_len: int,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        top_k: int = -1,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        n: int = 1,
+        stop_token_ids: Sequence[int] = (),
+        stop: Sequence[str] = (),
+        guide: Optional[TokenGuide] = None,
+        priority: int = 0,
+    ) -> Request:
+        """
+        添加一个生成请求。n > 1 时返回的请求在 prefill 后分叉, 全部 n 个结果见 Request.samples,
+        分支的 seed 依次为 seed + 1, ..., seed + n - 1。设置 seed 后投机解码的输出同样可复现, 但拒绝采样消耗的
+        随机数与逐 token 采样不同, 输出不一定与不投机时相同。
+        stop_token_ids 中的 token 与 eos 一样结束生成; 生成的文本中出现 stop 中的任一字符串时结束生成,
+        Request.output_text 截断到该字符串之前。guide 约束生成的 token 序列, 达到长度上限前一定以结束 token 结束。
+        kv cache 不足时先抢占 priority 数值大的请求。
+        """
+        if len(prompt_tokens) == 0:
+            raise ValueError("prompt_tokens must not be empty")
+        if max_gen_len < 1:
+            raise ValueError(f"max_gen_len must be positive, got {max_gen_len}")
+        if self.window_size is not None and n > 1:
+            raise ValueError("parallel sampling (n > 1) is not supported with a sliding window kv cache")
+        if self.window_size is None and len(prompt_tokens) >= self.max_seq_len:
+            raise ValueError(f"prompt length {len(prompt_tokens)} exceeds max_seq_len {self.max_seq_len}")
+        if not 0.0 < top_p <= 1.0:
+            raise ValueError(f"top_p must be in (0, 1], got {top_p}")
+        if not 0.0 <= min_p <= 1.0:
+            raise ValueError(f"min_p must be in [0, 1], got {min_p}")
+        if seed is not None and seed < 0:
+            raise ValueError(f"seed must be non-negative, got {seed}")
+        if not 1 <= n <= self.max_batch_size:
+            raise ValueError(f"n must be in [1, max_batch_size={self.max_batch_size}], got {n}")
+        if stop and self.detokenizer is None:
+            raise ValueError("stop strings need a tokenizer to decode the generated tokens")
+
+        request = Request(
+            self._next_request_id, list(prompt_tokens), max_gen_len, temperature, top_p, top_k, min_p, seed, n,
+            tuple(stop_token_ids), self._get_stop_matcher(stop), guide, priority=priority,
+        )
+        if self._kv_need_size(request) > self.kv_mem_manager.max_num_tokens:
+            raise ValueError(
+                f"request needs {self._kv_need_size(request)} kv cache tokens, "
+                f"but only {self.kv_mem_manager.max_num_tokens} tokens in total"
+            )
+        self._next_request_id += 1
+        self.waiting.append(request)
+        return request
+
+    def _get_stop_matcher(self, stop: Sequence[str]) -> Optional[StopStringMatcher]:
+        if not stop:
+            return None
+        key = tuple(stop)
+        if key not in self._stop_matchers:
+            self._stop_matchers[key] = StopStringMatcher(key)
+        return self._stop_matchers[key]
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0 or len(self.swapped) > 0
+
+    def _kv_need_size(self, request: Request) -> int:
+        """请求最多占用的 kv cache 容量 (token 数)"""
+        return min(request.prompt_len + request.max_gen_len, self._kv_capacity)
+
+    def _to_device(self, values, dtype) -> torch.Tensor:
+        """主机端的列表经锁页内存异步拷贝到设备, 不阻塞 cpu"""
+        return torch.tensor(values, dtype=dtype, pin_memory=self._pin_memory).to(self.device, non_blocking=True)
+
+    def _write_block_table(self, request: Request, start: int, blocks: torch.Tensor):
+        blocks = blocks.to(torch.int32)
+        if self._pin_memory:
+            blocks = blocks.pin_memory()
+        self.block_tables[request.table_row, start: start + blocks.numel()].copy_(blocks, non_blocking=True)
+
+    def _grow_kv(self, request: Request, need_size: int, evict: bool = True) -> bool:
+        """
+        保证请求的 kv cache 容量不小于前 need_size 个 token 所需 (滑动窗口淘汰的 token 不占用容量),
+        新增的 block 同步写入 block_tables。
+        """
+        need_size -= request.num_evicted_tokens
+        cur_blocks = 0 if request.kv_index is None else request.kv_index.numel()
+        # 请求持有主机端索引, 分配和释放都不需要和 GPU 同步
+        grow = lambda: self.kv_mem_manager.grow_kvcache(
+            request.kv_index, need_size, self.kv_chunk_size, max_size=self._kv_need_size(request), device="cpu"
+        )
+        kv_index = grow()
+        if kv_index is None and evict and self.prefix_cache is not None:
+            # 先淘汰 prefix cache 中没有被请求使用的 block, 仍然不够时再由调用方抢占
+            need_blocks = (need_size + self.block_size - 1) // self.block_size - cur_blocks
+            if self.prefix_cache.evict(need_blocks - self.kv_mem_manager.can_use_num_blocks) > 0:
+                kv_index = grow()
+        if kv_index is None:
+            return False
+
+        if kv_index.numel() > cur_blocks:
+            self._write_block_table(request, cur_blocks, kv_index[cur_blocks:])
+        request.kv_index = kv_index
+        return True
+
+    def _match_prefix(self, request: Request):
+        """复用 prefix cache 中与请求最长的公共前缀"""
+        request.num_cached_tokens = 0
+        request.num_computed_tokens = 0
+        request.num_evicted_tokens = 0
+        request.num_draft_computed_tokens = 0 # draft 模型总是从头补齐, 命中的前缀可能没有 draft 的 kv
+        if self.prefix_cache is None:
+            return
+
+        tokens = request.prompt_tokens + request.output_tokens
+        # 至少保留最后一个 token 做 prefill, 用于计算下一个 token 的 logits
+        max_tokens = len(tokens) - 1
+        if self.window_size is not None:
+            max_tokens = min(max_tokens, self.sink_size) # sink 之后的 block 会被重新旋转, 不能与其他请求共享
+        block_index, num_cached_tokens = self.prefix_cache.match_prefix(tokens, max_tokens=max_tokens)
+        if num_cached_tokens > 0:
+            request.kv_index = block_index
+            request.num_cached_tokens = num_cached_tokens
+            request.num_computed_tokens = num_cached_tokens
+            self._write_block_table(request, 0, block_index)
+
+    def _free_request(self, request: Request):
+        if request.kv_index is not None:
+            if self.prefix_cache is not None and request.status != RequestStatus.WAITING:
+                # 已经写入 kv cache 的 token 加入 prefix cache 供后续请求复用
+                tokens = request.prompt_tokens + request.output_tokens
+                num_tokens = request.num_computed_tokens
+                if self.window_size is not None:
+                    num_tokens = min(num_tokens, self.sink_size)
+                self.prefix_cache.insert(tokens[:num_tokens], request.kv_index)
+            self.kv_mem_manager.release_ref(request.kv_index) # 立即归还 kv cache
+            request.kv_index = None
+            request.num_computed_tokens = 0
+        if request.table_row is not None:
+            self.free_table_rows.append(request.table_row)
+            request.table_row = None
+        self.free_table_rows.extend(request.fork_table_rows)
+        request.fork_table_rows = []
+
+    def _preempt(self, request: Request):
+        """抢占请求: 优先把 kv cache 换出到交换空间, 否则释放全部 kv cache 并放回等待队列队首, 重新调度时 recompute"""
+        if self._swap_out(request):
+            return
+        logger.warning(f"kv cache is not enough, preempt request {request.request_id}")
+        self._free_request(request)
+        request.status = RequestStatus.WAITING
+        self.waiting.appendleft(request)
+
+    def _swap_out(self, request: Request) -> bool:
+        """把已完成 prefill 的请求已计算的 kv block 换出到交换空间并释放显存, 交换空间不足时返回 False"""
+        if self.swap_space is None or request.is_prefilling:
+            return False
+        self._slide_window(request, request.seq_len) # 先淘汰, 换入后 decode 下一个 token 不会超出容量
+        num_computed_tokens = request.num_computed_tokens
+        num_cached = num_computed_tokens - request.num_evicted_tokens
+        num_blocks = (num_cached + self.block_size - 1) // self.block_size
+        swap_index = self.swap_space.swap_out(request.kv_index[:num_blocks])
+        if swap_index is None:
+            return False
+
+        logger.warning(f"kv cache is not enough, swap out request {request.request_id}")
+        self._free_request(request)
+        request.swap_index = swap_index
+        request.num_computed_tokens = num_computed_tokens
+        request.num_draft_computed_tokens = 0 # 只换出目标模型的 kv, draft 模型换入后从头补齐
+        request.status = RequestStatus.SWAPPED
+        self.swapped.append(request)
+        return True
+
+    def _swap_in_requests(self) -> List[Request]:
+        """
+        按优先级换入被换出的请求: 分配新的 block 并把 kv 从交换空间拷回, 只使用空闲的 kv cache (可淘汰 prefix cache),
+        不抢占运行中的请求。
+
+        返回:
+            List[Request]: 换入后本步即可 decode 的请求。
+        """
+        swapped_in = []
+        for request in sorted(self.swapped, key=lambda r: (r.priority, r.request_id)):
+            if not self.free_table_rows:
+                break
+            request.table_row = self.free_table_rows.pop()
+            if not self._grow_kv(request, request.seq_len):
+                self.free_table_rows.append(request.table_row)
+                request.table_row = None
+                break
+            self.swap_space.swap_in(request.swap_index, request.kv_index[:request.swap_index.numel()])
+            request.swap_index = None
+            request.status = RequestStatus.RUNNING
+            self.swapped.remove(request)
+            self.running.append(request)
+            swapped_in.append(request)
+        return swapped_in
+
+    def _limit_chunk(self, request: Request, chunk_len: int) -> int:
+        """滑动窗口模式下限制 prefill 分块长度: 淘汰 sink 之后的全部完整 block 后, 仍能容纳该分块和下一个生成的 token"""
+        if self.window_size is None:
+            return chunk_len
+        num_cached = request.num_computed_tokens - request.num_evicted_tokens
+        num_evictable = max(num_cached - self.sink_size, 0) // self.block_size * self.block_size
+        return min(chunk_len, self._kv_capacity - (num_cached - num_evictable) - 1)
+
+    def _slide_window(self, request: Request, need_size: int):
+        """
+        滑动窗口模式下, 前 need_size 个 token 超出 kv cache 容量时淘汰 sink 之后最旧的 block: 淘汰的 block 归还
+        kv_mem_manager, 之后的 block 在 block_tables 中前移, 其中 token 的 k 按前移的距离重新旋转。
+        每次至少淘汰 min(kv_chunk_size, window_size // 4) 个 token, 重新旋转的开销由之后的多个 token 分摊。
+        """
+        if self.window_size is None:
+            return
+        overflow = need_size - request.num_evicted_tokens - self._kv_capacity
+        if overflow <= 0:
+            return
+        num_cached = request.num_computed_tokens - request.num_evicted_tokens
+        num_evict = max(overflow, min(self.kv_chunk_size, self.window_size // 4))
+        num_blocks = min(
+            (num_evict + self.block_size - 1) // self.block_size, (num_cached - self.sink_size) // self.block_size
+        )
+        num_evict = num_blocks * self.block_size
+        sink_blocks = self.sink_size // self.block_size
+
+        request.kv_index = self.kv_mem_manager.evict_kvcache(request.kv_index, sink_blocks, num_blocks)
+        self._write_block_table(request, sink_blocks, request.kv_index[sink_blocks:])
+        # 保留的窗口 token 在 cache 中的位置前移 num_evict 个
+        slots = self.kv_mem_manager.get_token_slots(request.kv_index, num_cached - num_evict, self.sink_size)
+        self.model_executor.shift_kv_positions(slots, -num_evict)
+        request.num_evicted_tokens += num_evict
+
+    def _prefill_need_size(self, request: Request, chunk_len: int) -> int:
+        need_size = request.num_computed_tokens + chunk_len
+        # 最后一个分块同时预留下一个生成 token 的位置, 避免刚完成 prefill 就被抢占
+        return need_size + 1 if need_size == request.seq_len else need_size
+
+    def _schedule_running(self, budget: int):
+        """
+        为运行中的请求安排本步的工作并预留 kv cache, 优先级高、先加入的请求优先, 空间不足时抢占优先级最低的请求中
+        最晚加入的一个。
+
+        返回:
+            prefill 分块列表 [(request, chunk_len)], decode 请求列表, 剩余的 prefill token 预算。
+        """
+        pending = sorted(self.running, key=lambda r: r.priority) # 稳定排序, 相同优先级保持加入顺序
+        prefill_chunks, decode_requests = [], []
+        while pending:
+            request = pending.pop(0)
+            if request.is_prefilling:
+                chunk_len = min(request.seq_len - request.num_computed_tokens, budget)
+                if chunk_len == 0:
+                    continue # 本步 prefill 预算已用完, 继续等待
+                chunk_len = self._limit_chunk(request, chunk_len)
+                need_size = self._prefill_need_size(request, chunk_len)
+            else:
+                need_size = request.seq_len
+
+            self._slide_window(request, need_size)
+            if self._grow_kv(request, need_size):
+                if request.is_prefilling:
+                    prefill_chunks.append((request, chunk_len))
+                    budget -= chunk_len
+                else:
+                    decode_requests.append(request)
+                continue
+            # 空间不足: 抢占排在最后的请求, 若当前请求就是最后一个则抢占自己
+            victim = pending.pop() if pending else request
+            self._preempt(victim)
+            if victim is not request:
+                pending.insert(0, request)
+
+        self.running = [request for request in self.running if request.status == RequestStatus.RUNNING]
+        return prefill_chunks, decode_requests, budget
+
+    def _admit_requests(self, budget: int):
+        """按 FCFS 顺序接纳新请求, 队首请求分配不到 kv cache 时停止接纳, 避免饿死长请求"""
+        prefill_chunks = []
+        while self.waiting and budget > 0:
+            request = self.waiting[0]
+            # 尚未分叉的并行采样请求同时为其余分支预留 block_tables 的行
+            num_rows = request.n if request.n > 1 and not request.branches else 1
+            if len(self.free_table_rows) < num_rows:
+                break
+            request.table_row = self.free_table_rows.pop()
+            request.fork_table_rows = [self.free_table_rows.pop() for _ in range(num_rows - 1)]
+            self._match_prefix(request)
+            chunk_len = self._limit_chunk(request, min(request.seq_len - request.num_computed_tokens, budget))
+            if not self._grow_kv(request, self._prefill_need_size(request, chunk_len)):
+                self._free_request(request)
+                break
+            request.status = RequestStatus.RUNNING
+            self.running.append(self.waiting.popleft())
+            prefill_chunks.append((request, chunk_len))
+            budget -= chunk_len
+
+        return prefill_chunks
+
+    def _share_kv(self, source: Request, target: Request) -> bool:
+        """
+        让 target 复用 source 已计算的 kv cache: 完整的 block 通过引用计数共享 (只写 block_tables, 不复制 kv),
+        末尾未写满的 block 之后会被两者写入不同的 token, 因此为 target 分配新 block 并复制其内容 (copy-on-write)。
+
+        返回:
+            bool: target 的 kv cache 是否已覆盖 source 的全部已计算 token; 复制时 kv cache 不足则只共享完整 block,
+                target.num_computed_tokens 停在 block 边界, 剩余的 token 之后重新计算。
+        """
+        num_tokens = source.num_computed_tokens
+        num_shared_blocks = num_tokens // self.block_size
+        shared_index = source.kv_index[:num_shared_blocks]
+        target.kv_index = shared_index.clone()
+        target.num_computed_tokens = num_shared_blocks * self.block_size
+        target.num_draft_computed_tokens = min(source.num_draft_computed_tokens, target.num_computed_tokens)
+        self.kv_mem_manager.add_ref(shared_index)
+        self._write_block_table(target, 0, shared_index)
+
+        if target.num_computed_tokens == num_tokens:
+            return True
+        if not self._grow_kv(target, num_tokens + 1):
+            return False
+        self.kv_mem_manager.copy_blocks(
+            source.kv_index[num_shared_blocks: num_shared_blocks + 1],
+            target.kv_index[num_shared_blocks: num_shared_blocks + 1],
+        )
+        target.num_computed_tokens = num_tokens
+        return True
+
+    def _fork(self, request: Request) -> List[Request]:
+        """
+        prefill 完成后把并行采样请求分叉为 n 个分支, 各分支通过 _share_kv 复用 prompt 的 kv cache。
+
+        返回:
+            List[Request]: kv cache 已就绪、本步与原请求使用同一行 logits 采样第一个 token 的分支;
+                复制 block 时 kv cache 不足的分支留在 running 中, 之后重新计算末尾不完整 block 的 token。
+        """
+        ready = []
+        for i in range(request.n - 1):
+            branch = Request(
+                self._next_request_id, list(request.prompt_tokens), request.max_gen_len, request.temperature,
+                request.top_p, request.top_k, request.min_p, None if request.seed is None else request.seed + i + 1,
+                stop_token_ids=request.stop_token_ids, stop_matcher=request.stop_matcher, guide=request.guide,
+                priority=request.priority,
+            )
+            self._next_request_id += 1
+            branch.status = RequestStatus.RUNNING
+            branch.table_row = request.fork_table_rows.pop()
+            request.branches.append(branch)
+            self.running.append(branch)
+            if self._share_kv(request, branch):
+                ready.append(branch)
+        return ready
+
+    def _forward(self, decode_items, chunks, model_executor=None) -> torch.Tensor:
+        """
+        把本步所有 decode token 和分块 (prefill 分块或投机解码的验证分块) 打包成一个 [1, total_tokens] 的 batch
+        做一次前向, 线性层只计算一次, attention 在模型内部按 decode / 分块两部分拆分。
+
+        参数:
+            decode_items: [(request, token, position)], 输入一个 token, 其 kv 写入第 position 个位置。
+            chunks: [(request, start, tokens, num_logits)], 输入从第 start 个位置开始的 tokens,
+                前面的 token 已在 kv cache 中; 返回最后 num_logits 个 token 的 logits。
+            model_executor (optional): 执行前向的模型, 默认为目标模型; 投机解码的 draft 模型与其共享 block_tables。
+        返回:
+            torch.Tensor: [num_logits, vocab_size], 依次为各 decode token 和各分块最后 num_logits 个 token 的 logits。
+        """
+        model_executor = self.model_executor if model_executor is None else model_executor
+        atten_info = model_executor.atten_info
+        input_ids, position_ids, token_slots = [], [], []
+        seq_lens, req_idx, q_lens, prefix_lens, num_logits = [], [], [], [], []
+
+        for request, token, position in decode_items:
+            position -= request.num_evicted_tokens # 滑动窗口淘汰的 token 之后, 位置编号为 token 在 cache 中的位置
+            input_ids.append(token)
+            position_ids.append(position)
+            token_slots.append(self.kv_mem_manager.get_token_slots(request.kv_index, position + 1, position))
+            seq_lens.append(position + 1)
+            req_idx.append(request.table_row)
+
+        # 命中 prefix cache 的前缀和之前的分块已在 kv cache 中, 本次只计算 [start, end) 的 token
+        for request, start, tokens, chunk_logits in chunks:
+            start -= request.num_evicted_tokens
+            end = start + len(tokens)
+            input_ids.extend(tokens)
+            position_ids.extend(range(start, end))
+            token_slots.append(self.kv_mem_manager.get_token_slots(request.kv_index, end, start))
+            seq_lens.append(end)
+            req_idx.append(request.table_row)
+            q_lens.append(len(tokens))
+            prefix_lens.append(start)
+            num_logits.append(chunk_logits)
+
+        num_decode = len(decode_items)
+        cu_seqlens = [0]
+        for q_len in q_lens:
+            cu_seqlens.append(cu_seqlens[-1] + q_len)
+        logits_index = list(range(num_decode))
+        for end, chunk_logits in zip(cu_seqlens[1:], num_logits):
+            logits_index.extend(range(num_decode + end - chunk_logits, num_decode + end))
+
+        atten_info.block_tables = self.block_tables
+        atten_info.block_size = self.block_size
+        # 所有分块都没有前缀时, attention 直接使用本次计算的 k v
+        atten_info.b_prefix_len = self._to_device(prefix_lens, torch.int32) if any(prefix_lens) else None
+        atten_info.b_req_idx = self._to_device(req_idx, torch.int32)
+        atten_info.b_seq_len = self._to_device(seq_lens, torch.int32)
+        atten_info.max_actual_seq_len = max(seq_lens)
+        atten_info.cur_select_index = self.kv_mem_manager._to_device(torch.cat(token_slots), self.device)
+        atten_info.num_decode_seqs = num_decode
+        atten_info.cu_seqlens = self._to_device(cu_seqlens, torch.int32)
+        atten_info.max_q_len = max(q_lens, default=0)
+        atten_info.logits_index = self._to_device(logits_index, torch.long)
+
+        input_ids = self._to_device([input_ids], torch.long)
+        position_ids = self._to_device([position_ids], torch.long)
+        try:
+            logits = model_executor.forward(input_ids, 0, position_ids=position_ids)
+        finally:
+            atten_info.cu_seqlens = None # 其他调用方 (如 generate_with_probs) 仍使用普通的 prefill / decode 路径
+
+        return logits[0]
+
+    def _apply_guides(self, logits: torch.Tensor, requests: List[Request]):
+        """按各请求的状态屏蔽约束解码不允许的 token, 使用同一个 guide 的行一起处理"""
+        groups: Dict[int, Tuple[TokenGuide, List[int], List[int]]] = {}
+        for row, request in enumerate(requests):
+            if request.guide is not None:
+                guide, rows, states = groups.setdefault(id(request.guide), (request.guide, [], []))
+                rows.append(row)
+                states.append(request.guide_state)
+        for guide, rows, states in groups.values():
+            device_rows = self._to_device(rows, torch.long)
+            logits[device_rows] = guide.apply(logits[device_rows], states)
+
+    def _step_seeds(self, requests: List[Request], offsets: Optional[List[int]] = None, stream: int = 0) -> List[int]:
+        """
+        设置了 seed 的请求每次采样使用由 seed 和已生成长度 (加上 offset) 确定的种子, 与同批的其他请求无关;
+        stream 区分同一位置上不同用途的随机数 (如 draft 模型的提议和目标模型的验证)。未设置 seed 的请求为 -1。
+        """
+        if offsets is None:
+            offsets = [0] * len(requests)
+        return [
+            -1 if r.seed is None else (r.seed * 1000003 + len(r.output_tokens) + offset + (stream << 40)) % (1 << 62)
+            for r, offset in zip(requests, offsets)
+        ]
+
+    def _sample(self, logits: torch.Tensor, requests: List[Request]) -> torch.Tensor:
+        """采样各请求的下一个 token, 结果留在设备上, 由 _read_back 与验证结果一起拷回"""
+        self._apply_guides(logits, requests)
+        # 采样参数留在主机端, 由 sample 按参数分组
+        return sample(
+            logits,
+            [r.temperature for r in requests],
+            top_ks=[r.top_k for r in requests],
+            top_ps=[r.top_p for r in requests],
+            min_ps=[r.min_p for r in requests],
+            seeds=self._step_seeds(requests),
+        )
+
+    def _read_back(self, values: List[torch.Tensor]) -> List[int]:
+        """本步设备上的所有结果拼接后一次性异步拷贝到锁页内存, 每步只在这里等待一次"""
+        values = torch.cat([value.long() for value in values])
+        host_values = self._token_buffer[:values.numel()]
+        host_values.copy_(values, non_blocking=self._pin_memory)
+        if self._copy_event is not None:
+            self._copy_event.record()
+            self._copy_event.synchronize()
+        return host_values.tolist()
+
+    def _append_and_check(self, request: Request, token: int):
+        request.output_tokens.append(token)
+        if request.guide is not None:
+            request.guide_state = request.guide.next_state(request.guide_state, token)
+        if token == self.eos_token_id or token in request.stop_token_ids:
+            request.finish_reason, request.stop_reason = "stop", token
+        elif len(request.output_tokens) >= request.max_gen_len or (
+            self.window_size is None and request.seq_len >= self.max_seq_len
+        ):
+            request.finish_reason = "length"
+        if request.finish_reason is not None:
+            request.status = RequestStatus.FINISHED
+
+    def _detokenize(self, requests: List[Request]):
+        """本步产生了新 token 的请求一起增量解码, 并在新文本上匹配停止字符串"""
+        token_lists = [
+            # 停止 token 不计入输出文本
+            request.output_tokens[:-1] if isinstance(request.stop_reason, int) else request.output_tokens
+            for request in requests
+        ]
+        deltas = self.detokenizer.decode(
+            token_lists, [request.decode_state for request in requests], [request.is_finished for request in requests]
+        )
+        for request, delta in zip(requests, deltas):
+            if request.stop_matcher is None or not delta:
+                request.output_text += delta
+                continue
+            state, end, stop = request.stop_matcher.feed(request.stop_state, delta)
+            request.stop_state = state
+            if end < 0:
+                request.output_text += delta
+                continue
+            # 停止字符串可能出现在投机解码一次接受的多个 token 中间, 之后的 token 留在 output_tokens 中但不计入文本
+            text = request.output_text + delta[:end]
+            request.output_text = text[:len(text) - len(stop)]
+            request.finish_reason, request.stop_reason = "stop", stop
+            request.status = RequestStatus.FINISHED
+
+    def _retire_finished(self):
+        still_running = []
+        for request in self.running:
+            if request.is_finished:
+                self._free_request(request)
+            else:
+                still_running.append(request)
+        self.running = still_running
+
+    def _propose(self, decode_requests: List[Request]):
+        """
+        为 decode 请求预留 draft token 的 kv cache 并向 proposer 获取提议。投机只使用空闲的 kv cache,
+        不会为此淘汰 prefix cache 或抢占其他请求, 预留失败的请求本步按普通 decode 处理。
+
+        返回:
+            各请求的 draft token 列表、提议分布, 以及投机前的 kv cache block 数 (用于回滚)。
+        """
+        num_tokens, num_blocks = [], []
+        for request in decode_requests:
+            num_blocks.append(request.kv_index.numel())
+            # 接受全部 draft token 后再加上额外采样的 token, 仍不能超过最大生成长度和 max_seq_len
+            k = min(
+                self.proposer.num_speculative_tokens,
+                request.max_gen_len - len(request.output_tokens) - 1,
+                self.max_seq_len - request.seq_len - 1,
+            )
+            if request.guide is not None:
+                k = 0 # 约束解码的请求不投机
+            if k > 0 and not self._grow_kv(request, request.seq_len + k, evict=False):
+                k = 0
+            num_tokens.append(max(k, 0))
+        drafts, draft_probs = self.proposer.propose(self, decode_requests, num_tokens)
+        return drafts, draft_probs, num_blocks
+
+    def _verify(self, logits: torch.Tensor, requests: List[Request], drafts, draft_probs) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        对验证分块做拒绝采样, 结果留在设备上, 由 _read_back 与采样结果一起拷回。
+
+        参数:
+            logits (torch.Tensor): [sum(num_draft + 1), vocab_size], 各请求最新 token 和 draft token 处的 logits。
+        返回:
+            Tuple[torch.Tensor, torch.Tensor]: 各请求接受的 draft token 数, 以及接受的 token 之后的下一个 token。
+        """
+        row_requests = [request for request, draft in zip(requests, drafts) for _ in range(len(draft) + 1)]
+        probs = sampling_probs(
+            logits,
+            [r.temperature for r in row_requests],
+            top_ks=[r.top_k for r in row_requests],
+            top_ps=[r.top_p for r in row_requests],
+            min_ps=[r.min_p for r in row_requests],
+        )
+
+        # 按最长的 draft 补齐成 [batch_size, max_draft + 1, vocab_size]
+        max_draft = max(len(draft) for draft in drafts)
+        batch_size, vocab_size = len(requests), probs.shape[-1]
+        target_probs = probs.new_zeros((batch_size, max_draft + 1, vocab_size))
+        draft_tokens = torch.zeros((batch_size, max_draft), dtype=torch.long)
+        proposal_probs = None if draft_probs is None else probs.new_zeros((batch_size, max_draft, vocab_size))
+        offset = 0
+        for i, draft in enumerate(drafts):
+            target_probs[i, :len(draft) + 1] = probs[offset: offset + len(draft) + 1]
+            draft_tokens[i, :len(draft)] = torch.tensor(draft, dtype=torch.long)
+            if proposal_probs is not None:
+                # draft 模型的词表可以比目标模型小 (如 Qwen2.5 不同规模的 embedding 填充不同), 多出的 token 提议概率为 0
+                proposal_probs[i, :len(draft), :draft_probs[i].shape[-1]] = draft_probs[i]
+            offset += len(draft) + 1
+        return rejection_sample(
+            target_probs,
+            draft_tokens.to(probs.device),
+            self._to_device([len(draft) for draft in drafts], torch.long),
+            proposal_probs,
+            seeds=torch.tensor(self._step_seeds(requests), dtype=torch.long),
+        )
+
+    def _accept_drafts(self, requests: List[Request], drafts, num_blocks, num_accepted: List[int], next_tokens: List[int]):
+        """追加被接受的 draft token 和下一个 token, 并回滚为被拒绝的 token 预留的 kv cache"""
+        for request, draft, blocks, accepted, token in zip(requests, drafts, num_blocks, num_accepted, next_tokens):
+            old_seq_len = request.seq_len
+            request.num_proposed_tokens += len(draft)
+            request.num_accepted_tokens += accepted
+            for new_token in draft[:accepted] + [token]:
+                self._append_and_check(request, new_token)
+                if request.is_finished:
+                    break
+            # 最新 token 和被接受的 draft token 的 kv 有效, 被拒绝的 draft token 的 kv 作废
+            request.num_computed_tokens = min(old_seq_len + accepted, request.seq_len)
+            request.num_draft_computed_tokens = min(request.num_draft_computed_tokens, request.num_computed_tokens)
+            if not request.is_finished:
+                keep_size = max(blocks * self.block_size, request.seq_len)
+                request.kv_index = self.kv_mem_manager.rollback_kvcache(request.kv_index, keep_size)
+
+    @torch.inference_mode()
+    def step(self) -> List[Request]:
+        """
+        执行一次调度迭代。
+
+        返回:
+            List[Request]: 本次迭代产生了新 token 的请求 (包含本步刚结束的请求)。
+        """
+        budget = self.prefill_chunk_size if self.prefill_chunk_size is not None else self.max_seq_len
+        prefill_chunks, decode_requests, budget = self._schedule_running(budget)
+        if self.swapped:
+            decode_requests += self._swap_in_requests()
+        if not self.swapped:
+            # 还有请求等待换入时不接纳新请求, 避免换出的请求被饿死
+            prefill_chunks += self._admit_requests(budget)
+        if not prefill_chunks and not decode_requests:
+            if self.waiting or self.swapped:
+                raise RuntimeError("no enough kv cache to schedule any waiting request")
+            return []
+
+        # 1. 投机解码: decode 请求先获取 draft token, 有 draft 的请求改为输入 [最新 token] + draft 的验证分块
+        verify_requests, drafts, draft_probs, num_blocks = [], [], None, []
+        if self.proposer is not None and decode_requests:
+            all_drafts, all_draft_probs, all_num_blocks = self._propose(decode_requests)
+            speculative = [i for i, draft in enumerate(all_drafts) if draft]
+            verify_requests = [decode_requests[i] for i in speculative]
+            drafts = [all_drafts[i] for i in speculative]
+            num_blocks = [all_num_blocks[i] for i in speculative]
+            if all_draft_probs is not None:
+                draft_probs = [all_draft_probs[i] for i in speculative]
+            for request, draft, blocks in zip(decode_requests, all_drafts, all_num_blocks):
+                if not draft:
+                    # 没有提议 (如 n-gram 未命中) 的请求归还投机预留的 kv cache
+                    request.kv_index = self.kv_mem_manager.rollback_kvcache(
+                        request.kv_index, max(blocks * self.block_size, request.seq_len)
+                    )
+            decode_requests = [request for request, draft in zip(decode_requests, all_drafts) if not draft]
+
+        # 2. decode token、验证分块与 prefill 分块打包在一次前向中计算
+        all_tokens = lambda request: request.prompt_tokens + request.output_tokens
+        decode_items = [(request, request.output_tokens[-1], request.seq_len - 1) for request in decode_requests]
+        chunks = [
+            (request, request.seq_len - 1, [request.output_tokens[-1]] + draft, len(draft) + 1)
+            for request, draft in zip(verify_requests, drafts)
+        ] + [
+            (request, request.num_computed_tokens,
+             all_tokens(request)[request.num_computed_tokens: request.num_computed_tokens + chunk_len], 1)
+            for request, chunk_len in prefill_chunks
+        ]
+        logits = self._forward(decode_items, chunks)
+        num_verify_rows = sum(len(draft) + 1 for draft in drafts)
+        verify_logits = logits[len(decode_requests): len(decode_requests) + num_verify_rows]
+        logits = torch.cat([logits[:len(decode_requests)], logits[len(decode_requests) + num_verify_rows:]])
+
+        scheduled = decode_requests + [request for request, _ in prefill_chunks]
+        for request, chunk_len in prefill_chunks:
+            request.num_computed_tokens += chunk_len
+        for request in decode_requests:
+            request.num_computed_tokens = request.seq_len
+
+        # 3. 完成 prefill 的请求生成第一个 token, decode 请求生成下一个 token, 验证分块按拒绝采样接受 draft token
+        # 并行采样的请求完成 prefill 后先分叉, 各分支从同一行 logits 独立采样第一个 token
+        stepped_requests = [request for request in scheduled if request.num_computed_tokens == request.seq_len]
+        rows = [i for i, request in enumerate(scheduled) if request.num_computed_tokens == request.seq_len]
+        for request, row in list(zip(stepped_requests, rows)):
+            if request.n > 1 and not request.branches:
+                branches = self._fork(request)
+                stepped_requests += branches
+                rows += [row] * len(branches)
+        # 采样结果与验证结果拼接后一起拷回主机, 每步只同步一次
+        device_values = []
+        if stepped_requests:
+            device_values.append(self._sample(logits[rows], stepped_requests))
+        if verify_requests:
+            device_values.extend(self._verify(verify_logits, verify_requests, drafts, draft_probs))
+        host_values = self._read_back(device_values) if device_values else []
+        num_stepped, num_verify = len(stepped_requests), len(verify_requests)
+        for request, token in zip(stepped_requests, host_values[:num_stepped]):
+            self._append_and_check(request, token)
+        if verify_requests:
+            self._accept_drafts(
+                verify_requests, drafts, num_blocks,
+                host_values[num_stepped: num_stepped + num_verify], host_values[num_stepped + num_verify:],
+            )
+        if self.detokenizer is not None:
+            self._detokenize(verify_requests + stepped_requests)
+
+        # 4. 退出已完成的请求
+        self._retire_finished()
+
+        return verify_requests + stepped_requests
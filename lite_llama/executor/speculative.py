@@ -0,0 +1,182 @@
+import torch, logging
+from typing import List, Optional, Tuple
+
+from .sampler import sampling_probs, _exponential_noise
+
+logger = logging.getLogger(__name__)
+
+@torch.no_grad()
+def rejection_sample(
+    target_probs: torch.Tensor,
+    draft_tokens: torch.Tensor,
+    num_draft_tokens: torch.Tensor,
+    draft_probs: Optional[torch.Tensor] = None,
+    seeds: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    投机解码的拒绝采样, 输出 token 的分布与直接从目标分布逐个采样完全相同。
+
+    第 i 个 draft token d 以 min(1, p(d) / q(d)) 的概率被接受; 第一个被拒绝的位置从 max(p - q, 0)
+    归一化后的分布重新采样, 全部接受时再从最后一个位置的目标分布额外采样一个 token。
+    p / q 为按请求采样参数截断后的分布 (见 sampling_probs), 贪心请求的 p 是 one-hot, 此时退化为逐个比较 argmax。
+
+    参数:
+        target_probs (torch.Tensor): [batch_size, max_draft + 1, vocab_size], 目标模型在最新 token 和各 draft token 处的分布。
+        draft_tokens (torch.Tensor): [batch_size, max_draft], 超出 num_draft_tokens 的部分可以是任意 token。
+        num_draft_tokens (torch.Tensor): [batch_size], 各请求的 draft token 数, 至少为 1。
+        draft_probs (torch.Tensor, optional): [batch_size, max_draft, vocab_size], draft 的提议分布;
+            为 None 表示确定性提议 (如 n-gram), 相当于 draft token 处为 1 的 one-hot。
+        seeds (torch.Tensor, optional): 主机端 [batch_size] 的随机种子, >= 0 的行的接受判定和重新采样
+            只使用由该种子确定的随机数, 与 batch 中其他行无关; < 0 或为 None 时使用全局随机数发生器。
+    返回:
+        Tuple[torch.Tensor, torch.Tensor]: 各请求接受的 draft token 数, 以及接受的 token 之后的下一个 token。
+    """
+    batch_size, max_draft = draft_tokens.shape
+    device = target_probs.device
+    if draft_probs is None:
+        draft_probs = torch.zeros_like(target_probs[:, :max_draft]).scatter_(-1, draft_tokens[..., None], 1.0)
+
+    p_draft = target_probs[:, :max_draft].gather(-1, draft_tokens[..., None]).squeeze(-1)
+    q_draft = draft_probs.gather(-1, draft_tokens[..., None]).squeeze(-1)
+    # 重新采样使用 argmax(residual / e), e ~ Exp(1), 与多项式采样等价; 有种子的行用同一个发生器依次生成 u 和 e
+    u = torch.rand_like(p_draft)
+    noise = torch.empty_like(target_probs[:, 0]).exponential_()
+    if seeds is not None:
+        for row in torch.nonzero(seeds >= 0).view(-1).tolist():
+            generator = torch.Generator(device=device).manual_seed(int(seeds[row]))
+            u[row].uniform_(generator=generator)
+            noise[row].exponential_(generator=generator)
+    # u < p / q 写成 u * q < p, draft token 总有 q > 0
+    accepted = u * q_draft < p_draft
+    accepted &= torch.arange(max_draft, device=device)[None, :] < num_draft_tokens[:, None]
+    num_accepted = torch.cumprod(accepted.to(torch.int32), dim=-1).sum(dim=-1)
+
+    rows = torch.arange(batch_size, device=device)
+    p = target_probs[rows, num_accepted]
+    rejected = (num_accepted < num_draft_tokens).to(p.dtype)
+    q = draft_probs[rows, num_accepted.clamp(max=max_draft - 1)] * rejected[:, None]
+    residual = (p - q).clamp_(min=0.0)
+    # p == q 时不会被拒绝, 浮点误差使残差全为 0 时退回目标分布
+    residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p)
+    next_tokens = torch.argmax(residual / noise, dim=-1)
+    return num_accepted, next_tokens
+
+class DraftModelProposer:
+    """
+    使用小的 draft 模型为投机解码提议 token。
+
+    draft ModelExecutor 需要与目标模型共享 kv cache 的 block 分配器 (构建时传入 kv_allocator), 两个模型的
+    block 索引和调度器的 block_tables 因此完全通用: 请求的 kv_index 只分配一次, 两个模型各自写自己的 kv buffer。
+    draft 模型的 kv cache 按需补齐: 每次提议前先把 draft 尚未计算的 token (新请求为整个 prompt, 之后通常只是
+    上一步被接受的 token) 作为一个分块前向, 再自回归地生成 num_speculative_tokens 个 token。
+    """
+    def __init__(self, draft_executor, num_speculative_tokens: int = 4):
+        if num_speculative_tokens < 1:
+            raise ValueError(f"num_speculative_tokens must be positive, got {num_speculative_tokens}")
+        self.draft_executor = draft_executor
+        self.num_speculative_tokens = num_speculative_tokens
+
+    @torch.no_grad()
+    def propose(self, scheduler, requests, num_tokens: List[int]) -> Tuple[List[List[int]], Optional[List[torch.Tensor]]]:
+        """
+        参数:
+            scheduler (ContinuousBatchScheduler): 提供打包前向和 block_tables, 请求的 kv cache 已预留
+                seq_len + num_tokens 个位置。
+            requests (List[Request]): 处于 decode 阶段的请求。
+            num_tokens (List[int]): 每个请求最多提议的 token 数, 0 表示本步不投机。
+        返回:
+            各请求的 draft token 列表, 以及对应的提议分布 (每个请求一个 [num_draft, vocab_size] 的张量)。
+        """
+        drafts = [[] for _ in requests]
+        draft_probs = [[] for _ in requests]
+        order = [i for i, k in enumerate(num_tokens) if k > 0]
+        if not order:
+            return drafts, None
+
+        # 1. 补齐 draft kv cache 并得到第一个 draft token 的分布, 打包 batch 中 decode token 在前
+        decode_items, chunks, decode_order, chunk_order = [], [], [], []
+        for i in order:
+            request = requests[i]
+            start = request.num_draft_computed_tokens
+            tokens = (request.prompt_tokens + request.output_tokens)[start:]
+            if len(tokens) == 1:
+                decode_items.append((request, tokens[0], request.seq_len - 1))
+                decode_order.append(i)
+            else:
+                chunks.append((request, start, tokens, 1))
+                chunk_order.append(i)
+        order = decode_order + chunk_order
+        logits = scheduler._forward(decode_items, chunks, self.draft_executor)
+
+        # 2. 自回归地生成 draft token, 每个请求最多 num_tokens[i] 个
+        for _ in range(max(num_tokens)):
+            batch = [requests[i] for i in order]
+            probs = sampling_probs(
+                logits,
+                [r.temperature for r in batch],
+                top_ks=[r.top_k for r in batch],
+                top_ps=[r.top_p for r in batch],
+                min_ps=[r.min_p for r in batch],
+            )
+            # 设置了 seed 的请求使用与目标模型验证不同的随机数流, 提议与接受判定相互独立
+            seeds = scheduler._step_seeds(batch, [len(drafts[i]) for i in order], stream=1)
+            noise = _exponential_noise(probs.shape, torch.tensor(seeds, dtype=torch.long), probs.device)
+            tokens = torch.argmax(probs / noise, dim=-1).tolist()
+            for row, (i, token) in enumerate(zip(order, tokens)):
+                drafts[i].append(token)
+                draft_probs[i].append(probs[row])
+
+            order = [i for i in order if len(drafts[i]) < num_tokens[i]]
+            if not order:
+                break
+            # 上一个 draft token 位于第 seq_len - 1 + len(drafts) 个位置
+            decode_items = [
+                (requests[i], drafts[i][-1], requests[i].seq_len - 1 + len(drafts[i])) for i in order
+            ]
+            logits = scheduler._forward(decode_items, [], self.draft_executor)
+
+        for request, draft in zip(requests, drafts):
+            if draft:
+                # 最后一个 draft token 没有输入 draft 模型, 其余 token 的 kv 已写入 draft 的 kv buffer
+                request.num_draft_computed_tokens = request.seq_len + len(draft) - 1
+        return drafts, [torch.stack(probs) if probs else None for probs in draft_probs]
+
+class NgramProposer:
+    """
+    Prompt lookup (n-gram) 投机解码, 不需要 draft 模型: 在 prompt 和已生成的 token 中查找与当前后缀相同的
+    最近一次出现的 n-gram, 把其后的 token 作为提议。摘要、代码编辑等输出大段复制输入的场景接受率很高。
+
+    每个请求维护一个 n-gram 索引 {n-gram: 最近一次出现的结束位置}, 随序列增长增量更新, 查找为 O(max_ngram)。
+    提议是确定性的, 验证时按 one-hot 提议分布做拒绝采样。
+    """
+    def __init__(self, num_speculative_tokens: int = 4, max_ngram: int = 3, min_ngram: int = 1):
+        if num_speculative_tokens < 1:
+            raise ValueError(f"num_speculative_tokens must be positive, got {num_speculative_tokens}")
+        if not 1 <= min_ngram <= max_ngram:
+            raise ValueError(f"invalid ngram range [{min_ngram}, {max_ngram}]")
+        self.num_speculative_tokens = num_speculative_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self._indexes = {} # request_id -> (request, {n-gram: 结束位置}, 已建索引的 token 数)
+
+    def _lookup(self, request, max_tokens: int) -> List[int]:
+        tokens = request.prompt_tokens + request.output_tokens
+        _, index, num_indexed = self._indexes.get(request.request_id, (request, {}, 0))
+        # 只索引结束位置在最后一个 token 之前的 n-gram, 后缀本身不会匹配到自己
+        for end in range(max(num_indexed, 1), len(tokens)):
+            for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+                index[tuple(tokens[end - n: end])] = end
+        self._indexes[request.request_id] = (request, index, len(tokens))
+
+        for n in range(min(self.max_ngram, len(tokens)), self.min_ngram - 1, -1):
+            end = index.get(tuple(tokens[len(tokens) - n:]))
+            if end is not None:
+                return tokens[end: end + max_tokens]
+        return []
+
+    def propose(self, scheduler, requests, num_tokens: List[int]) -> Tuple[List[List[int]], Optional[List[torch.Tensor]]]:
+        """接口与 DraftModelProposer.propose 相同, 提议分布为 None 表示确定性提议"""
+        # 已结束的请求不再需要索引
+        self._indexes = {key: value for key, value in self._indexes.items() if not value[0].is_finished}
+        drafts = [self._lookup(request, k) if k > 0 else [] for request, k in zip(requests, num_tokens)]
+        return drafts, None
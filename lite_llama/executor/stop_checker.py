@@ -0,0 +1,63 @@
+from collections import deque
+from typing import Optional, Sequence, Tuple
+
+class StopStringMatcher:
+    """
+    多个停止字符串 (stop strings) 的 Aho-Corasick 自动机, 在逐步解码出的文本上增量匹配。
+
+    自动机只依赖停止字符串, 可以被多个请求共享; 每个请求只保存当前状态 (一个整数), 每个新字符
+    均摊 O(1) 转移, 不需要在每步重新扫描已生成的全部文本。状态的深度是当前文本最长的、同时是某个停止字符串
+    前缀的后缀长度, 流式输出时这部分文本可能属于停止字符串, 应暂缓输出。
+    """
+    def __init__(self, stop_strings: Sequence[str]):
+        if not stop_strings or any(not stop for stop in stop_strings):
+            raise ValueError(f"stop strings must be non-empty, got {list(stop_strings)}")
+        self.stop_strings = tuple(stop_strings)
+        self._goto = [{}] # 状态 -> {字符: 状态}, 即 trie 的边
+        self._depth = [0]
+        self._output = [-1] # 在该状态结束的最长停止字符串的编号, 包括沿失败指针可达的状态
+
+        for index, stop in enumerate(self.stop_strings):
+            state = 0
+            for ch in stop:
+                if ch not in self._goto[state]:
+                    self._goto.append({})
+                    self._depth.append(self._depth[state] + 1)
+                    self._output.append(-1)
+                    self._goto[state][ch] = len(self._goto) - 1
+                state = self._goto[state][ch]
+            self._output[state] = index
+
+        # 按 BFS 顺序计算失败指针: 当前状态对应字符串的最长真后缀所在的状态
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            if self._output[state] < 0:
+                self._output[state] = self._output[self._fail[state]]
+            for ch, child in self._goto[state].items():
+                self._fail[child] = self._next(self._fail[state], ch) if state > 0 else 0
+                queue.append(child)
+
+    def _next(self, state: int, ch: str) -> int:
+        while state > 0 and ch not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(ch, 0)
+
+    def depth(self, state: int) -> int:
+        """状态对应的、可能是停止字符串前缀的文本后缀长度"""
+        return self._depth[state]
+
+    def feed(self, state: int, text: str) -> Tuple[int, int, Optional[str]]:
+        """
+        从 state 开始输入新的文本。
+
+        返回:
+            Tuple[int, int, Optional[str]]: 新状态; 第一个停止字符串在 text 中的结束位置 (不含), 没有匹配时为 -1;
+                以及匹配到的停止字符串。匹配可以从之前输入的文本开始。
+        """
+        for i, ch in enumerate(text):
+            state = self._next(state, ch)
+            if self._output[state] >= 0:
+                return state, i + 1, self.stop_strings[self._output[state]]
+        return state, -1, None
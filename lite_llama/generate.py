@@ -1,49 +1,25 @@
 import torch
 
-from typing import List, Optional, Tuple, TypedDict
+from typing import List, Optional, Tuple, TypedDict, Union
 from transformers import AutoTokenizer
 
 from .executor.model_executor import ModelExecutor
+from .executor.scheduler import ContinuousBatchScheduler
+from .executor.prefix_cache import RadixPrefixCache
+from .executor.mem_manager import HostKVCachePool
+from .executor.remote_kv import RemoteKVTier
+from .executor.speculative import DraftModelProposer
+from .executor.beam_search import BeamSearchDecoder
+from .executor.stop_checker import StopStringMatcher
+from .executor.grammar import GrammarCompiler, TokenGuide
 from .utils.file_interface import get_model_name_from_path
-from .kernels.softmax_split import softmax_split
+from .utils.prompt_templates import get_stop_token_ids
 
 class CompletionPrediction(TypedDict, total=False):
     generation: str
     tokens: List[str]  # not required
 
 
-@torch.inference_mode()
-def sample_top_p(probs, p):
-    """
-    执行 Top-p (Nucleus) 采样, 从概率分布中采样下一个词。
-    
-    参数：
-        probs (torch.Tensor): 概率分布张量，形状为 `[batch_size, vocab_size]`。
-        p (float): 累积概率阈值，取值范围在 0 到 1 之间。
-    返回：
-        torch.Tensor: 采样得到的词索引，形状为 `[batch_size, 1]`。
-
-    说明：
-        Top-p 采样算法: 选择概率累积和超过阈值 p 的最小集合，将这些词的概率重新归一化后进行采样。
-    """
-    # 对概率分布进行降序排序。probs_sort: 排序后的概率值，形状与 probs 相同。probs_idx: 排序后的索引，用于映射回原始词汇表。
-    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
-    # 计算排序后概率的累积和. 返回的 probs_sum 是累积概率分布。
-    probs_sum = torch.cumsum(probs_sort, dim=-1)
-    # 保留累积概率未超过阈值 p 的词汇的概率，其余词汇的概率被置为 0.0。
-    mask = probs_sum - probs_sort > p # 创建掩码，对于每个位置，计算累积概率（不包括当前词）是否超过阈值 p。
-    probs_sort[mask] = 0.0 # 将累积概率超过阈值 p 的词的概率置零。
-
-    # 对剩余的概率重新归一化, 确保总和为 1。
-    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    # 从重新归一化的概率分布中采样下一个词. 返回的 next_token 是采样得到的词在排序后概率分布中的索引。
-    next_token_sorted_idx = torch.multinomial(probs_sort, num_samples=1)
-    # 在 probs_idx 的最后一维（dim=-1）中，使用 next_token_sorted_idx 作为索引，提取对应的值。沿着 dim=1（列）进行索引提取
-    # NOTE: torch.gather 函数按照给定的索引张量 index，从输入张量中收集 (获取) 数据，并返回一个与索引张量形状一致的张量。
-    next_token = torch.gather(probs_idx, -1, index = next_token_sorted_idx)
-    
-    return next_token # 返回采样得到的下一个词的索引
-
 class GenerateText:
     """
     GenerateText 类用于加载LLaMA模型并执行迭代式生成式推理 (文本生成)。
@@ -58,6 +34,14 @@ class GenerateText:
         triton_weight = True,
         compiled_model = False,
         device="cuda",
+        block_size = 16,
+        enable_prefix_cache = True,
+        prefill_chunk_size = 512,
+        draft_checkpoints_dir = None,
+        num_speculative_tokens = 4,
+        kv_cache_dtype = None,
+        num_swap_blocks = 0,
+        remote_kv_address = None,
     ):
         self.checkpoints_dir = checkpoints_dir
         self.compiled_model = compiled_model
@@ -68,11 +52,47 @@ class GenerateText:
             max_gpu_num_blocks = max_gpu_num_blocks,
             max_seq_len = max_seq_len,
             triton_weight = triton_weight,
-            device = device
+            compiled_model = compiled_model,
+            device = device,
+            block_size = block_size, # 分页 kv cache 每个 block 的 token 数, prefix cache、交换和快照都以 block 为粒度
+            kv_cache_dtype = kv_cache_dtype, # "int8" / "fp8" 量化 kv cache
         )
         self.model_config = self.model_executor.model_config
         assert self.model_config.vocab_size != -1, "Vocab size must be set"
         self.tokenizer = self.load_tokenizer(tokenizer_path)
+        # 对话模型的回合结束 token (如 Llama-3 的 <|eot_id|>, Qwen2 的 <|im_end|>) 与 eos 一样结束生成
+        self.stop_token_ids = get_stop_token_ids(self.model_config.model_type, checkpoints_dir)
+        # prefix cache 在多次调用之间共享, 相同的系统提示只需 prefill 一次
+        # 设置 remote_kv_address ("host:port") 时, prefix cache 淘汰的 block 写入远端共享存储, 各副本可以拉回复用
+        kv_mem_manager = self.model_executor.kv_mem_manager
+        remote_tier = None
+        if remote_kv_address is not None:
+            remote_tier = RemoteKVTier.from_address(kv_mem_manager, remote_kv_address, self.model_executor.model_id)
+        self.prefix_cache = RadixPrefixCache(kv_mem_manager, remote_tier) if enable_prefix_cache else None
+        # kv cache 不足时被抢占请求的 kv 换出到主机端的交换空间, 显存空闲后换入, 不必重新 prefill
+        self.swap_space = HostKVCachePool(self.model_executor.kv_mem_manager, num_swap_blocks) if num_swap_blocks > 0 else None
+        # 长 prompt 按块 prefill, 每步 prefill 的 token 数不超过该值, 为 None 时整个 prompt 一次 prefill
+        self.prefill_chunk_size = prefill_chunk_size
+        # 约束解码的编译器在第一次使用时创建, 编译得到的词表状态机和掩码在多次调用之间缓存
+        self.grammar_compiler = None
+        # 投机解码: 使用相同 tokenizer 的小模型提议 token, 与目标模型共享 kv cache block 分配器;
+        # 自动计算 kv cache 大小时会占满显存, 使用 draft 模型时应显式设置 max_gpu_num_blocks
+        self.proposer = None
+        if draft_checkpoints_dir is not None:
+            draft_executor = ModelExecutor.build(
+                checkpoints_dir = draft_checkpoints_dir,
+                load_model = load_model,
+                max_gpu_num_blocks = max_gpu_num_blocks,
+                max_seq_len = max_seq_len,
+                triton_weight = triton_weight,
+                device = device,
+                block_size = block_size, # 共享分配器的 block 索引要互相通用, block_size 必须一致
+                kv_allocator = self.model_executor.kv_mem_manager.allocator,
+                kv_cache_dtype = kv_cache_dtype,
+            )
+            if draft_executor.llm_config.vocab_size > self.model_executor.llm_config.vocab_size:
+                raise ValueError("draft model vocab_size must not exceed the target model vocab_size")
+            self.proposer = DraftModelProposer(draft_executor, num_speculative_tokens)
     
     def load_tokenizer(self, pretrained_model_name_or_path):
         model_name = get_model_name_from_path(pretrained_model_name_or_path)
@@ -82,6 +102,23 @@ class GenerateText:
             use_fast = False
         tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path, use_fast=use_fast)
         return tokenizer
+
+    def compile_guide(
+        self, regex: Optional[str] = None, json_schema: Optional[Union[str, dict]] = None, device = "cuda"
+    ) -> Optional[TokenGuide]:
+        """把正则表达式或 JSON schema 编译为约束解码的 TokenGuide, 两者都为 None 时返回 None"""
+        if regex is not None and json_schema is not None:
+            raise ValueError("only one of regex and json_schema can be set")
+        if regex is None and json_schema is None:
+            return None
+        if self.grammar_compiler is None or self.grammar_compiler.device != device:
+            self.grammar_compiler = GrammarCompiler(
+                self.tokenizer, self.model_executor.llm_config.vocab_size,
+                [self.tokenizer.eos_token_id] + self.stop_token_ids, device,
+            )
+        if regex is not None:
+            return self.grammar_compiler.compile_regex(regex)
+        return self.grammar_compiler.compile_json_schema(json_schema)
     
     @torch.inference_mode()
     def generate(
@@ -91,8 +128,19 @@ class GenerateText:
         temperature: float = 0.6,
         top_p: float = 0.9,
         echo: bool = False,
-        device = "cuda"
-    ) -> Tuple[List[List[int]], Optional[List[List[float]]]]:
+        top_k: int = -1,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        device = "cuda",
+        n: int = 1,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        stop_token_ids: Optional[List[int]] = None,
+        stop: Optional[List[str]] = None,
+        regex: Optional[str] = None,
+        json_schema: Optional[Union[str, dict]] = None,
+    ) -> List[List[int]]:
         """
         基于提供的提示词 (prompts) 使用语言生成模型生成文本序列。
         
@@ -101,79 +149,77 @@ class GenerateText:
             max_gen_len (int): 最大生成序列长度。
             temperature (float, 可选): 控制采样随机性的温度值，默认 0.6。
             top_p (float, 可选): nucleus 采样的概率阈值，默认 0.9。
+            top_k (int, 可选): 只在概率最大的 top_k 个 token 中采样，<= 0 表示不限制。
+            min_p (float, 可选): 只保留概率不小于 min_p 倍最大概率的 token，默认 0 表示不限制。
+            seed (int, 可选): 随机种子，设置后每个请求的采样结果可复现。
             echo (bool, 可选): 是否在输出中包含提示词，默认 False。
+            n (int, 可选): 每个提示词的采样数，提示词只 prefill 一次，各样本共享其 kv cache，默认 1。
+            num_beams (int, 可选): beam search 的 beam 数，> 1 时使用 beam search 代替采样，返回得分最高的 n 个序列。
+            length_penalty (float, 可选): beam search 中序列得分 = 对数概率之和 / 生成长度 ** length_penalty。
+            early_stopping (bool, 可选): beam search 收集到 num_beams 个完成的序列后立即结束。
+            stop_token_ids (List[int], 可选): 额外的停止 token，与模型默认的停止 token 和 eos 一起生效。
+            stop (List[str], 可选): 停止字符串，生成的文本中出现任一字符串时立即结束该序列 (不支持 beam search)。
+            regex (str, 可选): 约束解码，生成的文本必须完整匹配该正则表达式 (不支持 beam search)。
+            json_schema (str | dict, 可选): 约束解码，生成的文本必须是符合该 JSON schema 的 JSON。
+                约束解码的序列只在匹配完成时结束，除非先达到 max_gen_len。
         返回：
-            Tuple[List[List[int]], Optional[List[List[float]]]]: 生成的 token 序列和（可选）对应的 log 概率。
+            List[List[int]]: 生成的 token 序列 (不含结束符和停止 token)，第 i 个提示词的 n 个样本位于 [i * n, (i + 1) * n)。
+                因停止字符串结束的序列包含停止字符串所在的 token，文本的截断见 text_completion。
         """
-        bsz = len(prompt_tokens) # 批量大小
-        max_prompt_len = max(len(t) for t in prompt_tokens)
-        total_len = min(self.model_config.max_seq_len, max_gen_len + max_prompt_len)
-        total_number_tokens = bsz * total_len
-        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
-        self.model_executor.atten_info.max_actual_seq_len = max_prompt_len
-
-        # 预分配tokens张量
-        tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device = device)
-        
-        # 填充提示词到 tokens 张量
-        for seq_id, token_ids in enumerate(prompt_tokens):
-            tokens[seq_id, : len(token_ids)] = torch.tensor(token_ids, dtype=torch.long, device = device)
-        
-        # 生成一个布尔张量，它的值为 True 的位置表示输入序列的实际内容（即非填充部分）, 形状为 (batch_size, total_len)
-        input_text_mask = tokens != pad_id
-        eos_reached = torch.zeros(bsz, dtype=torch.bool, device=device)
-        prev_pos = 0 # 初始化上一次生成的位置
-
-        # 一次性分配 bsz * total_len 个索引
-        self.model_executor.atten_info.select_index = self.model_executor.kv_mem_manager.alloc_kvcache_index(total_number_tokens)
-        select_index = self.model_executor.atten_info.select_index
-
-        # 初始化每个批次项的序列长度
-        actual_prompt_lens = torch.tensor([len(t) for t in prompt_tokens], dtype=torch.long, device=device)
-        self.model_executor.atten_info.b_seq_len = actual_prompt_lens
-        # print("self.model_executor.atten_info.b_seq_len ", self.model_executor.atten_info.b_seq_len)  
-
-        # 初始化起始索引张量
-        self.model_executor.atten_info.start_index = select_index[::total_len].to(torch.int32)
-        # print("start_index: ", self.model_executor.atten_info.start_index)
-        
-        # 初始化当前已选择的批次项索引
-        self.model_executor.atten_info.cur_select_index = select_index.unfold(0, max_prompt_len, total_len).reshape(-1)
-        # print("Prefill stage cur_select_index: ", self.model_executor.atten_info.cur_select_index)
-        
-        for cur_pos in range(max_prompt_len, total_len):
-            input_ids = tokens[:, prev_pos: cur_pos] # 当前输入 token ids, decode 阶段 input_ids shape is [4, 1]         
-            logits = self.model_executor.forward(input_ids, prev_pos) # 模型执行器的前向推理, logits shape is [batch_size, shape, vocab_size]
-            
-            if prev_pos > 0:
-                self.model_executor.atten_info.max_actual_seq_len += 1
-                self.model_executor.atten_info.b_seq_len += 1
-            
-            self.model_executor.atten_info.cur_select_index = (self.model_executor.atten_info.start_index 
-                                                               + self.model_executor.atten_info.b_seq_len)
-            
-            # print("Decode stage cur_select_index: ", self.model_executor.atten_info.cur_select_index)
-
-            probs = softmax_split(logits[:, -1] / temperature) # torch.softma 将 logits 转换为概率分布。
-            next_token = sample_top_p(probs, top_p) # next_token 形状为 [batch_size, 1]
-            next_token = next_token.reshape(-1) # 调整为一维, shape is batch_size
-
-            # 仅替换生成部分的token
-            mask = ~input_text_mask[:, cur_pos]
-            next_token = torch.where(mask, next_token, tokens[:, cur_pos])
-            tokens[:, cur_pos] = next_token
-            
-            # 更新结束标志
-            eos_reached |= (mask & (next_token == self.tokenizer.eos_token_id))
-            prev_pos = cur_pos
-
-            if eos_reached.all(): # 如果所有样本均到达结束 token，停止生成
-                break
-        
-        # out_tokens = self.process_output_tokens(tokens, prompt_tokens, max_gen_len, echo, self.tokenizer.eos_token_id)
-        self.model_executor.kv_mem_manager.release_ref(select_index) # 减少 kv cache 内存管理器的引用计数
+        # 连续批处理: 每个 decode step 都可以接纳新请求, 已结束的请求立即退出 batch 并释放 kv cache
+        scheduler = ContinuousBatchScheduler(
+            self.model_executor,
+            eos_token_id = self.tokenizer.eos_token_id,
+            max_batch_size = self.model_executor.llm_config.max_batch_size,
+            max_seq_len = self.model_config.max_seq_len,
+            prefill_chunk_size = self.prefill_chunk_size,
+            prefix_cache = self.prefix_cache,
+            device = device,
+            swap_space = self.swap_space,
+            proposer = None if num_beams > 1 else self.proposer,
+            tokenizer = self.tokenizer,
+        )
+        stop_token_ids = self.stop_token_ids + list(stop_token_ids or [])
+        guide = self.compile_guide(regex, json_schema, device)
+        if num_beams > 1:
+            if guide is not None:
+                raise ValueError("constrained decoding is not supported with beam search")
+            if n > num_beams:
+                raise ValueError(f"n ({n}) must not exceed num_beams ({num_beams})")
+            decoder = BeamSearchDecoder(scheduler, num_beams, length_penalty, early_stopping, stop_token_ids)
+            results = [
+                hypothesis.tokens for hypotheses in decoder.search(prompt_tokens, max_gen_len)
+                for hypothesis in hypotheses[:n]
+            ]
+            prompts = [tokens for tokens in prompt_tokens for _ in range(n)]
+            return [
+                self._truncate_eos(tokens, prompt, echo, stop_token_ids) for tokens, prompt in zip(results, prompts)
+            ]
 
-        return tokens
+        requests = [
+            scheduler.add_request(
+                token_ids, max_gen_len, temperature, top_p, top_k, min_p, seed, n, stop_token_ids, stop or (), guide
+            )
+            for token_ids in prompt_tokens
+        ]
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+
+        return [
+            self._truncate_eos(sample.output_tokens, sample.prompt_tokens, echo, stop_token_ids)
+            for request in requests for sample in request.samples
+        ]
+
+    def _truncate_eos(
+        self, generated_toks: List[int], prompt_tokens: List[int], echo: bool, stop_token_ids: List[int]
+    ) -> List[int]:
+        # 截断到结束符或停止 token 之前
+        stop_token_ids = set(stop_token_ids) | {self.tokenizer.eos_token_id}
+        for i, token in enumerate(generated_toks):
+            if token in stop_token_ids:
+                generated_toks = generated_toks[:i]
+                break
+        return list(prompt_tokens) + generated_toks if echo else generated_toks
     
     def text_completion(
         self,
@@ -183,10 +229,31 @@ class GenerateText:
         max_gen_len: Optional[int] = None,
         echo: bool = False,
         device = "cuda",
+        top_k: int = -1,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        n: int = 1,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        stop_token_ids: Optional[List[int]] = None,
+        stop: Optional[List[str]] = None,
+        regex: Optional[str] = None,
+        json_schema: Optional[Union[str, dict]] = None,
     ) -> List[CompletionPrediction]:
         """
         Perform text completion for a list of prompts using the language generation model.
+        With n > 1, each prompt is prefilled once and n completions are returned for it,
+        the completions of prompts[i] are at [i * n, (i + 1) * n).
+        With num_beams > 1, beam search is used and the n best beams are returned.
+        Generation stops at eos, the model's end-of-turn tokens, stop_token_ids, or any of the stop strings;
+        the returned text is cut before the stop string.
+        With regex or json_schema, every completion that ends before max_gen_len fully matches the regex
+        or is JSON valid against the schema.
         """
+        if max_gen_len is None:
+            max_gen_len = self.model_config.max_seq_len - 1
+
         input_ids = self.tokenizer.batch_encode_plus(prompts, add_special_tokens=True).input_ids
         generated_ids = self.generate(
             prompt_tokens = input_ids,
@@ -195,10 +262,36 @@ class GenerateText:
             top_p = top_p,
             echo = echo,
             device = device,
+            top_k = top_k,
+            min_p = min_p,
+            seed = seed,
+            n = n,
+            num_beams = num_beams,
+            length_penalty = length_penalty,
+            early_stopping = early_stopping,
+            stop_token_ids = stop_token_ids,
+            stop = stop,
+            regex = regex,
+            json_schema = json_schema,
         )
 
         generated_texts = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+        if stop:
+            # 序列在停止字符串出现的那一步结束, 文本截断到停止字符串之前
+            matcher = StopStringMatcher(stop)
+            prompt_lens = [
+                len(self.tokenizer.decode(input_ids[i // n], skip_special_tokens=True)) if echo else 0
+                for i in range(len(generated_texts))
+            ]
+            generated_texts = [
+                self._truncate_stop_string(text, matcher, start) for text, start in zip(generated_texts, prompt_lens)
+            ]
         return generated_texts
+
+    @staticmethod
+    def _truncate_stop_string(text: str, matcher: StopStringMatcher, start: int = 0) -> str:
+        _, end, matched = matcher.feed(0, text[start:])
+        return text if end < 0 else text[:start + end - len(matched)]
     
     def process_output_tokens(
         self,
@@ -1,8 +1,16 @@
 from typing import Optional
 import torch, logging
-from typing import List, Optional, Tuple, TypedDict, Generator
+from typing import List, Literal, Optional, Tuple, TypedDict, Generator, Union
 from .executor.model_executor import ModelExecutor
+from .executor.scheduler import ContinuousBatchScheduler, Request
+from .executor.prefix_cache import RadixPrefixCache
+from .executor.mem_manager import HostKVCachePool
+from .executor.remote_kv import RemoteKVTier
+from .executor.kv_snapshot import read_kv_snapshot_header
+from .executor.speculative import DraftModelProposer, NgramProposer
+from .executor.grammar import GrammarCompiler, TokenGuide
 from .utils.file_interface import get_model_name_from_path
+from .utils.prompt_templates import get_stop_token_ids
 
 from transformers import AutoTokenizer
 
@@ -15,37 +23,11 @@ class CompletionPrediction(TypedDict, total=False):
     tokens: List[str]  # not required
     logprobs: List[float]  # not required
 
-@torch.inference_mode()
-def sample_top_p(probs, p):
-    """
-    执行 Top-p (Nucleus) 采样, 从概率分布中采样下一个词。
-    
-    参数：
-        probs (torch.Tensor): 概率分布张量，形状为 `[batch_size, vocab_size]`。
-        p (float): 累积概率阈值，取值范围在 0 到 1 之间。
-    返回：
-        torch.Tensor: 采样得到的词索引，形状为 `[batch_size, 1]`。
-
-    说明：
-        Top-p 采样算法: 选择概率累积和超过阈值 p 的最小集合，将这些词的概率重新归一化后进行采样。
-    """
-    # 对概率分布进行降序排序。probs_sort: 排序后的概率值，形状与 probs 相同。probs_idx: 排序后的索引，用于映射回原始词汇表。
-    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
-    # 计算排序后概率的累积和. 返回的 probs_sum 是累积概率分布。
-    probs_sum = torch.cumsum(probs_sort, dim=-1)
-    # 保留累积概率未超过阈值 p 的词汇的概率，其余词汇的概率被置为 0.0。
-    mask = probs_sum - probs_sort > p # 创建掩码，对于每个位置，计算累积概率（不包括当前词）是否超过阈值 p。
-    probs_sort[mask] = 0.0 # 将累积概率超过阈值 p 的词的概率置零。
-
-    # 对剩余的概率重新归一化, 确保总和为 1。
-    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    # 从重新归一化的概率分布中采样下一个词. 返回的 next_token 是采样得到的词在排序后概率分布中的索引。
-    next_token_sorted_idx = torch.multinomial(probs_sort, num_samples=1)
-    # 在 probs_idx 的最后一维（dim=-1）中，使用 next_token_sorted_idx 作为索引，提取对应的值。沿着 dim=1（列）进行索引提取
-    # NOTE: torch.gather 函数按照给定的索引张量 index，从输入张量中收集 (获取) 数据，并返回一个与索引张量形状一致的张量。
-    next_token = torch.gather(probs_idx, -1, index = next_token_sorted_idx)
-    
-    return next_token # 返回采样得到的下一个词的索引
+class CompletionDelta(TypedDict):
+    """流式输出中一个序列本步新增的文本"""
+    index: int # 序列在 prompts 中的下标
+    text: str
+    finish_reason: Optional[Literal["stop", "length"]] # 序列在本步结束时设置, 否则为 None
 
 class GenerateStreamText:
     """
@@ -60,6 +42,16 @@ class GenerateStreamText:
         triton_weight = True,
         compiled_model = False,
         device="cuda",
+        block_size = 16,
+        enable_prefix_cache = True,
+        prefill_chunk_size = 512,
+        draft_checkpoints_dir = None,
+        num_speculative_tokens = 4,
+        kv_cache_dtype = None,
+        num_swap_blocks = 0,
+        remote_kv_address = None,
+        sink_size = None,
+        window_size = None,
     ):
         self.checkpoints_dir = checkpoints_dir
 
@@ -70,11 +62,52 @@ class GenerateStreamText:
             max_seq_len = max_seq_len,
             triton_weight = triton_weight,
             compiled_model = compiled_model,
-            device = device
+            device = device,
+            block_size = block_size, # 分页 kv cache 每个 block 的 token 数, prefix cache、交换和快照都以 block 为粒度
+            kv_cache_dtype = kv_cache_dtype, # "int8" / "fp8" 量化 kv cache
         )
         self.tokenizer = self.load_tokenizer(tokenizer_path)
         self.model_config = self.model_executor.model_config
         self.device = device
+        # 对话模型的回合结束 token (如 Llama-3 的 <|eot_id|>, Qwen2 的 <|im_end|>) 与 eos 一样结束生成
+        self.stop_token_ids = get_stop_token_ids(self.model_config.model_type, checkpoints_dir)
+        # prefix cache 在多次调用之间共享, 相同的系统提示只需 prefill 一次
+        # 设置 remote_kv_address ("host:port") 时, prefix cache 淘汰的 block 写入远端共享存储, 各副本可以拉回复用
+        kv_mem_manager = self.model_executor.kv_mem_manager
+        remote_tier = None
+        if remote_kv_address is not None:
+            remote_tier = RemoteKVTier.from_address(kv_mem_manager, remote_kv_address, self.model_executor.model_id)
+        self.prefix_cache = RadixPrefixCache(kv_mem_manager, remote_tier) if enable_prefix_cache else None
+        # kv cache 不足时被抢占请求的 kv 换出到主机端的交换空间, 显存空闲后换入, 不必重新 prefill
+        self.swap_space = HostKVCachePool(self.model_executor.kv_mem_manager, num_swap_blocks) if num_swap_blocks > 0 else None
+        # attention sink + 滑动窗口: 设置 window_size 时每个请求的 kv cache 只保留前 sink_size 个和最近的 token,
+        # 显存占用和每个 token 的延迟有上界, 生成长度不受 max_seq_len 限制, 适合长时间的流式对话
+        self.sink_size = block_size if sink_size is None else sink_size # 默认保留第一个 block 作为 sink
+        self.window_size = window_size
+        # 长 prompt 按块 prefill, 每步 prefill 的 token 数不超过该值, 为 None 时整个 prompt 一次 prefill
+        self.prefill_chunk_size = prefill_chunk_size
+        # 约束解码的编译器在第一次使用时创建, 编译得到的词表状态机和掩码在多次调用之间缓存
+        self.grammar_compiler = None
+        # 投机解码: 使用相同 tokenizer 的小模型提议 token, 与目标模型共享 kv cache block 分配器;
+        # 自动计算 kv cache 大小时会占满显存, 使用 draft 模型时应显式设置 max_gpu_num_blocks
+        self.proposer = None
+        self.num_speculative_tokens = num_speculative_tokens
+        self.speculative_stats = [] # 最近一次生成中每个请求的投机解码统计
+        if draft_checkpoints_dir is not None:
+            draft_executor = ModelExecutor.build(
+                checkpoints_dir = draft_checkpoints_dir,
+                load_model = load_model,
+                max_gpu_num_blocks = max_gpu_num_blocks,
+                max_seq_len = max_seq_len,
+                triton_weight = triton_weight,
+                device = device,
+                block_size = block_size, # 共享分配器的 block 索引要互相通用, block_size 必须一致
+                kv_allocator = self.model_executor.kv_mem_manager.allocator,
+                kv_cache_dtype = kv_cache_dtype,
+            )
+            if draft_executor.llm_config.vocab_size > self.model_executor.llm_config.vocab_size:
+                raise ValueError("draft model vocab_size must not exceed the target model vocab_size")
+            self.proposer = DraftModelProposer(draft_executor, num_speculative_tokens)
 
     def load_tokenizer(self, pretrained_model_name_or_path):
         model_name = get_model_name_from_path(pretrained_model_name_or_path)
@@ -85,8 +118,73 @@ class GenerateStreamText:
             tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path, use_fast=True, trust_remote_code=True)
         
         return tokenizer
+
+    def compile_guide(
+        self, regex: Optional[str] = None, json_schema: Optional[Union[str, dict]] = None
+    ) -> Optional[TokenGuide]:
+        """把正则表达式或 JSON schema 编译为约束解码的 TokenGuide, 两者都为 None 时返回 None"""
+        if regex is not None and json_schema is not None:
+            raise ValueError("only one of regex and json_schema can be set")
+        if regex is None and json_schema is None:
+            return None
+        if self.grammar_compiler is None:
+            self.grammar_compiler = GrammarCompiler(
+                self.tokenizer, self.model_executor.llm_config.vocab_size,
+                [self.tokenizer.eos_token_id] + self.stop_token_ids, self.device,
+            )
+        if regex is not None:
+            return self.grammar_compiler.compile_regex(regex)
+        return self.grammar_compiler.compile_json_schema(json_schema)
     
-    @torch.inference_mode()
+    def save_prefix_kv_cache(self, path: str, prompt: str) -> int:
+        """
+        把 prompt (如系统提示或整段对话) 的 kv cache 保存为快照文件, 未在 prefix cache 中的部分先 prefill。
+        重启后或其他进程用 load_prefix_kv_cache 恢复, 以该 prompt 开头的请求直接复用, 不必重新 prefill。
+
+        返回:
+            int: 保存的 token 数, 分页 kv cache 只保存完整的 block。
+        """
+        if self.prefix_cache is None:
+            raise RuntimeError("saving kv cache snapshots requires enable_prefix_cache=True")
+        prompt_tokens = self.tokenizer.encode(prompt, add_special_tokens=True)
+        block_index, num_tokens = self.prefix_cache.match_prefix(prompt_tokens)
+        if num_tokens < len(prompt_tokens):
+            self.model_executor.kv_mem_manager.release_ref(block_index)
+            # 只生成一个 token, 请求结束时 prompt 的 kv 加入 prefix cache
+            for _ in self._stream(
+                [prompt_tokens], 1, 0.0, 1.0, False, -1, 0.0, None, False, None, None, None,
+            ):
+                pass
+            block_index, num_tokens = self.prefix_cache.match_prefix(prompt_tokens)
+        try:
+            self.model_executor.save_kv_cache(path, prompt_tokens[:num_tokens], block_index)
+        finally:
+            self.model_executor.kv_mem_manager.release_ref(block_index)
+        return num_tokens
+
+    def load_prefix_kv_cache(self, path: str) -> int:
+        """
+        把 save_prefix_kv_cache 保存的快照映射回空闲的 block 并加入 prefix cache。
+
+        返回:
+            int: 恢复的 token 数。
+        """
+        if self.prefix_cache is None:
+            raise RuntimeError("loading kv cache snapshots requires enable_prefix_cache=True")
+        kv_mem_manager = self.model_executor.kv_mem_manager
+        result = self.model_executor.load_kv_cache(path)
+        if result is None:
+            # 空闲 block 不足时先淘汰 prefix cache 中没有被使用的 block
+            num_blocks = (read_kv_snapshot_header(path)[0]["num_tokens"] + kv_mem_manager.block_size - 1) // kv_mem_manager.block_size
+            self.prefix_cache.evict(num_blocks - kv_mem_manager.can_use_num_blocks)
+            result = self.model_executor.load_kv_cache(path)
+            if result is None:
+                raise RuntimeError(f"not enough free kv cache blocks to load {path}")
+        token_ids, block_index = result
+        self.prefix_cache.insert(token_ids, block_index)
+        kv_mem_manager.release_ref(block_index) # prefix cache 持有自己的引用
+        return len(token_ids)
+
     def generate_stream(
         self,
         prompt_tokens: List[List[int]],
@@ -94,7 +192,15 @@ class GenerateStreamText:
         temperature: float = 0.6,
         top_p: float = 0.9,
         echo: bool = False,
-    ) -> Generator[Tuple[List[str], Optional[List[float]]], None, None]:
+        top_k: int = -1,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        prompt_lookup: bool = False,
+        stop_token_ids: Optional[List[int]] = None,
+        stop: Optional[List[str]] = None,
+        regex: Optional[str] = None,
+        json_schema: Optional[Union[str, dict]] = None,
+    ) -> Generator[List[str], None, None]:
         """
         基于提供的 prompt_tokens, 使用语言生成模型逐个生成 token, 并在生成时立即输出。
 
@@ -103,113 +209,91 @@ class GenerateStreamText:
             max_gen_len (int): 生成的最大长度。
             temperature (float, optional): 控制采样随机性的温度值。默认为 0.6。
             top_p (float, optional): 用于 nucleus sampling 的概率阈值。默认为 0.9。
+            top_k (int, optional): 只在概率最大的 top_k 个 token 中采样, <= 0 表示不限制。
+            min_p (float, optional): 只保留概率不小于 min_p 倍最大概率的 token。默认为 0, 即不限制。
+            seed (int, optional): 随机种子, 设置后每个请求的采样结果可复现。
+            prompt_lookup (bool, optional): 使用 prompt lookup (n-gram) 投机解码, 从 prompt 和已生成的 token 中
+                查找提议, 不需要 draft 模型。每个请求的接受率记录在 self.speculative_stats 中。
+            stop_token_ids (List[int], optional): 额外的停止 token, 与模型默认的停止 token 和 eos 一起生效。
+            stop (List[str], optional): 停止字符串, 生成的文本中出现任一字符串时该请求立即结束, 输出不含停止字符串;
+                可能是停止字符串开头的文本会暂缓输出, 直到确定不匹配。
+            regex (str, optional): 约束解码, 生成的文本必须完整匹配该正则表达式。
+            json_schema (str | dict, optional): 约束解码, 生成的文本必须是符合该 JSON schema 的 JSON。
+                约束解码的请求不使用投机解码。
             logprobs (bool, optional): 是否计算生成 token 的对数概率。默认为 False。
             echo (bool, optional): 是否在输出中包含 prompt_tokens。默认为 False。
             
         generator 输出：
-            Tuple[List[str], Optional[List[float]]]: 包含生成的文本和对应的对数概率(如果 logprobs 为 True)。
+            List[str]: 每步各序列新增的文本, 本步没有新文本的序列为空字符串。
         说明：
-            该方法在生成循环中，每生成一个新 token, 就立即输出对应的文本和概率(如果需要）。
+            只输出增量文本, 多字节字符被拆成多个 token 时等字符完整后再输出。
         """
-        bsz = len(prompt_tokens)
-
-        min_prompt_len = min(len(t) for t in prompt_tokens)
-        max_prompt_len = max(len(t) for t in prompt_tokens)
-        assert max_prompt_len <= self.model_config.max_seq_len
-        total_len = min(self.model_config.max_seq_len, max_gen_len + max_prompt_len)
-        total_number_tokens = bsz * total_len
-        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
-        self.model_executor.atten_info.max_actual_seq_len = max_prompt_len
-        
-        # 预分配tokens张量
-        tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device="cuda")
-        input_text_mask = tokens != pad_id
-        eos_reached = torch.tensor([False] * bsz, device="cuda")
-        
-        # 填充提示词到 tokens 张量
-        for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device="cuda")
-
-        # 一次性分配 bsz * total_len 个索引
-        self.model_executor.atten_info.select_index = self.model_executor.kv_mem_manager.alloc_kvcache_index(total_number_tokens)
-        select_index = self.model_executor.atten_info.select_index
-
-        # 初始化每个批次项的序列长度
-        actual_prompt_lens = torch.tensor([len(t) for t in prompt_tokens], dtype=torch.long, device=self.device)
-        self.model_executor.atten_info.b_seq_len = actual_prompt_lens
-        # print("self.model_executor.atten_info.b_seq_len ", self.model_executor.atten_info.b_seq_len)  
-
-        # 初始化起始索引张量
-        self.model_executor.atten_info.start_index = select_index[::total_len].to(torch.int32)
-        # print("start_index: ", self.model_executor.atten_info.start_index)
-        
-        # 初始化当前已选择的批次项索引
-        self.model_executor.atten_info.cur_select_index = select_index.unfold(0, max_prompt_len, total_len).reshape(-1)
-        # print("Prefill stage cur_select_index: ", self.model_executor.atten_info.cur_select_index)
+        for _, deltas in self._stream(
+            prompt_tokens, max_gen_len, temperature, top_p, echo, top_k, min_p, seed, prompt_lookup, stop_token_ids, stop,
+            self.compile_guide(regex, json_schema),
+        ):
+            yield deltas
 
-        prev_pos = 0
-        last_yielded_pos = [len(prompt_tokens[i]) if not echo else 0 for i in range(bsz)] # 初始化每个样本已输出的位置
+    @torch.inference_mode()
+    def _stream(
+        self, prompt_tokens, max_gen_len, temperature, top_p, echo, top_k, min_p, seed, prompt_lookup, stop_token_ids, stop,
+        guide,
+    ) -> Generator[Tuple[List[Request], List[str]], None, None]:
+        """每步输出全部请求和各请求新增的文本"""
+        # 连续批处理: 已结束的请求立即退出 batch 并释放 kv cache, 不再陪跑到整个 batch 结束
+        scheduler = ContinuousBatchScheduler(
+            self.model_executor,
+            eos_token_id = self.tokenizer.eos_token_id,
+            max_batch_size = self.model_executor.llm_config.max_batch_size,
+            max_seq_len = self.model_config.max_seq_len,
+            prefill_chunk_size = self.prefill_chunk_size,
+            prefix_cache = self.prefix_cache,
+            device = self.device,
+            swap_space = self.swap_space,
+            sink_size = self.sink_size,
+            window_size = self.window_size,
+            proposer = NgramProposer(self.num_speculative_tokens) if prompt_lookup else self.proposer,
+            tokenizer = self.tokenizer,
+        )
+        stop_token_ids = self.stop_token_ids + list(stop_token_ids or [])
+        requests = [
+            scheduler.add_request(
+                token_ids, max_gen_len, temperature, top_p, top_k, min_p, seed,
+                stop_token_ids=stop_token_ids, stop=stop or (), guide=guide,
+            )
+            for token_ids in prompt_tokens
+        ]
+        # 调度器每步对所有新 token 做一次批量增量解码并维护 request.output_text, 这里只切出尚未输出的部分,
+        # 每步的开销和输出量只与新增文本有关, 与已生成的长度无关
+        yielded_chars = [0] * len(requests)
+        prefixes = self.tokenizer.batch_decode(prompt_tokens, skip_special_tokens=True) if echo else None
 
-        if min_prompt_len == total_len: # 如果 prompt 已经达到最大长度，无需生成
-            logits, _ = self.model.forward(tokens, prev_pos)
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            deltas = []
+            for i, request in enumerate(requests):
+                num_stable_chars = request.num_stable_chars
+                deltas.append(request.output_text[yielded_chars[i]: num_stable_chars])
+                yielded_chars[i] = num_stable_chars
+            if prefixes is not None: # echo 时第一步先输出 prompt
+                deltas = [prefix + delta for prefix, delta in zip(prefixes, deltas)]
+                prefixes = None
+            yield requests, deltas
 
-        for cur_pos in range(min_prompt_len, total_len):
-            input_ids = tokens[:, prev_pos: cur_pos]
-            logits = self.model_executor.forward(input_ids, prev_pos)
-
-            if prev_pos > 0:
-                self.model_executor.atten_info.max_actual_seq_len += 1
-                self.model_executor.atten_info.b_seq_len += 1
-            
-            self.model_executor.atten_info.cur_select_index = (self.model_executor.atten_info.start_index 
-                                                               + self.model_executor.atten_info.b_seq_len)
-            
-            if temperature > 0:
-                # NOTE: logits[:, -1] 表示选择的是最后一个位置（seq_len 维度的最后一项）对应的 logits。
-                # NOTE: 在生成模型中的 prefill 阶段，我们只关心当前生成的最后一个 token 的分布。
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                # NOTE: 使用核采样方法，从高概率的候选 token 中选择下一个 token 索引. top_p 控制采样范围（候选 token 的概率累积值）。
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits[:, -1], dim=-1)
-
-            next_token = next_token.reshape(-1)  # shape is (batch_size,)
-
-            # 仅在需要生成的情况下替换 token
-            # NOTE: input_text_mask[:, cur_pos]：获取掩码中当前列的布尔值，表示每个序列在当前位置是否为实际输入词元。
-            # NOTE: tokens[:, cur_pos]：获取 tokens 中当前列的值。next_token：包含当前生成的词元 ID。
-            next_token = torch.where(input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token)
-            tokens[:, cur_pos] = next_token
-
-            # eos_reached 是一个布尔张量，记录每个序列是否到达了终止状态, 形状为 [batch_size, 1]。
-            # NOTE: ～input_text_mask[:, cur_pos] 标记当前生成位置是否是模型生成的部分（非输入部分）。True 表示当前列是待生成的部分。False 表示当前列是输入部分。
-            # NOTE: next_token == self.tokenizer.eos_token_id 表示检测当前生成的 next_token 是否等于 eos_token_id，即模型生成了终止标记。
-            # NOTE: & 表示按位与操作，确保当前位置是非输入部分且生成了终止标记。
-            # NOTE: 使用 |= 按位或更新，表示如果某个序列已经到达 eos_token_id，则保持 True 状态，不会被后续重置为 False。
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (next_token == self.tokenizer.eos_token_id)
-            prev_pos = cur_pos
-            
-            # 为整个批次收集输出
-            batch_outputs = []
-            for i in range(bsz):
-                start = last_yielded_pos[i]
-                end = cur_pos + 1
-                if start < end:
-                    token = tokens[i, start:end].tolist()
-                    text = self.tokenizer.decode(token, skip_special_tokens=True) # 解码时跳过特殊标记。
-                    batch_outputs.append(text)
-                    last_yielded_pos[i] = end
-                else:
-                    batch_outputs.append('') # 如果没有新生成的内容，添加空字符串
-
-            # 将整个批次的输出一次性 yield
-            yield batch_outputs
-
-            if eos_reached.all():
-                break
-        
-        # 减少 kv cache 内存管理器的引用计数
-        self.model_executor.kv_mem_manager.release_ref(select_index)
+        if scheduler.proposer is not None:
+            self.speculative_stats = [
+                {
+                    "num_proposed_tokens": request.num_proposed_tokens,
+                    "num_accepted_tokens": request.num_accepted_tokens,
+                    "acceptance_rate": request.acceptance_rate,
+                }
+                for request in requests
+            ]
+            for i, stats in enumerate(self.speculative_stats):
+                logger.info(
+                    f"request {i}: accepted {stats['num_accepted_tokens']}/{stats['num_proposed_tokens']} "
+                    f"draft tokens, acceptance rate {stats['acceptance_rate']:.2f}"
+                )
 
     def text_completion_stream(
         self,
@@ -218,23 +302,37 @@ class GenerateStreamText:
         top_p: float = 0.9,
         max_gen_len: Optional[int] = None,
         echo: bool = False,
-    ) -> Generator[List[CompletionPrediction], None, None]:
+        top_k: int = -1,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        prompt_lookup: bool = False,
+        stop_token_ids: Optional[List[int]] = None,
+        stop: Optional[List[str]] = None,
+        regex: Optional[str] = None,
+        json_schema: Optional[Union[str, dict]] = None,
+    ) -> Generator[List[CompletionDelta], None, None]:
+        """
+        流式生成文本, 每步只输出有新文本或刚结束的序列的增量, 调用方自行拼接完整文本。
+        """
         if max_gen_len is None:
+            # 滑动窗口模式下生成长度不受 max_seq_len 限制, 仍需显式设置上限
             max_gen_len = self.model_config.max_seq_len - 1
 
         prompt_tokens = [self.tokenizer.encode(x, add_special_tokens=True) for x in prompts]
 
-        stream = self.generate_stream(
-            prompt_tokens=prompt_tokens,
-            max_gen_len=max_gen_len,
-            temperature=temperature,
-            top_p=top_p,
-            echo=echo,
+        stream = self._stream(
+            prompt_tokens, max_gen_len, temperature, top_p, echo, top_k, min_p, seed, prompt_lookup, stop_token_ids, stop,
+            self.compile_guide(regex, json_schema),
         )
-
-        # 初始化每个样本的生成结果
-        completions = [{'generation': '', 'tokens': []} for _ in prompts]
-        for batch_outputs in stream:
-            for i, text in enumerate(batch_outputs):
-                completions[i]['generation'] += text
-            yield completions.copy()
+        finished = [False] * len(prompts)
+        for requests, deltas in stream:
+            batch_deltas = []
+            for i, (request, text) in enumerate(zip(requests, deltas)):
+                just_finished = request.is_finished and not finished[i]
+                finished[i] = request.is_finished
+                if text or just_finished:
+                    batch_deltas.append(
+                        CompletionDelta(index=i, text=text, finish_reason=request.finish_reason if just_finished else None)
+                    )
+            if batch_deltas:
+                yield batch_deltas
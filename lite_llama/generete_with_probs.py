@@ -2,11 +2,12 @@ from typing import Optional
 import torch
 import logging
 from typing import List, Literal, Optional, Tuple, TypedDict
-import torch.nn.functional as F 
 from transformers import AutoTokenizer
 
 from .executor.model_executor import ModelExecutor
+from .executor.sampler import sample, logprobs_topk
 from .utils.file_interface import get_model_name_from_path
+from .utils.prompt_templates import get_stop_token_ids
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,10 +18,17 @@ class Message(TypedDict):
     role: Role
     content: str
 
+class SequenceLogprobs(TypedDict, total=False):
+    top_logprobs: List[List[Tuple[int, float]]] # 每个生成 token 处对数概率最大的 k 个 (token id, 对数概率), 降序
+    prompt_logprobs: List[Optional[float]] # prompt 每个 token 的对数概率, 第一个 token 没有上文, 为 None
+    prompt_top_logprobs: List[Optional[List[Tuple[int, float]]]]
+
 class CompletionPrediction(TypedDict, total=False):
     generation: str
     tokens: List[str]
     logprobs: List[float]
+    top_logprobs: List[List[Tuple[str, float]]] # 每个生成 token 处概率最大的 k 个 (token 文本, 对数概率)
+    prompt_logprobs: List[Optional[float]]
 
 class ChatPrediction(TypedDict, total=False):
     generation: Message
@@ -34,21 +42,6 @@ B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
 SPECIAL_TAGS = [B_INST, E_INST, "<<SYS>>", "<</SYS>>"]
 UNSAFE_ERROR = "Error: special tags are not allowed as part of the prompt."
 
-@torch.inference_mode()
-def sample_top_p(probs, p: float):
-    # 使用 in-place 操作减少内存分配
-    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
-    probs_sum = torch.cumsum(probs_sort, dim=-1)
-    # mask 记录累积概率超过 p 的位置
-    mask = probs_sum - probs_sort > p
-    # 将超过 p 的概率置 0
-    probs_sort[mask] = 0.0
-    # 原地归一化
-    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    next_token_sorted_idx = torch.multinomial(probs_sort, num_samples=1)
-    next_token = torch.gather(probs_idx, -1, next_token_sorted_idx)
-    return next_token
-
 class GenerateText:
     def __init__(self, 
         checkpoints_dir: str,
@@ -73,6 +66,8 @@ class GenerateText:
         )
         self.model_config = self.model_executor.model_config
         self.tokenizer = self.load_tokenizer(tokenizer_path)
+        # 对话模型的回合结束 token (如 Llama-3 的 <|eot_id|>, Qwen2 的 <|im_end|>) 与 eos 一样结束生成
+        self.stop_token_ids = [self.tokenizer.eos_token_id] + get_stop_token_ids(self.model_config.model_type, checkpoints_dir)
         self.device = device
     
     def load_tokenizer(self, pretrained_model_name_or_path):
@@ -93,21 +88,43 @@ class GenerateText:
         top_p: float = 0.9,
         logprobs: bool = True,
         echo: bool = False,
-        device = "cuda"
-    ) -> Tuple[List[List[int]], Optional[List[List[float]]]]:
+        device = "cuda",
+        check_interval: int = 8,
+        top_logprobs: int = 0,
+        prompt_logprobs: bool = False,
+    ) -> Tuple[List[List[int]], Optional[List[List[float]]], Optional[List[SequenceLogprobs]]]:
         """
         基于提供的提示词 (prompts) 使用语言生成模型生成文本序列。
+        prefill 阶段不做填充: 所有 prompt 首尾相接为一个 varlen batch, 每个 token 使用其在各自序列中的位置编号;
+        decode 阶段每个序列从各自 prompt 的末尾开始生成。
+
+        decode 循环中没有主机与设备之间的同步: 结束标记每 check_interval 步以非阻塞方式拷贝到锁页内存,
+        拷贝完成后才在主机端读取并把已结束的序列移出 batch; 在此之前已结束的序列只做不写入结果的陪跑计算。
+
+        对数概率由融合的 log-softmax + top-k (logprobs_topk) 在设备上计算, 每步的结果按 [1 + 2k] 打包写入设备端缓冲,
+        生成结束后只取出有效的位置, 一次拷贝回主机。
+
+        参数:
+            logprobs (bool): 返回生成 token 的对数概率。
+            top_logprobs (int): 每个生成 token 处额外返回对数概率最大的 top_logprobs 个 token。
+            prompt_logprobs (bool): prefill 时计算 prompt 每个 token 的对数概率 (及 top_logprobs 个候选)。
+        返回:
+            Tuple: 生成的 token、对应的对数概率 (logprobs 为 False 时为 None), 以及 top_logprobs > 0 或
+                prompt_logprobs 时每个序列的 SequenceLogprobs (否则为 None)。
         """
         bsz = len(prompt_tokens)
-        min_prompt_len = min(len(t) for t in prompt_tokens)
-        max_prompt_len = max(len(t) for t in prompt_tokens)
+        prompt_lens = [len(t) for t in prompt_tokens]
+        min_prompt_len = min(prompt_lens)
+        max_prompt_len = max(prompt_lens)
         assert max_prompt_len <= self.model_config.max_seq_len
         total_len = min(self.model_config.max_seq_len, max_gen_len + max_prompt_len)
         pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
         total_number_tokens = bsz * total_len
-        self.model_executor.atten_info.max_actual_seq_len = max_prompt_len
+        atten_info = self.model_executor.atten_info
+        atten_info.b_req_idx = None
+        atten_info.b_prefix_len = None
 
-        # 预分配tokens张量
+        # 预分配tokens张量, 只用于收集输出, pad token 不参与计算
         tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device=device)
         
         # 填充提示词到 tokens 张量
@@ -115,98 +132,133 @@ class GenerateText:
             length = len(token_ids)
             tokens[seq_id, :length] = torch.tensor(token_ids, dtype=torch.long, device=device)
 
-        # 生成一个布尔张量，它的值为 True 的位置表示输入序列的实际内容（即非填充部分）, 形状为 (batch_size, total_len)
-        input_text_mask = tokens != pad_id
-        eos_reached = torch.zeros(bsz, dtype=torch.bool, device=device)
-
-        # 一次性分配 bsz * total_len 个索引
-        self.model_executor.atten_info.select_index = self.model_executor.kv_mem_manager.alloc_kvcache_index(total_number_tokens)
-        select_index = self.model_executor.atten_info.select_index
-
-        # 初始化每个批次项的序列长度
-        actual_prompt_lens = torch.tensor([len(t) for t in prompt_tokens], dtype=torch.long, device=device)
-        self.model_executor.atten_info.b_seq_len = actual_prompt_lens
-        # print("self.model_executor.atten_info.b_seq_len ", self.model_executor.atten_info.b_seq_len)  
-
-        # 初始化起始索引张量
-        self.model_executor.atten_info.start_index = select_index[::total_len].to(torch.int32)
-        # print("start_index: ", self.model_executor.atten_info.start_index)
-        
-        # 初始化当前已选择的批次项索引
-        self.model_executor.atten_info.cur_select_index = select_index.unfold(0, max_prompt_len, total_len).reshape(-1)
-        # print("Prefill stage cur_select_index: ", self.model_executor.atten_info.cur_select_index)
-
-        token_logprobs = torch.zeros((bsz, total_len), dtype=torch.float, device=device) if logprobs else None
-        if min_prompt_len == total_len and logprobs:
-            # 若无生成空间，直接计算已存在 tokens 的对数似然（可选）
-            logits = self.model_executor.forward(tokens, 0)
-            token_logprobs.copy_(
-                -F.cross_entropy(
-                    input=logits.transpose(1, 2),
-                    target=tokens,
-                    reduction="none",
-                    ignore_index=pad_id,
-                )
+        # 一次性分配 bsz * total_len 个索引, 每个序列占用 total_len 个连续位置, 主机端保留一份用于释放
+        kv_mem_manager = self.model_executor.kv_mem_manager
+        host_select_index = kv_mem_manager.alloc_kvcache_index(total_number_tokens, device="cpu")
+        if host_select_index is None:
+            # 静态批处理无法抢占, 显存不足时应减小 batch 或使用 GenerateStreamText (连续批处理, 支持抢占和换出)
+            raise RuntimeError(
+                f"kv cache is not enough for {total_number_tokens} tokens, only {kv_mem_manager.can_use_mem_size} left"
             )
+        select_index = kv_mem_manager._to_device(host_select_index, device)
+        atten_info.select_index = select_index
+        start_index = select_index[::total_len].to(torch.int32)
+        atten_info.start_index = start_index
+
+        # 打包的 prompt: 第 i 个序列为 [cu_seqlens[i], cu_seqlens[i+1]), 位置编号在每个序列内从 0 开始
+        b_prompt_len = torch.tensor(prompt_lens, dtype=torch.int32, device=device)
+        cu_seqlens = torch.zeros(bsz + 1, dtype=torch.int32, device=device)
+        cu_seqlens[1:] = torch.cumsum(b_prompt_len, dim=0)
+        seq_ids = torch.repeat_interleave(torch.arange(bsz, device=device), b_prompt_len.long())
+        position_ids = torch.arange(seq_ids.numel(), device=device) - cu_seqlens[:-1].long()[seq_ids]
+        input_ids = torch.tensor(sum(prompt_tokens, []), dtype=torch.long, device=device)
+        last_token_index = cu_seqlens[1:].long() - 1
+
+        # 生成空间为 0 时同样计算全部 prompt token 的对数似然, echo 时与 prompt 一起返回
+        need_prompt_logprobs = prompt_logprobs or (logprobs and min_prompt_len == total_len)
+        need_gen_logprobs = logprobs or top_logprobs > 0
+        num_values = 1 + 2 * top_logprobs # 打包格式: [token 的对数概率, top-k 对数概率, top-k token id]
+        atten_info.cu_seqlens = cu_seqlens
+        atten_info.max_q_len = max_prompt_len
+        atten_info.num_decode_seqs = 0
+        atten_info.logits_index = torch.arange(seq_ids.numel(), device=device) if need_prompt_logprobs else last_token_index
+        atten_info.b_seq_len = b_prompt_len
+        atten_info.max_actual_seq_len = max_prompt_len
+        atten_info.cur_select_index = start_index.long()[seq_ids] + position_ids
+
+        gen_values = None
+        if need_gen_logprobs:
+            gen_values = torch.zeros((bsz, max(max_gen_len, 1), num_values), dtype=torch.float32, device=device)
 
         start_event = torch.cuda.Event(enable_timing=True)
         end_event = torch.cuda.Event(enable_timing=True)
         start_event.record()
 
-        token_count = 0
-        prev_pos = 0 # 初始化上一次生成的位置
-        # 为减少循环中的判断逻辑，这里将range起点由min_prompt_len改成max_prompt_len
-        # 因为在[min_prompt_len, max_prompt_len)区间，有的样本已经完成输入填充，有的刚好开始生成
-        # 实际上可以统一从 max_prompt_len 开始生成，因为在 (min_prompt_len, max_prompt_len) 的位置上，有的样本还属于prompt部分
-        # 这样减少复杂判断逻辑
-        for cur_pos in range(max_prompt_len, total_len):
-            # 取出新加入模型的 token (一般为单步输入)
-            input_ids = tokens[:, cur_pos - 1: cur_pos] if cur_pos > 0 else tokens[:, :1]
-            logits = self.model_executor.forward(input_ids, prev_pos)
-            
-            if prev_pos > 0:
-                self.model_executor.atten_info.max_actual_seq_len += 1
-                self.model_executor.atten_info.b_seq_len += 1
-            
-            self.model_executor.atten_info.cur_select_index = (self.model_executor.atten_info.start_index 
-                                                               + self.model_executor.atten_info.b_seq_len)
-            
-            # 对最后一个位置进行 softmax
-            step_logits = logits[:, -1, :]
-            if temperature > 0:
-                probs = F.softmax(step_logits / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p).reshape(-1)
-            else:
-                next_token = torch.argmax(step_logits, dim=-1)
-
-            # 对仍在生成过程（非输入部分）的位置写入next_token
-            # 对尚在prompt部分的位置保持原值不变
-            to_generate = ~input_text_mask[:, cur_pos]
-            next_token = torch.where(input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token)
-            tokens[:, cur_pos] = next_token
-
-            if logprobs:
-                # 本步仅计算新生成 token 的 logprob，而非整段重复计算
-                # 使用CrossEntropy时，只需对单一token位置进行计算, 可用gather简化
-                # CE = -log(softmax)，logit对应step_logits
-                # 获取实际的token目标值
-                target = tokens[:, cur_pos]
-                # 使用 log_softmax 代替 cross_entropy，可以只提取相应token的logprob
-                log_probs = F.log_softmax(step_logits, dim=-1)
-                step_logprobs = torch.gather(log_probs, 1, target.unsqueeze(1)).squeeze(1)
-
-                # 将计算结果写入相应位置
-                token_logprobs[:, cur_pos] = step_logprobs
-
-            # 检查终止条件
-            finished = to_generate & (next_token == self.tokenizer.eos_token_id)
-            eos_reached |= finished
-            prev_pos = cur_pos
-
-            token_count += (to_generate).sum().item()
-            if eos_reached.all():
+        try:
+            logits = self.model_executor.forward(input_ids.unsqueeze(0), 0, position_ids=position_ids.unsqueeze(0))[0]
+        finally:
+            atten_info.cu_seqlens = None
+        prompt_values = None
+        if need_prompt_logprobs:
+            # 位置 p 的 logits 给出位置 p + 1 的 token 的对数概率, 每个 prompt 的第一个 token 没有值 (nan)
+            prompt_values = torch.full((bsz, max_prompt_len, num_values), float("nan"), device=device)
+            src = torch.nonzero(position_ids < b_prompt_len.long()[seq_ids] - 1).view(-1)
+            prompt_values[seq_ids[src], position_ids[src] + 1] = logprobs_topk(logits[src], input_ids[src + 1], top_logprobs)
+            logits = logits[last_token_index]
+
+        # 每个序列最多生成 min(max_gen_len, total_len - prompt_len) 个 token, 不会越过自己的 kv cache 区域
+        kv_index = host_select_index.view(bsz, total_len)
+        rows = torch.arange(bsz, device=device) # 仍在 batch 中的序列在原 batch 中的行号
+        host_rows = torch.arange(bsz)
+        cur_lens = b_prompt_len.long() # 下一个生成的 token 所在的位置
+        gen_left = torch.clamp(total_len - cur_lens, max=max_gen_len)
+        done = gen_left <= 0
+        num_generated = torch.zeros(bsz, dtype=torch.long, device=device)
+        stop_ids = torch.tensor(self.stop_token_ids, dtype=torch.long, device=device)
+
+        # 异步终止检查: done 拷贝到锁页内存, 用 event 判断拷贝是否完成, 不阻塞 decode 循环
+        use_cuda = torch.device(device).type == "cuda"
+        host_done = torch.empty(bsz, dtype=torch.bool, pin_memory=use_cuda)
+        check_event = torch.cuda.Event() if use_cuda else None
+        host_done.copy_(torch.tensor([prompt_len >= total_len for prompt_len in prompt_lens]))
+        check_pending = True # 未 record 的 event 视为已完成
+        step_logits = logits
+        for step in range(max_gen_len):
+            if check_pending and (check_event is None or check_event.query()):
+                finished = host_done[:host_rows.numel()].clone()
+                check_pending = False
+                if finished.any():
+                    # 已结束的序列移出 batch 并立即释放其 kv cache, 后续 decode 只计算仍在生成的序列
+                    kv_mem_manager.release_ref(kv_index[host_rows[finished]].reshape(-1))
+                    host_rows = host_rows[~finished]
+                    keep = (~finished).to(device, non_blocking=True)
+                    rows, cur_lens, gen_left, done = rows[keep], cur_lens[keep], gen_left[keep], done[keep]
+                    if step_logits is not None:
+                        step_logits = step_logits[keep]
+            if host_rows.numel() == 0:
                 break
 
+            if step_logits is None:
+                # decode: 输入各序列最新的 token, 位置为 cur_lens - 1, 已结束但尚未移出的序列重复计算最后一个 token
+                atten_info.start_index = start_index[rows]
+                atten_info.b_seq_len = cur_lens.to(torch.int32)
+                atten_info.max_actual_seq_len = max_prompt_len + step
+                atten_info.cur_select_index = start_index[rows].long() + cur_lens - 1
+                input_ids = tokens[rows, cur_lens - 1].unsqueeze(1)
+                logits = self.model_executor.forward(input_ids, 0, position_ids=(cur_lens - 1).unsqueeze(1))
+                step_logits = logits[:, -1, :]
+
+            num_rows = host_rows.numel()
+            next_token = sample(step_logits, [temperature] * num_rows, top_ps=[top_p] * num_rows)
+
+            # 结果按原 batch 的行号写回, 已结束的序列保持不变
+            active = ~done
+            write_pos = torch.clamp(cur_lens, max=total_len - 1)
+            tokens[rows, write_pos] = torch.where(active, next_token, tokens[rows, write_pos])
+            if need_gen_logprobs:
+                # 融合 kernel 只读取一次 logits, 不生成 [batch_size, vocab_size] 的 log_softmax
+                step_values = logprobs_topk(step_logits, next_token, top_logprobs)
+                col = torch.clamp(num_generated[rows], max=gen_values.shape[1] - 1)
+                gen_values[rows, col] = torch.where(active[:, None], step_values, gen_values[rows, col])
+
+            # 更新终止条件, 全部在设备上完成
+            num_generated[rows] += active.long()
+            cur_lens = cur_lens + active.long()
+            gen_left = gen_left - active.long()
+            done = done | torch.isin(next_token, stop_ids) | (gen_left <= 0)
+            step_logits = None
+
+            if not check_pending and (step + 1) % check_interval == 0:
+                host_done[:host_rows.numel()].copy_(done, non_blocking=use_cuda)
+                if check_event is not None:
+                    check_event.record()
+                check_pending = True
+
+        # 生成 max_gen_len 步后所有序列都已结束, 释放尚未移出 batch 的序列的 kv cache
+        if host_rows.numel() > 0:
+            kv_mem_manager.release_ref(kv_index[host_rows].reshape(-1))
+        token_count = int(num_generated.sum())
+
         end_event.record()
         torch.cuda.synchronize()
 
@@ -215,15 +267,11 @@ class GenerateText:
         logger.info(f"Batch inference time, no decode: {elapsed_time_sec * 1000:.4f} ms")
         logger.info(f"Tokens per second, no decode: {tokens_per_second:.2f} tokens/s")
 
-        out_tokens, out_logprobs = self.process_output_tokens(
-            tokens, prompt_tokens, max_gen_len, logprobs, echo, self.tokenizer.eos_token_id, token_logprobs
+        return self.process_output_tokens(
+            tokens, prompt_tokens, num_generated, echo, self.stop_token_ids,
+            logprobs, top_logprobs, prompt_logprobs, gen_values, prompt_values,
         )
 
-        # 减少 kv cache 内存管理器的引用计数
-        self.model_executor.kv_mem_manager.release_ref(select_index)
-
-        return out_tokens, out_logprobs
-
     def text_completion(
         self,
         prompts: List[str],
@@ -233,12 +281,14 @@ class GenerateText:
         logprobs: bool = False,
         echo: bool = False,
         device = "cuda",
+        top_logprobs: int = 0,
+        prompt_logprobs: bool = False,
     ) -> List[CompletionPrediction]:
         if max_gen_len is None:
             max_gen_len = self.model_config.max_seq_len - 1
 
         input_ids = self.tokenizer.batch_encode_plus(prompts, add_special_tokens=True).input_ids
-        generated_ids, generation_logprobs = self.generate(
+        generated_ids, generation_logprobs, details = self.generate(
             prompt_tokens = input_ids,
             max_gen_len = max_gen_len,
             temperature = temperature,
@@ -246,17 +296,28 @@ class GenerateText:
             logprobs = logprobs,
             echo = echo,
             device = device,
+            top_logprobs = top_logprobs,
+            prompt_logprobs = prompt_logprobs,
         )
 
-        if logprobs:
-            return [
-                {
+        if logprobs or details is not None:
+            predictions = []
+            for i, t in enumerate(generated_ids):
+                prediction: CompletionPrediction = {
                     "generation": self.tokenizer.decode(t, skip_special_tokens=True),
                     "tokens": [self.tokenizer.decode([x], skip_special_tokens=True) for x in t],
-                    "logprobs": logprobs_i,
                 }
-                for t, logprobs_i in zip(generated_ids, generation_logprobs)
-            ]
+                if logprobs:
+                    prediction["logprobs"] = generation_logprobs[i]
+                if top_logprobs > 0:
+                    prediction["top_logprobs"] = [
+                        [(self.tokenizer.decode([token]), logprob) for token, logprob in candidates]
+                        for candidates in details[i]["top_logprobs"]
+                    ]
+                if prompt_logprobs:
+                    prediction["prompt_logprobs"] = details[i]["prompt_logprobs"]
+                predictions.append(prediction)
+            return predictions
         generated_texts = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
         return generated_texts
 
@@ -264,41 +325,86 @@ class GenerateText:
         self,
         tokens: torch.Tensor,
         prompt_tokens: List[List[int]],
-        max_gen_len: int,
-        logprobs: bool,
+        num_generated: torch.Tensor,
         echo: bool,
-        eos_token_id,
-        token_logprobs: Optional[torch.Tensor] = None
-    ) -> Tuple[List[List[int]], Optional[List[List[float]]]]:
-
-        out_tokens = []
-        out_logprobs = [] if logprobs else None
+        stop_token_ids: List[int],
+        logprobs: bool = False,
+        top_logprobs: int = 0,
+        prompt_logprobs: bool = False,
+        gen_values: Optional[torch.Tensor] = None,
+        prompt_values: Optional[torch.Tensor] = None,
+    ) -> Tuple[List[List[int]], Optional[List[List[float]]], Optional[List[SequenceLogprobs]]]:
+        """
+        提取最终的输出序列。对数概率只取出各序列有效的位置 (prompt 与实际生成的 token), 拼接后一次拷贝回主机。
+        """
         tokens_list = tokens.tolist()  # 转为CPU列表，只在最终处理输出时进行
-
-        if logprobs:
-            logprobs_list = token_logprobs.tolist()
-
+        stop_token_ids = set(stop_token_ids)
+        num_generated = num_generated.tolist()
+        prompt_lens = [len(t) for t in prompt_tokens]
+
+        # 有效位置的下标在主机端构造, 设备上一次 gather 后拷贝
+        parts = []
+        if gen_values is not None:
+            rows = [i for i, n in enumerate(num_generated) for _ in range(n)]
+            cols = [j for n in num_generated for j in range(n)]
+            parts.append(gen_values[rows, cols])
+        if prompt_values is not None:
+            rows = [i for i, n in enumerate(prompt_lens) for _ in range(n)]
+            cols = [j for n in prompt_lens for j in range(n)]
+            parts.append(prompt_values[rows, cols])
+        values = torch.cat(parts).cpu().tolist() if parts else []
+        offset = 0
+        seq_gen_values, seq_prompt_values = [], []
+        if gen_values is not None:
+            for n in num_generated:
+                seq_gen_values.append(values[offset: offset + n])
+                offset += n
+        if prompt_values is not None:
+            for n in prompt_lens:
+                seq_prompt_values.append(values[offset: offset + n])
+                offset += n
+
+        k = top_logprobs
+        top_of = lambda row: [(int(token), logprob) for logprob, token in zip(row[1: 1 + k], row[1 + k:])]
+        out_tokens, out_logprobs = [], [] if logprobs else None
+        out_details = [] if top_logprobs > 0 or prompt_logprobs else None
         for i, seq_tokens in enumerate(tokens_list):
-            prompt_len = len(prompt_tokens[i])
-            start_idx = 0 if echo else prompt_len
-            end_idx = prompt_len + max_gen_len
-            generated_toks = seq_tokens[start_idx:end_idx]
-
-            if logprobs:
-                seq_logprobs = logprobs_list[i][start_idx:end_idx]
-
-            # 截断到 EOS 之前
-            if eos_token_id in generated_toks:
-                eos_idx = generated_toks.index(eos_token_id)
-                generated_toks = generated_toks[:eos_idx]
-                if logprobs:
-                    seq_logprobs = seq_logprobs[:eos_idx]
-
-            out_tokens.append(generated_toks)
+            prompt_len = prompt_lens[i]
+            generated_toks = seq_tokens[prompt_len: prompt_len + num_generated[i]]
+            gen_rows = seq_gen_values[i] if gen_values is not None else []
+
+            # 截断到第一个停止 token (eos 或回合结束 token) 之前
+            for eos_idx, token in enumerate(generated_toks):
+                if token in stop_token_ids:
+                    generated_toks = generated_toks[:eos_idx]
+                    gen_rows = gen_rows[:eos_idx]
+                    break
+
+            prompt_rows = seq_prompt_values[i] if prompt_values is not None else []
+            # 位置 0 为 nan (没有上文)
+            seq_prompt_logprobs = [None if row[0] != row[0] else row[0] for row in prompt_rows]
+
+            out_tokens.append(list(prompt_tokens[i]) + generated_toks if echo else generated_toks)
             if logprobs:
+                seq_logprobs = [row[0] for row in gen_rows]
+                if echo:
+                    # 未计算 prompt 对数概率时 prompt 部分为 0
+                    prompt_part = [p or 0.0 for p in seq_prompt_logprobs] if prompt_rows else [0.0] * prompt_len
+                    seq_logprobs = prompt_part + seq_logprobs
                 out_logprobs.append(seq_logprobs)
-
-        return (out_tokens, out_logprobs if logprobs else None)
+            if out_details is not None:
+                details = SequenceLogprobs()
+                if top_logprobs > 0:
+                    details["top_logprobs"] = [top_of(row) for row in gen_rows]
+                if prompt_logprobs:
+                    details["prompt_logprobs"] = seq_prompt_logprobs
+                    if top_logprobs > 0:
+                        details["prompt_top_logprobs"] = [
+                            None if logprob is None else top_of(row) for logprob, row in zip(seq_prompt_logprobs, prompt_rows)
+                        ]
+                out_details.append(details)
+
+        return out_tokens, out_logprobs, out_details
     
     def chat_completion(
         self,
@@ -352,7 +458,7 @@ class GenerateText:
             )
             prompt_tokens.append(dialog_tokens)
 
-        generation_tokens, generation_logprobs = self.generate(
+        generation_tokens, generation_logprobs, _ = self.generate(
             prompt_tokens=prompt_tokens,
             max_gen_len=max_gen_len,
             temperature=temperature,
@@ -4,11 +4,14 @@ from .layernorm import layernorm
 from .activations import (gelu, relu, leaky_relu, tanh)
 from .activation_layers import ACT2FN
 from .flashattention import flash_attention_v1
-from .flashattentionv2 import flash_attention_v2
-from .flashdecoding import flash_decoding
+from .flashattentionv2 import flash_attention_v2, flash_attention_v2_varlen, flash_attention_v2_paged, flash_attention_v2_varlen_paged
+from .flashdecoding import flash_decoding, flash_decoding_paged
 from .fused_linear import (fused_linear)
 from .rope import (precompute_freqs_cis, rope)
 from .swiglu import (SiLUMulFunction, swiglu_forward)
 from .rope_layer import rope_forward
 from .rotary_emb import rotary_emb_fwd
-from .softmax_split import softmax_split
\ No newline at end of file
+from .softmax_split import softmax_split
+from .softmax_sampling import fused_top_p_sampling
+from .logprobs import fused_logprobs_topk
+from .kv_quant import quantize_kv_cache, write_kv_cache, split_kv_scale
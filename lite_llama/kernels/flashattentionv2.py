@@ -7,6 +7,8 @@ import triton.language as tl
 from torch.cuda.amp import custom_fwd
 from typing import List, Optional, Union
 
+from .kv_quant import kv_scale_args
+
 # TESLA = "Tesla" in torch.cuda.get_device_name(0)
 
 @triton.jit
@@ -222,4 +224,573 @@ def flash_attention_v2(
         qk_scale,
         causal_mask
     )
-    return output
\ No newline at end of file
+    return output
+
+@triton.jit
+def flash_attention_v2_varlen_kernel(
+    q_ptr,
+    k_ptr,
+    v_ptr,
+    o_ptr,
+    cu_seqlens_ptr,
+
+    q_tokens_stride,
+    q_heads_stride,
+    q_dim_stride,
+
+    k_tokens_stride,
+    k_heads_stride,
+    k_dim_stride,
+
+    v_tokens_stride,
+    v_heads_stride,
+    v_dim_stride,
+
+    out_tokens_stride,
+    out_heads_stride,
+    out_dim_stride,
+
+    num_kv_groups, # group of kv heads
+    n_heads,      # number of heads
+    HEAD_DIM: tl.constexpr, # head_dim dimension
+    BLOCK_M_SIZE: tl.constexpr,
+    BLOCK_N_SIZE: tl.constexpr,
+    qk_scale,
+    ):
+    """
+    flashattention2 的 varlen 内核: 各序列的 q k v 首尾相接存放, 第 i 个序列为 [cu_seqlens[i], cu_seqlens[i+1]),
+    每个序列只对自己的 token 做因果 attention, 不需要填充 (padding)。
+    """
+    block_m_idx = tl.program_id(0)
+    head_idx = tl.program_id(1)
+
+    cur_batch_idx = head_idx // n_heads
+    cur_head_idx = head_idx % n_heads
+    cur_kv_head_idx = cur_head_idx // num_kv_groups
+
+    seq_start = tl.load(cu_seqlens_ptr + cur_batch_idx)
+    seq_len = tl.load(cu_seqlens_ptr + cur_batch_idx + 1) - seq_start
+    if block_m_idx * BLOCK_M_SIZE >= seq_len:
+        return # 按最长序列划分 grid, 较短序列多余的 query 块直接退出
+
+    m_range_offs = tl.arange(0, BLOCK_M_SIZE)
+    n_range_offs = tl.arange(0, BLOCK_N_SIZE)
+    dhead_range_offs = tl.arange(0, HEAD_DIM)
+
+    offs_m = block_m_idx * BLOCK_M_SIZE + m_range_offs
+
+    offs_q = (
+        (seq_start + offs_m[:, None]) * q_tokens_stride
+        + cur_head_idx * q_heads_stride
+        + dhead_range_offs[None, :] * q_dim_stride)
+    offs_o = (
+        (seq_start + offs_m[:, None]) * out_tokens_stride
+        + cur_head_idx * out_heads_stride
+        + dhead_range_offs[None, :] * out_dim_stride)
+
+    q_mask = offs_m[:, None] < seq_len
+    q = tl.load(q_ptr + offs_q, mask=q_mask, other=0.0)
+
+    m_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32) - float("inf")
+    d_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M_SIZE, HEAD_DIM], dtype=tl.float32)
+
+    # 因果遮罩下, 当前 query 块只需要看到其最后一个 query 位置之前的 key
+    n_end = tl.minimum((block_m_idx + 1) * BLOCK_M_SIZE, seq_len)
+    for block_n_start_idx in range(0, n_end, BLOCK_N_SIZE):
+        offs_n = block_n_start_idx + n_range_offs
+        n_mask = offs_n < n_end
+
+        k = tl.load(
+            k_ptr + (seq_start + offs_n[:, None]) * k_tokens_stride + cur_kv_head_idx * k_heads_stride + dhead_range_offs[None, :] * k_dim_stride,
+            mask=n_mask[:, None], other=0.0
+        )
+
+        qk = tl.dot(q, tl.trans(k))
+        mask = (offs_m[:, None] >= offs_n[None, :]) & n_mask[None, :]
+        qk = qk * qk_scale + tl.where(mask, 0, -1.0e8)
+        m_ij = tl.maximum(m_i, tl.max(qk, 1))
+        qk -= m_ij[:, None]
+
+        p = tl.math.exp2(qk)
+        d_ij = tl.sum(p, 1)
+        alpha = tl.math.exp2(m_i - m_ij)
+        d_i = d_i * alpha + d_ij
+        acc = acc * alpha[:, None]
+
+        v = tl.load(
+            v_ptr + (seq_start + offs_n[:, None]) * v_tokens_stride + cur_kv_head_idx * v_heads_stride + dhead_range_offs[None, :] * v_dim_stride,
+            mask=n_mask[:, None], other=0.0
+        )
+        p = p.to(v.dtype)
+        acc = tl.dot(p, v, acc)
+        m_i = m_ij
+
+    acc = acc / d_i[:, None]
+    tl.store(o_ptr + offs_o, acc, mask=q_mask)
+
+@torch.no_grad()
+def flash_attention_v2_varlen(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    qk_scale,
+    cu_seqlens: torch.Tensor,
+    max_seqlen: int,
+    ):
+    """flash_attention_v2 的 varlen 模式, 多个长度不同的 prompt 不做填充, 打包后一次完成 prefill attention
+    参数:
+        q: Query tensor, shape: [total_tokens, n_heads, head_dim], 各序列的 token 首尾相接.
+        k: Key tensor, shape: [total_tokens, kv_num_heads, head_dim].
+        v: Value tensor, shape is consistent with k.
+        qk_scale: 与 flash_attention_v2 相同, 需要预先乘以 1/log(2).
+        cu_seqlens: shape: [bs + 1], 各序列在打包张量中的起始偏移, cu_seqlens[-1] = total_tokens.
+        max_seqlen: 最长的序列长度, 用于划分 grid.
+    """
+    BLOCK_SIZE = 64
+    num_kv_groups = q.shape[1] // k.shape[1]
+    output = torch.empty_like(q)
+
+    assert q.shape[-1] == k.shape[-1] == v.shape[-1]
+    assert q.dtype == k.dtype == v.dtype, f"All tensors must have the same dtype: {q.dtype}, {k.dtype}, {v.dtype}"
+    _, n_heads, head_dim = q.size()
+    bs = cu_seqlens.shape[0] - 1
+
+    grid = lambda meta: (triton.cdiv(max_seqlen, BLOCK_SIZE), bs*n_heads, 1)
+    flash_attention_v2_varlen_kernel[grid](
+        q,
+        k,
+        v,
+        output,
+        cu_seqlens,
+        *q.stride(),
+        *k.stride(),
+        *v.stride(),
+        *output.stride(),
+        num_kv_groups,
+        n_heads,
+        head_dim,
+        BLOCK_SIZE,  # BLOCK_M_SIZE
+        BLOCK_SIZE,  # BLOCK_N_SIZE
+        qk_scale,
+    )
+    return output
+
+def torch_varlen_attention(q, k, v, cu_seqlens):
+    """flash_attention_v2_varlen 的 pytorch 参考实现, 逐个序列做因果 attention, softmax 缩放因子为 1/sqrt(head_dim)"""
+    num_kv_groups = q.shape[1] // k.shape[1]
+    output = torch.empty_like(q)
+    for i in range(cu_seqlens.shape[0] - 1):
+        start, end = int(cu_seqlens[i]), int(cu_seqlens[i + 1])
+        qi = q[start:end].transpose(0, 1).float() # [n_heads, seq_len, head_dim]
+        ki = k[start:end].transpose(0, 1).repeat_interleave(num_kv_groups, dim=0).float()
+        vi = v[start:end].transpose(0, 1).repeat_interleave(num_kv_groups, dim=0).float()
+        scores = torch.matmul(qi, ki.transpose(1, 2)) / math.sqrt(q.shape[-1])
+        causal_mask = torch.ones(end - start, end - start, dtype=torch.bool, device=q.device).tril()
+        scores = scores.masked_fill(~causal_mask, float("-inf"))
+        output[start:end] = torch.matmul(torch.softmax(scores, dim=-1), vi).transpose(0, 1).to(q.dtype)
+    return output
+
+@triton.jit
+def flash_attention_v2_paged_kernel(
+    q_ptr,
+    k_cache_ptr,
+    v_cache_ptr,
+    o_ptr,
+    block_tables_ptr,
+    b_req_idx_ptr,
+    b_prefix_len_ptr,
+
+    q_batch_stride,
+    q_heads_stride,
+    q_seq_stride,
+    q_dim_stride,
+
+    k_tokens_stride,
+    k_heads_stride,
+    k_dim_stride,
+
+    v_tokens_stride,
+    v_heads_stride,
+    v_dim_stride,
+
+    out_batch_stride,
+    out_heads_stride,
+    out_seq_stride,
+    out_dim_stride,
+
+    block_tables_bs_stride,
+    block_tables_seq_stride,
+
+    k_scale_ptr, # 量化 kv cache 的缩放因子, KV_QUANT 为 False 时不读取
+    v_scale_ptr,
+    ks_tokens_stride,
+    ks_heads_stride,
+    vs_tokens_stride,
+    vs_heads_stride,
+
+    num_kv_groups, # group of kv heads
+    n_heads,      # number of heads
+    m_size,       # sequence length of q
+    HEAD_DIM: tl.constexpr, # head_dim dimension
+    BLOCK_M_SIZE: tl.constexpr,
+    BLOCK_N_SIZE: tl.constexpr,
+    KV_BLOCK_SIZE: tl.constexpr, # kv cache 每个 block 包含的 token 数
+    qk_scale,
+    KV_QUANT: tl.constexpr = False, # kv cache 为 int8 / fp8 时在加载后反量化为 q 的类型
+    ):
+    """
+    带前缀的 prefill flashattention2 内核: 第 i 个序列前 b_prefix_len[i] 个 token 的 kv 已在分页 kv cache 中,
+    本次 m_size 个 token 的 kv 也已写入 cache, k v 全部按 block table 从 cache 中读取, query 的绝对位置为 prefix_len + m。
+    """
+    block_m_idx = tl.program_id(0)
+    head_idx = tl.program_id(1)
+
+    cur_batch_idx = head_idx // n_heads
+    cur_head_idx = head_idx % n_heads
+    cur_kv_head_idx = cur_head_idx // num_kv_groups
+
+    prefix_len = tl.load(b_prefix_len_ptr + cur_batch_idx)
+    cur_req_idx = tl.load(b_req_idx_ptr + cur_batch_idx)
+
+    m_range_offs = tl.arange(0, BLOCK_M_SIZE)
+    n_range_offs = tl.arange(0, BLOCK_N_SIZE)
+    dhead_range_offs = tl.arange(0, HEAD_DIM)
+
+    offs_m = block_m_idx * BLOCK_M_SIZE + m_range_offs
+    q_pos = prefix_len + offs_m # query 在整个序列中的位置
+
+    offs_q = (
+        cur_batch_idx * q_batch_stride
+        + cur_head_idx * q_heads_stride
+        + (offs_m[:, None] * q_seq_stride + dhead_range_offs[None,:] * q_dim_stride))
+    offs_o = (
+        cur_batch_idx * out_batch_stride
+        + cur_head_idx * out_heads_stride
+        + (offs_m[:,None] * out_seq_stride + dhead_range_offs[None,:] * out_dim_stride))
+
+    q_mask = offs_m[:, None] < m_size
+    q = tl.load(q_ptr + offs_q, mask=q_mask, other=0.0)
+    block_table_ptrs = block_tables_ptr + cur_req_idx * block_tables_bs_stride
+
+    m_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32) - float("inf")
+    d_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M_SIZE, HEAD_DIM], dtype=tl.float32)
+
+    # 因果遮罩下, 当前 query 块只需要看到其最后一个 query 位置之前的 key
+    n_end = tl.minimum(prefix_len + (block_m_idx + 1) * BLOCK_M_SIZE, prefix_len + m_size)
+    for block_n_start_idx in range(0, n_end, BLOCK_N_SIZE):
+        offs_n = block_n_start_idx + n_range_offs
+        n_mask = offs_n < n_end
+
+        # 按 block table 换算 key 在 kv cache 中的位置
+        block_idx = tl.load(block_table_ptrs + (offs_n // KV_BLOCK_SIZE) * block_tables_seq_stride, mask=n_mask, other=0).to(tl.int64)
+        kv_loc = block_idx * KV_BLOCK_SIZE + offs_n % KV_BLOCK_SIZE
+        k = tl.load(
+            k_cache_ptr + kv_loc[:, None] * k_tokens_stride + cur_kv_head_idx * k_heads_stride + dhead_range_offs[None, :] * k_dim_stride,
+            mask=n_mask[:, None], other=0.0
+        )
+        if KV_QUANT:
+            k_s = tl.load(k_scale_ptr + kv_loc * ks_tokens_stride + cur_kv_head_idx * ks_heads_stride, mask=n_mask, other=0.0)
+            k = (k.to(tl.float32) * k_s[:, None]).to(q.dtype)
+
+        qk = tl.dot(q, tl.trans(k))
+        mask = (q_pos[:, None] >= offs_n[None, :]) & n_mask[None, :]
+        qk = qk * qk_scale + tl.where(mask, 0, -1.0e8)
+        m_ij = tl.maximum(m_i, tl.max(qk, 1))
+        qk -= m_ij[:, None]
+
+        p = tl.math.exp2(qk)
+        d_ij = tl.sum(p, 1)
+        alpha = tl.math.exp2(m_i - m_ij)
+        d_i = d_i * alpha + d_ij
+        acc = acc * alpha[:, None]
+
+        v = tl.load(
+            v_cache_ptr + kv_loc[:, None] * v_tokens_stride + cur_kv_head_idx * v_heads_stride + dhead_range_offs[None, :] * v_dim_stride,
+            mask=n_mask[:, None], other=0.0
+        )
+        if KV_QUANT:
+            v_s = tl.load(v_scale_ptr + kv_loc * vs_tokens_stride + cur_kv_head_idx * vs_heads_stride, mask=n_mask, other=0.0)
+            v = (v.to(tl.float32) * v_s[:, None]).to(q.dtype)
+        p = p.to(v.dtype)
+        acc = tl.dot(p, v, acc)
+        m_i = m_ij
+
+    acc = acc / d_i[:, None]
+    tl.store(o_ptr + offs_o, acc, mask=q_mask)
+
+@torch.no_grad()
+def flash_attention_v2_paged(
+    q: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    qk_scale,
+    block_tables: torch.Tensor,
+    b_req_idx: torch.Tensor,
+    b_prefix_len: torch.Tensor,
+    block_size: int = 1,
+    k_scale: torch.Tensor = None,
+    v_scale: torch.Tensor = None,
+    ):
+    """带已缓存前缀的 prefill attention, 用于 prefix cache 命中和分块 prefill
+    参数:
+        q: Query tensor, shape: [bs, n_heads, m_size, head_dim], 本次 prefill 的 token.
+        k_cache, v_cache: 分页 kv cache, shape: [num_blocks * block_size, kv_num_heads, head_dim], 本次 token 的 kv 需已写入.
+        qk_scale: 与 flash_attention_v2 相同, 需要预先乘以 1/log(2).
+        block_tables, b_req_idx: 各序列占用的 kv cache block, 含义同 flash_decoding_paged.
+        b_prefix_len: shape: [bs], 各序列本次 prefill 之前已缓存的 token 数.
+        k_scale, v_scale: 量化 kv cache 的缩放因子, shape: [num_blocks * block_size, kv_num_heads], 为 None 表示未量化.
+    """
+    BLOCK_SIZE = 64
+    num_kv_groups = q.shape[1] // k_cache.shape[1]
+    output = torch.empty_like(q)
+
+    assert q.shape[-1] == k_cache.shape[-1] == v_cache.shape[-1]
+    bs, n_heads, m_size, head_dim = q.size()
+
+    grid = lambda meta: (triton.cdiv(m_size, BLOCK_SIZE), bs*n_heads, 1)
+    flash_attention_v2_paged_kernel[grid](
+        q,
+        k_cache,
+        v_cache,
+        output,
+        block_tables,
+        b_req_idx,
+        b_prefix_len,
+        *q.stride(),
+        *k_cache.stride(),
+        *v_cache.stride(),
+        *output.stride(),
+        *block_tables.stride(),
+        *kv_scale_args(k_cache, k_scale, v_scale),
+        num_kv_groups,
+        n_heads,
+        m_size,
+        head_dim,
+        BLOCK_SIZE,  # BLOCK_M_SIZE
+        BLOCK_SIZE,  # BLOCK_N_SIZE
+        block_size,
+        qk_scale,
+        KV_QUANT=k_scale is not None,
+    )
+    return output
+
+def torch_paged_prefill_attention(q, k_cache, v_cache, block_tables, b_req_idx, b_prefix_len, block_size=1):
+    """flash_attention_v2_paged 的 pytorch 参考实现, softmax 缩放因子为 1/sqrt(head_dim)"""
+    bs, n_heads, m_size, head_dim = q.shape
+    num_kv_groups = n_heads // k_cache.shape[1]
+    output = torch.empty_like(q)
+    for i in range(bs):
+        prefix_len = int(b_prefix_len[i])
+        seq_pos = torch.arange(prefix_len + m_size, device=q.device)
+        kv_loc = block_tables[b_req_idx[i], seq_pos // block_size].long() * block_size + seq_pos % block_size
+        k = k_cache[kv_loc].transpose(0, 1).repeat_interleave(num_kv_groups, dim=0).float() # [n_heads, n_size, head_dim]
+        v = v_cache[kv_loc].transpose(0, 1).repeat_interleave(num_kv_groups, dim=0).float()
+        scores = torch.matmul(q[i].float(), k.transpose(1, 2)) / math.sqrt(head_dim)
+        causal_mask = (prefix_len + torch.arange(m_size, device=q.device))[:, None] >= seq_pos[None, :]
+        scores = scores.masked_fill(~causal_mask, float("-inf"))
+        output[i] = torch.matmul(torch.softmax(scores, dim=-1), v).to(q.dtype)
+    return output
+
+@triton.jit
+def flash_attention_v2_varlen_paged_kernel(
+    q_ptr,
+    k_cache_ptr,
+    v_cache_ptr,
+    o_ptr,
+    cu_seqlens_ptr,
+    b_seq_len_ptr,
+    block_tables_ptr,
+    b_req_idx_ptr,
+
+    q_tokens_stride,
+    q_heads_stride,
+    q_dim_stride,
+
+    k_tokens_stride,
+    k_heads_stride,
+    k_dim_stride,
+
+    v_tokens_stride,
+    v_heads_stride,
+    v_dim_stride,
+
+    out_tokens_stride,
+    out_heads_stride,
+    out_dim_stride,
+
+    block_tables_bs_stride,
+    block_tables_seq_stride,
+
+    k_scale_ptr, # 量化 kv cache 的缩放因子, KV_QUANT 为 False 时不读取
+    v_scale_ptr,
+    ks_tokens_stride,
+    ks_heads_stride,
+    vs_tokens_stride,
+    vs_heads_stride,
+
+    num_kv_groups, # group of kv heads
+    n_heads,      # number of heads
+    HEAD_DIM: tl.constexpr, # head_dim dimension
+    BLOCK_M_SIZE: tl.constexpr,
+    BLOCK_N_SIZE: tl.constexpr,
+    KV_BLOCK_SIZE: tl.constexpr, # kv cache 每个 block 包含的 token 数
+    qk_scale,
+    KV_QUANT: tl.constexpr = False, # kv cache 为 int8 / fp8 时在加载后反量化为 q 的类型
+    ):
+    """
+    打包 (varlen) 的分页 prefill flashattention2 内核: 各序列本次的 query 首尾相接存放, 第 i 个序列的 query 为
+    [cu_seqlens[i], cu_seqlens[i+1]), 其 kv (含已缓存的前缀) 共 b_seq_len[i] 个, 全部按 block table 从 cache 中读取。
+    """
+    block_m_idx = tl.program_id(0)
+    head_idx = tl.program_id(1)
+
+    cur_batch_idx = head_idx // n_heads
+    cur_head_idx = head_idx % n_heads
+    cur_kv_head_idx = cur_head_idx // num_kv_groups
+
+    q_start = tl.load(cu_seqlens_ptr + cur_batch_idx)
+    m_size = tl.load(cu_seqlens_ptr + cur_batch_idx + 1) - q_start
+    if block_m_idx * BLOCK_M_SIZE >= m_size:
+        return # 按最长序列划分 grid, 较短序列多余的 query 块直接退出
+    seq_len = tl.load(b_seq_len_ptr + cur_batch_idx)
+    prefix_len = seq_len - m_size
+    cur_req_idx = tl.load(b_req_idx_ptr + cur_batch_idx)
+
+    m_range_offs = tl.arange(0, BLOCK_M_SIZE)
+    n_range_offs = tl.arange(0, BLOCK_N_SIZE)
+    dhead_range_offs = tl.arange(0, HEAD_DIM)
+
+    offs_m = block_m_idx * BLOCK_M_SIZE + m_range_offs
+    q_pos = prefix_len + offs_m # query 在整个序列中的位置
+
+    offs_q = (
+        (q_start + offs_m[:, None]) * q_tokens_stride
+        + cur_head_idx * q_heads_stride
+        + dhead_range_offs[None, :] * q_dim_stride)
+    offs_o = (
+        (q_start + offs_m[:, None]) * out_tokens_stride
+        + cur_head_idx * out_heads_stride
+        + dhead_range_offs[None, :] * out_dim_stride)
+
+    q_mask = offs_m[:, None] < m_size
+    q = tl.load(q_ptr + offs_q, mask=q_mask, other=0.0)
+    block_table_ptrs = block_tables_ptr + cur_req_idx * block_tables_bs_stride
+
+    m_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32) - float("inf")
+    d_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M_SIZE, HEAD_DIM], dtype=tl.float32)
+
+    n_end = tl.minimum(prefix_len + (block_m_idx + 1) * BLOCK_M_SIZE, seq_len)
+    for block_n_start_idx in range(0, n_end, BLOCK_N_SIZE):
+        offs_n = block_n_start_idx + n_range_offs
+        n_mask = offs_n < n_end
+
+        block_idx = tl.load(block_table_ptrs + (offs_n // KV_BLOCK_SIZE) * block_tables_seq_stride, mask=n_mask, other=0).to(tl.int64)
+        kv_loc = block_idx * KV_BLOCK_SIZE + offs_n % KV_BLOCK_SIZE
+        k = tl.load(
+            k_cache_ptr + kv_loc[:, None] * k_tokens_stride + cur_kv_head_idx * k_heads_stride + dhead_range_offs[None, :] * k_dim_stride,
+            mask=n_mask[:, None], other=0.0
+        )
+        if KV_QUANT:
+            k_s = tl.load(k_scale_ptr + kv_loc * ks_tokens_stride + cur_kv_head_idx * ks_heads_stride, mask=n_mask, other=0.0)
+            k = (k.to(tl.float32) * k_s[:, None]).to(q.dtype)
+
+        qk = tl.dot(q, tl.trans(k))
+        mask = (q_pos[:, None] >= offs_n[None, :]) & n_mask[None, :]
+        qk = qk * qk_scale + tl.where(mask, 0, -1.0e8)
+        m_ij = tl.maximum(m_i, tl.max(qk, 1))
+        qk -= m_ij[:, None]
+
+        p = tl.math.exp2(qk)
+        d_ij = tl.sum(p, 1)
+        alpha = tl.math.exp2(m_i - m_ij)
+        d_i = d_i * alpha + d_ij
+        acc = acc * alpha[:, None]
+
+        v = tl.load(
+            v_cache_ptr + kv_loc[:, None] * v_tokens_stride + cur_kv_head_idx * v_heads_stride + dhead_range_offs[None, :] * v_dim_stride,
+            mask=n_mask[:, None], other=0.0
+        )
+        if KV_QUANT:
+            v_s = tl.load(v_scale_ptr + kv_loc * vs_tokens_stride + cur_kv_head_idx * vs_heads_stride, mask=n_mask, other=0.0)
+            v = (v.to(tl.float32) * v_s[:, None]).to(q.dtype)
+        p = p.to(v.dtype)
+        acc = tl.dot(p, v, acc)
+        m_i = m_ij
+
+    acc = acc / d_i[:, None]
+    tl.store(o_ptr + offs_o, acc, mask=q_mask)
+
+@torch.no_grad()
+def flash_attention_v2_varlen_paged(
+    q: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    qk_scale,
+    cu_seqlens: torch.Tensor,
+    b_seq_len: torch.Tensor,
+    max_q_len: int,
+    block_tables: torch.Tensor,
+    b_req_idx: torch.Tensor,
+    block_size: int = 1,
+    k_scale: torch.Tensor = None,
+    v_scale: torch.Tensor = None,
+    ):
+    """打包 (varlen) 的分页 prefill attention, 一次 kernel 调用处理长度各异、前缀各异的多个 prefill 分块
+    参数:
+        q: Query tensor, shape: [total_tokens, n_heads, head_dim], 各序列本次的 token 首尾相接.
+        k_cache, v_cache: 分页 kv cache, shape: [num_blocks * block_size, kv_num_heads, head_dim], 本次 token 的 kv 需已写入.
+        qk_scale: 与 flash_attention_v2 相同, 需要预先乘以 1/log(2).
+        cu_seqlens: shape: [bs + 1], 各序列 query 在 q 中的起始偏移, cu_seqlens[-1] = total_tokens.
+        b_seq_len: shape: [bs], 各序列包含本次 token 在内的 kv 长度, 前缀长度为 b_seq_len - query 长度.
+        max_q_len: 最长的 query 长度, 用于划分 grid.
+        block_tables, b_req_idx: 各序列占用的 kv cache block, 含义同 flash_decoding_paged.
+        k_scale, v_scale: 量化 kv cache 的缩放因子, 含义同 flash_attention_v2_paged.
+    """
+    BLOCK_SIZE = 64
+    num_kv_groups = q.shape[1] // k_cache.shape[1]
+    output = torch.empty_like(q)
+
+    assert q.shape[-1] == k_cache.shape[-1] == v_cache.shape[-1]
+    _, n_heads, head_dim = q.size()
+    bs = b_seq_len.shape[0]
+
+    grid = lambda meta: (triton.cdiv(max_q_len, BLOCK_SIZE), bs*n_heads, 1)
+    flash_attention_v2_varlen_paged_kernel[grid](
+        q,
+        k_cache,
+        v_cache,
+        output,
+        cu_seqlens,
+        b_seq_len,
+        block_tables,
+        b_req_idx,
+        *q.stride(),
+        *k_cache.stride(),
+        *v_cache.stride(),
+        *output.stride(),
+        *block_tables.stride(),
+        *kv_scale_args(k_cache, k_scale, v_scale),
+        num_kv_groups,
+        n_heads,
+        head_dim,
+        BLOCK_SIZE,  # BLOCK_M_SIZE
+        BLOCK_SIZE,  # BLOCK_N_SIZE
+        block_size,
+        qk_scale,
+        KV_QUANT=k_scale is not None,
+    )
+    return output
+
+def torch_varlen_paged_prefill_attention(q, k_cache, v_cache, cu_seqlens, b_seq_len, block_tables, b_req_idx, block_size=1):
+    """flash_attention_v2_varlen_paged 的 pytorch 参考实现, 逐个序列调用 torch_paged_prefill_attention"""
+    output = torch.empty_like(q)
+    for i in range(b_seq_len.shape[0]):
+        start, end = int(cu_seqlens[i]), int(cu_seqlens[i + 1])
+        b_prefix_len = (b_seq_len[i: i + 1] - (end - start))
+        output[start:end] = torch_paged_prefill_attention(
+            q[None, start:end].transpose(1, 2), k_cache, v_cache, block_tables, b_req_idx[i: i + 1], b_prefix_len, block_size
+        )[0].transpose(0, 1)
+    return output
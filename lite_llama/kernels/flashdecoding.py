@@ -2,6 +2,8 @@ import triton, torch
 import triton.language as tl
 from torch.cuda.amp import custom_fwd
 
+from .kv_quant import kv_scale_args
+
 @triton.jit
 def detect_nan_kernel(input_ptr, output_ptr, N, BLOCK_SIZE: tl.constexpr):
     pid = tl.program_id(0)
@@ -25,6 +27,7 @@ def _flash_decoding_stage1_kernel(
 	B_Start_Loc, B_Seqlen, 
 	num_kv_groups, # group of kv heads
     Mid_O, Mid_O_LogExpSum,
+    K_Scale, V_Scale, # 量化 kv cache 的缩放因子, KV_QUANT 为 False 时不读取
 
     q_bs_stride, q_heads_stride, q_dim_stride,  # Q 的 strides
     k_bs_stride, k_heads_stride, k_dim_stride,  # K 的 strides
@@ -32,10 +35,12 @@ def _flash_decoding_stage1_kernel(
 
     mido_batch_stride, mido_heads_stride, mido_partitions_stride, mido_dim_stride,
     mido_les_batch_stride, mido_les_heads_stride, mido_les_partitions_stride,
+    ks_bs_stride, ks_heads_stride, vs_bs_stride, vs_heads_stride,
 
     BLOCK_SEQ: tl.constexpr, # 默认 128
     BLOCK_N: tl.constexpr,   # 默认 32
     BLOCK_DMODEL: tl.constexpr,
+    KV_QUANT: tl.constexpr, # kv cache 为 int8 / fp8 时在加载后按 (token, head) 的缩放因子反量化
 ):
 	"""Flash Attention Stage1 Triton Kernel"""
 	# 获取当前程序的 block 在各个维度上的索引
@@ -103,6 +108,12 @@ def _flash_decoding_stage1_kernel(
 		# 加载 K 和 V
 		k = tl.load(k_ptrs, mask=k_mask[:, None], other=0.0)  # [BLOCK_N, BLOCK_DMODEL]
 		v = tl.load(v_ptrs, mask=k_mask[:, None], other=0.0)  # [BLOCK_N, BLOCK_DMODEL]
+		if KV_QUANT:
+			kv_loc = cur_batch_start_loc + offs_n_new
+			k_s = tl.load(K_Scale + kv_loc * ks_bs_stride + kv_head_pid * ks_heads_stride, mask=k_mask, other=0.0)
+			v_s = tl.load(V_Scale + kv_loc * vs_bs_stride + kv_head_pid * vs_heads_stride, mask=k_mask, other=0.0)
+			k = k.to(tl.float32) * k_s[:, None]
+			v = v.to(tl.float32) * v_s[:, None]
 		# if head_pid == 3:
 		# 	tl.device_print(f"k", k)
 		# 	tl.device_print(f"v", v)
@@ -176,6 +187,7 @@ def flash_decode_stage1(
 	max_actual_seq_len,  # 最大的实际序列长度
     mid_o, mid_o_logexpsum, # Mid_O: [batchs, num_heads, cdiv(seq_len, PARTITION_SIZE), head_dim], Mid_O_LogExpSum: [batchs, num_heads, cdiv(seq_len, PARTITION_SIZE)]
     PARTITION_SIZE,
+    k_scale=None, v_scale=None, # 量化 kv cache 的缩放因子: [batchs * seq_len, num_heads]
 ):
 	BLOCK_N_SIZE = 16
 
@@ -193,15 +205,18 @@ def flash_decode_stage1(
         b_start_loc, b_seq_len, 
 		num_kv_groups,   # kv 组数量
 		mid_o, mid_o_logexpsum,
+		*kv_scale_args(k, k_scale, v_scale)[:2],
 		*q.stride(),
 		*k.stride(),
 		*v.stride(),
 		*mid_o.stride(),
 		*mid_o_logexpsum.stride(),
+		*kv_scale_args(k, k_scale, v_scale)[2:],
 
 		BLOCK_SEQ = PARTITION_SIZE,
 		BLOCK_N = BLOCK_N_SIZE,
 		BLOCK_DMODEL = head_dim,
+		KV_QUANT = k_scale is not None,
 		num_warps = 2,
 		num_stages = 2,
 	)
@@ -301,7 +316,8 @@ def flash_decoding(
     k_cache, v_cache, 	     # 键/值向量缓存，形状为 [max_tokens, kv_num_head, head_dim]
     qk_scale,
     b_start_loc, b_seq_len, # start locations and sequence lengths for kv cache in a batch
-    max_actual_seq_len
+    max_actual_seq_len,
+    k_scale = None, v_scale = None, # 量化 kv cache 的缩放因子，形状为 [max_tokens, kv_num_head], 为 None 表示 kv cache 未量化
 ):
 	# q.view(-1, num_heads, head_dim)
 	assert q.shape[-1] == k_cache.shape[-1] == v_cache.shape[-1]
@@ -317,7 +333,7 @@ def flash_decoding(
 	mid_o_logexpsum = torch.empty((batchs, num_heads, max_num_partitions), dtype=torch.float32, device=q.device)
 
 	# decode stage 1: attention in partitions
-	flash_decode_stage1(q, k_cache, v_cache, qk_scale, b_start_loc, b_seq_len, max_actual_seq_len, mid_o, mid_o_logexpsum, PARTITION_SIZE)
+	flash_decode_stage1(q, k_cache, v_cache, qk_scale, b_start_loc, b_seq_len, max_actual_seq_len, mid_o, mid_o_logexpsum, PARTITION_SIZE, k_scale, v_scale)
 	# print(detect_nan(mid_o))
 	# print(detect_nan(mid_o_logexpsum))
 	
@@ -329,6 +345,161 @@ def flash_decoding(
 	return atten_output
 
 
+@triton.jit
+def _flash_decoding_stage1_paged_kernel(
+    Q, K, V, qk_scale,
+	Block_tables, B_req_idx, B_Seqlen,
+	num_kv_groups, # group of kv heads
+    Mid_O, Mid_O_LogExpSum,
+    K_Scale, V_Scale,
+
+    q_bs_stride, q_heads_stride, q_dim_stride,  # Q 的 strides
+    k_bs_stride, k_heads_stride, k_dim_stride,  # K 的 strides
+    v_bs_stride, v_heads_stride, v_dim_stride,  # V 的 strides
+    block_tables_bs_stride, block_tables_seq_stride,
+
+    mido_batch_stride, mido_heads_stride, mido_partitions_stride, mido_dim_stride,
+    mido_les_batch_stride, mido_les_heads_stride, mido_les_partitions_stride,
+    ks_bs_stride, ks_heads_stride, vs_bs_stride, vs_heads_stride,
+
+    BLOCK_SEQ: tl.constexpr, # 默认 128
+    BLOCK_N: tl.constexpr,   # 默认 32
+    BLOCK_DMODEL: tl.constexpr,
+    KV_BLOCK_SIZE: tl.constexpr, # kv cache 每个 block 包含的 token 数
+    KV_QUANT: tl.constexpr,
+):
+	"""Flash Attention Stage1 Triton Kernel, 分页 kv cache 版本, 序列第 j 个 token 位于
+	block Block_tables[req, j // KV_BLOCK_SIZE] 的第 j % KV_BLOCK_SIZE 个位置"""
+	batch_pid = tl.program_id(0)
+	head_pid = tl.program_id(1)
+	seq_block_pid = tl.program_id(2)
+	kv_head_pid = head_pid // num_kv_groups
+
+	cur_batch_seq_len = tl.load(B_Seqlen + batch_pid)
+	cur_req_idx = tl.load(B_req_idx + batch_pid)
+
+	cur_batch_partition_start_index = seq_block_pid * BLOCK_SEQ
+	cur_batch_partition_end_index = tl.minimum(cur_batch_seq_len, cur_batch_partition_start_index + BLOCK_SEQ)
+	num_blocks = tl.where(cur_batch_partition_end_index - cur_batch_partition_start_index <= 0,
+                       	0, (cur_batch_partition_end_index - cur_batch_partition_start_index + BLOCK_N - 1) // BLOCK_N)
+
+	offs_n = cur_batch_partition_start_index + tl.arange(0, BLOCK_N)  # [BLOCK_N]
+	offs_d = tl.arange(0, BLOCK_DMODEL)  # [BLOCK_DMODEL]
+
+	q = tl.load(Q + batch_pid * q_bs_stride + head_pid * q_heads_stride + offs_d * q_dim_stride)  # [BLOCK_DMODEL]
+	block_table_ptrs = Block_tables + cur_req_idx * block_tables_bs_stride
+
+	d_i = 0.0
+	m_i = -float("inf")
+	acc = tl.zeros([BLOCK_DMODEL], dtype=tl.float32)
+
+	for start_n in range(0, num_blocks, 1):
+		offs_n_new = start_n * BLOCK_N + offs_n  # [BLOCK_N]
+		k_mask = offs_n_new < cur_batch_partition_end_index  # [BLOCK_N]
+
+		# 先从 block table 中读取 token 所在的 block, 换算出其在 kv buffer 中的位置, 再按位置加载 K 和 V
+		block_idx = tl.load(block_table_ptrs + (offs_n_new // KV_BLOCK_SIZE) * block_tables_seq_stride, mask=k_mask, other=0).to(tl.int64)
+		kv_loc = block_idx * KV_BLOCK_SIZE + offs_n_new % KV_BLOCK_SIZE
+		k = tl.load(
+			K + kv_loc[:, None] * k_bs_stride + kv_head_pid * k_heads_stride + offs_d[None, :] * k_dim_stride,
+			mask=k_mask[:, None], other=0.0
+		)  # [BLOCK_N, BLOCK_DMODEL]
+		v = tl.load(
+			V + kv_loc[:, None] * v_bs_stride + kv_head_pid * v_heads_stride + offs_d[None, :] * v_dim_stride,
+			mask=k_mask[:, None], other=0.0
+		)  # [BLOCK_N, BLOCK_DMODEL]
+		if KV_QUANT:
+			k_s = tl.load(K_Scale + kv_loc * ks_bs_stride + kv_head_pid * ks_heads_stride, mask=k_mask, other=0.0)
+			v_s = tl.load(V_Scale + kv_loc * vs_bs_stride + kv_head_pid * vs_heads_stride, mask=k_mask, other=0.0)
+			k = k.to(tl.float32) * k_s[:, None]
+			v = v.to(tl.float32) * v_s[:, None]
+
+		qk = tl.sum(q[None, :] * k, axis=1)  # [BLOCK_N]
+		qk *= qk_scale
+		qk = tl.where(k_mask, qk, float("-inf"))  # [BLOCK_N]
+
+		current_max = tl.max(qk)
+		m_ij = tl.maximum(m_i, current_max)
+		p = tl.exp(qk - m_ij)  # [BLOCK_N]
+		alpha = tl.exp(m_i - m_ij)
+		d_i = alpha * d_i + tl.sum(p, axis=0)
+		acc = alpha * acc + tl.sum(p[:, None] * v, axis=0)  # [BLOCK_DMODEL]
+		m_i = m_ij
+
+	need_store = num_blocks > 0
+
+	off_mid_o = (
+		batch_pid * mido_batch_stride
+		+ head_pid * mido_heads_stride
+		+ seq_block_pid * mido_partitions_stride
+		+ offs_d * mido_dim_stride
+	)
+	off_mid_o_les = (
+		batch_pid * mido_les_batch_stride
+		+ head_pid * mido_les_heads_stride
+		+ seq_block_pid * mido_les_partitions_stride
+	)
+
+	part_atten_out = tl.where(need_store, acc / d_i, 0.0)  # [BLOCK_DMODEL]
+	logexpsum = tl.where(need_store, m_i + tl.log(d_i), float("-inf"))
+
+	tl.store(Mid_O + off_mid_o, part_atten_out, mask=need_store)
+	tl.store(Mid_O_LogExpSum + off_mid_o_les, logexpsum, mask=need_store)
+
+@torch.no_grad()
+def flash_decoding_paged(
+    q, 			 # q 查询向量，形状为 [bsz, num_head, head_dim]
+    k_cache, v_cache, 	     # 键/值向量缓存，形状为 [num_blocks * block_size, kv_num_head, head_dim]
+    qk_scale,
+    block_tables, b_req_idx, # block_tables: [max_reqs, max_blocks_per_seq], 各请求依次占用的 block; b_req_idx: batch 中各序列在表中的行号
+    b_seq_len,
+    max_actual_seq_len,
+    block_size = 1,
+    k_scale = None, v_scale = None, # 量化 kv cache 的缩放因子, 形状为 [num_blocks * block_size, kv_num_head]
+):
+	"""flash_decoding 的分页 kv cache 版本, 按 block table 读取 kv cache; block_size=1 时 block table 即逐 token 的位置表"""
+	assert q.shape[-1] == k_cache.shape[-1] == v_cache.shape[-1]
+	PARTITION_SIZE = 128
+	BLOCK_N_SIZE = 16
+	batchs, num_heads, head_dim = q.shape
+
+	max_num_partitions = (max_actual_seq_len + PARTITION_SIZE -1) // PARTITION_SIZE
+	mid_o = torch.empty((batchs, num_heads, max_num_partitions, head_dim), dtype=torch.float32, device=q.device)
+	mid_o_logexpsum = torch.empty((batchs, num_heads, max_num_partitions), dtype=torch.float32, device=q.device)
+
+	# decode stage 1: attention in partitions
+	grid = (batchs, num_heads, max_num_partitions)
+	num_kv_groups = q.shape[1] // k_cache.shape[1] # num_q_heads // num_k_heads
+	_flash_decoding_stage1_paged_kernel[grid](
+		q, k_cache, v_cache, qk_scale,
+		block_tables, b_req_idx, b_seq_len,
+		num_kv_groups,
+		mid_o, mid_o_logexpsum,
+		*kv_scale_args(k_cache, k_scale, v_scale)[:2],
+		*q.stride(),
+		*k_cache.stride(),
+		*v_cache.stride(),
+		*block_tables.stride(),
+		*mid_o.stride(),
+		*mid_o_logexpsum.stride(),
+		*kv_scale_args(k_cache, k_scale, v_scale)[2:],
+
+		BLOCK_SEQ = PARTITION_SIZE,
+		BLOCK_N = BLOCK_N_SIZE,
+		BLOCK_DMODEL = head_dim,
+		KV_BLOCK_SIZE = block_size,
+		KV_QUANT = k_scale is not None,
+		num_warps = 2,
+		num_stages = 2,
+	)
+
+	# decode stage 2: reduction among partitions
+	atten_output = torch.empty_like(q)
+	flash_decode_stage2(mid_o, mid_o_logexpsum, atten_output, b_seq_len, PARTITION_SIZE)
+
+	return atten_output
+
+
 def _naive_attention(q, k, v):
     import math
     head_dim = q.shape[-1]
@@ -353,6 +524,19 @@ def torch_attention_with_kvcache(q, k_cache, v_cache, b_start_loc, b_seq_len):
         out[i:i+1] = oi
     return out
 
+def torch_paged_attention(q, k_cache, v_cache, block_tables, b_req_idx, b_seq_len, block_size=1):
+    """flash_decoding_paged 的 pytorch 参考实现"""
+    out = torch.empty_like(q)
+    num_kv_groups = q.shape[1] // k_cache.shape[1]
+    for i in range(q.shape[0]):
+        seq_pos = torch.arange(int(b_seq_len[i]), device=q.device)
+        block_idx = block_tables[b_req_idx[i], seq_pos // block_size].long()
+        kv_loc = block_idx * block_size + seq_pos % block_size
+        ki = k_cache[kv_loc].repeat_interleave(num_kv_groups, dim=1)
+        vi = v_cache[kv_loc].repeat_interleave(num_kv_groups, dim=1)
+        out[i:i+1] = _naive_attention(q[i:i+1], ki, vi)
+    return out
+
 if __name__ == "__main__":
     torch.manual_seed(0)
     # inputs
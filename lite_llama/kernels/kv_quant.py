@@ -0,0 +1,101 @@
+# kv cache 量化: k v 写入 cache 时按 (token, kv head) 计算缩放因子并量化为 int8 / fp8, 读取时在 attention kernel 中反量化
+
+import triton
+from triton import language as tl
+import torch
+
+# kv_cache_dtype -> (cache 存储类型, 量化后的最大绝对值)
+KV_CACHE_DTYPES = {
+    "int8": (torch.int8, 127.0),
+    "fp8": (torch.float8_e4m3fn, 448.0),
+}
+
+@triton.jit
+def _quantize_kv_kernel(
+    KV, Dest_Index, KV_Buffer, KV_Scale,
+    kv_bs_stride, kv_heads_stride, kv_dim_stride,
+    buffer_bs_stride, buffer_heads_stride, buffer_dim_stride,
+    scale_bs_stride, scale_heads_stride,
+    QMAX: tl.constexpr,
+    IS_INT8: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+):
+    """每个 program 量化一个 token 的一个 head: scale = max(|x|) / QMAX, 量化值写入 kv buffer 的 Dest_Index 行"""
+    token_pid = tl.program_id(0)
+    head_pid = tl.program_id(1)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+
+    dest = tl.load(Dest_Index + token_pid).to(tl.int64)
+    x = tl.load(KV + token_pid * kv_bs_stride + head_pid * kv_heads_stride + offs_d * kv_dim_stride).to(tl.float32)
+    scale = tl.max(tl.abs(x), 0) / QMAX
+    scale = tl.where(scale > 0, scale, 1.0) # 全零向量的缩放因子取 1, 避免除零
+    x = x / scale
+    if IS_INT8:
+        # 四舍五入后截断到 [-QMAX, QMAX], 直接转换 int8 会截掉小数且溢出时回绕
+        x = tl.minimum(tl.maximum(tl.where(x >= 0, x + 0.5, x - 0.5), -QMAX), QMAX)
+
+    tl.store(
+        KV_Buffer + dest * buffer_bs_stride + head_pid * buffer_heads_stride + offs_d * buffer_dim_stride,
+        x.to(KV_Buffer.dtype.element_ty),
+    )
+    tl.store(KV_Scale + dest * scale_bs_stride + head_pid * scale_heads_stride, scale)
+
+@torch.no_grad()
+def quantize_kv_cache(kv: torch.Tensor, kv_buffer: torch.Tensor, kv_scale: torch.Tensor, dest_index: torch.Tensor):
+    """
+    把本次计算的 kv 量化后写入 kv cache。
+
+    参数:
+        kv (torch.Tensor): 形状为 [num_tokens, 2 * num_kv_heads, head_dim], 前一半 head 为 k, 后一半为 v。
+        kv_buffer (torch.Tensor): 量化的 kv cache, 形状为 [max_num_tokens, 2 * num_kv_heads, head_dim], int8 或 fp8。
+        kv_scale (torch.Tensor): 形状为 [max_num_tokens, 2 * num_kv_heads] 的 float32 缩放因子。
+        dest_index (torch.Tensor): 形状为 [num_tokens], 各 token 在 kv buffer 中的位置。
+    """
+    num_tokens, num_heads, head_dim = kv.shape
+    if num_tokens == 0:
+        return
+    qmax = 127.0 if kv_buffer.dtype == torch.int8 else 448.0
+    _quantize_kv_kernel[(num_tokens, num_heads)](
+        kv, dest_index, kv_buffer, kv_scale,
+        *kv.stride(),
+        *kv_buffer.stride(),
+        *kv_scale.stride(),
+        QMAX=qmax,
+        IS_INT8=kv_buffer.dtype == torch.int8,
+        BLOCK_DMODEL=head_dim,
+        num_warps=1,
+    )
+
+def write_kv_cache(kv: torch.Tensor, kv_buffer: torch.Tensor, kv_scale, dest_index: torch.Tensor):
+    """把 kv 写入 kv cache 的 dest_index 行, kv_scale 为 None 表示不量化, 直接拷贝"""
+    if kv_scale is None:
+        kv_buffer[dest_index] = kv
+    else:
+        quantize_kv_cache(kv, kv_buffer, kv_scale, dest_index)
+
+def split_kv_scale(kv_scale, num_kv_heads: int):
+    """把一层的缩放因子按 kv buffer 的布局拆为 k 和 v 两部分, kv_scale 为 None (未量化) 时返回 (None, None)"""
+    if kv_scale is None:
+        return None, None
+    return kv_scale[:, :num_kv_heads], kv_scale[:, num_kv_heads:]
+
+def kv_scale_args(k_cache, k_scale, v_scale):
+    """attention kernel 的缩放因子指针及其 strides; kv cache 未量化时用 k_cache 占位, kernel 不会读取"""
+    if k_scale is None:
+        return k_cache, k_cache, 0, 0, 0, 0
+    return (k_scale, v_scale, *k_scale.stride(), *v_scale.stride())
+
+def torch_quantize_kv(kv: torch.Tensor, kv_cache_dtype: str):
+    """quantize_kv_cache 的 pytorch 参考实现, 返回量化值和形状为 kv.shape[:-1] 的缩放因子"""
+    dtype, qmax = KV_CACHE_DTYPES[kv_cache_dtype]
+    kv = kv.float()
+    scale = kv.abs().amax(dim=-1) / qmax
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    x = kv / scale[..., None]
+    if dtype == torch.int8:
+        x = torch.where(x >= 0, x + 0.5, x - 0.5).trunc().clamp(-qmax, qmax) # 与 kernel 一致, 四舍五入远离零
+    return x.to(dtype), scale
+
+def dequantize_kv(kv_buffer: torch.Tensor, kv_scale: torch.Tensor, dtype=torch.float16) -> torch.Tensor:
+    """反量化 kv cache (或其中若干行), 用于参考实现和调试"""
+    return (kv_buffer.float() * kv_scale[..., None].float()).to(dtype)
@@ -0,0 +1,103 @@
+# 在 softmax_split 的分块 log-sum-exp 基础上融合 top-k, 一次读取 logits 得到对数概率与概率最大的 k 个 token
+
+import triton
+from triton import language as tl
+import torch
+
+from .softmax_split import combine_logsumexp_kernel
+
+@triton.jit
+def _logsumexp_topk_kernel(
+    logz_ptr,
+    topv_ptr,
+    topi_ptr,
+    logits_ptr,
+    rows_ptr,
+    N,
+    stride_logits,
+    K: tl.constexpr,
+    TILE_N: tl.constexpr,
+):
+    """每个 program 处理一行的一个分块: 输出分块的 log-sum-exp, 以及分块内 logits 最大的 K 个值和下标"""
+    pid_n = tl.program_id(0)
+    num_programs_n = tl.num_programs(0)
+    pid_m = tl.program_id(1)
+
+    row = tl.load(rows_ptr + pid_m).to(tl.int64)
+    tile_offsets = tl.arange(0, TILE_N)
+    n_offsets = pid_n * TILE_N + tile_offsets
+    mask = n_offsets < N
+    inp = tl.load(logits_ptr + row * stride_logits + n_offsets, mask=mask, other=-float("inf")).to(tl.float32)
+    m = tl.max(inp, 0)
+    m = tl.where(m == -float("inf"), 0.0, m) # 整个分块被屏蔽 (如约束解码) 时 log-sum-exp 为 -inf 而不是 nan
+    z = tl.sum(tl.exp(inp - m), 0)
+    tile = pid_m * num_programs_n + pid_n
+    tl.store(logz_ptr + tile, m + tl.log(z))
+
+    # K 很小, 逐个取出分块内的最大值, 候选留在片上
+    vals = inp
+    for j in tl.static_range(K):
+        best = tl.max(vals, 0)
+        best_index = tl.argmax(vals, 0)
+        tl.store(topv_ptr + tile * K + j, best)
+        tl.store(topi_ptr + tile * K + j, pid_n * TILE_N + best_index)
+        vals = tl.where(tile_offsets == best_index, -float("inf"), vals)
+
+@torch.no_grad()
+def fused_logprobs_topk(
+    logits: torch.Tensor,
+    tokens: torch.Tensor,
+    k: int = 0,
+    rows: torch.Tensor = None,
+) -> torch.Tensor:
+    """
+    融合的 log-softmax + top-k: 每个分块只读取一次 logits, 同时得到分块的 log-sum-exp 和分块内的 top-k 候选,
+    再合并各分块的结果, 不在全局内存中生成 [batch_size, vocab_size] 的对数概率。
+
+    参数:
+        logits (torch.Tensor): 形状为 [num_logits, vocab_size], 最后一维连续。
+        tokens (torch.Tensor): 形状为 [batch_size], 需要对数概率的 token (如采样得到的 token)。
+        k (int): 每行返回对数概率最大的 k 个 token, 0 表示只计算 tokens 的对数概率。
+        rows (torch.Tensor, optional): 形状为 [batch_size], 每行对应的 logits 行号, 默认为 0..num_logits-1。
+    返回:
+        torch.Tensor: 形状为 [batch_size, 1 + 2k] 的 float32 张量, 依次为 tokens 的对数概率、降序排列的 top-k
+            对数概率和对应的 token id (以 float32 存储, 词表小于 2^24 时精确), 便于一次拷贝回主机。
+    """
+    assert logits.stride(-1) == 1
+    N = logits.shape[-1]
+    device = logits.device
+    if rows is None:
+        rows = torch.arange(logits.shape[0], device=device)
+    M = rows.numel()
+    K = max(min(k, N), 1)
+
+    TILE_N = min(4096, triton.next_power_of_2(N))
+    num_tiles_n = triton.cdiv(N, TILE_N)
+    tile_logz = torch.empty((M, num_tiles_n), dtype=torch.float32, device=device)
+    tile_topv = torch.empty((M, num_tiles_n * K), dtype=torch.float32, device=device)
+    tile_topi = torch.empty((M, num_tiles_n * K), dtype=torch.int64, device=device)
+    _logsumexp_topk_kernel[(num_tiles_n, M, 1)](
+        tile_logz, tile_topv, tile_topi, logits, rows, N, logits.stride(0), K, TILE_N
+    )
+
+    logz = torch.empty((M, ), dtype=torch.float32, device=device)
+    combine_logsumexp_kernel[(M, 1, 1)](logz, tile_logz, M, num_tiles_n, triton.next_power_of_2(num_tiles_n))
+
+    token_logprobs = logits[rows, tokens].float() - logz
+    if k == 0:
+        return token_logprobs[:, None]
+    # 各分块的候选只有 num_tiles * k 个, 直接用 torch.topk 合并
+    topv, index = torch.topk(tile_topv, min(k, N), dim=-1)
+    topi = torch.gather(tile_topi, 1, index)
+    return torch.cat([token_logprobs[:, None], topv - logz[:, None], topi.float()], dim=-1)
+
+def torch_logprobs_topk(logits: torch.Tensor, tokens: torch.Tensor, k: int = 0, rows: torch.Tensor = None) -> torch.Tensor:
+    """fused_logprobs_topk 的 pytorch 参考实现, 返回格式相同"""
+    if rows is not None:
+        logits = logits[rows]
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    token_logprobs = log_probs.gather(1, tokens.view(-1, 1))
+    if k == 0:
+        return token_logprobs
+    topv, topi = torch.topk(log_probs, min(k, logits.shape[-1]), dim=-1)
+    return torch.cat([token_logprobs, topv, topi.float()], dim=-1)
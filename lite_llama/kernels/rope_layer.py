@@ -139,6 +139,10 @@ def rope_forward(q, k, cos, sin):
     cos = cos.contiguous()
     sin = sin.contiguous()
 
+    # cos/sin 形状为 (1, seq_len, head_dim) 时所有序列共用同一组位置;
+    # 连续批处理时每个序列位置不同, 形状为 (bsz, seq_len, head_dim), 此时按 token 行号一一对应
+    cos_rows = cos.shape[0] * cos.shape[-2]
+
     _triton_rope[(n_row,)](
         q,
         q.stride(1),
@@ -148,7 +152,7 @@ def rope_forward(q, k, cos, sin):
         cos.stride(-2),
         sin,
         sin.stride(-2),
-        seq_len,
+        cos_rows,
         batch_size,
         n_q_head,
         n_kv_head,
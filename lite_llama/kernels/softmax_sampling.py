@@ -0,0 +1,248 @@
+# 在 softmax_split 的分块 log-sum-exp 基础上融合 temperature / softmax / top-p (nucleus) 采样
+
+import triton
+from triton import language as tl
+import torch
+
+@triton.jit
+def _scaled_split_kernel(
+    tile_logz_ptr,
+    cand_val_ptr,
+    cand_idx_ptr,
+    best_score_ptr,
+    best_idx_ptr,
+    logits_ptr,
+    rows_ptr,
+    inv_temp_ptr,
+    seed_ptr,
+    N,
+    stride_logits,
+    TILE_N: tl.constexpr,
+    TOP_K: tl.constexpr,
+):
+    """
+    与 logsumexp_kernel 相同的分块 log-sum-exp, 输入先乘以 1 / temperature。每个分块只读取一次 logits, 同时输出:
+    分块内按降序排列的 TOP_K 个候选 (logit / temperature 与 token 索引), 以及分块内 Gumbel-max 的最高分和对应 token。
+    """
+    pid_n = tl.program_id(0)
+    num_programs_n = tl.num_programs(0)
+    pid_m = tl.program_id(1)
+
+    row = tl.load(rows_ptr + pid_m).to(tl.int64)
+    inv_temp = tl.load(inv_temp_ptr + pid_m)
+    seed = tl.load(seed_ptr + pid_m)
+    tile_offsets = tl.arange(0, TILE_N)
+    n_offsets = pid_n * TILE_N + tile_offsets
+    mask = n_offsets < N
+    inp = tl.load(logits_ptr + row * stride_logits + n_offsets, mask=mask, other=-float("inf")).to(tl.float32)
+    inp = inp * inv_temp
+    m = tl.max(inp, 0)
+    z = tl.sum(tl.exp(inp - m), 0)
+    out_offset = pid_m * num_programs_n + pid_n
+    tl.store(tile_logz_ptr + out_offset, m + tl.log(z))
+
+    # 不做截断的行直接用各分块 Gumbel-max 的结果采样, 噪声只取决于 (seed, token 索引)
+    u = tl.rand(seed, n_offsets)
+    score = tl.where(mask, inp - tl.log(-tl.log(u)), -float("inf"))
+    tl.store(best_score_ptr + out_offset, tl.max(score, 0))
+    tl.store(best_idx_ptr + out_offset, pid_n * TILE_N + tl.argmax(score, 0))
+
+    # 在寄存器中逐个取出分块内最大的 TOP_K 个值, 不足 TOP_K 个有效 token 时补 -inf
+    cand_ptr = out_offset * TOP_K
+    for k in range(TOP_K):
+        tile_max = tl.max(inp, 0)
+        tile_index = tl.argmax(inp, 0)
+        tl.store(cand_val_ptr + cand_ptr + k, tile_max)
+        tl.store(cand_idx_ptr + cand_ptr + k, pid_n * TILE_N + tile_index)
+        inp = tl.where(tile_offsets == tile_index, -float("inf"), inp)
+
+@triton.jit
+def _top_p_sampling_kernel(
+    out_ptr,
+    tile_logz_ptr,
+    cand_val_ptr,
+    cand_idx_ptr,
+    best_score_ptr,
+    best_idx_ptr,
+    logits_ptr,
+    rows_ptr,
+    inv_temp_ptr,
+    top_p_ptr,
+    min_p_ptr,
+    seed_ptr,
+    N,
+    stride_logits,
+    num_tiles,
+    NUM_ITERS: tl.constexpr,
+    TILE_N: tl.constexpr,
+    TOP_K: tl.constexpr,
+    BLOCK_TILES: tl.constexpr,
+):
+    """
+    每个 program 处理一行: 合并各分块的 log-sum-exp, 在片上对候选二分查找 nucleus 的概率阈值,
+    再在阈值以上的候选中用 Gumbel-max 采样。
+
+    各分块第 TOP_K 大的值中最大的一个记为 c, 概率大于 p_c = exp(c - logz) 的 token 都在候选中。
+    保留的 token 都高于 p_c 时 (常见情况) 不再读取 logits; 只有 nucleus 或 min_p 截断覆盖了候选之外的 token
+    才重新读取整行, 此时结果与逐行二分查找完全一致。
+    """
+    pid_m = tl.program_id(0)
+    tile_offsets = tl.arange(0, BLOCK_TILES)
+    tile_mask = tile_offsets < num_tiles
+    tile_logz = tl.load(tile_logz_ptr + pid_m * num_tiles + tile_offsets, mask=tile_mask, other=-float("inf"))
+    m = tl.max(tile_logz, 0)
+    logz = m + tl.log(tl.sum(tl.exp(tile_logz - m), 0))
+
+    cand_ptr = pid_m * num_tiles * TOP_K
+    cand_offsets = tl.arange(0, BLOCK_TILES * TOP_K)
+    cand_mask = cand_offsets < num_tiles * TOP_K
+    cand = tl.load(cand_val_ptr + cand_ptr + cand_offsets, mask=cand_mask, other=-float("inf"))
+    probs = tl.exp(cand - logz)
+    p_max = tl.max(probs, 0)
+    kth = tl.load(cand_val_ptr + cand_ptr + tile_offsets * TOP_K + TOP_K - 1, mask=tile_mask, other=-float("inf"))
+    p_c = tl.exp(tl.max(kth, 0) - logz)
+
+    # 排序实现保留 "概率更大的 token 的累积概率 <= top_p" 的 token, 这些 token 的概率不小于某个阈值。
+    # 不变量: mass(lo) > top_p >= mass(hi), mass(t) 为概率严格大于 t 的 token 的概率和。
+    # 收敛后 (lo, hi] 中只剩最后一个进入 nucleus 的 token, 因此保留概率严格大于 lo 的 token。
+    row = tl.load(rows_ptr + pid_m).to(tl.int64)
+    row_ptr = logits_ptr + row * stride_logits
+    inv_temp = tl.load(inv_temp_ptr + pid_m)
+    top_p = tl.load(top_p_ptr + pid_m)
+    nucleus_lo = p_max * 0.0 - 1.0
+    if top_p < 1.0:
+        if tl.sum(tl.where(probs > p_c, probs, 0.0), 0) > top_p:
+            # nucleus 在候选内闭合, 候选上的 mass 是精确的
+            lo = p_c
+            hi = p_max
+            for _ in range(NUM_ITERS):
+                mid = (lo + hi) * 0.5
+                in_nucleus = tl.sum(tl.where(probs > mid, probs, 0.0), 0) <= top_p
+                hi = tl.where(in_nucleus, mid, hi)
+                lo = tl.where(in_nucleus, lo, mid)
+            nucleus_lo = lo
+        else:
+            # 分布很平时 nucleus 超出候选, 在 [0, p_c] 内二分, 每次迭代重新读取整行
+            lo = p_max * 0.0
+            hi = p_c
+            for _ in range(NUM_ITERS):
+                mid = (lo + hi) * 0.5
+                mass = tl.zeros((TILE_N,), dtype=tl.float32)
+                for start in range(0, N, TILE_N):
+                    n_offsets = start + tl.arange(0, TILE_N)
+                    inp = tl.load(row_ptr + n_offsets, mask=n_offsets < N, other=-float("inf")).to(tl.float32)
+                    row_probs = tl.exp(inp * inv_temp - logz)
+                    mass += tl.where(row_probs > mid, row_probs, 0.0)
+                in_nucleus = tl.sum(mass, 0) <= top_p
+                hi = tl.where(in_nucleus, mid, hi)
+                lo = tl.where(in_nucleus, lo, mid)
+            nucleus_lo = lo
+    min_prob = tl.load(min_p_ptr + pid_m) * p_max
+
+    # Gumbel-max: argmax(log p + g), g ~ Gumbel(0, 1), 等价于在保留的 token 中按重新归一化的概率采样
+    seed = tl.load(seed_ptr + pid_m)
+    if (nucleus_lo >= p_c) | (min_prob > p_c):
+        cand_idx = tl.load(cand_idx_ptr + cand_ptr + cand_offsets, mask=cand_mask, other=0)
+        u = tl.rand(seed, cand_idx)
+        keep = cand_mask & (probs > nucleus_lo) & (probs >= min_prob)
+        score = tl.where(keep, cand - tl.log(-tl.log(u)), -float("inf"))
+        best_index = tl.sum(tl.where(cand_offsets == tl.argmax(score, 0), cand_idx, 0), 0)
+    elif (nucleus_lo >= 0.0) | (min_prob > 0.0):
+        best_score = -float("inf")
+        best_index = 0
+        for start in range(0, N, TILE_N):
+            n_offsets = start + tl.arange(0, TILE_N)
+            mask = n_offsets < N
+            inp = tl.load(row_ptr + n_offsets, mask=mask, other=-float("inf")).to(tl.float32)
+            scaled = inp * inv_temp
+            row_probs = tl.exp(scaled - logz)
+            keep = mask & (row_probs > nucleus_lo) & (row_probs >= min_prob)
+            u = tl.rand(seed, n_offsets)
+            score = tl.where(keep, scaled - tl.log(-tl.log(u)), -float("inf"))
+            tile_best = tl.max(score, 0)
+            tile_index = start + tl.argmax(score, 0)
+            better = tile_best > best_score
+            best_index = tl.where(better, tile_index, best_index)
+            best_score = tl.where(better, tile_best, best_score)
+    else:
+        # 不做截断: 各分块 Gumbel-max 的最高分中取最大
+        tile_scores = tl.load(best_score_ptr + pid_m * num_tiles + tile_offsets, mask=tile_mask, other=-float("inf"))
+        tile_indexs = tl.load(best_idx_ptr + pid_m * num_tiles + tile_offsets, mask=tile_mask, other=0)
+        best_index = tl.sum(tl.where(tile_offsets == tl.argmax(tile_scores, 0), tile_indexs, 0), 0)
+
+    tl.store(out_ptr + pid_m, best_index)
+
+@torch.no_grad()
+def fused_top_p_sampling(
+    logits: torch.Tensor,
+    temperatures: torch.Tensor,
+    top_ps: torch.Tensor,
+    min_ps: torch.Tensor = None,
+    seeds: torch.Tensor = None,
+    rows: torch.Tensor = None,
+    num_iters: int = 32,
+    num_candidates: int = 64,
+) -> torch.Tensor:
+    """
+    融合的 temperature + softmax + top-p / min-p 采样。
+
+    按 softmax_split 的方式把每行 logits 切成多个分块并行处理, 一次读取中同时得到 logits / temperature 的分块
+    log-sum-exp、每个分块概率最大的 num_candidates 个候选和分块内的 Gumbel-max 结果。随后每行只在片上对这些候选
+    二分查找 nucleus 的概率阈值并采样, 不再读取 logits; 只有 nucleus 超出候选的平坦分布才重新读取整行。
+
+    参数:
+        logits (torch.Tensor): 形状为 [num_logits, vocab_size], 最后一维连续。
+        temperatures (torch.Tensor): 形状为 [batch_size], 必须大于 0。
+        top_ps (torch.Tensor): 形状为 [batch_size], >= 1 的行跳过阈值查找。
+        min_ps (torch.Tensor, optional): 形状为 [batch_size], 保留概率不小于 min_p * 最大概率的 token。
+        seeds (torch.Tensor, optional): 形状为 [batch_size] 的 int64 随机种子, 为 None 时从全局随机数发生器生成。
+        rows (torch.Tensor, optional): 形状为 [batch_size], 每个采样行对应的 logits 行号, 默认为 0..num_logits-1。
+        num_iters (int): 二分查找的迭代次数, 阈值精度约为 最大概率 / 2^num_iters。
+        num_candidates (int): 每个分块保留的候选 token 数, 向上取到 2 的幂。
+    返回:
+        torch.Tensor: 形状为 [batch_size] 的 token 索引。
+    """
+    assert logits.stride(-1) == 1
+    N = logits.shape[-1]
+    device = logits.device
+    if rows is None:
+        rows = torch.arange(logits.shape[0], device=device)
+    M = rows.numel()
+    if min_ps is None:
+        min_ps = torch.zeros(M, dtype=torch.float32, device=device)
+    if seeds is None:
+        seeds = torch.randint(0, 2 ** 31 - 1, (M,), dtype=torch.int64).to(device, non_blocking=True)
+    inv_temps = (1.0 / temperatures.float()).contiguous()
+    seeds = seeds.contiguous()
+
+    TILE_N = min(4096, triton.next_power_of_2(N))
+    TOP_K = min(triton.next_power_of_2(num_candidates), TILE_N)
+    num_tiles_n = triton.cdiv(N, TILE_N)
+    tile_logz = torch.empty((M, num_tiles_n), dtype=torch.float32, device=device)
+    cand_val = torch.empty((M, num_tiles_n, TOP_K), dtype=torch.float32, device=device)
+    cand_idx = torch.empty((M, num_tiles_n, TOP_K), dtype=torch.int32, device=device)
+    best_score = torch.empty((M, num_tiles_n), dtype=torch.float32, device=device)
+    best_idx = torch.empty((M, num_tiles_n), dtype=torch.int32, device=device)
+    _scaled_split_kernel[(num_tiles_n, M, 1)](
+        tile_logz, cand_val, cand_idx, best_score, best_idx,
+        logits, rows, inv_temps, seeds, N, logits.stride(0), TILE_N, TOP_K,
+    )
+
+    out = torch.empty((M, ), dtype=torch.int64, device=device)
+    _top_p_sampling_kernel[(M, )](
+        out, tile_logz, cand_val, cand_idx, best_score, best_idx,
+        logits, rows, inv_temps, top_ps.float().contiguous(), min_ps.float().contiguous(), seeds,
+        N, logits.stride(0), num_tiles_n, num_iters, TILE_N, TOP_K, triton.next_power_of_2(num_tiles_n),
+    )
+    return out
+
+def torch_top_p_sampling_probs(logits, temperatures, top_ps, min_ps=None):
+    """fused_top_p_sampling 的 pytorch 参考实现, 返回截断并重新归一化后的采样分布, 形状为 [batch_size, vocab_size]"""
+    probs = torch.softmax(logits.float() / temperatures.float()[:, None], dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    mask = torch.cumsum(probs_sort, dim=-1) - probs_sort > top_ps.float()[:, None]
+    if min_ps is not None:
+        mask |= probs_sort < min_ps.float()[:, None] * probs_sort[:, :1]
+    probs_sort[mask] = 0.0
+    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    return torch.zeros_like(probs).scatter_(-1, probs_idx, probs_sort)
@@ -2,10 +2,13 @@ from typing import Optional
 import torch, logging, re
 from PIL import Image
 
-from typing import List, Optional, Tuple, TypedDict, Generator, Union
+from typing import List, Literal, Optional, Tuple, TypedDict, Generator, Union
 from .executor.model_executor import ModelExecutor
+from .executor.sampler import sample
+from .executor.detokenizer import DecodeState, IncrementalDetokenizer
 from .utils.constants import *
 from .utils.file_interface import get_model_name_from_path
+from .utils.prompt_templates import get_stop_token_ids
 
 from transformers import AutoTokenizer, AutoProcessor
 
@@ -18,6 +21,12 @@ class CompletionPrediction(TypedDict, total=False):
     tokens: List[str]  # not required
     logprobs: List[float]  # not required
 
+class CompletionDelta(TypedDict):
+    """流式输出中一个序列本步新增的文本"""
+    index: int # 序列在 prompts 中的下标
+    text: str
+    finish_reason: Optional[Literal["stop", "length"]] # 序列在本步结束时设置, 否则为 None
+
 def tokenizer_image_token(
     prompt, 
     tokenizer, 
@@ -94,6 +103,10 @@ class LlavaGeneratorStream:
             device = device
         )
         self.tokenizer = self.load_tokenizer(tokenizer_path)
+        # 对话模型的回合结束 token (如 Llama-3 的 <|eot_id|>) 与 eos 一样结束生成
+        self.stop_token_ids = {self.tokenizer.eos_token_id} | set(
+            get_stop_token_ids(self.model_executor.model_config.model_type, checkpoints_dir)
+        )
         self.device = device
 
     def load_tokenizer(self, pretrained_model_name_or_path):
@@ -140,7 +153,7 @@ class LlavaGeneratorStream:
         temperature: float = 0.6,
         top_p: float = 0.9,
         echo: bool = False,
-    ) -> Generator[Tuple[List[str], Optional[List[float]]], None, None]:
+    ) -> Generator[Tuple[List[str], List[Optional[str]]], None, None]:
         """
         基于提供的 prompt_tokens, 使用语言生成模型逐个生成 token, 并在生成时立即输出。
 
@@ -153,9 +166,10 @@ class LlavaGeneratorStream:
             echo (bool, optional): 是否在输出中包含 prompt_tokens。默认为 False。
             
         generator 输出：
-            Tuple[List[str], Optional[List[float]]]: 包含生成的文本和对应的对数概率(如果 logprobs 为 True)。
+            Tuple[List[str], List[Optional[str]]]: 每步各序列新增的文本 (没有新文本时为空字符串), 以及各序列的
+                结束原因: 遇到 eos 或回合结束 token 为 "stop", 达到最大长度为 "length", 未结束为 None。
         说明：
-            该方法在生成循环中，每生成一个新 token, 就立即输出对应的文本和概率(如果需要）。
+            每步只把新 token 复制到 host 一次, 所有序列合并为一次增量解码, 开销与已生成的长度无关。
         """
         bsz = len(prompt_tokens)
         min_prompt_len = min(len(t) for t in prompt_tokens)
@@ -176,11 +190,15 @@ class LlavaGeneratorStream:
         
         # 生成一个布尔张量，它的值为 True 的位置表示输入序列的实际内容（即非填充部分）, 形状为 (batch_size, total_len)
         input_text_mask = tokens != pad_id
-        eos_reached = torch.tensor([False] * bsz, device=self.device)
 
         # 一次性分配 bsz * total_len 个索引
-        self.model_executor.atten_info.select_index = self.model_executor.kv_mem_manager.alloc_kvcache_index(total_number_tokens)
+        kv_mem_manager = self.model_executor.kv_mem_manager
+        self.model_executor.atten_info.select_index = kv_mem_manager.alloc_kvcache_index(total_number_tokens)
         select_index = self.model_executor.atten_info.select_index
+        if select_index is None:
+            raise RuntimeError(
+                f"kv cache is not enough for {total_number_tokens} tokens, only {kv_mem_manager.can_use_mem_size} left"
+            )
 
         # 初始化每个批次项的序列长度
         actual_prompt_lens = torch.tensor([len(t) for t in prompt_tokens], dtype=torch.long, device=self.device)
@@ -196,7 +214,19 @@ class LlavaGeneratorStream:
         # print("Prefill stage cur_select_index: ", self.model_executor.atten_info.cur_select_index)
 
         prev_pos = 0
-        last_yielded_pos = [len(prompt_tokens[i]) if not echo else 0 for i in range(bsz)] # 初始化每个样本已输出的位置
+        # 每个序列在 host 上维护已生成的 token, 解码时跳过图像占位 token
+        prompt_lists = [[t for t in torch.as_tensor(p).tolist() if t >= 0] for p in prompt_tokens]
+        prompt_lens = [len(t) for t in prompt_tokens]
+        output_tokens = [[] for _ in range(bsz)]
+        finish_reasons = [None] * bsz
+        decode_states = [DecodeState.from_prompt(p) for p in prompt_lists]
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        prefixes = self.tokenizer.batch_decode(prompt_lists, skip_special_tokens=True) if echo else None
+
+        # 与 ContinuousBatchScheduler 相同, 采样结果经锁页内存 non_blocking 拷回, 每步只等待这一次拷贝的 event
+        pin_memory = torch.device(self.device).type == "cuda"
+        host_tokens = torch.empty(bsz, dtype=torch.long, pin_memory=pin_memory)
+        copy_event = torch.cuda.Event() if pin_memory else None
 
         if min_prompt_len == total_len: # 如果 prompt 已经达到最大长度，无需生成
             logits, _ = self.model.forward(tokens, prev_pos, image_tensors)
@@ -218,38 +248,47 @@ class LlavaGeneratorStream:
             self.model_executor.atten_info.cur_select_index = (self.model_executor.atten_info.start_index 
                                                                + self.model_executor.atten_info.b_seq_len)
             
-            if temperature > 0:
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits[:, -1], dim=-1)
+            next_token = sample(logits[:, -1], [temperature] * bsz, top_ps=[top_p] * bsz)
 
             next_token = next_token.reshape(-1)  # shape is (batch_size,)
 
             # 仅在需要生成的情况下替换 token
             next_token = torch.where(input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token)
             tokens[:, cur_pos] = next_token
+            host_tokens.copy_(next_token, non_blocking=pin_memory)
+            if copy_event is not None:
+                copy_event.record()
 
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (next_token == self.tokenizer.eos_token_id)
             prev_pos = cur_pos
             
-            # 为整个批次收集输出
-            batch_outputs = []
-            for i in range(bsz):
-                start = last_yielded_pos[i]
-                end = cur_pos + 1
-                if start < end:
-                    token = tokens[i, start:end].tolist()
-                    text = self.tokenizer.decode(token, skip_special_tokens=True)
-                    batch_outputs.append(text)
-                    last_yielded_pos[i] = end
-                else:
-                    batch_outputs.append('') # 如果没有新生成的内容，添加空字符串
-
-            # 将整个批次的输出一次性 yield
-            yield batch_outputs
-
-            if eos_reached.all():
+            # 只解码本步产生了新 token 且之前未结束的序列, 整个批次一次 batch_decode
+            if copy_event is not None:
+                copy_event.synchronize()
+            active = []
+            for i, token in enumerate(host_tokens.tolist()):
+                if cur_pos < prompt_lens[i] or finish_reasons[i] is not None:
+                    continue
+                output_tokens[i].append(token)
+                if token in self.stop_token_ids:
+                    finish_reasons[i] = "stop"
+                elif cur_pos + 1 == total_len:
+                    finish_reasons[i] = "length"
+                active.append(i)
+            batch_outputs = [''] * bsz
+            texts = detokenizer.decode(
+                [output_tokens[i] for i in active],
+                [decode_states[i] for i in active],
+                [finish_reasons[i] is not None for i in active],
+            )
+            for i, text in zip(active, texts):
+                batch_outputs[i] = text
+            if prefixes is not None: # echo 时第一步先输出 prompt
+                batch_outputs = [prefix + text for prefix, text in zip(prefixes, batch_outputs)]
+                prefixes = None
+
+            yield batch_outputs, list(finish_reasons)
+
+            if all(reason is not None for reason in finish_reasons):
                 break
         
         # 减少 kv cache 内存管理器的引用计数
@@ -263,8 +302,8 @@ class LlavaGeneratorStream:
         top_p: float = 0.9,
         max_gen_len: Optional[int] = None,
         echo: bool = False,
-    ) -> Generator[List[CompletionPrediction], None, None]:
-        """每次迭代时，生成器返回一个包含多个 CompletionPrediction 字典的列表。"""
+    ) -> Generator[List[CompletionDelta], None, None]:
+        """每次迭代时，生成器返回有新文本或刚结束的序列的 CompletionDelta 列表, 调用方自行拼接完整文本。"""
         
         if max_gen_len is None:
             max_gen_len = self.max_seq_len - 1
@@ -282,40 +321,15 @@ class LlavaGeneratorStream:
             echo=echo,
         )
 
-        # 初始化每个样本的生成结果
-        completions = [{'generation': '', 'tokens': []} for _ in prompts]
-        for batch_outputs in stream:
-            for i, text in enumerate(batch_outputs):
-                completions[i]['generation'] += text
-            yield completions.copy()
-    
-def sample_top_p(probs, p):
-    """
-    执行 Top-p (Nucleus) 采样, 从概率分布中采样下一个词。
-    
-    参数：
-        probs (torch.Tensor): 概率分布张量，形状为 `[batch_size, vocab_size]`。
-        p (float): 累积概率阈值，取值范围在 0 到 1 之间。
-    返回：
-        torch.Tensor: 采样得到的词索引，形状为 `[batch_size, 1]`。
-
-    说明：
-        Top-p 采样算法: 选择概率累积和超过阈值 p 的最小集合，将这些词的概率重新归一化后进行采样。
-    """
-    # 对概率分布进行降序排序。probs_sort: 排序后的概率值，形状与 probs 相同。probs_idx: 排序后的索引，用于映射回原始词汇表。
-    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
-    # 计算排序后概率的累积和. 返回的 probs_sum 是累积概率分布。
-    probs_sum = torch.cumsum(probs_sort, dim=-1)
-    # 保留累积概率未超过阈值 p 的词汇的概率，其余词汇的概率被置为 0.0。
-    mask = probs_sum - probs_sort > p # 创建掩码，对于每个位置，计算累积概率（不包括当前词）是否超过阈值 p。
-    probs_sort[mask] = 0.0 # 将累积概率超过阈值 p 的词的概率置零。
-
-    # 对剩余的概率重新归一化, 确保总和为 1。
-    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    # 从重新归一化的概率分布中采样下一个词. 返回的 next_token 是采样得到的词在排序后概率分布中的索引。
-    next_token_sorted_idx = torch.multinomial(probs_sort, num_samples=1)
-    # 在 probs_idx 的最后一维（dim=-1）中，使用 next_token_sorted_idx 作为索引，提取对应的值。沿着 dim=1（列）进行索引提取
-    # NOTE: torch.gather 函数按照给定的索引张量 index，从输入张量中收集 (获取) 数据，并返回一个与索引张量形状一致的张量。
-    next_token = torch.gather(probs_idx, -1, index = next_token_sorted_idx)
-    
-    return next_token # 返回采样得到的下一个词的索引
+        reported = [False] * len(prompts)
+        for batch_outputs, finish_reasons in stream:
+            batch_deltas = []
+            for i, (text, finish_reason) in enumerate(zip(batch_outputs, finish_reasons)):
+                just_finished = finish_reason is not None and not reported[i]
+                reported[i] = finish_reason is not None
+                if text or just_finished:
+                    batch_deltas.append(
+                        CompletionDelta(index=i, text=text, finish_reason=finish_reason if just_finished else None)
+                    )
+            if batch_deltas:
+                yield batch_deltas
@@ -48,13 +48,28 @@ class FusedAttention(nn.Module):
         combined_kv = torch.cat([xk, xv], dim=2) # (B, L, 2*num_kv_heads, head_dim)  
         combined_kv_reshaped = combined_kv.view(-1, self.num_kv_heads*2, self.head_dim)
 
-        atten_info.kv_buffer[layer_index][atten_info.cur_select_index] = combined_kv_reshaped
+        kv_scale = None if atten_info.kv_scale is None else atten_info.kv_scale[layer_index]
+        write_kv_cache(combined_kv_reshaped, atten_info.kv_buffer[layer_index], kv_scale, atten_info.cur_select_index)
+        k_scale, v_scale = split_kv_scale(kv_scale, self.num_kv_heads)
 
         # 3. sel-attention. flashattention 计算: softmax(qk^t) * v
         xq = xq.transpose(1, 2) # (batch_size, seq_len, self.num_kv_heads, self.head_dim) -> (batch_size, self.num_kv_heads, seq_len, self.head_dim)
-        keys = xk.transpose(1, 2)
-        values = xv.transpose(1, 2)
-        output = flash_attention_v2(xq, keys, values, qk_scale)
+        if atten_info.b_prefix_len is not None:
+            # 前缀的 kv 已在 cache 中 (prefix cache 命中), 从分页 kv cache 中读取完整的 k v
+            k_buffer = atten_info.kv_buffer[layer_index][:, :self.num_kv_heads, :]
+            v_buffer = atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :]
+            output = flash_attention_v2_paged(
+                xq, k_buffer, v_buffer, qk_scale,
+                atten_info.block_tables,
+                atten_info.b_req_idx,
+                atten_info.b_prefix_len,
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+        else:
+            keys = xk.transpose(1, 2)
+            values = xv.transpose(1, 2)
+            output = flash_attention_v2(xq, keys, values, qk_scale)
         output = (output.transpose(1, 2).contiguous().view(batch_size, seq_len, -1))
         
         # 4. attention 输出做线性变换
@@ -86,23 +101,110 @@ class FusedAttention(nn.Module):
         k_buffer = atten_info.kv_buffer[layer_index][:, :self.num_kv_heads, :] # k_buffer and v_buffer shape is  torch.Size([6000, 8, 64]) torch.Size([6000, 8, 64])
         v_buffer = atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :]
 
-        k_buffer[atten_info.cur_select_index] = xk.squeeze(dim=1)
-        v_buffer[atten_info.cur_select_index] = xv.squeeze(dim=1)
+        # 量化 kv cache 时 k v 一起按 (token, head) 量化后写入
+        kv_scale = None if atten_info.kv_scale is None else atten_info.kv_scale[layer_index]
+        combined_kv = torch.cat([xk, xv], dim=2).view(-1, self.num_kv_heads*2, self.head_dim)
+        write_kv_cache(combined_kv, atten_info.kv_buffer[layer_index], kv_scale, atten_info.cur_select_index)
+        k_scale, v_scale = split_kv_scale(kv_scale, self.num_kv_heads)
         
         # 3. flashattention 计算: softmax(qk^t) * v
-        output = flash_decoding(
-            xq, k_buffer, v_buffer, 
-            qk_scale,
-            atten_info.start_index, 
-            atten_info.b_seq_len, 
-            atten_info.max_actual_seq_len
-        ) # ouput shape is [batchs, num_heads, head_dim]
+        if atten_info.b_req_idx is not None:
+            # 分页 kv cache, 序列的 kv 不连续, 通过 block table 定位
+            output = flash_decoding_paged(
+                xq, k_buffer, v_buffer,
+                qk_scale,
+                atten_info.block_tables,
+                atten_info.b_req_idx,
+                atten_info.b_seq_len,
+                atten_info.max_actual_seq_len,
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+        else:
+            output = flash_decoding(
+                xq, k_buffer, v_buffer,
+                qk_scale,
+                atten_info.start_index,
+                atten_info.b_seq_len,
+                atten_info.max_actual_seq_len,
+                k_scale, v_scale,
+            ) # ouput shape is [batchs, num_heads, head_dim]
         
         output = output.view(batch_size, seq_len, self.num_heads_q * self.head_dim)
 
         output = self.o_proj(output)
         return output
 
+    def packed_forward(self,
+        x: torch.Tensor,
+        atten_info,
+        layer_index:int,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        qk_scale = None,
+    ):
+        """
+        打包的混合 batch: decode token 与 prefill 分块拼接为 (1, total_tokens, Dim), 投影只计算一次,
+        只有 attention 按 decode / prefill 两部分分别调用各自的 kernel。
+        """
+        _, num_tokens, _ = x.shape
+
+        # 1. 计算 Q K V, 应用旋转位置编码 (每个 token 的位置由 position_ids 给出), 并写入 kv cache
+        xq = self.q_proj(x).view(1, num_tokens, self.num_heads_q, self.head_dim)
+        xkv = F.linear(x, self.kv_proj_weight)
+        xk, xv = torch.split(xkv, [self.num_kv_heads * self.head_dim, xkv.size(-1) - self.num_kv_heads * self.head_dim], dim=-1)
+        xk = xk.view(1, num_tokens, self.num_kv_heads, self.head_dim)
+        xv = xv.view(1, num_tokens, self.num_kv_heads, self.head_dim)
+
+        cos, sin = position_embeddings
+        xq, xk, _, _ = rope_forward(xq, xk, cos, sin)
+
+        combined_kv = torch.cat([xk, xv], dim=2).view(-1, self.num_kv_heads*2, self.head_dim)
+        kv_scale = None if atten_info.kv_scale is None else atten_info.kv_scale[layer_index]
+        write_kv_cache(combined_kv, atten_info.kv_buffer[layer_index], kv_scale, atten_info.cur_select_index)
+        k_scale, v_scale = split_kv_scale(kv_scale, self.num_kv_heads)
+
+        # 2. decode token 与 prefill 分块分别计算 attention, kv 全部从分页 kv cache 中读取
+        xq = xq.view(num_tokens, self.num_heads_q, self.head_dim)
+        k_buffer = atten_info.kv_buffer[layer_index][:, :self.num_kv_heads, :]
+        v_buffer = atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :]
+        num_decode = atten_info.num_decode_seqs
+        output = torch.empty_like(xq)
+        if num_decode > 0:
+            output[:num_decode] = flash_decoding_paged(
+                xq[:num_decode], k_buffer, v_buffer,
+                qk_scale,
+                atten_info.block_tables,
+                atten_info.b_req_idx[:num_decode],
+                atten_info.b_seq_len[:num_decode],
+                atten_info.max_actual_seq_len,
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+        if num_decode < num_tokens and atten_info.b_prefix_len is None:
+            # prefill 分块都没有已缓存的前缀, 直接使用本次计算的 k v, 不必从 kv cache 中按 block 读取
+            output[num_decode:] = flash_attention_v2_varlen(
+                xq[num_decode:], xk[0, num_decode:], xv[0, num_decode:],
+                qk_scale * 1.4426950408889634,
+                atten_info.cu_seqlens,
+                atten_info.max_q_len,
+            )
+        elif num_decode < num_tokens:
+            output[num_decode:] = flash_attention_v2_varlen_paged(
+                xq[num_decode:], k_buffer, v_buffer,
+                qk_scale * 1.4426950408889634,
+                atten_info.cu_seqlens,
+                atten_info.b_seq_len[num_decode:],
+                atten_info.max_q_len,
+                atten_info.block_tables,
+                atten_info.b_req_idx[num_decode:],
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+
+        output = output.view(1, num_tokens, self.num_heads_q * self.head_dim)
+        output = self.o_proj(output)
+        return output
+
 class FusedMLP(nn.Module):
 
     def __init__(self, config: LlamaConfig):
@@ -145,7 +247,11 @@ class LlamaDecoderLayer(nn.Module):
         hidden_states = rmsnorm_fwd(x, self.attention_norm_weight.data, eps=self.config.rms_norm_eps)
 
         # attention 部分计算结果正确, 张量尺寸符合要求
-        if seq_len > 1:
+        if atten_info.cu_seqlens is not None:
+            attn_output = self.self_attn.packed_forward(
+                hidden_states, atten_info, layer_index, position_embeddings, qk_scale
+            )
+        elif seq_len > 1:
             attn_output = self.self_attn.context_forward(
                 hidden_states, atten_info, layer_index, position_embeddings, qk_scale
             )
@@ -198,7 +304,8 @@ class LlamaModel(nn.Module):
             _, seq_len = input_ids.shape
             h = self.get_input_embeddings(input_ids)
         
-        if seq_len > 1:
+        # 打包 batch 中 decode 与 prefill 的缩放系数不同, 由 packed_forward 各自处理
+        if seq_len > 1 and atten_info.cu_seqlens is None:
             qk_scale = self.qk_scale * 1.4426950408889634
         else:
             qk_scale = self.qk_scale
@@ -214,6 +321,8 @@ class LlamaModel(nn.Module):
             h = layer(h, atten_info, i, position_embeddings, qk_scale)  # h.shape [batch_size, seq_len, hidden_dim]
             # assert not torch.isnan(h).any(), f"In {i} decoder layer, h tensor contains NaN values!"
 
+        if atten_info.cu_seqlens is not None:
+            h = h[:, atten_info.logits_index] # 打包 batch 只需要每个序列最后一个 token 的 logits
         h = rmsnorm_fwd(h, self.norm_weight.data, eps=self.config.rms_norm_eps)
         # self.hidden_states.append(h)
         output = self.lm_head(h)
@@ -31,13 +31,28 @@ class Attention(nn.Module):
         # 1. 获取 prefill 阶段的 select_index, 并更新 kv cache 张量
         combined_kv = torch.cat([xk, xv], dim=2) # (B, L, 2*num_kv_heads, head_dim)  
         combined_kv_reshaped = combined_kv.view(-1, self.num_kv_heads*2, self.head_dim)
-        atten_info.kv_buffer[layer_index][atten_info.cur_select_index] = combined_kv_reshaped
+        kv_scale = None if atten_info.kv_scale is None else atten_info.kv_scale[layer_index]
+        write_kv_cache(combined_kv_reshaped, atten_info.kv_buffer[layer_index], kv_scale, atten_info.cur_select_index)
+        k_scale, v_scale = split_kv_scale(kv_scale, self.num_kv_heads)
 
         # 2. sel-attention. flashattention 计算: softmax(qk^t) * v
         xq = xq.transpose(1, 2)
-        keys = xk.transpose(1, 2)
-        values = xv.transpose(1, 2)
-        output = flash_attention_v2(xq, keys, values, qk_scale)
+        if atten_info.b_prefix_len is not None:
+            # 前缀的 kv 已在 cache 中, 从分页 kv cache 中读取完整的 k v
+            k_buffer = atten_info.kv_buffer[layer_index][:, :self.num_kv_heads, :]
+            v_buffer = atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :]
+            output = flash_attention_v2_paged(
+                xq, k_buffer, v_buffer, qk_scale,
+                atten_info.block_tables,
+                atten_info.b_req_idx,
+                atten_info.b_prefix_len,
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+        else:
+            keys = xk.transpose(1, 2)
+            values = xv.transpose(1, 2)
+            output = flash_attention_v2(xq, keys, values, qk_scale)
         
         output = (output.transpose(1, 2).contiguous().view(batch_size, seq_len, self.hidden_size))
         
@@ -59,22 +74,99 @@ class Attention(nn.Module):
         k_buffer = atten_info.kv_buffer[layer_index][:, :self.num_kv_heads, :] # k_buffer and v_buffer shape is  torch.Size([6000, 8, 64]) torch.Size([6000, 8, 64])
         v_buffer = atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :]
 
-        k_buffer[atten_info.cur_select_index] = xk.squeeze(dim=1)
-        v_buffer[atten_info.cur_select_index] = xv.squeeze(dim=1)
+        # 量化 kv cache 时 k v 一起按 (token, head) 量化后写入
+        kv_scale = None if atten_info.kv_scale is None else atten_info.kv_scale[layer_index]
+        combined_kv = torch.cat([xk, xv], dim=2).view(-1, self.num_kv_heads*2, self.head_dim)
+        write_kv_cache(combined_kv, atten_info.kv_buffer[layer_index], kv_scale, atten_info.cur_select_index)
+        k_scale, v_scale = split_kv_scale(kv_scale, self.num_kv_heads)
 
         # 2. flashattention 计算: softmax(qk^t) * v
-        output = flash_decoding(
-            xq, k_buffer, v_buffer, 
-            qk_scale,
-            atten_info.start_index, 
-            atten_info.b_seq_len, 
-            atten_info.max_actual_seq_len
-        ) # ouput shape is [batchs, num_heads, head_dim]
+        if atten_info.b_req_idx is not None:
+            # 分页 kv cache, 序列的 kv 不连续, 通过 block table 定位
+            output = flash_decoding_paged(
+                xq, k_buffer, v_buffer,
+                qk_scale,
+                atten_info.block_tables,
+                atten_info.b_req_idx,
+                atten_info.b_seq_len,
+                atten_info.max_actual_seq_len,
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+        else:
+            output = flash_decoding(
+                xq, k_buffer, v_buffer,
+                qk_scale,
+                atten_info.start_index,
+                atten_info.b_seq_len,
+                atten_info.max_actual_seq_len,
+                k_scale, v_scale,
+            ) # ouput shape is [batchs, num_heads, head_dim]
 
         output = output.view(batch_size, seq_len, self.hidden_size) # 输出张量 seq_len = 1
 
         return output
 
+    def packed_forward(self,
+        xq: torch.Tensor,
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+        atten_info,
+        layer_index:int,
+        qk_scale = None,
+    ) -> torch.Tensor:
+        """打包的混合 batch: decode token 与 prefill 分块拼接为 (1, total_tokens), attention 按两部分分别计算"""
+        xq = xq.to(torch.float16)
+        _, num_tokens, num_heads_q, head_dim = xq.shape
+
+        # 1. 更新 kv cache
+        combined_kv = torch.cat([xk, xv], dim=2).view(-1, self.num_kv_heads*2, self.head_dim)
+        kv_scale = None if atten_info.kv_scale is None else atten_info.kv_scale[layer_index]
+        write_kv_cache(combined_kv, atten_info.kv_buffer[layer_index], kv_scale, atten_info.cur_select_index)
+        k_scale, v_scale = split_kv_scale(kv_scale, self.num_kv_heads)
+
+        # 2. decode token 与 prefill 分块分别计算 attention, kv 全部从分页 kv cache 中读取
+        xq = xq.view(num_tokens, num_heads_q, head_dim)
+        k_buffer = atten_info.kv_buffer[layer_index][:, :self.num_kv_heads, :]
+        v_buffer = atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :]
+        num_decode = atten_info.num_decode_seqs
+        output = torch.empty_like(xq)
+        if num_decode > 0:
+            output[:num_decode] = flash_decoding_paged(
+                xq[:num_decode], k_buffer, v_buffer,
+                qk_scale,
+                atten_info.block_tables,
+                atten_info.b_req_idx[:num_decode],
+                atten_info.b_seq_len[:num_decode],
+                atten_info.max_actual_seq_len,
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+        if num_decode < num_tokens and atten_info.b_prefix_len is None:
+            # prefill 分块都没有已缓存的前缀, 直接使用本次计算的 k v, 不必从 kv cache 中按 block 读取
+            output[num_decode:] = flash_attention_v2_varlen(
+                xq[num_decode:], xk[0, num_decode:], xv[0, num_decode:],
+                qk_scale * 1.4426950408889634,
+                atten_info.cu_seqlens,
+                atten_info.max_q_len,
+            )
+        elif num_decode < num_tokens:
+            output[num_decode:] = flash_attention_v2_varlen_paged(
+                xq[num_decode:], k_buffer, v_buffer,
+                qk_scale * 1.4426950408889634,
+                atten_info.cu_seqlens,
+                atten_info.b_seq_len[num_decode:],
+                atten_info.max_q_len,
+                atten_info.block_tables,
+                atten_info.b_req_idx[num_decode:],
+                atten_info.block_size,
+                k_scale, v_scale,
+            )
+
+        output = output.view(1, num_tokens, self.hidden_size)
+
+        return output
+
 class Qwen2Attention(nn.Module):
     def __init__(self,  
         hidden_size: int,
@@ -134,8 +226,14 @@ class Qwen2Attention(nn.Module):
         # 计算 attention 的输入 q、k、v
         xq, xk, xv = self._get_qkv(x, position_embeddings)
 
-        # 根据输入张量 seq_len 长度选择 context_forward 还是 token_forward
-        if seq_len > 1:
+        # 根据输入张量 seq_len 长度选择 context_forward 还是 token_forward, 打包的混合 batch 使用 packed_forward
+        if atten_info.cu_seqlens is not None:
+            attn_output = self.attn.packed_forward(
+                xq, xk, xv,
+                atten_info, layer_index,
+                qk_scale,
+            )
+        elif seq_len > 1:
             attn_output = self.attn.context_forward(
                 xq, xk, xv,
                 atten_info, layer_index,
@@ -253,7 +351,8 @@ class Qwen2Model(nn.Module):
         else:
             h = self.get_input_embeddings(input_ids)
 
-        if seq_len > 1:
+        # 打包 batch 中 decode 与 prefill 的缩放系数不同, 由 packed_forward 各自处理
+        if seq_len > 1 and atten_info.cu_seqlens is None:
             qk_scale = self.qk_scale * 1.4426950408889634
         else:
             qk_scale = self.qk_scale
@@ -269,6 +368,8 @@ class Qwen2Model(nn.Module):
             # self.hidden_states.append(h)
             h = layer(h, atten_info, i, position_embeddings, qk_scale)  # h.shape [batch_size, seq_len, hidden_dim]
 
+        if atten_info.cu_seqlens is not None:
+            h = h[:, atten_info.logits_index] # 打包 batch 只需要每个序列最后一个 token 的 logits
         h = rmsnorm_fwd(h, self.norm_weight, eps=self.rmsnorm_eps)
         # self.hidden_states.append(h)
         
@@ -397,7 +397,8 @@ def get_prompter(model_type, model_path="", short_prompt=False, empty_prompt=Fal
 
 
 def get_stop_token_ids(model_type, model_path=""):
-    if model_type.lower() == "llama":
+    # 对话模型的回合结束 token, 与 tokenizer.eos_token_id 一起作为停止 token
+    if model_type.lower() in ("llama", "llava"):
         if (
             "llama-3" in model_path.lower() or "llama3" in model_path.lower()
         ) and "30b" not in model_path.lower():
@@ -411,6 +412,9 @@ def get_stop_token_ids(model_type, model_path=""):
             return [50278, 0]
         else:
             return []
+    elif model_type.lower() == "qwen2":
+        # <|endoftext|>, <|im_end|>
+        return [151643, 151645]
     else:
         raise ValueError(f"model type {model_type} is not supported")
 
@@ -0,0 +1,97 @@
+# 测试共用的桩模型、参考实现, 以及 CPU 上的 ModelExecutor 和 KVCacheMemoryManager 构造函数
+import torch
+from lite_llama.executor.mem_manager import KVCacheMemoryManager
+from lite_llama.executor.model_executor import ModelExecutor
+from lite_llama.models.model_config import LlamaConfig
+
+VOCAB_SIZE = 50
+EOS_TOKEN_ID = 0
+
+class StubModel:
+    """
+    桩模型: 把输入 token id 写入 kv cache, 再从 kv cache 读回每个序列的完整历史,
+    下一个 token = sum(历史 token) % VOCAB_SIZE. 只有 atten_info 中的元数据全部正确时, 输出才和参考实现一致。
+    """
+    vocab_size = VOCAB_SIZE
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.prefill_lens = []
+
+    def forward(self, input_ids, start_pos, atten_info, position_ids=None):
+        # 调度器把 decode token 和 prefill 分块打包为 [1, total_tokens] 的混合 batch
+        assert atten_info.cu_seqlens is not None and input_ids.shape[0] == 1
+        num_decode = atten_info.num_decode_seqs
+        q_lens = [1] * num_decode + (atten_info.cu_seqlens[1:] - atten_info.cu_seqlens[:-1]).tolist()
+        self.batch_sizes.append(len(q_lens))
+        self.prefill_lens.extend(q_lens[num_decode:])
+        kv_buffer = atten_info.kv_buffer[0]
+        kv_buffer[atten_info.cur_select_index, 0, 0] = input_ids.reshape(-1).to(kv_buffer.dtype)
+
+        # 每个序列本次的 token 位于其末尾
+        expected_pos = torch.cat([
+            torch.arange(int(seq_len) - q_len, int(seq_len)) for seq_len, q_len in zip(atten_info.b_seq_len, q_lens)
+        ])
+        assert torch.equal(position_ids.reshape(-1), expected_pos)
+
+        # 只计算 logits_index 指定的 token 的 logits, 每个 token 只能看到自己及之前位置的 kv
+        seq_of_token = torch.cat([torch.full((q_len,), i) for i, q_len in enumerate(q_lens)])
+        logits_index = atten_info.logits_index.tolist()
+        logits = torch.empty((1, len(logits_index), self.vocab_size))
+        block_size = atten_info.block_size
+        for row, token in enumerate(logits_index):
+            i = int(seq_of_token[token])
+            seq_pos = torch.arange(int(position_ids[0, token]) + 1)
+            block_idx = atten_info.block_tables[int(atten_info.b_req_idx[i]), seq_pos // block_size].to(torch.long)
+            kv_loc = block_idx * block_size + seq_pos % block_size
+            history = kv_buffer[kv_loc, 0, 0].to(torch.long)
+            logits[0, row] = self.logits_row(history)
+        return logits
+
+    def logits_row(self, history):
+        row = torch.full((self.vocab_size,), -1e4)
+        row[self.next_token(history)] = 0.0
+        return row
+
+    def next_token(self, history):
+        return int(history.sum()) % VOCAB_SIZE
+
+class WrongDraftModel(StubModel):
+    """总是提议与目标模型不同的 token 的 draft 模型"""
+    def next_token(self, history):
+        return (int(history.sum()) + 1) % VOCAB_SIZE
+
+class BracketTokenizer:
+    """把每个 token 解码为 <token> 的桩分词器"""
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(f"<{token}>" for token in token_ids)
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [self.decode(token_ids, skip_special_tokens) for token_ids in sequences]
+
+def reference_generate(prompt, max_gen_len):
+    seq, out = list(prompt), []
+    while len(out) < max_gen_len:
+        token = sum(seq) % VOCAB_SIZE
+        out.append(token)
+        seq.append(token)
+        if token == EOS_TOKEN_ID:
+            break
+    return out
+
+def build_executor(gpu_num_blocks, block_size=1):
+    config = LlamaConfig(num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, device="cpu")
+    return ModelExecutor(config, StubModel(), max_gpu_num_blocks=gpu_num_blocks, device="cpu", block_size=block_size)
+
+def build_draft_executor(executor, model):
+    config = LlamaConfig(num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, device="cpu")
+    kv_mem_manager = executor.kv_mem_manager
+    return ModelExecutor(
+        config, model, device="cpu", block_size=kv_mem_manager.block_size, kv_allocator=kv_mem_manager.allocator
+    )
+
+def build_manager(gpu_num_blocks, block_size=1, kv_cache_dtype=None, num_layers=2, num_kv_heads=2, head_dim=8):
+    return KVCacheMemoryManager(
+        num_layers=num_layers, num_kv_heads=num_kv_heads, head_dim=head_dim, gpu_num_blocks=gpu_num_blocks,
+        block_size=block_size, dtype=torch.float16, device="cpu", kv_cache_dtype=kv_cache_dtype,
+    )
@@ -0,0 +1,114 @@
+# 代码可直接运行，使用桩模型 (stub model) 在 CPU 上测试 BeamSearchDecoder
+import unittest
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.model_executor import ModelExecutor
+from lite_llama.executor.scheduler import ContinuousBatchScheduler
+from lite_llama.executor.beam_search import BeamSearchDecoder
+from lite_llama.models.model_config import LlamaConfig
+from tests.helpers import StubModel
+
+VOCAB_SIZE = 5
+EOS_TOKEN_ID = 0
+
+def token_logprobs(history):
+    """由完整历史确定的随机对数概率"""
+    seed = 0
+    for token in history:
+        seed = (seed * 131 + int(token) + 1) % (1 << 31)
+    logits = torch.randn(VOCAB_SIZE, generator=torch.Generator().manual_seed(seed)) * 2
+    return torch.log_softmax(logits, dim=-1)
+
+class RandomHistoryModel(StubModel):
+    """从 kv cache 读回历史, 下一个 token 的 logits 由整个历史确定, beam 的 kv 映射错误时结果会不同"""
+    vocab_size = VOCAB_SIZE
+
+    def logits_row(self, history):
+        return token_logprobs(history.tolist())
+
+def exhaustive_search(prompt, max_gen_len):
+    """枚举所有以 eos 结束或达到最大长度的序列, 返回 (累计对数概率, 序列) 并按概率降序排列"""
+    results = []
+    def expand(tokens, sum_logprobs):
+        logprobs = token_logprobs(prompt + tokens)
+        for token in range(VOCAB_SIZE):
+            new_tokens, score = tokens + [token], sum_logprobs + float(logprobs[token])
+            if token == EOS_TOKEN_ID or len(new_tokens) == max_gen_len:
+                results.append((score, new_tokens))
+            else:
+                expand(new_tokens, score)
+    expand([], 0.0)
+    return sorted(results, key=lambda item: item[0], reverse=True)
+
+def build_scheduler(max_batch_size, block_size, gpu_num_blocks=512):
+    config = LlamaConfig(num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, device="cpu")
+    executor = ModelExecutor(
+        config, RandomHistoryModel(), max_gpu_num_blocks=gpu_num_blocks, device="cpu", block_size=block_size
+    )
+    return ContinuousBatchScheduler(
+        executor, EOS_TOKEN_ID, max_batch_size=max_batch_size, max_seq_len=64, kv_chunk_size=block_size, device="cpu"
+    )
+
+class TestBeamSearchDecoder(unittest.TestCase):
+    def _check_exhaustive(self, block_size):
+        # beam 数不小于所有可能的前缀数时, beam search 等价于穷举, 前 beam_width 个候选完全相同
+        scheduler = build_scheduler(max_batch_size=25, block_size=block_size)
+        copies = []
+        copy_blocks = scheduler.kv_mem_manager.copy_blocks
+        scheduler.kv_mem_manager.copy_blocks = lambda src, dst: copies.append(len(src)) or copy_blocks(src, dst)
+
+        prompt = [3, 1, 4, 1, 2]
+        decoder = BeamSearchDecoder(scheduler, beam_width=25, length_penalty=0.0)
+        hypotheses = decoder.search([prompt], max_gen_len=3)[0]
+        expected = exhaustive_search(prompt, 3)[:25]
+        self.assertEqual([hyp.tokens for hyp in hypotheses], [tokens for _, tokens in expected])
+        for hyp, (score, _) in zip(hypotheses, expected):
+            self.assertAlmostEqual(hyp.score, score, places=4)
+
+        kv_mem_manager = scheduler.kv_mem_manager
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+        self.assertEqual(sorted(scheduler.free_table_rows), list(range(25)))
+        return copies
+
+    def test_matches_exhaustive_search_without_kv_copies(self):
+        # block_size = 1 时 beam 重排只修改 block_tables, 从不复制 kv
+        self.assertEqual(self._check_exhaustive(block_size=1), [])
+
+    def test_matches_exhaustive_search_with_paged_kv(self):
+        # 只复制末尾未写满的 block
+        copies = self._check_exhaustive(block_size=4)
+        self.assertGreater(len(copies), 0)
+        self.assertTrue(all(n == 1 for n in copies))
+
+    def test_batched_prompts_match_single_prompt(self):
+        prompts = [[1, 2, 3], [4, 4], [2, 3, 1, 1, 3, 2]]
+        expected = []
+        for prompt in prompts:
+            decoder = BeamSearchDecoder(build_scheduler(max_batch_size=3, block_size=2), beam_width=3)
+            expected.append(decoder.search([prompt], max_gen_len=6)[0])
+        # 一次打包 2 个 prompt 的 beam, 第三个 prompt 在下一批
+        scheduler = build_scheduler(max_batch_size=7, block_size=2)
+        results = BeamSearchDecoder(scheduler, beam_width=3).search(prompts, max_gen_len=6)
+        for hypotheses, expected_hypotheses in zip(results, expected):
+            self.assertEqual([hyp.tokens for hyp in hypotheses], [hyp.tokens for hyp in expected_hypotheses])
+            scores = [hyp.score for hyp in hypotheses]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(scheduler.kv_mem_manager.can_use_mem_size, scheduler.kv_mem_manager.max_num_tokens)
+
+    def test_early_stopping(self):
+        scheduler = build_scheduler(max_batch_size=2, block_size=1)
+        hypotheses = BeamSearchDecoder(scheduler, beam_width=2, early_stopping=True).search([[1, 2]], max_gen_len=20)[0]
+        self.assertEqual(len(hypotheses), 2)
+        for hyp in hypotheses:
+            self.assertLessEqual(len(hyp.tokens), 20)
+
+    def test_invalid_arguments(self):
+        scheduler = build_scheduler(max_batch_size=2, block_size=1)
+        with self.assertRaises(ValueError):
+            BeamSearchDecoder(scheduler, beam_width=3)
+        scheduler.add_request([1, 2], 4)
+        with self.assertRaises(RuntimeError):
+            BeamSearchDecoder(scheduler, beam_width=2).search([[1, 2]], 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# 代码可直接运行，用模拟 sentencepiece 字节回退的分词器测试 IncrementalDetokenizer 的增量解码
+import unittest
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.detokenizer import DecodeState, IncrementalDetokenizer
+
+class ByteFallbackTokenizer:
+    """
+    0-255 是字节 token, 之后是以 "▁" 表示前导空格的词 token; 与 sentencepiece 一样, 解码时去掉开头的一个空格,
+    不完整的 utf-8 字节解码为 U+FFFD。
+    """
+    eos_token_id = 256
+    words = ["</s>", "▁hello", "▁world", "▁a", "b"]
+
+    def __init__(self):
+        self.num_batch_decode_calls = 0
+
+    def encode_word(self, word):
+        return 256 + self.words.index(word)
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        data = b""
+        for token in token_ids:
+            if token < 256:
+                data += bytes([token])
+            elif not (skip_special_tokens and token == self.eos_token_id):
+                data += self.words[token - 256].replace("▁", " ").encode()
+        text = data.decode("utf-8", errors="replace")
+        return text[1:] if text.startswith(" ") else text
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        self.num_batch_decode_calls += 1
+        return [self.decode(token_ids, skip_special_tokens) for token_ids in sequences]
+
+class TestIncrementalDetokenizer(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = ByteFallbackTokenizer()
+        self.detokenizer = IncrementalDetokenizer(self.tokenizer)
+
+    def _stream(self, prompt, generated, finished_at_end=True):
+        state = DecodeState.from_prompt(prompt)
+        deltas = []
+        for i in range(1, len(generated) + 1):
+            finished = finished_at_end and i == len(generated)
+            deltas.extend(self.detokenizer.decode([generated[:i]], [state], [finished]))
+        return deltas
+
+    def test_multi_byte_characters_split_across_tokens(self):
+        hello = self.tokenizer.encode_word("▁hello")
+        generated = list("你好".encode()) + [self.tokenizer.encode_word("▁world")] + list("é".encode())
+        deltas = self._stream([hello], generated)
+        self.assertEqual("".join(deltas), "你好 worldé")
+        # 不完整的字符不输出替换字符, 每个字符在其最后一个字节到达时整体输出
+        self.assertNotIn("\ufffd", "".join(deltas))
+        self.assertEqual([delta for delta in deltas if delta], ["你", "好", " world", "é"])
+
+    def test_leading_space_uses_prompt_context(self):
+        hello, world = self.tokenizer.encode_word("▁hello"), self.tokenizer.encode_word("▁world")
+        self.assertEqual(self._stream([hello], [world, world]), [" world", " world"])
+        # 没有上下文时, 第一个 token 的前导空格按 sentencepiece 的规则被去掉
+        self.assertEqual(self._stream([], [world, world]), ["world", " world"])
+
+    def test_finished_sequence_flushes_incomplete_bytes(self):
+        generated = list("好".encode())[:2]
+        self.assertEqual(self._stream([], generated, finished_at_end=False), ["", ""])
+        self.assertEqual(self._stream([], generated), ["", "\ufffd"])
+
+    def test_one_batch_decode_call_per_step(self):
+        a, b, eos = self.tokenizer.encode_word("▁a"), self.tokenizer.encode_word("b"), self.tokenizer.eos_token_id
+        sequences = [[a, b, a, eos], list("é".encode()) + [b, b], [b, a, b, a]]
+        states = [DecodeState.from_prompt([a]) for _ in sequences]
+        texts = ["" for _ in sequences]
+        for step in range(1, 5):
+            deltas = self.detokenizer.decode([tokens[:step] for tokens in sequences], states, [step == 4] * 3)
+            for i, delta in enumerate(deltas):
+                texts[i] += delta
+        self.assertEqual(self.tokenizer.num_batch_decode_calls, 4)
+        self.assertEqual(texts, [" ab a", "ébb", "b ab a"])
+        for tokens, text in zip(sequences, texts):
+            # 增量解码的结果与带上下文整体解码一致
+            self.assertEqual(text, self.tokenizer.decode([a] + tokens)[len(self.tokenizer.decode([a])):])
+
+if __name__ == "__main__":
+    unittest.main()
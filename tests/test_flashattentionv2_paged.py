@@ -0,0 +1,45 @@
+# 代码可直接运行，对比 flash_attention_v2_paged 与 pytorch 参考实现的结果, 无 GPU 时使用 triton 解释器
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1"
+
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.kernels.flashattentionv2 import flash_attention_v2_paged, torch_paged_prefill_attention
+
+class TestFlashAttentionV2Paged(unittest.TestCase):
+    def _run(self, prefix_lens, m_size, block_size):
+        torch.manual_seed(0)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        num_heads, num_kv_heads, head_dim = 4, 2, 32
+        num_blocks = 512 // block_size
+        max_blocks_per_seq = (max(prefix_lens) + m_size + block_size - 1) // block_size
+        batch_size = len(prefix_lens)
+
+        k_cache = torch.randn(num_blocks * block_size, num_kv_heads, head_dim, device=device, dtype=torch.float16)
+        v_cache = torch.randn(num_blocks * block_size, num_kv_heads, head_dim, device=device, dtype=torch.float16)
+        q = torch.randn(batch_size, num_heads, m_size, head_dim, device=device, dtype=torch.float16)
+
+        perm = torch.randperm(num_blocks, device=device).to(torch.int32)
+        block_tables = torch.zeros(batch_size, max_blocks_per_seq, dtype=torch.int32, device=device)
+        block_tables[:] = perm[:batch_size * max_blocks_per_seq].view(batch_size, -1)
+        b_req_idx = torch.arange(batch_size, dtype=torch.int32, device=device).flip(0)
+        b_prefix_len = torch.tensor(prefix_lens, dtype=torch.int32, device=device)
+
+        qk_scale = 1.0 / head_dim ** 0.5 * 1.4426950408889634
+        out = flash_attention_v2_paged(q, k_cache, v_cache, qk_scale, block_tables, b_req_idx, b_prefix_len, block_size)
+        ref = torch_paged_prefill_attention(q, k_cache, v_cache, block_tables, b_req_idx, b_prefix_len, block_size)
+        self.assertTrue(torch.allclose(out.float(), ref.float(), atol=1e-2, rtol=1e-2))
+
+    def test_without_prefix(self):
+        self._run(prefix_lens=[0], m_size=70, block_size=1)
+
+    def test_with_prefix(self):
+        self._run(prefix_lens=[37, 0], m_size=29, block_size=1)
+
+    def test_with_prefix_paged(self):
+        self._run(prefix_lens=[64, 100], m_size=80, block_size=4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+# 代码可直接运行，对比 flash_attention_v2_varlen_paged 与 pytorch 参考实现的结果, 无 GPU 时使用 triton 解释器
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1"
+
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.kernels.flashattentionv2 import flash_attention_v2_varlen_paged, torch_varlen_paged_prefill_attention
+
+class TestFlashAttentionV2VarlenPaged(unittest.TestCase):
+    def _run(self, prefix_lens, q_lens, block_size):
+        torch.manual_seed(0)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        num_heads, num_kv_heads, head_dim = 4, 2, 32
+        num_blocks = 1024 // block_size
+        seq_lens = [p + m for p, m in zip(prefix_lens, q_lens)]
+        max_blocks_per_seq = (max(seq_lens) + block_size - 1) // block_size
+        batch_size = len(q_lens)
+
+        k_cache = torch.randn(num_blocks * block_size, num_kv_heads, head_dim, device=device, dtype=torch.float16)
+        v_cache = torch.randn(num_blocks * block_size, num_kv_heads, head_dim, device=device, dtype=torch.float16)
+        q = torch.randn(sum(q_lens), num_heads, head_dim, device=device, dtype=torch.float16)
+
+        perm = torch.randperm(num_blocks, device=device).to(torch.int32)
+        block_tables = perm[:batch_size * max_blocks_per_seq].view(batch_size, -1).contiguous()
+        b_req_idx = torch.arange(batch_size, dtype=torch.int32, device=device).flip(0)
+        b_seq_len = torch.tensor(seq_lens, dtype=torch.int32, device=device)
+        cu_seqlens = torch.tensor([0] + q_lens, dtype=torch.int32, device=device).cumsum(0).to(torch.int32)
+
+        qk_scale = 1.0 / head_dim ** 0.5 * 1.4426950408889634
+        out = flash_attention_v2_varlen_paged(
+            q, k_cache, v_cache, qk_scale, cu_seqlens, b_seq_len, max(q_lens), block_tables, b_req_idx, block_size
+        )
+        ref = torch_varlen_paged_prefill_attention(q, k_cache, v_cache, cu_seqlens, b_seq_len, block_tables, b_req_idx, block_size)
+        self.assertTrue(torch.allclose(out.float(), ref.float(), atol=1e-2, rtol=1e-2))
+
+    def test_uneven_lengths(self):
+        self._run(prefix_lens=[0, 0, 0], q_lens=[70, 3, 129], block_size=1)
+
+    def test_mixed_prefix_and_single_token(self):
+        # 长度为 1 的分块等价于 decode
+        self._run(prefix_lens=[37, 0, 90], q_lens=[1, 29, 1], block_size=1)
+
+    def test_paged(self):
+        self._run(prefix_lens=[64, 5, 0], q_lens=[80, 17, 33], block_size=4)
+
+if __name__ == "__main__":
+    unittest.main()
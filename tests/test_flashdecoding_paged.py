@@ -0,0 +1,53 @@
+# 代码可直接运行，对比 flash_decoding_paged 与 pytorch 参考实现的结果, 无 GPU 时使用 triton 解释器
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1"
+
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.kernels.flashdecoding import flash_decoding_paged, torch_paged_attention
+
+class TestFlashDecodingPaged(unittest.TestCase):
+    def _run(self, block_size):
+        torch.manual_seed(0)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        num_heads, num_kv_heads, head_dim = 4, 2, 32
+        num_blocks, max_seq_len = 512 // block_size, 300
+        max_blocks_per_seq = (max_seq_len + block_size - 1) // block_size
+        seq_lens = [1, 37, 129, 300]
+        batch_size = len(seq_lens)
+
+        k_cache = torch.randn(num_blocks * block_size, num_kv_heads, head_dim, device=device, dtype=torch.float16)
+        v_cache = torch.randn(num_blocks * block_size, num_kv_heads, head_dim, device=device, dtype=torch.float16)
+        q = torch.randn(batch_size, num_heads, head_dim, device=device, dtype=torch.float16)
+
+        # 每个请求占用的 block 打乱且互不重叠, 模拟非连续分配
+        perm = torch.randperm(num_blocks, device=device).to(torch.int32)
+        block_tables = torch.zeros(batch_size + 1, max_blocks_per_seq, dtype=torch.int32, device=device)
+        b_req_idx = torch.tensor([2, 0, 4, 1], dtype=torch.int32, device=device)
+        offset = 0
+        for row, length in zip(b_req_idx.tolist(), seq_lens):
+            seq_blocks = (length + block_size - 1) // block_size
+            block_tables[row, :seq_blocks] = perm[offset: offset + seq_blocks]
+            offset += seq_blocks
+        b_seq_len = torch.tensor(seq_lens, dtype=torch.int32, device=device)
+
+        qk_scale = 1.0 / head_dim ** 0.5
+        out = flash_decoding_paged(
+            q, k_cache, v_cache, qk_scale, block_tables, b_req_idx, b_seq_len, max(seq_lens), block_size
+        )
+        ref = torch_paged_attention(q, k_cache, v_cache, block_tables, b_req_idx, b_seq_len, block_size)
+        self.assertTrue(torch.allclose(out.float(), ref.float(), atol=1e-2, rtol=1e-2))
+
+    def test_token_table(self):
+        self._run(block_size=1)
+
+    def test_block_size_4(self):
+        self._run(block_size=4)
+
+    def test_block_size_16(self):
+        self._run(block_size=16)
+
+if __name__ == "__main__":
+    unittest.main()
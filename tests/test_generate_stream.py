@@ -0,0 +1,165 @@
+# 代码可直接运行，在 CPU 上用随机初始化的小模型测试 GenerateStreamText 的 prompt lookup 投机解码
+import unittest
+from unittest import mock
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.model_executor import ModelExecutor
+from lite_llama.generate_stream import GenerateStreamText
+from lite_llama.models.model_config import LlamaConfig
+
+VOCAB_SIZE = 16
+
+class TinyBigramModel(torch.nn.Module):
+    """
+    随机初始化的二元语法 (bigram) 小模型: 下一个 token 的 logits 由当前 token 和前一个 token 决定,
+    前一个 token 从 kv cache 中读取, 因此 kv cache 的写入位置和 block_tables 必须正确。
+    """
+    def __init__(self):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.cur_logits = torch.randn(VOCAB_SIZE, VOCAB_SIZE, generator=generator) * 3
+        self.prev_logits = torch.randn(VOCAB_SIZE, VOCAB_SIZE, generator=generator)
+
+    def forward(self, input_ids, start_pos, atten_info, position_ids=None):
+        kv_buffer = atten_info.kv_buffer[0]
+        kv_buffer[atten_info.cur_select_index, 0, 0] = input_ids.reshape(-1).to(kv_buffer.dtype)
+        num_decode = atten_info.num_decode_seqs
+        q_lens = [1] * num_decode + (atten_info.cu_seqlens[1:] - atten_info.cu_seqlens[:-1]).tolist()
+        seq_of_token = torch.cat([torch.full((q_len,), i) for i, q_len in enumerate(q_lens)])
+
+        logits = []
+        for token in atten_info.logits_index.tolist():
+            i, pos = int(seq_of_token[token]), int(position_ids[0, token])
+            cur = int(input_ids[0, token])
+            row = logits_row = self.cur_logits[cur].clone()
+            if pos > 0:
+                block = atten_info.block_tables[int(atten_info.b_req_idx[i]), (pos - 1) // atten_info.block_size]
+                prev = int(kv_buffer[int(block) * atten_info.block_size + (pos - 1) % atten_info.block_size, 0, 0])
+                row = logits_row + self.prev_logits[prev]
+            logits.append(row)
+        return torch.stack(logits)[None]
+
+class DigitTokenizer:
+    eos_token_id = VOCAB_SIZE - 1
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(f"{token} " for token in token_ids if token != self.eos_token_id)
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [self.decode(token_ids, skip_special_tokens) for token_ids in sequences]
+
+    def encode(self, text, add_special_tokens=True):
+        return [int(token) for token in text.split()]
+
+class TestGenerateStreamPromptLookup(unittest.TestCase):
+    def setUp(self):
+        config = LlamaConfig(
+            num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, max_seq_len=128, device="cpu"
+        )
+        # 跳过 __init__ 中的权重和分词器加载, 只设置 generate_stream 需要的属性
+        self.generator = GenerateStreamText.__new__(GenerateStreamText)
+        self.generator.model_executor = ModelExecutor(config, TinyBigramModel(), max_gpu_num_blocks=64, device="cpu", block_size=4)
+        self.generator.model_config = config
+        self.generator.tokenizer = DigitTokenizer()
+        self.generator.device = "cpu"
+        self.generator.prefix_cache = None
+        self.generator.swap_space = None
+        self.generator.sink_size, self.generator.window_size = 4, None
+        self.generator.prefill_chunk_size = 8
+        self.generator.proposer = None
+        self.generator.num_speculative_tokens = 3
+        self.generator.speculative_stats = []
+        self.generator.stop_token_ids = []
+        self.generator.grammar_compiler = None
+        self.prompts = [[1, 2, 3, 4, 5, 1, 2, 3], [7, 8, 7, 8, 9, 7, 8]]
+
+    def _generate(self, **kwargs):
+        texts = ["", ""]
+        for outputs in self.generator.generate_stream(self.prompts, max_gen_len=24, temperature=0.0, **kwargs):
+            for i, text in enumerate(outputs):
+                texts[i] += text
+        return texts
+
+    def test_prompt_lookup_matches_plain_decoding(self):
+        expected = self._generate()
+        self.assertEqual(self._generate(prompt_lookup=True), expected)
+        kv_mem_manager = self.generator.model_executor.kv_mem_manager
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+
+        stats = self.generator.speculative_stats
+        self.assertEqual(len(stats), 2)
+        self.assertGreater(sum(s["num_proposed_tokens"] for s in stats), 0)
+        self.assertGreater(sum(s["num_accepted_tokens"] for s in stats), 0)
+        for s in stats:
+            self.assertLessEqual(s["num_accepted_tokens"], s["num_proposed_tokens"])
+
+    def test_stop_strings_and_stop_tokens(self):
+        expected = self._generate()
+        tokens = [text.split() for text in expected]
+        # 以第一个请求第 3、4 个 token 组成的文本为停止字符串, 输出截断到其第一次出现之前
+        stop = f"{tokens[0][2]} {tokens[0][3]} "
+        texts = self._generate(stop=[stop])
+        for text, full_text in zip(texts, expected):
+            index = full_text.find(stop)
+            self.assertEqual(text, full_text if index < 0 else full_text[:index])
+
+        stop_token = int(tokens[1][1])
+        texts = self._generate(stop_token_ids=[stop_token])
+        for text, full_tokens in zip(texts, tokens):
+            if str(stop_token) in full_tokens:
+                full_tokens = full_tokens[:full_tokens.index(str(stop_token))]
+            self.assertEqual(text.split(), full_tokens)
+
+    def test_text_completion_stream_yields_deltas(self):
+        expected = self._generate()
+        prompts = [self.generator.tokenizer.decode(tokens) for tokens in self.prompts]
+        texts, finish_reasons = ["", ""], [[], []]
+        for batch_deltas in self.generator.text_completion_stream(prompts, temperature=0.0, max_gen_len=24):
+            self.assertTrue(batch_deltas)
+            for delta in batch_deltas:
+                self.assertTrue(delta["text"] or delta["finish_reason"] is not None)
+                texts[delta["index"]] += delta["text"]
+                if delta["finish_reason"] is not None:
+                    finish_reasons[delta["index"]].append(delta["finish_reason"])
+        self.assertEqual(texts, expected)
+        for reasons in finish_reasons:
+            self.assertEqual(len(reasons), 1) # 每个序列只报告一次结束
+            self.assertIn(reasons[0], ("stop", "length"))
+
+class TestGenerateStreamPagedEngine(unittest.TestCase):
+    """通过 GenerateStreamText 的构造函数建立引擎, 检查 block_size 传到 kv cache 及其上的 prefix cache 和交换空间"""
+    def _build(self, checkpoints_dir, block_size, max_gpu_num_blocks, **kwargs):
+        config = LlamaConfig(
+            num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, max_seq_len=128, device="cpu"
+        )
+        return ModelExecutor(config, TinyBigramModel(), max_gpu_num_blocks=max_gpu_num_blocks, device="cpu", block_size=block_size)
+
+    def test_block_size_reaches_paged_kv_cache(self):
+        with mock.patch.object(ModelExecutor, "build", side_effect=self._build), \
+             mock.patch.object(GenerateStreamText, "load_tokenizer", return_value=DigitTokenizer()):
+            generator = GenerateStreamText(
+                "tiny-llama", "tiny-llama", max_gpu_num_blocks=16, device="cpu", block_size=4, prefill_chunk_size=8,
+                num_swap_blocks=8,
+            )
+        kv_mem_manager = generator.model_executor.kv_mem_manager
+        self.assertEqual(kv_mem_manager.block_size, 4)
+        self.assertEqual(kv_mem_manager.max_num_tokens, 64)
+        self.assertEqual(generator.prefix_cache.block_size, 4)
+        self.assertEqual(generator.swap_space.block_size, 4)
+        self.assertEqual(generator.sink_size, 4) # 默认保留一个 block 作为 sink
+
+        prompts = [[1, 2, 3, 4, 5, 6, 7, 8, 9, 10], [1, 2, 3, 4, 5, 6, 7, 8, 11]]
+        outputs = []
+        for _ in range(2):
+            texts = ["", ""]
+            for deltas in generator.generate_stream(prompts, max_gen_len=12, temperature=0.0):
+                for i, text in enumerate(deltas):
+                    texts[i] += text
+            outputs.append(texts)
+        # 第二次生成复用 prefix cache 中完整的 block, 输出不变
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertGreater(generator.prefix_cache.num_hit_tokens, 0)
+        self.assertEqual(generator.prefix_cache.num_hit_tokens % 4, 0)
+
+if __name__ == "__main__":
+    unittest.main()
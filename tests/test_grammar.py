@@ -0,0 +1,157 @@
+# 代码可直接运行，测试正则 / JSON schema 约束解码: 字节级 DFA、词表状态机与调度器中的掩码
+import unittest
+import json, random, re
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.grammar import GrammarCompiler, json_schema_to_regex, regex_to_dfa, vocab_bytes
+from lite_llama.executor.scheduler import ContinuousBatchScheduler
+from tests.helpers import EOS_TOKEN_ID, VOCAB_SIZE, build_executor
+
+# 单字符 token 与若干多字符 token 混合的词表, 0 号为 eos; 字节级 BPE 风格, Ġ 表示空格
+PIECES = ["</s>"] + list('{}[]":,-.0123456789abfilnrstuxy') + [
+    "Ġ", '{"', '":', 'Ġ"', '",', "true", "false", "ok", "tag", "ab", "null", "Ġtrue", "Ġfalse", '"}', "Ġ[", "12", "e", "Ġnull",
+]
+
+class PieceTokenizer:
+    all_special_ids = [EOS_TOKEN_ID]
+
+    def __len__(self):
+        return len(PIECES)
+
+    def convert_ids_to_tokens(self, ids):
+        return [PIECES[i] for i in ids]
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        data = b"".join(vocab_bytes(self)[token] or b"" for token in token_ids)
+        return data.decode("utf-8", errors="replace")
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [self.decode(token_ids, skip_special_tokens) for token_ids in sequences]
+
+def dfa_fullmatch(dfa, text):
+    transitions, accepting = dfa
+    state = 0
+    for b in text.encode():
+        state = transitions[state].get(b)
+        if state is None:
+            return False
+    return accepting[state]
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ok": {"type": "boolean"},
+        "tag": {"type": "string", "maxLength": 3},
+        "n": {"type": "integer"},
+        "xs": {"type": "array", "items": {"enum": [1, "a", None]}, "maxItems": 2},
+    },
+    "required": ["ok", "tag"],
+}
+
+class TestRegexToDFA(unittest.TestCase):
+    def test_matches_python_re(self):
+        patterns = [
+            r"(ab|cd)+e", r"a{2,3}b?", r"[^a-c]x*", r"\d{3}-\w+", "你好|hi", r"(?:a|b)*abb", r".\S\W", r"[\d\-x]+{",
+            json_schema_to_regex(SCHEMA),
+        ]
+        alphabet = 'abcdex-0129你好hi{}":,[] trufalsn.\n'
+        rng = random.Random(0)
+        for pattern in patterns:
+            dfa, compiled = regex_to_dfa(pattern), re.compile(pattern, re.ASCII)
+            for _ in range(3000):
+                text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 8)))
+                self.assertEqual(dfa_fullmatch(dfa, text), bool(compiled.fullmatch(text)), (pattern, text))
+
+    def test_invalid_patterns(self):
+        for pattern in ["(ab", "*a", "[b-a]", r"(?=a)", r"\p"]:
+            with self.assertRaises(ValueError):
+                regex_to_dfa(pattern)
+
+    def test_json_schema_optional_properties(self):
+        regex = re.compile(json_schema_to_regex(SCHEMA))
+        for text in ['{"ok": true, "tag": "ab"}', '{"ok":false,"tag":"","n":-12}', '{"ok": true, "tag": "x", "xs": [1, null]}']:
+            self.assertTrue(regex.fullmatch(text), text)
+        for text in ['{"tag": "ab"}', '{"ok": true, "tag": "abcd"}', '{"ok": true,, "tag": ""}', '{"ok": 1, "tag": ""}']:
+            self.assertFalse(regex.fullmatch(text), text)
+
+class TestTokenGuide(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = PieceTokenizer()
+        self.compiler = GrammarCompiler(self.tokenizer, VOCAB_SIZE + 4, [EOS_TOKEN_ID], device="cpu")
+
+    def test_vocab_bytes(self):
+        data = vocab_bytes(self.tokenizer)
+        self.assertIsNone(data[0])
+        self.assertEqual(data[PIECES.index("Ġtrue")], b" true")
+
+    def test_allowed_tokens_and_transitions(self):
+        guide = self.compiler.compile_regex(r"(true|false)")
+        self.assertIs(self.compiler.compile_regex(r"(true|false)"), guide) # 编译结果被缓存
+        logits = torch.zeros(1, VOCAB_SIZE + 4)
+        guide.apply(logits, [0])
+        allowed = {PIECES[i] for i in torch.nonzero(logits[0] == 0).view(-1).tolist()}
+        self.assertEqual(allowed, {"t", "f", "true", "false"})
+
+        state = guide.next_state(0, PIECES.index("true"))
+        self.assertTrue(guide.is_accepting(state))
+        self.assertEqual(guide.next_state(state, PIECES.index("a")), -1)
+        logits = torch.zeros(1, VOCAB_SIZE + 4)
+        guide.apply(logits, [state])
+        self.assertEqual(torch.nonzero(logits[0] == 0).view(-1).tolist(), [EOS_TOKEN_ID])
+
+    def test_unmatchable_with_vocabulary(self):
+        with self.assertRaises(ValueError):
+            self.compiler.compile_regex("zz") # 词表中没有 z
+
+class TestConstrainedScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = PieceTokenizer()
+        self.compiler = GrammarCompiler(self.tokenizer, VOCAB_SIZE, [EOS_TOKEN_ID], device="cpu")
+
+    def test_json_schema_outputs_are_valid(self):
+        executor = build_executor(gpu_num_blocks=512, block_size=4)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, max_seq_len=256, device="cpu", tokenizer=self.tokenizer
+        )
+        schema = {
+            "type": "object",
+            "properties": {
+                "ok": {"type": "boolean"},
+                "tag": {"enum": ["ab", "ba"]},
+                "xs": {"type": "array", "items": {"type": "null"}, "maxItems": 2},
+            },
+            "required": ["ok", "tag"],
+        }
+        guide = self.compiler.compile_json_schema(schema)
+        requests = [
+            scheduler.add_request([3, 5, 7], 200, temperature=1.0, seed=seed, guide=guide) for seed in range(6)
+        ]
+        requests.append(scheduler.add_request([11], 200, temperature=0.0, guide=guide))
+        requests.append(scheduler.add_request([2, 4], 10, temperature=0.0))
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+
+        for request in requests[:-1]:
+            self.assertEqual(request.finish_reason, "stop")
+            self.assertEqual(request.output_tokens[-1], EOS_TOKEN_ID)
+            value = json.loads(request.output_text)
+            self.assertIn(value["ok"], (True, False))
+            self.assertIn(value["tag"], ("ab", "ba"))
+            self.assertLessEqual(len(value.get("xs", [])), 2)
+        # 没有 guide 的请求不受影响
+        self.assertIsNone(requests[-1].guide)
+        self.assertEqual(len(requests[-1].output_tokens), 10)
+
+    def test_parallel_sampling_branches_share_guide(self):
+        executor = build_executor(gpu_num_blocks=256)
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_batch_size=4, device="cpu")
+        guide = self.compiler.compile_regex(r"-?[1-9][0-9]?")
+        request = scheduler.add_request([3, 5], 8, temperature=1.0, seed=1, n=3, guide=guide)
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+        for sample in request.samples:
+            text = self.tokenizer.decode(sample.output_tokens[:-1])
+            self.assertRegex(text, r"^-?[1-9][0-9]?$")
+
+if __name__ == "__main__":
+    unittest.main()
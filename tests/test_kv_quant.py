@@ -0,0 +1,129 @@
+# 代码可直接运行，测试 int8 / fp8 量化 kv cache: 写入时量化、attention kernel 中反量化, 与 pytorch 参考实现对比, 无 GPU 时使用 triton 解释器
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1"
+
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.kernels.kv_quant import quantize_kv_cache, torch_quantize_kv, dequantize_kv, split_kv_scale
+from lite_llama.kernels.flashdecoding import flash_decoding, flash_decoding_paged, torch_paged_attention
+from lite_llama.kernels.flashattentionv2 import flash_attention_v2_varlen_paged, torch_varlen_paged_prefill_attention
+from lite_llama.executor.mem_manager import ComputeMaxAvailableBlocks, KVCacheMemoryManager
+
+class TestKVQuant(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.num_heads, self.num_kv_heads, self.head_dim = 4, 2, 32
+
+    def _quantized_cache(self, kv_cache_dtype, num_tokens):
+        """随机 kv 经 quantize_kv_cache 打乱写入量化 cache, 返回原始 kv、量化 cache 与缩放因子"""
+        manager = KVCacheMemoryManager(
+            1, self.num_kv_heads, self.head_dim, num_tokens, device=self.device, kv_cache_dtype=kv_cache_dtype
+        )
+        kv = torch.randn(num_tokens, 2 * self.num_kv_heads, self.head_dim, device=self.device, dtype=torch.float16)
+        kv[:, 1] *= 10 # 不同 head 的数值范围不同, 按 head 计算缩放因子
+        dest_index = torch.randperm(num_tokens, device=self.device)
+        quantize_kv_cache(kv, manager.gpu_kv_buffer[0], manager.gpu_kv_scale[0], dest_index)
+        full_kv = torch.empty_like(kv)
+        full_kv[dest_index] = kv
+        return full_kv, manager.gpu_kv_buffer[0], manager.gpu_kv_scale[0]
+
+    def test_quantize_matches_reference(self):
+        for kv_cache_dtype in ("int8", "fp8"):
+            kv, kv_buffer, kv_scale = self._quantized_cache(kv_cache_dtype, 64)
+            ref_q, ref_scale = torch_quantize_kv(kv, kv_cache_dtype)
+            self.assertTrue(torch.allclose(kv_scale, ref_scale, rtol=1e-6))
+            if kv_cache_dtype == "fp8" and not torch.cuda.is_available():
+                continue # triton 解释器转换 fp8 时向上舍入到 2 的幂会出错 (如 127.6 -> 64), 只在 GPU 上检查量化值
+            self.assertTrue(torch.equal(kv_buffer.float(), ref_q.float()), kv_cache_dtype)
+            # 量化误差相对每个 head 的最大值有界
+            err = (dequantize_kv(kv_buffer, kv_scale, torch.float32) - kv.float()).abs().amax(dim=-1)
+            bound = 0.5 / 127 if kv_cache_dtype == "int8" else 1 / 16
+            self.assertTrue(bool((err <= kv.float().abs().amax(dim=-1) * bound + 1e-3).all()), kv_cache_dtype)
+
+    def _block_tables(self, seq_lens, num_tokens):
+        perm = torch.randperm(num_tokens, device=self.device).to(torch.int32)
+        block_tables = torch.zeros(len(seq_lens), max(seq_lens), dtype=torch.int32, device=self.device)
+        offset = 0
+        for i, length in enumerate(seq_lens):
+            block_tables[i, :length] = perm[offset: offset + length]
+            offset += length
+        return block_tables, torch.arange(len(seq_lens), dtype=torch.int32, device=self.device)
+
+    def test_flash_decoding_paged_dequantizes(self):
+        seq_lens = [1, 37, 200]
+        for kv_cache_dtype in ("int8", "fp8"):
+            kv, kv_buffer, kv_scale = self._quantized_cache(kv_cache_dtype, 256)
+            H = self.num_kv_heads
+            q = torch.randn(len(seq_lens), self.num_heads, self.head_dim, device=self.device, dtype=torch.float16)
+            block_tables, b_req_idx = self._block_tables(seq_lens, 256)
+            b_seq_len = torch.tensor(seq_lens, dtype=torch.int32, device=self.device)
+            k_scale, v_scale = split_kv_scale(kv_scale, H)
+
+            out = flash_decoding_paged(
+                q, kv_buffer[:, :H], kv_buffer[:, H:], self.head_dim ** -0.5, block_tables, b_req_idx, b_seq_len,
+                max(seq_lens), 1, k_scale, v_scale,
+            )
+            # 与反量化后的 cache 上的参考实现一致, 与未量化的 kv 上的结果误差很小
+            dequant = dequantize_kv(kv_buffer, kv_scale)
+            ref = torch_paged_attention(q, dequant[:, :H], dequant[:, H:], block_tables, b_req_idx, b_seq_len)
+            self.assertTrue(torch.allclose(out.float(), ref.float(), atol=1e-2, rtol=1e-2), kv_cache_dtype)
+            exact = torch_paged_attention(q, kv[:, :H], kv[:, H:], block_tables, b_req_idx, b_seq_len)
+            mean_err = (out.float() - exact.float()).abs().mean().item()
+            self.assertLess(mean_err, 1e-2 if kv_cache_dtype == "int8" else 5e-2, kv_cache_dtype)
+
+            # 连续 kv cache 版本
+            b_start_loc = torch.tensor([0, 1, 38], dtype=torch.int32, device=self.device)
+            out = flash_decoding(
+                q, kv_buffer[:, :H], kv_buffer[:, H:], self.head_dim ** -0.5, b_start_loc, b_seq_len, max(seq_lens),
+                k_scale, v_scale,
+            )
+            contiguous_tables = torch.stack([
+                torch.arange(start, start + max(seq_lens), device=self.device).clamp(max=255) for start in b_start_loc.tolist()
+            ]).to(torch.int32)
+            ref = torch_paged_attention(q, dequant[:, :H], dequant[:, H:], contiguous_tables, b_req_idx, b_seq_len)
+            self.assertTrue(torch.allclose(out.float(), ref.float(), atol=1e-2, rtol=1e-2), kv_cache_dtype)
+
+    def test_varlen_paged_prefill_dequantizes(self):
+        kv, kv_buffer, kv_scale = self._quantized_cache("int8", 128)
+        H = self.num_kv_heads
+        seq_lens, q_lens = [20, 70], [5, 70]
+        block_tables, b_req_idx = self._block_tables(seq_lens, 128)
+        cu_seqlens = torch.tensor([0, 5, 75], dtype=torch.int32, device=self.device)
+        q = torch.randn(75, self.num_heads, self.head_dim, device=self.device, dtype=torch.float16)
+        b_seq_len = torch.tensor(seq_lens, dtype=torch.int32, device=self.device)
+        k_scale, v_scale = split_kv_scale(kv_scale, H)
+
+        out = flash_attention_v2_varlen_paged(
+            q, kv_buffer[:, :H], kv_buffer[:, H:], self.head_dim ** -0.5 * 1.4426950408889634, cu_seqlens, b_seq_len,
+            max(q_lens), block_tables, b_req_idx, 1, k_scale, v_scale,
+        )
+        dequant = dequantize_kv(kv_buffer, kv_scale)
+        ref = torch_varlen_paged_prefill_attention(q, dequant[:, :H], dequant[:, H:], cu_seqlens, b_seq_len, block_tables, b_req_idx)
+        self.assertTrue(torch.allclose(out.float(), ref.float(), atol=1e-2, rtol=1e-2))
+
+class TestQuantizedKVCacheMemory(unittest.TestCase):
+    def test_block_bytes_account_for_element_size(self):
+        kwargs = dict(num_layers=16, hidden_size=2048, num_heads=32, num_kv_heads=8, head_dim=64, block_size=16)
+        fp16 = ComputeMaxAvailableBlocks(**kwargs).compute_cache_block_size_bytes()
+        int8 = ComputeMaxAvailableBlocks(**kwargs, kv_cache_dtype="int8").compute_cache_block_size_bytes()
+        self.assertEqual(fp16, 16 * 16 * 8 * 64 * 2 * 2)
+        # kv 减半, 另加每个 (token, kv head) 4 字节的缩放因子
+        self.assertEqual(int8, fp16 // 2 + 16 * 16 * 8 * 2 * 4)
+        with self.assertRaises(ValueError):
+            ComputeMaxAvailableBlocks(**kwargs, kv_cache_dtype="int4")
+
+    def test_copy_blocks_copies_scales(self):
+        manager = KVCacheMemoryManager(2, 1, 8, gpu_num_blocks=4, block_size=2, device="cpu", kv_cache_dtype="fp8")
+        self.assertEqual(manager.gpu_kv_buffer[0].dtype, torch.float8_e4m3fn)
+        self.assertEqual(manager.gpu_kv_scale[1].shape, (8, 2))
+        manager.gpu_kv_scale[1][2:4] = 3.0
+        manager.copy_blocks(torch.tensor([1]), torch.tensor([3]))
+        self.assertTrue(bool((manager.gpu_kv_scale[1][6:8] == 3.0).all()))
+        with self.assertRaises(ValueError):
+            KVCacheMemoryManager(1, 1, 8, gpu_num_blocks=4, device="cpu", kv_cache_dtype="int4")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+# 代码可直接运行，在 CPU 上测试 kv cache 快照的保存与恢复: 跨 block_size 的往返、量化 kv 的缩放因子、header 校验,
+# 以及恢复后调度器直接复用快照中的前缀而不重新 prefill
+import os, sys, tempfile
+import unittest
+import torch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.mem_manager import KVCacheMemoryManager
+from lite_llama.executor.kv_snapshot import load_kv_snapshot, read_kv_snapshot_header, save_kv_snapshot
+from lite_llama.executor.prefix_cache import RadixPrefixCache
+from lite_llama.executor.scheduler import ContinuousBatchScheduler
+from tests.helpers import EOS_TOKEN_ID, build_executor, build_manager, reference_generate
+
+class TestKVSnapshot(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "prefix.kv")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _fill(self, manager, num_tokens):
+        """分配 block 并写入随机 kv, 返回 block 索引和各层按 token 顺序的 kv"""
+        num_blocks = (num_tokens + manager.block_size - 1) // manager.block_size
+        block_index = manager.alloc_blocks(num_blocks, device="cpu")
+        slots = manager.get_token_slots(block_index, num_tokens)
+        kvs, scales = [], []
+        for layer in range(manager.num_layers):
+            if manager.gpu_kv_scale is None:
+                manager.gpu_kv_buffer[layer][slots] = torch.randn(num_tokens, 4, 8).half()
+            else:
+                manager.gpu_kv_buffer[layer][slots] = torch.randint(-127, 128, (num_tokens, 4, 8), dtype=torch.int8)
+                manager.gpu_kv_scale[layer][slots] = torch.rand(num_tokens, 4)
+                scales.append(manager.gpu_kv_scale[layer][slots].clone())
+            kvs.append(manager.gpu_kv_buffer[layer][slots].clone())
+        return block_index, kvs, scales
+
+    def test_round_trip_across_block_sizes(self):
+        src = build_manager(16, block_size=4)
+        src.alloc_blocks(3, device="cpu") # 占用一些 block, 快照的 block 不从 0 开始
+        token_ids = list(range(100, 111))
+        block_index, kvs, _ = self._fill(src, len(token_ids))
+        save_kv_snapshot(self.path, src, token_ids, block_index, "llama-test")
+
+        header, data_offset = read_kv_snapshot_header(self.path)
+        self.assertEqual(header["token_ids"], token_ids)
+        self.assertEqual((header["num_layers"], header["num_kv_heads"], header["head_dim"]), (2, 2, 8))
+        self.assertEqual(data_offset % 64, 0)
+
+        dst = build_manager(32, block_size=2)
+        dst.alloc_blocks(5, device="cpu")
+        restored_ids, restored_index = load_kv_snapshot(self.path, dst, "llama-test")
+        self.assertEqual(restored_ids, token_ids)
+        self.assertEqual(restored_index.numel(), 6)
+        slots = dst.get_token_slots(restored_index, len(token_ids))
+        for layer in range(2):
+            self.assertTrue(torch.equal(dst.gpu_kv_buffer[layer][slots], kvs[layer]))
+        dst.release_ref(restored_index)
+        self.assertEqual(dst.can_use_num_blocks, 27)
+
+    def test_quantized_kv_with_scales(self):
+        src = build_manager(8, block_size=2, kv_cache_dtype="int8")
+        block_index, kvs, scales = self._fill(src, 5)
+        save_kv_snapshot(self.path, src, [1, 2, 3, 4, 5], block_index, "llama-test")
+
+        dst = build_manager(8, block_size=1, kv_cache_dtype="int8")
+        _, restored_index = load_kv_snapshot(self.path, dst, "llama-test")
+        slots = dst.get_token_slots(restored_index, 5)
+        for layer in range(2):
+            self.assertTrue(torch.equal(dst.gpu_kv_buffer[layer][slots], kvs[layer]))
+            self.assertTrue(torch.equal(dst.gpu_kv_scale[layer][slots], scales[layer]))
+
+    def test_mismatch_and_invalid_files(self):
+        src = build_manager(8)
+        block_index, _, _ = self._fill(src, 4)
+        save_kv_snapshot(self.path, src, [1, 2, 3, 4], block_index, "llama-test")
+
+        with self.assertRaises(ValueError):
+            load_kv_snapshot(self.path, build_manager(8), "qwen2-test")
+        with self.assertRaises(ValueError):
+            load_kv_snapshot(self.path, build_manager(8, kv_cache_dtype="int8"), "llama-test")
+        with self.assertRaises(ValueError):
+            load_kv_snapshot(self.path, KVCacheMemoryManager(1, 2, 8, gpu_num_blocks=8, device="cpu"), "llama-test")
+
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        with self.assertRaises(ValueError):
+            load_kv_snapshot(self.path, build_manager(8), "llama-test")
+        with open(self.path, "r+b") as f:
+            f.write(b"NOTASNAP")
+        with self.assertRaises(ValueError):
+            read_kv_snapshot_header(self.path)
+
+        # 失败的检查不占用 block; 空闲 block 不足时返回 None
+        manager = build_manager(8)
+        manager.alloc_blocks(6, device="cpu")
+        save_kv_snapshot(self.path, src, [1, 2, 3, 4], block_index, "llama-test")
+        self.assertIsNone(load_kv_snapshot(self.path, manager, "llama-test"))
+        self.assertEqual(manager.can_use_num_blocks, 2)
+
+    def test_restored_prefix_skips_prefill(self):
+        prompt = [3, 1, 4, 1, 5, 9, 2, 6]
+        for block_size in (1, 2):
+            # 第一个进程: prefill 系统提示后保存快照
+            executor = build_executor(gpu_num_blocks=64, block_size=block_size)
+            prefix_cache = RadixPrefixCache(executor.kv_mem_manager)
+            scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, prefix_cache=prefix_cache, device="cpu")
+            scheduler.add_request(prompt, 1, temperature=0.0)
+            while scheduler.has_unfinished_requests():
+                scheduler.step()
+            block_index, num_tokens = prefix_cache.match_prefix(prompt)
+            self.assertEqual(num_tokens, len(prompt))
+            executor.save_kv_cache(self.path, prompt, block_index)
+            executor.kv_mem_manager.release_ref(block_index)
+
+            # 重启后的进程: 映射快照并加入 prefix cache, 新请求只 prefill 最后一个 token
+            executor = build_executor(gpu_num_blocks=64, block_size=block_size)
+            prefix_cache = RadixPrefixCache(executor.kv_mem_manager)
+            token_ids, block_index = executor.load_kv_cache(self.path)
+            prefix_cache.insert(token_ids, block_index)
+            executor.kv_mem_manager.release_ref(block_index)
+
+            scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, prefix_cache=prefix_cache, device="cpu")
+            request = scheduler.add_request(prompt + [7], 6, temperature=0.0)
+            while scheduler.has_unfinished_requests():
+                scheduler.step()
+            self.assertEqual(request.output_tokens, reference_generate(prompt + [7], 6))
+            self.assertEqual(executor.model.prefill_lens, [1])
+
+if __name__ == "__main__":
+    unittest.main()
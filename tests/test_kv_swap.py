@@ -0,0 +1,120 @@
+# 代码可直接运行，用 CPU 上的 kv buffer 模拟设备显存池, 测试 kv cache 换出到主机端交换空间及调度器的抢占策略
+import unittest
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.mem_manager import HostKVCachePool, KVCacheMemoryManager
+from lite_llama.executor.scheduler import ContinuousBatchScheduler, RequestStatus
+from tests.helpers import EOS_TOKEN_ID, build_executor, reference_generate
+
+class TestHostKVCachePool(unittest.TestCase):
+    def test_swap_round_trip(self):
+        manager = KVCacheMemoryManager(2, 1, 4, gpu_num_blocks=8, block_size=2, device="cpu", kv_cache_dtype="int8")
+        for buffer in manager.gpu_kv_buffer + manager.gpu_kv_scale:
+            buffer.copy_(torch.randint(-100, 100, buffer.shape).to(buffer.dtype))
+        expected = [buffer.view(8, 2, *buffer.shape[1:])[[5, 1, 6]].clone() for buffer in manager.gpu_kv_buffer + manager.gpu_kv_scale]
+
+        pool = HostKVCachePool(manager, num_blocks=4)
+        host_index = pool.swap_out(torch.tensor([5, 1, 6]))
+        self.assertEqual(pool.can_use_num_blocks, 1)
+        self.assertIsNone(pool.swap_out(torch.tensor([0, 2]))) # 交换空间不足
+        for buffer in manager.gpu_kv_buffer + manager.gpu_kv_scale:
+            buffer.zero_() # 换出后设备上的 block 被其他请求覆盖
+
+        pool.swap_in(host_index, torch.tensor([7, 0, 3]))
+        for buffer, blocks in zip(manager.gpu_kv_buffer + manager.gpu_kv_scale, expected):
+            self.assertTrue(torch.equal(buffer.view(8, 2, *buffer.shape[1:])[[7, 0, 3]], blocks))
+        self.assertEqual(pool.can_use_num_blocks, 4)
+
+    def test_fragmented_swap_space(self):
+        manager = KVCacheMemoryManager(1, 1, 4, gpu_num_blocks=6, device="cpu")
+        manager.gpu_kv_buffer[0].copy_(torch.arange(6 * 2 * 4, dtype=torch.float16).view(6, 2, 4))
+        pool = HostKVCachePool(manager, num_blocks=4)
+        first, second = pool.swap_out(torch.tensor([0])), pool.swap_out(torch.tensor([1]))
+        pool.swap_out(torch.tensor([2]))
+        pool.free(first)
+        pool.free(pool.swap_out(torch.tensor([3]))) # 空闲的 host block 为 {0, 3}, 不连续
+        host_index = pool.swap_out(torch.tensor([4, 5]))
+        self.assertEqual(host_index.tolist(), [0, 3])
+        pool.swap_in(host_index, torch.tensor([1, 0]))
+        pool.swap_in(second, torch.tensor([2]))
+        expected = torch.arange(6 * 2 * 4, dtype=torch.float16).view(6, 2, 4)
+        self.assertTrue(torch.equal(manager.gpu_kv_buffer[0][[1, 0, 2]], expected[[4, 5, 1]]))
+
+class TestSwapPreemption(unittest.TestCase):
+    def _run(self, scheduler):
+        statuses = {}
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            for request in scheduler.swapped:
+                statuses.setdefault(request.request_id, set()).add(RequestStatus.SWAPPED)
+            for request in scheduler.waiting:
+                statuses.setdefault(request.request_id, set()).add(RequestStatus.WAITING)
+        return statuses
+
+    def test_swap_instead_of_recompute(self):
+        # 两个请求的完整 kv 需求为 2 * 22 = 44 > 32, 增长过程中必然触发抢占
+        executor = build_executor(gpu_num_blocks=32)
+        swap_space = HostKVCachePool(executor.kv_mem_manager, num_blocks=32)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, device="cpu", swap_space=swap_space
+        )
+        prompts = [[1, 2], [5, 6]]
+        requests = [scheduler.add_request(p, 20, temperature=0.0) for p in prompts]
+        statuses = self._run(scheduler)
+
+        self.assertEqual(statuses, {requests[1].request_id: {RequestStatus.SWAPPED}})
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 20))
+        # 换入后直接 decode, 每个 prompt 只 prefill 一次
+        self.assertEqual(sorted(executor.model.prefill_lens), [2, 2])
+        self.assertEqual(swap_space.can_use_num_blocks, 32)
+        self.assertEqual(executor.kv_mem_manager.can_use_mem_size, executor.kv_mem_manager.max_num_tokens)
+        self.assertEqual(sorted(scheduler.free_table_rows), list(range(4)))
+
+    def test_low_priority_is_preempted(self):
+        executor = build_executor(gpu_num_blocks=32)
+        swap_space = HostKVCachePool(executor.kv_mem_manager, num_blocks=32)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, device="cpu", swap_space=swap_space
+        )
+        prompts = [[1, 2], [5, 6]]
+        low = scheduler.add_request(prompts[0], 20, temperature=0.0, priority=1)
+        high = scheduler.add_request(prompts[1], 20, temperature=0.0)
+        statuses = self._run(scheduler)
+        # 先加入但优先级低的请求被换出
+        self.assertEqual(statuses, {low.request_id: {RequestStatus.SWAPPED}})
+        self.assertEqual(low.output_tokens, reference_generate(prompts[0], 20))
+        self.assertEqual(high.output_tokens, reference_generate(prompts[1], 20))
+
+    def test_falls_back_to_recompute(self):
+        # 交换空间放不下被抢占请求的 kv 时退化为重新计算
+        executor = build_executor(gpu_num_blocks=32)
+        swap_space = HostKVCachePool(executor.kv_mem_manager, num_blocks=4)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, device="cpu", swap_space=swap_space
+        )
+        prompts = [[1, 2], [5, 6]]
+        requests = [scheduler.add_request(p, 20, temperature=0.0) for p in prompts]
+        statuses = self._run(scheduler)
+        self.assertEqual(statuses, {requests[1].request_id: {RequestStatus.WAITING}})
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 20))
+        self.assertEqual(swap_space.can_use_num_blocks, 4)
+
+    def test_paged_swap_with_many_requests(self):
+        executor = build_executor(gpu_num_blocks=12, block_size=4)
+        swap_space = HostKVCachePool(executor.kv_mem_manager, num_blocks=24)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, device="cpu", swap_space=swap_space
+        )
+        prompts = [[3, 5, 7], [11], [2, 4, 6, 8, 10], [9, 1], [13, 17]]
+        requests = [scheduler.add_request(p, 16, temperature=0.0, priority=i % 2) for i, p in enumerate(prompts)]
+        statuses = self._run(scheduler)
+        self.assertTrue(any(RequestStatus.SWAPPED in s for s in statuses.values()))
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 16))
+        self.assertEqual(swap_space.can_use_num_blocks, 24)
+        self.assertEqual(executor.kv_mem_manager.can_use_num_blocks, 12)
+
+if __name__ == "__main__":
+    unittest.main()
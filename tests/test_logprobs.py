@@ -0,0 +1,88 @@
+# 代码可直接运行，对比 fused_logprobs_topk 与 pytorch 参考实现, 无 GPU 时使用 triton 解释器
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1"
+
+import math
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.kernels.logprobs import fused_logprobs_topk, torch_logprobs_topk
+from lite_llama.generete_with_probs import GenerateText
+
+class TestLogprobsTopk(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def _check(self, logits, tokens, k, rows=None):
+        out = fused_logprobs_topk(logits, tokens, k, rows=rows)
+        ref = torch_logprobs_topk(logits, tokens, k, rows=rows)
+        self.assertEqual(out.shape, ref.shape)
+        self.assertTrue(torch.allclose(out[:, :1 + k], ref[:, :1 + k], atol=1e-4), (out, ref))
+        # 并列的 logits 可能返回不同的 token, 比较 token 对应的对数概率
+        ref_logprobs = torch.log_softmax(logits[rows if rows is not None else slice(None)].float(), dim=-1)
+        self.assertTrue(torch.allclose(ref_logprobs.gather(1, out[:, 1 + k:].long()), out[:, 1:1 + k], atol=1e-4))
+
+    def test_matches_reference_multiple_tiles(self):
+        batch_size, vocab_size = 4, 5000 # 大于一个分块, 候选分布在不同的分块中
+        logits = torch.randn(batch_size, vocab_size, device=self.device) * 3
+        tokens = torch.randint(0, vocab_size, (batch_size,), device=self.device)
+        for k in (0, 1, 5):
+            self._check(logits, tokens, k)
+
+    def test_half_logits_and_rows(self):
+        logits = (torch.randn(6, 300, device=self.device) * 2).half()
+        rows = torch.tensor([5, 0, 3], device=self.device)
+        tokens = torch.tensor([1, 299, 17], device=self.device)
+        self._check(logits, tokens, 3, rows=rows)
+
+    def test_masked_tile(self):
+        # 约束解码屏蔽了整个分块时结果仍然有限
+        logits = torch.randn(2, 5000, device=self.device)
+        logits[:, :4096] = -float("inf")
+        tokens = torch.tensor([4100, 4999], device=self.device)
+        out = fused_logprobs_topk(logits, tokens, 2)
+        self.assertTrue(bool(torch.isfinite(out).all()))
+        self._check(logits, tokens, 2)
+
+class TestProcessOutputTokens(unittest.TestCase):
+    def test_compact_logprobs(self):
+        generator = GenerateText.__new__(GenerateText)
+        eos = 9
+        prompt_tokens = [[1, 2, 3], [4]]
+        tokens = torch.tensor([[1, 2, 3, 5, eos, 0], [4, 6, 7, 8, 0, 0]])
+        num_generated = torch.tensor([2, 3])
+        k = 2
+        gen_values = torch.zeros(2, 3, 1 + 2 * k)
+        gen_values[0, :2] = torch.tensor([[-0.5, -0.125, -2.0, 5, 1], [-0.3, -0.3, -1.5, eos, 2]])
+        gen_values[1, :3] = torch.tensor([[-1.0, -0.2, -1.0, 3, 6], [-0.75, -0.75, -1.0, 7, 1], [-0.25, -0.25, -3.0, 8, 0]])
+        prompt_values = torch.full((2, 3, 1 + 2 * k), float("nan"))
+        prompt_values[0, 1:] = torch.tensor([[-1.2, -0.5, -1.2, 1, 2], [-0.9, -0.9, -1.0, 3, 4]])
+
+        out_tokens, out_logprobs, details = generator.process_output_tokens(
+            tokens, prompt_tokens, num_generated, False, [eos], True, k, True, gen_values, prompt_values
+        )
+        self.assertEqual(out_tokens, [[5], [6, 7, 8]])
+        self.assertEqual(out_logprobs, [[-0.5], [-1.0, -0.75, -0.25]])
+        self.assertEqual(details[0]["top_logprobs"], [[(5, -0.125), (1, -2.0)]])
+        self.assertEqual(len(details[1]["top_logprobs"]), 3)
+        self.assertEqual(details[0]["prompt_logprobs"][0], None)
+        self.assertTrue(math.isclose(details[0]["prompt_logprobs"][2], -0.9, rel_tol=1e-6))
+        self.assertEqual(details[1]["prompt_logprobs"], [None])
+        self.assertEqual(details[1]["prompt_top_logprobs"], [None])
+
+        _, echo_logprobs, _ = generator.process_output_tokens(
+            tokens, prompt_tokens, num_generated, True, [eos], True, 0, False, gen_values[..., :1], None
+        )
+        self.assertEqual(echo_logprobs[1], [0.0, -1.0, -0.75, -0.25])
+
+        # 回合结束 token 与 eos 一样截断输出
+        stop_tokens, stop_logprobs, _ = generator.process_output_tokens(
+            tokens, prompt_tokens, num_generated, False, [eos, 7], True, 0, False, gen_values[..., :1], None
+        )
+        self.assertEqual(stop_tokens, [[5], [6]])
+        self.assertEqual(stop_logprobs[1], [-1.0])
+
+if __name__ == "__main__":
+    unittest.main()
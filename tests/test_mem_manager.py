@@ -3,7 +3,7 @@
 import unittest
 import torch, os,sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
-from lite_llama.executor.mem_manager import KVCacheMemoryManager
+from lite_llama.executor.mem_manager import KVCacheMemoryManager, KVCacheAllocator
 
 class TestKVCacheMemoryManager(unittest.TestCase):
     def setUp(self):
@@ -162,8 +162,7 @@ class TestKVCacheMemoryManager(unittest.TestCase):
         select_index = self.manager.alloc_kvcache(need_size)
         self.assertIsNotNone(select_index)
         # 手动设置块8为已使用以打破连续性
-        self.manager.kv_mem_use_state[7] = 1
-        self.manager.can_use_mem_size -=1
+        self.manager.add_ref(torch.tensor([7]))
         # 现在尝试分配 3 个连续块，应失败
         contiguous_result = self.manager.alloc_contiguous_kvcache(3)
         self.assertIsNone(contiguous_result)
@@ -181,6 +180,162 @@ class TestKVCacheMemoryManager(unittest.TestCase):
         # 检查 gpu_kv_buffer 是否为 None
         self.assertIsNone(self.manager.gpu_kv_buffer)
 
+    def test_fragmentation_stats(self):
+        """kv_mem_use_state 是主机端引用计数的镜像"""
+        select_index = self.manager.alloc_kvcache(4)
+        self.manager.release_ref(select_index[1:3])
+        self.assertEqual(self.manager.kv_mem_use_state.tolist(), [1, 0, 0, 1, 0, 0, 0, 0, 0])
+        stats = self.manager.fragmentation_stats()
+        self.assertEqual(stats["num_free_ranges"], 2)
+        self.assertEqual(stats["largest_free_range"], 5)
+        self.manager.release_ref(select_index)
+
+    def test_grow_kvcache(self):
+        """按 chunk 增长, 空间不足一个 chunk 时只分配所需大小"""
+        kv_index = self.manager.grow_kvcache(None, 2, chunk_size=4)
+        self.assertEqual(kv_index.numel(), 4)
+        self.assertIs(self.manager.grow_kvcache(kv_index, 4, chunk_size=4), kv_index) # 容量足够时不分配
+        kv_index = self.manager.grow_kvcache(kv_index, 5, chunk_size=4, max_size=6)
+        self.assertEqual(kv_index.numel(), 6) # 不超过 max_size
+        kv_index = self.manager.grow_kvcache(kv_index, 8, chunk_size=4)
+        self.assertEqual(kv_index.numel(), 8) # 只剩 3 个块, 退化为按需分配
+        self.assertEqual(self.manager.can_use_mem_size, 1)
+        self.assertIsNone(self.manager.grow_kvcache(kv_index, 10, chunk_size=4))
+        self.manager.release_ref(kv_index)
+        self.assertEqual(self.manager.can_use_mem_size, self.gpu_num_blocks)
+
+    def test_paged_blocks(self):
+        """block_size > 1 时以 block 为单位分配, 容量按 token 计算"""
+        manager = KVCacheMemoryManager(
+            head_dim=self.head_dim, num_kv_heads=self.num_kv_heads, num_layers=self.num_layers,
+            gpu_num_blocks=4, block_size=4, dtype=self.dtype, device=self.device
+        )
+        self.assertEqual(manager.gpu_kv_buffer[0].shape[0], 16)
+        block_index = manager.grow_kvcache(None, 5, chunk_size=1, device="cpu")
+        self.assertEqual(block_index.tolist(), [0, 1])
+        self.assertEqual(manager.can_use_mem_size, 8)
+        self.assertIs(manager.grow_kvcache(block_index, 8, chunk_size=1, device="cpu"), block_index) # 容量 8 已足够
+        self.assertEqual(manager.get_token_slots(torch.tensor([3, 1]), 6).tolist(), [12, 13, 14, 15, 4, 5])
+        with self.assertRaises(AssertionError):
+            manager.alloc_kvcache(1)
+        manager.release_ref(block_index)
+        self.assertEqual(manager.can_use_mem_size, 16)
+
+    def test_rollback_kvcache(self):
+        """回滚只保留容纳前 num_tokens 个 token 的 block"""
+        kv_index = self.manager.grow_kvcache(None, 7, chunk_size=1, device="cpu")
+        kept = self.manager.rollback_kvcache(kv_index, 4)
+        self.assertEqual(kept.tolist(), kv_index[:4].tolist())
+        self.assertEqual(self.manager.can_use_mem_size, self.gpu_num_blocks - 4)
+        self.assertIs(self.manager.rollback_kvcache(kept, 4), kept)
+        self.manager.release_ref(kept)
+        self.assertEqual(self.manager.can_use_mem_size, self.gpu_num_blocks)
+
+    def test_copy_blocks(self):
+        """copy_blocks 复制各层 kv buffer 中整个 block 的内容"""
+        manager = KVCacheMemoryManager(
+            head_dim=self.head_dim, num_kv_heads=self.num_kv_heads, num_layers=self.num_layers,
+            gpu_num_blocks=4, block_size=2, dtype=self.dtype, device=self.device
+        )
+        for kv_buffer in manager.gpu_kv_buffer:
+            kv_buffer.copy_(torch.randn_like(kv_buffer))
+        manager.copy_blocks(torch.tensor([1, 3]), torch.tensor([0, 2]))
+        for kv_buffer in manager.gpu_kv_buffer:
+            self.assertTrue(torch.equal(kv_buffer[0:2], kv_buffer[2:4]))
+            self.assertTrue(torch.equal(kv_buffer[4:6], kv_buffer[6:8]))
+
+    def test_shared_allocator(self):
+        """共享分配器的两个管理器使用同一组 block, 各自拥有自己的 kv buffer"""
+        draft = KVCacheMemoryManager(
+            head_dim=16, num_kv_heads=1, num_layers=1, gpu_num_blocks=self.gpu_num_blocks,
+            dtype=self.dtype, device=self.device, allocator=self.manager.allocator,
+        )
+        block_index = self.manager.alloc_blocks(3, device="cpu")
+        self.assertEqual(draft.can_use_num_blocks, self.gpu_num_blocks - 3)
+        draft.release_ref(block_index)
+        self.assertEqual(self.manager.can_use_num_blocks, self.gpu_num_blocks)
+        self.assertEqual(draft.gpu_kv_buffer[0].shape, (self.gpu_num_blocks, 2, 16))
+        with self.assertRaises(ValueError):
+            KVCacheMemoryManager(16, 1, 16, self.gpu_num_blocks + 1, device=self.device, allocator=self.manager.allocator)
+
+class TestKVCacheAllocator(unittest.TestCase):
+    def setUp(self):
+        self.allocator = KVCacheAllocator(16)
+
+    def test_alloc_lowest_first(self):
+        index = self.allocator.alloc(4)
+        self.assertEqual(index.tolist(), [0, 1, 2, 3])
+        self.assertEqual(self.allocator.num_free, 12)
+        self.assertIsNone(self.allocator.alloc(13))
+
+    def test_release_coalesces_ranges(self):
+        a = self.allocator.alloc(4)
+        b = self.allocator.alloc(4)
+        c = self.allocator.alloc(4)
+        self.allocator.release_ref(a)
+        self.allocator.release_ref(c)
+        self.assertEqual(self.allocator.fragmentation_stats()["num_free_ranges"], 2)
+        self.allocator.release_ref(b)
+        stats = self.allocator.fragmentation_stats()
+        self.assertEqual(stats["num_free_ranges"], 1)
+        self.assertEqual(stats["largest_free_range"], 16)
+        self.assertEqual(stats["fragmentation"], 0.0)
+
+    def test_non_contiguous_alloc_spans_ranges(self):
+        index = self.allocator.alloc(16)
+        self.allocator.release_ref(index[[1, 2, 5, 9, 10, 11]])
+        self.assertIsNone(self.allocator.alloc_contiguous(4))
+        self.assertEqual(self.allocator.alloc_contiguous(3), 9)
+        self.assertEqual(self.allocator.alloc(3).tolist(), [1, 2, 5])
+        self.assertEqual(self.allocator.num_free, 0)
+
+    def test_fragmentation_stats(self):
+        index = self.allocator.alloc(16)
+        self.allocator.release_ref(index[::2])
+        stats = self.allocator.fragmentation_stats()
+        self.assertEqual(stats["num_free_tokens"], 8)
+        self.assertEqual(stats["num_free_ranges"], 8)
+        self.assertEqual(stats["largest_free_range"], 1)
+        self.assertAlmostEqual(stats["fragmentation"], 1 - 1 / 8)
+
+    def test_shared_refs(self):
+        index = self.allocator.alloc(4)
+        self.allocator.add_ref(index[:2]) # 前两个位置被共享
+        self.allocator.release_ref(index)
+        self.assertEqual(self.allocator.ref_counts[:4].tolist(), [1, 1, 0, 0])
+        self.assertEqual(self.allocator.num_free, 14)
+        self.allocator.release_ref(index[:2])
+        self.assertEqual(self.allocator.num_free, 16)
+        self.allocator.release_ref(index) # 重复释放被忽略
+        self.assertEqual(self.allocator.num_free, 16)
+        self.assertTrue(torch.all(self.allocator.ref_counts == 0))
+
+    def test_add_ref_on_free_token(self):
+        self.allocator.add_ref(torch.tensor([5, 5]))
+        self.assertEqual(int(self.allocator.ref_counts[5]), 2)
+        self.assertEqual(self.allocator.num_free, 15)
+        self.assertEqual(self.allocator.alloc_contiguous(6), 6)
+        self.assertEqual(self.allocator.alloc(5).tolist(), [0, 1, 2, 3, 4])
+
+    def test_random_alloc_release_consistency(self):
+        generator = torch.Generator().manual_seed(0)
+        allocator = KVCacheAllocator(64)
+        held = []
+        for _ in range(200):
+            if held and torch.rand(1, generator=generator).item() < 0.5:
+                allocator.release_ref(held.pop(int(torch.randint(len(held), (1,), generator=generator))))
+            else:
+                size = int(torch.randint(1, 9, (1,), generator=generator))
+                index = allocator.alloc(size) if size % 2 else allocator.alloc_contiguous(size)
+                if isinstance(index, int):
+                    index = torch.arange(index, index + size)
+                if index is not None:
+                    held.append(index)
+            used = torch.cat(held) if held else torch.empty(0, dtype=torch.long)
+            self.assertEqual(used.unique().numel(), used.numel()) # 分配的位置互不重叠
+            self.assertEqual(allocator.num_free, 64 - used.numel())
+            self.assertEqual(int((allocator.ref_counts == 0).sum()), allocator.num_free)
+
 if __name__ == '__main__':
     suite = unittest.TestSuite()
     tests = [
@@ -196,6 +351,9 @@ if __name__ == '__main__':
         "test_alloc_contiguous_kvcache_with_insufficient_memory",
         "test_in_alloc_contiguous_kvcache",
         "test_free_buffers",
+        "test_grow_kvcache",
+        "test_fragmentation_stats",
+        "test_paged_blocks",
     ]
     suite.addTests(unittest.TestLoader().loadTestsFromNames(tests, TestKVCacheMemoryManager))
     unittest.TextTestRunner().run(suite)
\ No newline at end of file
@@ -0,0 +1,93 @@
+# 代码可直接运行，在 CPU 上测试 RadixPrefixCache 的前缀匹配、插入、引用计数和 LRU 淘汰
+import unittest
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.prefix_cache import RadixPrefixCache
+from tests.helpers import build_manager
+
+class TestRadixPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.manager = build_manager(32)
+        self.cache = RadixPrefixCache(self.manager)
+
+    def _cache_sequence(self, tokens):
+        """模拟一个请求: 分配 kv cache, 结束时插入缓存并释放自己的引用"""
+        block_index = self.manager.alloc_blocks(len(tokens), device="cpu")
+        self.cache.insert(tokens, block_index)
+        self.manager.release_ref(block_index)
+        return block_index
+
+    def test_match_and_refcount(self):
+        block_index = self._cache_sequence([1, 2, 3, 4, 5])
+        self.assertEqual(self.manager.can_use_mem_size, 27) # 树持有 5 个 block
+
+        matched, num_tokens = self.cache.match_prefix([1, 2, 3, 9])
+        self.assertEqual(num_tokens, 3)
+        self.assertEqual(matched.tolist(), block_index[:3].tolist())
+        self.assertEqual(self.manager.allocator.ref_counts[matched].tolist(), [2, 2, 2])
+        self.manager.release_ref(matched)
+
+        _, num_tokens = self.cache.match_prefix([7, 8])
+        self.assertEqual(num_tokens, 0)
+
+    def test_max_tokens(self):
+        self._cache_sequence([1, 2, 3, 4])
+        matched, num_tokens = self.cache.match_prefix([1, 2, 3, 4], max_tokens=3)
+        self.assertEqual(num_tokens, 3)
+        self.manager.release_ref(matched)
+
+    def test_insert_splits_node(self):
+        first = self._cache_sequence([1, 2, 3, 4])
+        second = self._cache_sequence([1, 2, 7, 8])
+        # 公共前缀 [1, 2] 复用第一个序列的 block, 第二个序列重复计算的 block 被释放
+        self.assertEqual(self.cache.num_cached_blocks, 6)
+        self.assertEqual(self.manager.can_use_mem_size, 26)
+        matched, num_tokens = self.cache.match_prefix([1, 2, 7, 8, 9])
+        self.assertEqual(num_tokens, 4)
+        self.assertEqual(matched.tolist(), first[:2].tolist() + second[2:].tolist())
+        self.manager.release_ref(matched)
+
+    def test_lru_eviction(self):
+        self._cache_sequence([1, 2, 3])
+        self._cache_sequence([4, 5, 6])
+        matched, _ = self.cache.match_prefix([1, 2, 3]) # [1, 2, 3] 最近被访问
+        self.manager.release_ref(matched)
+
+        self.assertEqual(self.cache.evict(1), 3)
+        self.assertEqual(self.cache.match_prefix([4, 5, 6])[1], 0)
+        matched, num_tokens = self.cache.match_prefix([1, 2, 3])
+        self.assertEqual(num_tokens, 3)
+        self.manager.release_ref(matched)
+
+    def test_referenced_prefix_not_evicted(self):
+        self._cache_sequence([1, 2, 3])
+        matched, _ = self.cache.match_prefix([1, 2, 3])
+        self.assertEqual(self.cache.evict(3), 0) # 正在被请求使用
+        self.manager.release_ref(matched)
+        self.assertEqual(self.cache.evict(3), 3)
+        self.assertEqual(self.manager.can_use_mem_size, 32)
+
+    def test_evict_parent_after_children(self):
+        self._cache_sequence([1, 2, 3, 4])
+        self._cache_sequence([1, 2, 5, 6])
+        self.assertEqual(self.cache.evict(100), 6)
+        self.assertEqual(self.cache.num_cached_blocks, 0)
+        self.assertEqual(self.manager.can_use_mem_size, 32)
+
+    def test_block_granularity(self):
+        manager = build_manager(8, block_size=4)
+        cache = RadixPrefixCache(manager)
+        block_index = manager.alloc_blocks(3, device="cpu")
+        # 只缓存完整的 block: 10 个 token 只缓存前 8 个
+        self.assertEqual(cache.insert(list(range(10)), block_index), 8)
+        manager.release_ref(block_index)
+        self.assertEqual(manager.can_use_num_blocks, 6)
+        matched, num_tokens = cache.match_prefix([0, 1, 2, 3, 4, 5, 9, 9])
+        self.assertEqual(num_tokens, 4)
+        self.assertEqual(matched.tolist(), block_index[:1].tolist())
+        manager.release_ref(matched)
+        cache.clear()
+        self.assertEqual(manager.can_use_num_blocks, 8)
+
+if __name__ == "__main__":
+    unittest.main()
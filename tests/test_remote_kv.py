@@ -0,0 +1,219 @@
+# 代码可直接运行，在 CPU 上测试远端共享 kv 层: 本地 TCP 替身服务、token 哈希链、block 的序列化往返,
+# 以及一个副本淘汰的前缀被另一个副本拉回复用而不重新 prefill
+import os, sys, socket, time
+import unittest
+import torch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.prefix_cache import RadixPrefixCache
+from lite_llama.executor.remote_kv import InMemoryKVStore, KVStore, KVStoreServer, RemoteKVTier, TCPKVStore
+from lite_llama.executor.scheduler import ContinuousBatchScheduler
+from tests.helpers import EOS_TOKEN_ID, build_executor, build_manager, reference_generate
+
+class TestKVStore(unittest.TestCase):
+    def test_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            KVStore()
+
+    def test_in_memory_lru(self):
+        store = InMemoryKVStore(max_bytes=10)
+        store.put_many([(b"a", b"1234"), (b"b", b"5678")])
+        store.get_many([b"a"]) # a 最近被访问, 超出容量时先淘汰 b
+        store.put_many([(b"c", b"90ab")])
+        self.assertEqual(store.get_many([b"a", b"b", b"c"]), [b"1234", None, b"90ab"])
+        self.assertEqual(store.num_bytes, 8)
+
+    def test_tcp_round_trip(self):
+        server = KVStoreServer().start()
+        try:
+            client = TCPKVStore(*server.address)
+            items = [(bytes([i]) * 32, os.urandom(1000 * i)) for i in range(100)] # 一次请求批量发送全部条目
+            client.put_many(items)
+            self.assertEqual(len(server.store), 100)
+            self.assertEqual(client.get_many([key for key, _ in items] + [b"missing"]), [v for _, v in items] + [None])
+            self.assertEqual(client.contains_many([items[3][0], b"missing"]), [True, False])
+            client.close()
+            self.assertEqual(client.get_many([items[1][0]]), [items[1][1]]) # 断开后重连
+            client.close()
+        finally:
+            server.close()
+
+class TestRemoteKVTier(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def _fill(self, manager, num_blocks):
+        block_index = manager.alloc_blocks(num_blocks, device="cpu")
+        slots = manager.get_token_slots(block_index, num_blocks * manager.block_size)
+        for layer in range(manager.num_layers):
+            if manager.gpu_kv_scale is None:
+                manager.gpu_kv_buffer[layer][slots] = torch.randn(slots.numel(), *manager.gpu_kv_buffer[layer].shape[1:]).half()
+            else:
+                manager.gpu_kv_buffer[layer][slots] = torch.randint(-127, 128, (slots.numel(), *manager.gpu_kv_buffer[layer].shape[1:]), dtype=torch.int8)
+                manager.gpu_kv_scale[layer][slots] = torch.rand(slots.numel(), *manager.gpu_kv_scale[layer].shape[1:])
+        return block_index, slots
+
+    def test_block_round_trip(self):
+        for kv_cache_dtype in (None, "int8"):
+            store = InMemoryKVStore()
+            src = build_manager(16, block_size=2, kv_cache_dtype=kv_cache_dtype)
+            src.alloc_blocks(3, device="cpu")
+            block_index, src_slots = self._fill(src, 4)
+            tokens = [5, 6, 7, 8, 9, 10, 11, 12, 13]
+            tier = RemoteKVTier(src, store, "llama-test")
+            self.assertEqual(tier.push(tokens, block_index), 4)
+            self.assertEqual(tier.push(tokens, block_index), 0) # 已写入的 block 不重复拷贝
+            tier.flush()
+            self.assertEqual(tier.num_pushed_blocks, 4)
+
+            dst = build_manager(16, block_size=2, kv_cache_dtype=kv_cache_dtype)
+            dst_tier = RemoteKVTier(dst, store, "llama-test")
+            payloads = dst_tier.fetch(tokens, 1, 3)
+            self.assertEqual(len(payloads), 3)
+            remote_index = dst_tier.load(payloads)
+            dst_slots = dst.get_token_slots(remote_index, 6)
+            for layer in range(2):
+                self.assertTrue(torch.equal(dst.gpu_kv_buffer[layer][dst_slots], src.gpu_kv_buffer[layer][src_slots[2:]]))
+                if kv_cache_dtype is not None:
+                    self.assertTrue(torch.equal(dst.gpu_kv_scale[layer][dst_slots], src.gpu_kv_scale[layer][src_slots[2:]]))
+
+    def test_hash_chain_keys(self):
+        store = InMemoryKVStore()
+        manager = build_manager(16, block_size=2)
+        block_index, _ = self._fill(manager, 3)
+        writer = RemoteKVTier(manager, store, "llama-test")
+        writer.push([1, 2, 3, 4, 5, 6], block_index)
+        writer.flush()
+
+        tier = RemoteKVTier(build_manager(16, block_size=2), store, "llama-test")
+        # 同一个 block 的 token 相同但前缀不同时不能命中
+        self.assertEqual(len(tier.fetch([9, 2, 3, 4, 5, 6], 1, 2)), 0)
+        self.assertEqual(len(tier.fetch([1, 2, 3, 4, 7, 6], 0, 3)), 2)
+        # 不同模型或不同 kv cache 布局不共享
+        self.assertEqual(len(RemoteKVTier(build_manager(16, block_size=2), store, "qwen2-test").fetch([1, 2, 3, 4, 5, 6], 0, 3)), 0)
+        self.assertEqual(len(RemoteKVTier(build_manager(16, block_size=1), store, "llama-test").fetch([1, 2, 3, 4], 0, 4)), 0)
+
+    def test_unreachable_store_is_a_miss(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        manager = build_manager(16, block_size=2)
+        tier = RemoteKVTier.from_address(manager, f"127.0.0.1:{port}", "llama-test")
+        block_index, _ = self._fill(manager, 2)
+        with self.assertLogs("lite_llama.executor.remote_kv", level="WARNING"):
+            tier.push([1, 2, 3, 4], block_index)
+            tier.flush()
+            self.assertEqual(tier.fetch([1, 2, 3, 4], 0, 2), [])
+        self.assertEqual(tier.num_pushed_blocks, 0)
+        self.assertEqual(tier.push([1, 2, 3, 4], block_index), 2) # 写入失败的键可以重新排队
+
+    def test_fetch_is_bounded(self):
+        store = InMemoryKVStore()
+        manager = build_manager(16, block_size=2)
+        block_index, _ = self._fill(manager, 4)
+        tokens = list(range(8))
+        writer = RemoteKVTier(manager, store, "llama-test")
+        writer.push(tokens, block_index)
+        writer.flush()
+        self.assertEqual(len(RemoteKVTier(build_manager(16, block_size=2), store, "llama-test", max_fetch_blocks=3).fetch(tokens, 0, 4)), 3)
+
+        # 存储响应慢于 fetch_timeout 时按未命中处理, 不等待响应
+        class SlowStore(InMemoryKVStore):
+            def get_many(self, keys, timeout=None):
+                time.sleep(1.0)
+                return super().get_many(keys)
+
+        server = KVStoreServer(store=SlowStore()).start()
+        try:
+            tier = RemoteKVTier(build_manager(16, block_size=2), TCPKVStore(*server.address), "llama-test", fetch_timeout=0.05)
+            begin = time.monotonic()
+            with self.assertLogs("lite_llama.executor.remote_kv", level="WARNING"):
+                self.assertEqual(tier.fetch(tokens, 0, 4), [])
+            self.assertLess(time.monotonic() - begin, 0.5)
+            tier.store.close()
+        finally:
+            server.close()
+
+    def test_one_store_call_per_match_and_evict(self):
+        class CountingStore(InMemoryKVStore):
+            def __init__(self):
+                super().__init__()
+                self.calls = []
+
+            def put_many(self, items):
+                self.calls.append(("put", len(items)))
+                super().put_many(items)
+
+            def get_many(self, keys, timeout=None):
+                self.calls.append(("get", len(keys)))
+                return super().get_many(keys, timeout)
+
+            def contains_many(self, keys):
+                self.calls.append(("contains", len(keys)))
+                return super().contains_many(keys)
+
+        store = CountingStore()
+        manager = build_manager(32, block_size=1)
+        tier = RemoteKVTier(manager, store, "llama-test")
+        prefix_cache = RadixPrefixCache(manager, tier)
+        for tokens in ([1, 2, 3, 4, 5], [1, 2, 7, 8], [9, 9, 9]):
+            block_index = manager.alloc_blocks(len(tokens), device="cpu")
+            prefix_cache.insert(tokens, block_index)
+            manager.release_ref(block_index)
+
+        self.assertEqual(prefix_cache.evict(32), 10) # 三个叶子和一个公共前缀节点
+        tier.flush()
+        self.assertEqual(store.calls, [("contains", 10), ("put", 10)])
+
+        store.calls.clear()
+        block_index, num_tokens = prefix_cache.match_prefix([1, 2, 3, 4, 5, 6])
+        self.assertEqual(num_tokens, 5)
+        self.assertEqual(store.calls, [("get", 6)])
+        manager.release_ref(block_index)
+
+class TestSharedPrefixAcrossReplicas(unittest.TestCase):
+    def setUp(self):
+        self.server = KVStoreServer().start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def _replica(self, block_size):
+        executor = build_executor(gpu_num_blocks=32, block_size=block_size)
+        tier = RemoteKVTier(executor.kv_mem_manager, TCPKVStore(*self.server.address), "stub")
+        prefix_cache = RadixPrefixCache(executor.kv_mem_manager, tier)
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, prefix_cache=prefix_cache, device="cpu")
+        return executor, prefix_cache, scheduler
+
+    def _run(self, scheduler, prompt, max_gen_len):
+        request = scheduler.add_request(prompt, max_gen_len, temperature=0.0)
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+        self.assertEqual(request.output_tokens, reference_generate(prompt, max_gen_len))
+
+    def test_evicted_prefix_reused_by_other_replica(self):
+        system_prompt = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3]
+        for block_size in (1, 2): # 两种 block_size 的键互不相同, 共用一个存储
+            executor_a, prefix_cache_a, scheduler_a = self._replica(block_size)
+            self._run(scheduler_a, system_prompt + [8], 1)
+            prefix_cache_a.evict(32) # 淘汰时排队写入远端
+            prefix_cache_a.remote_tier.flush()
+            self.assertGreater(prefix_cache_a.remote_tier.num_pushed_blocks, 0)
+            self.assertEqual(executor_a.kv_mem_manager.can_use_num_blocks, 32)
+
+            executor_b, prefix_cache_b, scheduler_b = self._replica(block_size)
+            prompt = system_prompt + [7, 7]
+            self._run(scheduler_b, prompt, 5)
+            # 只 prefill 远端没有的后缀
+            self.assertEqual(executor_b.model.prefill_lens, [2])
+            self.assertEqual(prefix_cache_b.num_remote_hit_tokens, len(system_prompt))
+
+            # 拉回的 block 已插入本地树, 之后本地直接命中
+            num_fetched = prefix_cache_b.remote_tier.num_fetched_blocks
+            self._run(scheduler_b, system_prompt + [4], 3)
+            self.assertEqual(prefix_cache_b.remote_tier.num_fetched_blocks, num_fetched)
+            self.assertEqual(executor_b.model.prefill_lens, [2, 1])
+            prefix_cache_b.clear()
+            self.assertEqual(executor_b.kv_mem_manager.can_use_num_blocks, 32)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+# 代码可直接运行，测试批量采样器 sample 的各项截断和确定性
+import unittest
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.sampler import sample, sampling_probs
+
+def reference_probs(logits, temperature, top_k=-1, top_p=1.0, min_p=0.0):
+    """对整个词表排序后截断的参考实现"""
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+    keep = torch.ones_like(sorted_probs, dtype=torch.bool)
+    if top_k > 0:
+        keep[top_k:] = False
+    keep &= (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) <= top_p
+    keep &= sorted_probs >= min_p * sorted_probs[0]
+    out = torch.zeros_like(probs)
+    out[sorted_idx[keep]] = sorted_probs[keep]
+    return out / out.sum()
+
+class TestSampler(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.logits = torch.randn(4, 50)
+
+    def test_greedy_rows(self):
+        tokens = sample(self.logits, [0.0, 0.0, 0.0, 0.0])
+        self.assertTrue(torch.equal(tokens, self.logits.argmax(dim=-1)))
+        # 与采样行混合时, 贪心行仍然取 argmax
+        tokens = sample(self.logits, [0.0, 1.0, 0.0, 1.0], top_ks=[-1, 1, -1, 1])
+        self.assertTrue(torch.equal(tokens, self.logits.argmax(dim=-1)))
+
+    def test_truncation_keeps_only_allowed_tokens(self):
+        logits = self.logits[:1].repeat(2000, 1)
+        cases = [dict(top_k=3), dict(top_p=0.3), dict(min_p=0.5), dict(top_k=5, top_p=0.5)]
+        for case in cases:
+            tokens = sample(
+                logits, [1.0] * 2000,
+                top_ks=[case.get("top_k", -1)] * 2000,
+                top_ps=[case.get("top_p", 1.0)] * 2000,
+                min_ps=[case.get("min_p", 0.0)] * 2000,
+            )
+            allowed = reference_probs(logits[0], 1.0, **case) > 0
+            self.assertTrue(bool(allowed[tokens].all()), case)
+
+    def test_distribution_with_candidate_fallback(self):
+        # 候选数小于 nucleus 大小时回退到全词表排序, 分布仍与参考实现一致
+        num_samples = 20000
+        logits = torch.randn(1, 8).repeat(num_samples, 1)
+        for num_candidates in (2, 8):
+            tokens = sample(logits, [0.8] * num_samples, top_ps=[0.9] * num_samples, num_candidates=num_candidates)
+            freq = torch.bincount(tokens, minlength=8).float() / num_samples
+            ref = reference_probs(logits[0], 0.8, top_p=0.9)
+            self.assertTrue(torch.allclose(freq, ref, atol=0.02), (freq, ref))
+
+    def test_seed_is_deterministic_per_row(self):
+        params = dict(temperatures=[1.0] * 4, top_ps=[0.9] * 4, seeds=[7, 7, 11, -1])
+        first = sample(self.logits, **params)
+        second = sample(self.logits, **params)
+        self.assertTrue(torch.equal(first[:3], second[:3]))
+        # 种子相同的行与 batch 中的其他行无关
+        alone = sample(self.logits[1:2], [1.0], top_ps=[0.9], seeds=[7])
+        self.assertEqual(int(alone[0]), int(first[1]))
+
+    def test_sampling_probs_matches_reference(self):
+        probs = sampling_probs(self.logits, [0.0, 0.7, 1.0, 1.2], top_ks=[-1, -1, 5, -1], top_ps=[1.0, 0.8, 1.0, 0.9], min_ps=[0.0, 0.0, 0.0, 0.1])
+        self.assertTrue(torch.equal(probs[0], torch.nn.functional.one_hot(self.logits[0].argmax(), 50).float()))
+        for row, case in [(1, dict(top_p=0.8)), (2, dict(top_k=5)), (3, dict(top_p=0.9, min_p=0.1))]:
+            temperature = [0.0, 0.7, 1.0, 1.2][row]
+            ref = reference_probs(self.logits[row], temperature, **case)
+            self.assertTrue(torch.allclose(probs[row], ref, atol=1e-6))
+
+if __name__ == "__main__":
+    unittest.main()
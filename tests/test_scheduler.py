@@ -0,0 +1,382 @@
+# 代码可直接运行，使用桩模型 (stub model) 在 CPU 上测试 ContinuousBatchScheduler
+
+import unittest
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.model_executor import ModelExecutor
+from lite_llama.executor.scheduler import ContinuousBatchScheduler, RequestStatus
+from lite_llama.executor.prefix_cache import RadixPrefixCache
+from lite_llama.executor.speculative import DraftModelProposer, NgramProposer
+from lite_llama.models.model_config import LlamaConfig
+from tests.helpers import (
+    EOS_TOKEN_ID, VOCAB_SIZE, BracketTokenizer, StubModel, WrongDraftModel,
+    build_draft_executor, build_executor, reference_generate,
+)
+
+class TestContinuousBatchScheduler(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.executor = build_executor(gpu_num_blocks=256)
+        self.prompts = [[3, 5, 7], [11], [2, 4, 6, 8, 10, 12], [9, 1], [13, 17, 19, 23]]
+        self.max_gen_lens = [6, 12, 3, 8, 5]
+
+    def _run_to_completion(self, scheduler):
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+
+    def test_matches_reference(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=2, device="cpu")
+        requests = [
+            scheduler.add_request(p, n, temperature=0.0) for p, n in zip(self.prompts, self.max_gen_lens)
+        ]
+        self._run_to_completion(scheduler)
+        for request, prompt, max_gen_len in zip(requests, self.prompts, self.max_gen_lens):
+            self.assertEqual(request.status, RequestStatus.FINISHED)
+            self.assertEqual(request.output_tokens, reference_generate(prompt, max_gen_len))
+
+    def test_batch_never_exceeds_limit_and_changes(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=3, device="cpu")
+        for p, n in zip(self.prompts, self.max_gen_lens):
+            scheduler.add_request(p, n, temperature=0.0)
+        self._run_to_completion(scheduler)
+        batch_sizes = self.executor.model.batch_sizes
+        self.assertLessEqual(max(batch_sizes), 3)
+        self.assertGreater(len(set(batch_sizes)), 1)
+
+    def test_admit_request_while_running(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=4, device="cpu")
+        first = scheduler.add_request([3, 5, 7], 10, temperature=0.0)
+        scheduler.step()
+        scheduler.step()
+        late = scheduler.add_request([9, 1], 4, temperature=0.0)
+        stepped = scheduler.step()
+        self.assertIn(late, stepped)
+        self.assertIn(first, stepped)
+        self._run_to_completion(scheduler)
+        self.assertEqual(first.output_tokens, reference_generate([3, 5, 7], 10))
+        self.assertEqual(late.output_tokens, reference_generate([9, 1], 4))
+
+    def test_kv_released_on_finish(self):
+        kv_mem_manager = self.executor.kv_mem_manager
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=8, device="cpu")
+        short = scheduler.add_request([1, 2], 1, temperature=0.0)
+        long = scheduler.add_request([3, 4], 20, temperature=0.0)
+        scheduler.step()
+        self.assertTrue(short.is_finished)
+        self.assertIsNone(short.kv_index)
+        self.assertFalse(long.is_finished)
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens - long.kv_index.numel())
+        self._run_to_completion(scheduler)
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+
+    def test_kv_limited_admission(self):
+        executor = build_executor(gpu_num_blocks=12)
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_batch_size=8, device="cpu")
+        requests = [scheduler.add_request([5, 6], 8, temperature=0.0) for _ in range(3)]
+        scheduler.step()
+        self.assertEqual(len(scheduler.running), 1) # 每个请求需要 10 个 token 的 kv cache
+        self._run_to_completion(scheduler)
+        for request in requests:
+            self.assertEqual(request.output_tokens, reference_generate([5, 6], 8))
+
+    def test_kv_grows_in_chunks(self):
+        kv_mem_manager = self.executor.kv_mem_manager
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, device="cpu")
+        request = scheduler.add_request([1, 2], 30, temperature=0.0)
+        scheduler.step()
+        self.assertEqual(request.kv_index.numel(), 4) # prefill 只分配一个 chunk
+        capacities = []
+        while not request.is_finished:
+            capacities.append(request.kv_index.numel())
+            # 最新生成的 token 在下一次 decode 时才写入 kv cache
+            self.assertGreaterEqual(request.kv_index.numel(), request.seq_len - 1)
+            scheduler.step()
+        self.assertTrue(all(c % 4 == 0 for c in capacities))
+        self.assertEqual(max(capacities), 32) # 2 + 30 个 token
+        self.assertEqual(request.output_tokens, reference_generate([1, 2], 30))
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+
+    def test_preempt_and_recompute(self):
+        # 两个请求的完整 kv 需求为 2 * 22 = 44 > 32, 增长过程中必然触发抢占
+        executor = build_executor(gpu_num_blocks=32)
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, device="cpu")
+        prompts = [[1, 2], [5, 6]]
+        requests = [scheduler.add_request(p, 20, temperature=0.0) for p in prompts]
+        scheduler.step()
+        self.assertEqual(len(scheduler.running), 2)
+        preempted = False
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            preempted = preempted or requests[1].status == RequestStatus.WAITING
+        self.assertTrue(preempted)
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 20))
+        self.assertEqual(executor.kv_mem_manager.can_use_mem_size, executor.kv_mem_manager.max_num_tokens)
+        self.assertEqual(sorted(scheduler.free_table_rows), list(range(4)))
+
+    def test_paged_kv_cache(self):
+        executor = build_executor(gpu_num_blocks=16, block_size=4)
+        kv_mem_manager = executor.kv_mem_manager
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_batch_size=2, kv_chunk_size=4, device="cpu")
+        requests = [
+            scheduler.add_request(p, n, temperature=0.0) for p, n in zip(self.prompts, self.max_gen_lens)
+        ]
+        scheduler.step()
+        for request in scheduler.running:
+            self.assertEqual(len(request.output_tokens), 1) # 新接纳的请求本步只做 prefill
+            # 每个 block 4 个 token, 容量按 block 计算
+            self.assertEqual(request.kv_index.numel(), (request.seq_len + 3) // 4)
+        self._run_to_completion(scheduler)
+        for request, prompt, max_gen_len in zip(requests, self.prompts, self.max_gen_lens):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, max_gen_len))
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+
+    def test_prefix_cache_reuse(self):
+        prefix_cache = RadixPrefixCache(self.executor.kv_mem_manager)
+        scheduler = ContinuousBatchScheduler(
+            self.executor, EOS_TOKEN_ID, max_batch_size=4, prefix_cache=prefix_cache, device="cpu"
+        )
+        system_prompt = [7, 3, 9, 4, 1, 8, 2, 6]
+        prompts = [system_prompt + [11, 12], system_prompt + [13], system_prompt + [11, 12]]
+        requests = []
+        for prompt in prompts:
+            requests.append(scheduler.add_request(prompt, 5, temperature=0.0))
+            self._run_to_completion(scheduler)
+
+        # 第二个请求只 prefill 系统提示之后的部分, 第三个请求与第一个相同, 只需 prefill 最后一个 token
+        self.assertEqual(self.executor.model.prefill_lens, [10, 1, 1])
+        self.assertEqual([r.num_cached_tokens for r in requests], [0, 8, 9])
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 5))
+
+        prefix_cache.clear()
+        kv_mem_manager = self.executor.kv_mem_manager
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+
+    def test_prefix_cache_evicted_under_pressure(self):
+        executor = build_executor(gpu_num_blocks=24, block_size=4)
+        prefix_cache = RadixPrefixCache(executor.kv_mem_manager)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4, prefix_cache=prefix_cache, device="cpu"
+        )
+        prompts = [[i + 1] * 30 for i in range(6)]
+        requests = [scheduler.add_request(prompt, 10, temperature=0.0) for prompt in prompts]
+        self._run_to_completion(scheduler)
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 10))
+        # 缓存的 block 与空闲 block 之和等于总 block 数
+        self.assertEqual(prefix_cache.num_cached_blocks + executor.kv_mem_manager.can_use_num_blocks, 24)
+
+    def test_chunked_prefill_interleaves_decode(self):
+        scheduler = ContinuousBatchScheduler(
+            self.executor, EOS_TOKEN_ID, max_batch_size=4, prefill_chunk_size=8, device="cpu"
+        )
+        short = scheduler.add_request([3, 5, 7], 10, temperature=0.0)
+        scheduler.step()
+        long_prompt = list(range(1, 21))
+        long = scheduler.add_request(long_prompt, 4, temperature=0.0)
+        for num_computed in (8, 16):
+            # 长 prompt 分块 prefill 的同时, 已在运行的请求每步仍然 decode 一个 token, 两者打包在一次前向中
+            num_forwards = len(self.executor.model.batch_sizes)
+            stepped = scheduler.step()
+            self.assertEqual(self.executor.model.batch_sizes[num_forwards:], [2])
+            self.assertEqual(stepped, [short])
+            self.assertEqual(long.num_computed_tokens, num_computed)
+            self.assertEqual(long.output_tokens, [])
+        self.assertEqual(scheduler.step(), [short, long])
+        self.assertEqual(self.executor.model.prefill_lens, [3, 8, 8, 4])
+
+        self._run_to_completion(scheduler)
+        self.assertEqual(short.output_tokens, reference_generate([3, 5, 7], 10))
+        self.assertEqual(long.output_tokens, reference_generate(long_prompt, 4))
+
+    def test_chunked_prefill_budget_shared(self):
+        executor = build_executor(gpu_num_blocks=64, block_size=4)
+        prefix_cache = RadixPrefixCache(executor.kv_mem_manager)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=4, kv_chunk_size=4,
+            prefill_chunk_size=6, prefix_cache=prefix_cache, device="cpu"
+        )
+        prompts = [list(range(1, 15)), list(range(1, 13)) + [30, 31], [9, 1]]
+        requests = [scheduler.add_request(p, 6, temperature=0.0) for p in prompts]
+        self._run_to_completion(scheduler)
+        # 每一步所有请求 prefill 的 token 总数不超过 prefill_chunk_size
+        self.assertLessEqual(max(executor.model.prefill_lens), 6)
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, 6))
+        prefix_cache.clear()
+        self.assertEqual(executor.kv_mem_manager.can_use_num_blocks, 64)
+
+    def test_sampling_per_request_params(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=4, device="cpu")
+        greedy = scheduler.add_request([3, 5, 7], 6, temperature=0.0)
+        sampled = scheduler.add_request([3, 5, 7], 6, temperature=0.8, top_p=0.5)
+        self._run_to_completion(scheduler)
+        # 桩模型输出的分布是 one-hot, top_p 采样结果与 argmax 一致
+        self.assertEqual(greedy.output_tokens, sampled.output_tokens)
+
+    def test_seeded_sampling_is_reproducible(self):
+        # 温度很高时桩模型的分布接近均匀分布, 相同 seed 的请求无论与哪些请求同批都得到相同的输出
+        outputs = []
+        for companions in ([], self.prompts):
+            scheduler = ContinuousBatchScheduler(build_executor(gpu_num_blocks=256), EOS_TOKEN_ID, device="cpu")
+            request = scheduler.add_request([3, 5, 7], 8, temperature=1e4, top_p=1.0, seed=42)
+            for prompt in companions:
+                scheduler.add_request(prompt, 8, temperature=1e4, top_k=5)
+            self._run_to_completion(scheduler)
+            outputs.append(request.output_tokens)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertNotEqual(outputs[0], reference_generate([3, 5, 7], 8))
+
+    def test_parallel_sampling_shares_prompt_kv(self):
+        executor = build_executor(gpu_num_blocks=64, block_size=4)
+        kv_mem_manager = executor.kv_mem_manager
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_batch_size=4, device="cpu")
+        prompt = [3, 5, 7, 9, 11, 13] # 第二个 block 未写满, 分叉时需要复制
+        request = scheduler.add_request(prompt, 6, temperature=0.0, n=3)
+        scheduler.step()
+
+        # prompt 只 prefill 一次, 第一个 block 由 3 个分支共享, 未写满的 block 各自一份
+        self.assertEqual(executor.model.prefill_lens, [len(prompt)])
+        self.assertEqual(len(request.samples), 3)
+        self.assertEqual(len(scheduler.free_table_rows), 1)
+        shared_block = int(request.kv_index[0])
+        self.assertEqual(int(kv_mem_manager.allocator.ref_counts[shared_block]), 3)
+        for branch in request.branches:
+            self.assertEqual(int(branch.kv_index[0]), shared_block)
+            self.assertNotEqual(int(branch.kv_index[1]), int(request.kv_index[1]))
+
+        self._run_to_completion(scheduler)
+        for sample in request.samples:
+            self.assertEqual(sample.output_tokens, reference_generate(prompt, 6))
+        self.assertEqual(kv_mem_manager.can_use_mem_size, kv_mem_manager.max_num_tokens)
+        self.assertEqual(sorted(scheduler.free_table_rows), [0, 1, 2, 3])
+
+    def test_parallel_sampling_recomputes_tail_when_kv_is_short(self):
+        # kv cache 只够 prompt 和一个分支, 其余分支复制不到 block 时重新计算末尾的 token, 结果不变
+        executor = build_executor(gpu_num_blocks=3, block_size=2)
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_batch_size=3, kv_chunk_size=2, device="cpu")
+        request = scheduler.add_request([3, 5, 7], 3, temperature=0.0, n=3)
+        self._run_to_completion(scheduler)
+        self.assertGreater(len(executor.model.prefill_lens), 1)
+        for sample in request.samples:
+            self.assertEqual(sample.output_tokens, reference_generate([3, 5, 7], 3))
+        self.assertEqual(executor.kv_mem_manager.can_use_mem_size, executor.kv_mem_manager.max_num_tokens)
+
+    def test_parallel_sampling_seeds_branches(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_batch_size=4, device="cpu")
+        request = scheduler.add_request([3, 5, 7], 4, temperature=0.8, seed=7, n=3)
+        self._run_to_completion(scheduler)
+        self.assertEqual([sample.seed for sample in request.samples], [7, 8, 9])
+        with self.assertRaises(ValueError):
+            scheduler.add_request([1], 4, n=5)
+
+    def test_stop_token_ids(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, device="cpu")
+        expected = reference_generate([3, 5, 7], 10)
+        request = scheduler.add_request([3, 5, 7], 10, temperature=0.0, stop_token_ids=[expected[2]])
+        other = scheduler.add_request([3, 5, 7], 4, temperature=0.0)
+        self._run_to_completion(scheduler)
+        self.assertEqual(request.output_tokens, expected[:3])
+        self.assertEqual((request.finish_reason, request.stop_reason), ("stop", expected[2]))
+        self.assertEqual(other.finish_reason, "length")
+
+    def test_stop_strings_retire_request_early(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, device="cpu", tokenizer=BracketTokenizer())
+        expected = reference_generate([3, 5, 7], 10) # [15, 30, 10, 20, 40, ...]
+        stop = f"<{expected[1]}><{expected[2]}"
+        request = scheduler.add_request([3, 5, 7], 10, temperature=0.0, stop=["<49>", stop])
+        stepped = []
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            if not request.is_finished:
+                # 末尾可能属于停止字符串的文本暂不计入可输出部分
+                stepped.append(request.output_text[:request.num_stable_chars])
+        # 停止字符串在第三个 token 解码后出现, 请求在同一步结束, 文本截断到停止字符串之前
+        self.assertEqual(request.output_tokens, expected[:3])
+        self.assertEqual((request.finish_reason, request.stop_reason), ("stop", stop))
+        self.assertEqual(request.output_text, f"<{expected[0]}>")
+        self.assertEqual(stepped, [f"<{expected[0]}>", f"<{expected[0]}>"])
+        self.assertEqual(self.executor.kv_mem_manager.can_use_mem_size, self.executor.kv_mem_manager.max_num_tokens)
+        with self.assertRaises(ValueError):
+            ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, device="cpu").add_request([1], 4, stop=["x"])
+
+    def _run_speculative(self, draft_model, block_size, kv_chunk_size=32):
+        executor = build_executor(gpu_num_blocks=256 // block_size, block_size=block_size)
+        if draft_model is None:
+            proposer = NgramProposer(num_speculative_tokens=3)
+        else:
+            proposer = DraftModelProposer(build_draft_executor(executor, draft_model), num_speculative_tokens=3)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=3, kv_chunk_size=kv_chunk_size, device="cpu", proposer=proposer
+        )
+        requests = [
+            scheduler.add_request(p, n + 10, temperature=0.0) for p, n in zip(self.prompts, self.max_gen_lens)
+        ]
+        num_steps = 0
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            num_steps += 1
+            for request in scheduler.running:
+                # 为被拒绝的 draft token 预留的 kv cache 已经回滚
+                self.assertLessEqual(request.kv_index.numel() * block_size, max(request.seq_len, kv_chunk_size) + block_size)
+        for request, prompt, max_gen_len in zip(requests, self.prompts, self.max_gen_lens):
+            self.assertEqual(request.output_tokens, reference_generate(prompt, max_gen_len + 10))
+        self.assertEqual(executor.kv_mem_manager.can_use_mem_size, executor.kv_mem_manager.max_num_tokens)
+        return requests, num_steps
+
+    def test_speculative_decoding_with_exact_draft(self):
+        requests, num_steps = self._run_speculative(StubModel(), block_size=4)
+        for request in requests:
+            if request.num_proposed_tokens:
+                self.assertEqual(request.acceptance_rate, 1.0)
+        # 每步最多为每个请求产生 num_speculative_tokens + 1 个 token, 步数远少于逐 token decode
+        self.assertLess(num_steps, sum(len(r.output_tokens) for r in requests) // 3)
+        self.assertGreater(sum(r.num_accepted_tokens for r in requests), 0)
+
+    def test_speculative_decoding_rejects_and_rolls_back(self):
+        requests, _ = self._run_speculative(WrongDraftModel(), block_size=1, kv_chunk_size=1)
+        self.assertGreater(sum(r.num_proposed_tokens for r in requests), 0)
+        self.assertEqual(sum(r.num_accepted_tokens for r in requests), 0)
+
+    def test_prompt_lookup_speculative_decoding(self):
+        # 桩模型的输出序列按 2 的幂次循环, n-gram 提议部分被接受, 部分被拒绝
+        requests, _ = self._run_speculative(None, block_size=2, kv_chunk_size=2)
+        self.assertGreater(sum(r.num_proposed_tokens for r in requests), 0)
+        self.assertGreater(sum(r.num_accepted_tokens for r in requests), 0)
+
+    def test_seeded_speculative_decoding_is_reproducible(self):
+        # 投机解码时设置了 seed 的请求同样与同批的其他请求无关; prompt 包含词表中除 eos 外的所有 token, 每步都有 n-gram 提议
+        outputs = []
+        for companions in ([], self.prompts):
+            scheduler = ContinuousBatchScheduler(
+                build_executor(gpu_num_blocks=256), EOS_TOKEN_ID, device="cpu", proposer=NgramProposer(num_speculative_tokens=3)
+            )
+            request = scheduler.add_request(list(range(1, VOCAB_SIZE)), 8, temperature=1e4, top_p=1.0, seed=42)
+            for prompt in companions:
+                scheduler.add_request(prompt, 8, temperature=1e4, top_k=5)
+            self._run_to_completion(scheduler)
+            outputs.append(request.output_tokens)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_invalid_requests(self):
+        scheduler = ContinuousBatchScheduler(self.executor, EOS_TOKEN_ID, max_seq_len=8, device="cpu")
+        with self.assertRaises(ValueError):
+            scheduler.add_request([], 4)
+        with self.assertRaises(ValueError):
+            scheduler.add_request(list(range(1, 9)), 4)
+        with self.assertRaises(ValueError):
+            scheduler.add_request([1], 4, top_p=0.0)
+        with self.assertRaises(ValueError):
+            scheduler.add_request([1], 4, seed=-1)
+
+    def test_compiled_model_falls_back_to_eager(self):
+        # cuda graph 只捕获了非分页的 decode, 与调度器的打包 forward 不兼容, 构造时给出警告并回退到 eager 执行
+        config = LlamaConfig(num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, device="cpu")
+        with self.assertLogs("lite_llama.executor.model_executor", level="WARNING"):
+            executor = ModelExecutor(config, StubModel(), max_gpu_num_blocks=8, compiled_model=True, device="cpu", block_size=4)
+        self.assertFalse(executor.compiled_model)
+        self.assertIsNone(executor.model_runner)
+
+if __name__ == "__main__":
+    unittest.main()
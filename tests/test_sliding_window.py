@@ -0,0 +1,193 @@
+# 代码可直接运行，测试 attention sink + 滑动窗口 kv cache: 调度器用桩模型在 CPU 上对比参考实现, k 的重新旋转对比直接在新位置计算的 RoPE
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1" # 量化 kv cache 的重新量化使用 triton kernel
+
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.model_executor import ModelExecutor
+from lite_llama.executor.mem_manager import HostKVCachePool
+from lite_llama.executor.scheduler import ContinuousBatchScheduler, RequestStatus
+from lite_llama.kernels.kv_quant import dequantize_kv, quantize_kv_cache
+from lite_llama.models.model_config import LlamaConfig
+from lite_llama.models.RotaryEmbedding import LlamaRotaryEmbedding
+from tests.helpers import EOS_TOKEN_ID, VOCAB_SIZE, StubModel
+
+class ZeroRotary:
+    """旋转角度恒为 0 的 RoPE, 桩模型把 token id 存在 k 中, 重新旋转时保持不变; 记录每次平移的距离"""
+    def __init__(self, head_dim):
+        self.inv_freq = torch.zeros(head_dim // 2)
+        self.shifts = []
+
+    def __call__(self, x, position_ids):
+        self.shifts.append(int(position_ids))
+        head_dim = 2 * self.inv_freq.numel()
+        return torch.ones(1, 1, head_dim), torch.zeros(1, 1, head_dim)
+
+class WindowStubModel(StubModel):
+    def __init__(self, head_dim):
+        super().__init__()
+        self.rotary_emb = ZeroRotary(head_dim)
+        self.max_positions = []
+
+    def forward(self, input_ids, start_pos, atten_info, position_ids=None):
+        self.max_positions.append(int(position_ids.max()))
+        return super().forward(input_ids, start_pos, atten_info, position_ids)
+
+def build_window_executor(gpu_num_blocks, block_size=1):
+    config = LlamaConfig(num_layers=1, num_heads=2, num_kv_heads=1, hidden_size=16, vocab_size=VOCAB_SIZE, device="cpu")
+    executor = ModelExecutor(
+        config, WindowStubModel(config.head_dim), max_gpu_num_blocks=gpu_num_blocks, device="cpu", block_size=block_size
+    )
+    # 桩模型只写入 k 的第一个元素, 其余元素清零, 避免未初始化的 inf 在重新旋转时变成 nan
+    executor.kv_mem_manager.gpu_kv_buffer[0].zero_()
+    return executor
+
+def reference_window_generate(prompt, max_gen_len, sink_size, window_size, evict_size, block_size, chunk_size):
+    """按与调度器相同的淘汰策略模拟 kv cache 中保留的 token, 下一个 token = sum(cache) % VOCAB_SIZE"""
+    capacity = sink_size + window_size
+    cache, pending, out = [], list(prompt), []
+
+    def slide(need):
+        overflow = need - capacity
+        if overflow > 0:
+            num_evict = max(overflow, evict_size)
+            num_blocks = min((num_evict + block_size - 1) // block_size, (len(cache) - sink_size) // block_size)
+            del cache[sink_size: sink_size + num_blocks * block_size]
+
+    while pending:
+        num_evictable = max(len(cache) - sink_size, 0) // block_size * block_size
+        chunk_len = min(len(pending), chunk_size, capacity - (len(cache) - num_evictable) - 1)
+        slide(len(cache) + chunk_len + (1 if chunk_len == len(pending) else 0))
+        cache += pending[:chunk_len]
+        pending = pending[chunk_len:]
+    token = sum(cache) % VOCAB_SIZE
+    out.append(token)
+    while len(out) < max_gen_len and token != EOS_TOKEN_ID:
+        slide(len(cache) + 1)
+        cache.append(token)
+        token = sum(cache) % VOCAB_SIZE
+        out.append(token)
+    return out
+
+class TestSlidingWindowScheduler(unittest.TestCase):
+    def _run(self, scheduler, capacity):
+        executor = scheduler.model_executor
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            for request in scheduler.running:
+                # 每个请求占用的 kv cache 不超过 sink_size + window_size
+                self.assertLessEqual(request.kv_index.numel() * scheduler.block_size, capacity)
+        self.assertLess(max(executor.model.max_positions), capacity)
+        self.assertEqual(executor.kv_mem_manager.can_use_mem_size, executor.kv_mem_manager.max_num_tokens)
+
+    def test_generation_beyond_max_seq_len(self):
+        for block_size in (1, 2):
+            executor = build_window_executor(gpu_num_blocks=64, block_size=block_size)
+            scheduler = ContinuousBatchScheduler(
+                executor, EOS_TOKEN_ID, max_batch_size=4, max_seq_len=16, kv_chunk_size=4, prefill_chunk_size=None,
+                device="cpu", sink_size=4, window_size=8,
+            )
+            prompts = [[1, 2, 3], [5, 6, 7, 8, 9], [11, 13]]
+            requests = [scheduler.add_request(p, 40, temperature=0.0) for p in prompts]
+            self._run(scheduler, capacity=12)
+            for request, prompt in zip(requests, prompts):
+                expected = reference_window_generate(prompt, 40, 4, 8, 2, block_size, 16)
+                self.assertEqual(request.output_tokens, expected, block_size)
+                if len(expected) == 40:
+                    self.assertEqual(request.finish_reason, "length")
+                    self.assertGreater(request.num_evicted_tokens, 0)
+            # 保留的 token 前移时按淘汰的 token 数重新旋转
+            self.assertTrue(executor.model.rotary_emb.shifts)
+            self.assertTrue(all(shift < 0 and -shift % block_size == 0 for shift in executor.model.rotary_emb.shifts))
+
+    def test_long_prompt_chunked_prefill(self):
+        # prompt 超过 kv cache 容量和 max_seq_len, 分块 prefill 时同样淘汰
+        executor = build_window_executor(gpu_num_blocks=32, block_size=2)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=2, max_seq_len=16, kv_chunk_size=4, prefill_chunk_size=5,
+            device="cpu", sink_size=2, window_size=10,
+        )
+        prompt = [(7 * i) % 49 + 1 for i in range(37)]
+        request = scheduler.add_request(prompt, 20, temperature=0.0)
+        self._run(scheduler, capacity=12)
+        self.assertEqual(request.output_tokens, reference_window_generate(prompt, 20, 2, 10, 2, 2, 5))
+
+    def test_swap_keeps_window(self):
+        # 两个请求各需 12 个 token 的 kv cache, 显存只有 20 个, 被抢占的请求换出后换入继续 decode
+        executor = build_window_executor(gpu_num_blocks=20)
+        swap_space = HostKVCachePool(executor.kv_mem_manager, num_blocks=32)
+        scheduler = ContinuousBatchScheduler(
+            executor, EOS_TOKEN_ID, max_batch_size=2, max_seq_len=16, kv_chunk_size=4, prefill_chunk_size=None,
+            device="cpu", swap_space=swap_space, sink_size=4, window_size=8,
+        )
+        prompts = [[1, 2], [5, 6]]
+        requests = [scheduler.add_request(p, 30, temperature=0.0) for p in prompts]
+        swapped = False
+        while scheduler.has_unfinished_requests():
+            scheduler.step()
+            swapped |= any(r.status == RequestStatus.SWAPPED for r in requests)
+        self.assertTrue(swapped)
+        for request, prompt in zip(requests, prompts):
+            self.assertEqual(request.output_tokens, reference_window_generate(prompt, 30, 4, 8, 2, 1, 16))
+        self.assertEqual(swap_space.can_use_num_blocks, 32)
+
+    def test_invalid_config(self):
+        executor = build_window_executor(gpu_num_blocks=16, block_size=4)
+        with self.assertRaises(ValueError):
+            ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_seq_len=32, device="cpu", sink_size=2, window_size=8)
+        with self.assertRaises(ValueError):
+            ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_seq_len=8, device="cpu", sink_size=4, window_size=8)
+        scheduler = ContinuousBatchScheduler(executor, EOS_TOKEN_ID, max_seq_len=16, device="cpu", sink_size=4, window_size=8)
+        with self.assertRaises(ValueError):
+            scheduler.add_request([1, 2], 4, n=2)
+
+class RotaryModel:
+    def __init__(self, config):
+        self.rotary_emb = LlamaRotaryEmbedding(config=config)
+
+class TestShiftKVPositions(unittest.TestCase):
+    def _rope(self, rotary_emb, k, positions):
+        cos, sin = rotary_emb(k.float(), positions[None])
+        cos, sin = cos[0, :, None], sin[0, :, None]
+        half = k.shape[-1] // 2
+        return k * cos + torch.cat([-k[..., half:], k[..., :half]], dim=-1) * sin
+
+    def test_rerotated_keys_match_new_positions(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(num_layers=2, num_heads=4, num_kv_heads=2, hidden_size=128, max_position_embeddings=4096, device="cpu")
+        for kv_cache_dtype in (None, "int8"):
+            executor = ModelExecutor(config, RotaryModel(config), max_gpu_num_blocks=64, device="cpu", kv_cache_dtype=kv_cache_dtype)
+            rotary_emb = executor.model.rotary_emb
+            manager = executor.kv_mem_manager
+            H, delta = config.num_kv_heads, 37
+            k = torch.randn(10, H, config.head_dim)
+            positions = torch.arange(100, 110)
+            slots = torch.randperm(64)[:10]
+
+            for layer in range(config.num_layers):
+                kv = torch.cat([self._rope(rotary_emb, k, positions), torch.randn(10, H, config.head_dim)], dim=1).half()
+                if kv_cache_dtype is None:
+                    manager.gpu_kv_buffer[layer][slots] = kv
+                else:
+                    quantize_kv_cache(kv, manager.gpu_kv_buffer[layer], manager.gpu_kv_scale[layer], slots)
+            v_before = manager.gpu_kv_buffer[0][slots, H:].clone()
+
+            executor.shift_kv_positions(slots, -delta)
+            expected = self._rope(rotary_emb, k, positions - delta)
+            for layer in range(config.num_layers):
+                if kv_cache_dtype is None:
+                    shifted = manager.gpu_kv_buffer[layer][slots, :H].float()
+                    self.assertTrue(torch.allclose(shifted, expected, atol=1e-2), layer)
+                else:
+                    shifted = dequantize_kv(
+                        manager.gpu_kv_buffer[layer][slots, :H], manager.gpu_kv_scale[layer][slots, :H], torch.float32
+                    )
+                    # 两次量化的误差
+                    self.assertLess((shifted - expected).abs().max().item(), 2 * 2 * expected.abs().max().item() / 127)
+            # v 不变
+            self.assertTrue(torch.equal(manager.gpu_kv_buffer[0][slots, H:], v_before))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# 代码可直接运行，对比 fused_top_p_sampling 与 pytorch 参考实现的采样分布, 无 GPU 时使用 triton 解释器
+import os, sys
+import torch
+if not torch.cuda.is_available():
+    os.environ["TRITON_INTERPRET"] = "1"
+
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.kernels.softmax_sampling import fused_top_p_sampling, torch_top_p_sampling_probs
+
+class TestSoftmaxSampling(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def _params(self, batch_size, temperature, top_p, min_p=0.0):
+        full = lambda value, dtype: torch.full((batch_size,), value, dtype=dtype, device=self.device)
+        return full(temperature, torch.float32), full(top_p, torch.float32), full(min_p, torch.float32)
+
+    def test_distribution_matches_reference(self):
+        num_samples, vocab_size = 1500, 24
+        logits = torch.randn(1, vocab_size, device=self.device, dtype=torch.float16) * 2
+        rows = torch.zeros(num_samples, dtype=torch.int64, device=self.device) # 所有采样行读取同一行 logits
+        # num_candidates=2 时 nucleus 和 min_p 截断都超出候选, 走重新读取整行的路径
+        for num_candidates in (64, 2):
+            for temperature, top_p, min_p in [(0.7, 0.8, 0.0), (1.3, 1.0, 0.1), (1.0, 1.0, 0.0)]:
+                temperatures, top_ps, min_ps = self._params(num_samples, temperature, top_p, min_p)
+                tokens = fused_top_p_sampling(
+                    logits, temperatures, top_ps, min_ps, rows=rows, num_candidates=num_candidates
+                )
+                ref = torch_top_p_sampling_probs(logits, temperatures[:1], top_ps[:1], min_ps[:1])[0]
+                self.assertTrue(bool((ref[tokens] > 0).all()))
+                freq = torch.bincount(tokens, minlength=vocab_size).float() / num_samples
+                self.assertTrue(torch.allclose(freq.cpu(), ref.cpu(), atol=0.04), (freq, ref))
+
+    def test_nucleus_support_multiple_tiles(self):
+        # 词表大于一个分块时, 阈值以上的 token 集合与排序实现一致
+        batch_size, vocab_size = 8, 5000
+        logits = torch.randn(batch_size, vocab_size, device=self.device) * 4
+        temperatures, top_ps, _ = self._params(batch_size, 0.5, 0.6)
+        ref = torch_top_p_sampling_probs(logits, temperatures, top_ps)
+        for _ in range(2):
+            tokens = fused_top_p_sampling(logits, temperatures, top_ps)
+            self.assertTrue(bool((ref.gather(1, tokens[:, None]) > 0).all()))
+
+    def test_flat_distribution_multiple_tiles(self):
+        # 分布很平时 nucleus 远大于候选数, 阈值在整行上查找
+        batch_size, vocab_size = 4, 5000
+        logits = torch.randn(batch_size, vocab_size, device=self.device) * 0.05
+        temperatures, top_ps, _ = self._params(batch_size, 1.0, 0.3)
+        ref = torch_top_p_sampling_probs(logits, temperatures, top_ps)
+        tokens = fused_top_p_sampling(logits, temperatures, top_ps)
+        self.assertTrue(bool((ref.gather(1, tokens[:, None]) > 0).all()))
+
+    def test_small_top_p_is_greedy(self):
+        batch_size, vocab_size = 4, 100
+        logits = torch.randn(batch_size, vocab_size, device=self.device)
+        temperatures, top_ps, _ = self._params(batch_size, 1.0, 1e-6)
+        tokens = fused_top_p_sampling(logits, temperatures, top_ps)
+        self.assertTrue(torch.equal(tokens, logits.argmax(dim=-1)))
+
+    def test_seed_is_deterministic(self):
+        batch_size, vocab_size = 4, 100
+        logits = torch.randn(batch_size, vocab_size, device=self.device)
+        temperatures, top_ps, _ = self._params(batch_size, 1.0, 0.9)
+        seeds = torch.tensor([1, 2, 3, 4], device=self.device)
+        first = fused_top_p_sampling(logits, temperatures, top_ps, seeds=seeds)
+        second = fused_top_p_sampling(logits, temperatures, top_ps, seeds=seeds)
+        self.assertTrue(torch.equal(first, second))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# 代码可直接运行，检验投机解码的拒绝采样保持目标分布不变
+import unittest
+import torch, os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.speculative import rejection_sample, NgramProposer
+from lite_llama.executor.scheduler import Request
+
+class TestRejectionSample(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.num_samples, self.vocab_size = 20000, 6
+        self.p = torch.softmax(torch.randn(2, self.vocab_size) * 1.5, dim=-1) # 两个位置的目标分布
+        self.q = torch.softmax(torch.randn(1, self.vocab_size) * 1.5, dim=-1) # 第一个位置的提议分布
+
+    def _first_token_freq(self, num_accepted, next_tokens, draft_tokens):
+        first = torch.where(num_accepted > 0, draft_tokens[:, 0], next_tokens)
+        return torch.bincount(first, minlength=self.vocab_size).float() / self.num_samples
+
+    def test_draft_model_proposal_keeps_target_distribution(self):
+        n = self.num_samples
+        draft_tokens = torch.multinomial(self.q.expand(n, -1), 1)
+        num_accepted, next_tokens = rejection_sample(
+            self.p.expand(n, -1, -1), draft_tokens, torch.ones(n, dtype=torch.long), self.q.expand(n, -1)[:, None]
+        )
+        freq = self._first_token_freq(num_accepted, next_tokens, draft_tokens)
+        self.assertTrue(torch.allclose(freq, self.p[0], atol=0.015), (freq, self.p[0]))
+        # 被接受时下一个 token 来自第二个位置的目标分布
+        bonus = next_tokens[num_accepted == 1]
+        freq = torch.bincount(bonus, minlength=self.vocab_size).float() / bonus.numel()
+        self.assertTrue(torch.allclose(freq, self.p[1], atol=0.02), (freq, self.p[1]))
+
+    def test_deterministic_proposal_keeps_target_distribution(self):
+        n = self.num_samples
+        draft_tokens = torch.full((n, 1), int(self.p[0].argmin()), dtype=torch.long)
+        num_accepted, next_tokens = rejection_sample(self.p.expand(n, -1, -1), draft_tokens, torch.ones(n, dtype=torch.long))
+        freq = self._first_token_freq(num_accepted, next_tokens, draft_tokens)
+        self.assertTrue(torch.allclose(freq, self.p[0], atol=0.015), (freq, self.p[0]))
+
+    def test_seeded_rows_are_reproducible(self):
+        # 有种子的行只使用自己的随机数, 结果与同批其他行是否有种子无关
+        n = 64
+        draft_tokens = torch.multinomial(self.q.expand(n, -1), 1)
+        args = (self.p.expand(n, -1, -1), draft_tokens, torch.ones(n, dtype=torch.long), self.q.expand(n, -1)[:, None])
+        seeds = torch.arange(n)
+        first = rejection_sample(*args, seeds=seeds)
+        seeds[n // 2:] = -1
+        second = rejection_sample(*args, seeds=seeds)
+        for a, b in zip(first, second):
+            self.assertTrue(torch.equal(a[:n // 2], b[:n // 2]))
+
+    def test_greedy_accepts_matching_prefix(self):
+        # 贪心请求的目标分布是 one-hot, 只接受与 argmax 相同的前缀, 之后输出 argmax
+        target = torch.zeros(2, 4, self.vocab_size)
+        target[0, torch.arange(4), torch.tensor([1, 2, 3, 4])] = 1.0
+        target[1, torch.arange(4), torch.tensor([5, 0, 1, 2])] = 1.0
+        draft_tokens = torch.tensor([[1, 2, 0], [5, 3, 0]])
+        num_accepted, next_tokens = rejection_sample(target, draft_tokens, torch.tensor([3, 1]))
+        self.assertEqual(num_accepted.tolist(), [2, 1])
+        self.assertEqual(next_tokens.tolist(), [3, 0])
+
+class TestNgramProposer(unittest.TestCase):
+    def test_longest_most_recent_match(self):
+        proposer = NgramProposer(num_speculative_tokens=3, max_ngram=3)
+        request = Request(0, [5, 1, 2, 9, 9, 7, 1, 2, 4, 4, 8], 16, output_tokens=[3, 1, 2])
+        # 后缀 [3, 1, 2] 没有出现过, [1, 2] 最近一次出现在 4, 4 之前
+        drafts, probs = proposer.propose(None, [request], [3])
+        self.assertEqual(drafts, [[4, 4, 8]])
+        self.assertIsNone(probs)
+
+        request.output_tokens += [4, 4]
+        # 后缀 [2, 4, 4] 与之前的 3-gram 匹配, 提议被截断到序列末尾
+        drafts, _ = proposer.propose(None, [request], [3])
+        self.assertEqual(drafts, [[8, 3, 1]])
+
+    def test_no_match_and_disabled(self):
+        proposer = NgramProposer(num_speculative_tokens=2, max_ngram=2)
+        first = Request(0, [1, 2, 3], 8)
+        second = Request(1, [4, 5, 4], 8)
+        drafts, _ = proposer.propose(None, [first, second], [2, 0])
+        self.assertEqual(drafts, [[], []])
+        drafts, _ = proposer.propose(None, [second], [2])
+        self.assertEqual(drafts, [[5, 4]])
+
+if __name__ == "__main__":
+    unittest.main()
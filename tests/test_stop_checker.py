@@ -0,0 +1,54 @@
+# 代码可直接运行，用于测试停止字符串的增量匹配 StopStringMatcher
+import unittest
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from lite_llama.executor.stop_checker import StopStringMatcher
+
+def first_stop(text, stops):
+    """朴素实现: 结束位置最早的停止字符串, 同一位置结束时取最长的"""
+    for end in range(1, len(text) + 1):
+        matched = [stop for stop in stops if text[:end].endswith(stop)]
+        if matched:
+            return end, max(matched, key=len)
+    return -1, None
+
+class TestStopStringMatcher(unittest.TestCase):
+    def test_match_across_chunks(self):
+        matcher = StopStringMatcher(["<|im_end|>", "\n\nUser:"])
+        state = 0
+        for chunk in ["Hello", " world<|im", "_en"]:
+            state, end, stop = matcher.feed(state, chunk)
+            self.assertEqual(end, -1)
+        state, end, stop = matcher.feed(state, "d|> trailing")
+        self.assertEqual((end, stop), (3, "<|im_end|>"))
+
+    def test_depth_marks_possible_prefix(self):
+        matcher = StopStringMatcher(["abcd", "bx"])
+        state, end, _ = matcher.feed(0, "zzab")
+        self.assertEqual(end, -1)
+        self.assertEqual(matcher.depth(state), 2) # "ab" 可能是 "abcd" 的开头
+        state, end, _ = matcher.feed(state, "q")
+        self.assertEqual(matcher.depth(state), 0)
+
+    def test_overlapping_patterns_match_naive(self):
+        stops = ["he", "she", "hers", "his", "ss", "a"]
+        matcher = StopStringMatcher(stops)
+        for text in ["ushers", "xhixhis", "ssh", "this is a test", "hhhers", "nothing", "sheha"]:
+            # 逐字符输入与一次输入的结果相同
+            state, result = 0, (-1, None)
+            for i, ch in enumerate(text):
+                state, end, stop = matcher.feed(state, ch)
+                if end >= 0:
+                    result = (i + 1, stop)
+                    break
+            self.assertEqual(result, first_stop(text, stops), text)
+            self.assertEqual(matcher.feed(0, text)[1:], first_stop(text, stops), text)
+
+    def test_invalid_stop_strings(self):
+        with self.assertRaises(ValueError):
+            StopStringMatcher([])
+        with self.assertRaises(ValueError):
+            StopStringMatcher(["ok", ""])
+
+if __name__ == "__main__":
+    unittest.main()